@@ -0,0 +1,23 @@
+"""Timing and reporting helpers for the *_benchmark.py scripts.
+
+Example:
+
+  result, elapsed = benchmark_util.Measure(ParseAll, data)
+  benchmark_util.PrintRow("synthetic", 4000, "lines", elapsed)
+"""
+
+import time
+
+
+def Measure(function, *args, **kwargs):
+  """Calls function, returns a (result, elapsed seconds) tuple."""
+  start = time.time()
+  result = function(*args, **kwargs)
+  return result, time.time() - start
+
+
+def PrintRow(label, amount, unit, elapsed, note=""):
+  """Prints the amount of work done in a run and the throughput."""
+  print "%-12s %10s %-5s %9.4fs %12.1f %s/s%s" % (
+      label, "%g" % amount, unit, elapsed, amount / max(elapsed, 1e-9), unit,
+      note)
@@ -0,0 +1,247 @@
+"""A local, size-limited cache of blobs downloaded from the releases server.
+
+Elfdump data are indexed by md5 sums of the binaries they describe, so once
+downloaded, they can be reused by later runs. Catalogs
+are cached too, together with their ETags, and revalidated with the server
+before every use, see rest.RestClient.GetCatalog(). Each blob is kept in a
+separate file, so that several processes on the same host can share the
+cache: new entries are written to temporary files and renamed into place, and
+eviction is done by one process at a time, under a file lock.
+
+The least recently used entries are evicted first. The modification time of
+an entry is updated every time the entry is read.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import tempfile
+import time
+
+from lib.python import configuration
+
+# Blob tags whose content never changes for a given md5 sum. Elfdump data are
+# only saved if there are none for the binary yet. Pkgstats are not cached:
+# they are saved again when a package is indexed again, e.g. with a new
+# stats version.
+IMMUTABLE_BLOB_TAGS = frozenset(['elfdump'])
+LOCK_FILENAME = '.lock'
+TMP_PREFIX = '.tmp-'
+# Eviction brings the size of the cache down to this fraction of the budget,
+# so that it doesn't need to run again right after the next write.
+EVICTION_TARGET = 0.8
+# Temporary files older than this were left behind by killed processes.
+STALE_TMP_SECONDS = 3600
+
+
+class BlobCache(object):
+
+  def __init__(self, directory, max_size):
+    self.directory = directory
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    # Bytes written since the last eviction run.
+    self._written = 0
+    configuration.MkdirP(self.directory)
+
+  def _GetPath(self, tag, md5_sum):
+    return os.path.join(self.directory, tag, md5_sum[:2], md5_sum)
+
+  def Open(self, tag, md5_sum):
+    """Returns the blob as a file object, or None if it's not in the cache.
+
+    The file object needs to be closed by the caller.
+    """
+    path = self._GetPath(tag, md5_sum)
+    try:
+      fd = open(path, 'rb')
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        logging.warning("Could not read %r from the blob cache: %s", path, e)
+      self.misses += 1
+      return None
+    try:
+      # Marks the entry as recently used.
+      os.utime(path, None)
+    except OSError:
+      # The entry might have been evicted in the meantime.
+      pass
+    self.hits += 1
+    return fd
+
+  def Get(self, tag, md5_sum):
+    """Returns the serialized blob, or None if it's not in the cache."""
+    fd = self.Open(tag, md5_sum)
+    if fd is None:
+      return None
+    try:
+      return fd.read()
+    except IOError as e:
+      logging.warning("Could not read %r from the blob cache: %s", fd.name, e)
+      return None
+    finally:
+      fd.close()
+
+  def Create(self, tag, md5_sum):
+    """Starts writing a blob piece by piece.
+
+    Returns:
+      A BlobWriter, or None if the blob can't be written. The blob appears
+      in the cache when the writer is committed.
+    """
+    path = self._GetPath(tag, md5_sum)
+    try:
+      configuration.MkdirP(os.path.dirname(path))
+      fd, tmp_path = tempfile.mkstemp(
+          dir=os.path.dirname(path), prefix=TMP_PREFIX)
+    except (IOError, OSError) as e:
+      logging.warning("Could not write %r to the blob cache: %s", path, e)
+      return None
+    return BlobWriter(self, os.fdopen(fd, 'wb'), tmp_path, path)
+
+  def Put(self, tag, md5_sum, data):
+    """Stores a serialized blob.
+
+    Failures are logged and otherwise ignored, the cache is only an
+    optimization.
+    """
+    writer = self.Create(tag, md5_sum)
+    if writer is not None:
+      writer.write(data)
+      writer.Commit()
+
+  def _Written(self, size):
+    self._written += size
+    if self._written > self.max_size * (1 - EVICTION_TARGET):
+      self.Evict()
+
+  def Evict(self):
+    """Removes the least recently used entries until the cache fits."""
+    lock_path = os.path.join(self.directory, LOCK_FILENAME)
+    with open(lock_path, 'a') as lock_fd:
+      try:
+        fcntl.lockf(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except IOError:
+        logging.debug("Another process is evicting blobs from %r.",
+                      self.directory)
+        return
+      try:
+        self._EvictLocked()
+      finally:
+        fcntl.lockf(lock_fd, fcntl.LOCK_UN)
+
+  def _EvictLocked(self):
+    self._written = 0
+    entries = []
+    total_size = 0
+    now = time.time()
+    for dirpath, unused_dirnames, filenames in os.walk(self.directory):
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        try:
+          st = os.stat(path)
+          if filename.startswith(TMP_PREFIX):
+            if now - st.st_mtime > STALE_TMP_SECONDS:
+              os.unlink(path)
+            continue
+        except OSError:
+          continue
+        if filename == LOCK_FILENAME:
+          continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total_size += st.st_size
+    if total_size <= self.max_size:
+      return
+    entries.sort()
+    target_size = self.max_size * EVICTION_TARGET
+    for unused_mtime, size, path in entries:
+      if total_size <= target_size:
+        break
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+      total_size -= size
+      self.evictions += 1
+    logging.debug("Evicted %d blobs from %r, %.1fMB left.",
+                  self.evictions, self.directory, total_size / 1024.0 / 1024)
+
+  def GetStats(self):
+    return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+    }
+
+
+class BlobWriter(object):
+  """Writes a blob to a temporary file, which is renamed into place.
+
+  Like BlobCache.Put(), failures are logged and otherwise ignored.
+  """
+
+  def __init__(self, cache, fd, tmp_path, path):
+    self.cache = cache
+    self.fd = fd
+    self.tmp_path = tmp_path
+    self.path = path
+    self.size = 0
+    self.failed = False
+
+  def write(self, data):
+    if self.failed:
+      return
+    try:
+      self.fd.write(data)
+      self.size += len(data)
+    except (IOError, OSError) as e:
+      logging.warning("Could not write %r to the blob cache: %s", self.path, e)
+      self.Abort()
+      self.failed = True
+
+  def Commit(self):
+    if self.failed:
+      return
+    try:
+      self.fd.close()
+      os.rename(self.tmp_path, self.path)
+    except (IOError, OSError) as e:
+      logging.warning("Could not write %r to the blob cache: %s", self.path, e)
+      self.Abort()
+      return
+    self.cache._Written(self.size)
+
+  def Abort(self):
+    """Discards the blob."""
+    self.fd.close()
+    try:
+      os.unlink(self.tmp_path)
+    except OSError:
+      pass
+
+
+_caches_by_directory = {}
+
+
+def GetBlobCache(config=None):
+  """Returns the blob cache configured in the 'blob_cache' section.
+
+  There is one BlobCache object per directory in a process, so the hit and
+  miss counters include all the users of the cache. Returns None if the
+  cache is not enabled.
+  """
+  if config is None:
+    config = configuration.GetConfig()
+  if not config.has_option('blob_cache', 'directory'):
+    return None
+  directory = config.get('blob_cache', 'directory')
+  if not directory:
+    return None
+  directory = os.path.expanduser(directory)
+  if directory not in _caches_by_directory:
+    max_size = config.getint('blob_cache', 'size_mb') * 1024 * 1024
+    _caches_by_directory[directory] = BlobCache(directory, max_size)
+  return _caches_by_directory[directory]
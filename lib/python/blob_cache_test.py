@@ -0,0 +1,81 @@
+#!/usr/bin/env python2.6
+
+import ConfigParser
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from lib.python import blob_cache
+
+
+class BlobCacheUnitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='blob_cache_test-')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testMiss(self):
+    cache = blob_cache.BlobCache(self.directory, 1024)
+    self.assertEqual(None, cache.Get('pkgstats', 'a' * 32))
+    self.assertEqual({'hits': 0, 'misses': 1, 'evictions': 0},
+                     cache.GetStats())
+
+  def testPutAndGet(self):
+    cache = blob_cache.BlobCache(self.directory, 1024)
+    cache.Put('pkgstats', 'a' * 32, '{"foo": "bar"}')
+    self.assertEqual('{"foo": "bar"}', cache.Get('pkgstats', 'a' * 32))
+    self.assertEqual(None, cache.Get('elfdump', 'a' * 32))
+    self.assertEqual(1, cache.hits)
+    self.assertEqual(1, cache.misses)
+
+  def testSharedBetweenInstances(self):
+    blob_cache.BlobCache(self.directory, 1024).Put('pkgstats', 'a' * 32, 'x')
+    cache = blob_cache.BlobCache(self.directory, 1024)
+    self.assertEqual('x', cache.Get('pkgstats', 'a' * 32))
+
+  def testEvictsLeastRecentlyUsed(self):
+    cache = blob_cache.BlobCache(self.directory, 1000)
+    md5_sums = ['%032x' % i for i in range(4)]
+    for i, md5_sum in enumerate(md5_sums[:3]):
+      cache.Put('pkgstats', md5_sum, 'x' * 300)
+      path = os.path.join(self.directory, 'pkgstats', md5_sum[:2], md5_sum)
+      os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+    # Reading the oldest entry makes it the most recently used one.
+    self.assertTrue(cache.Get('pkgstats', md5_sums[0]))
+    cache.Put('pkgstats', md5_sums[3], 'x' * 300)
+    self.assertTrue(cache.Get('pkgstats', md5_sums[0]))
+    self.assertEqual(None, cache.Get('pkgstats', md5_sums[1]))
+    self.assertEqual(None, cache.Get('pkgstats', md5_sums[2]))
+    self.assertTrue(cache.Get('pkgstats', md5_sums[3]))
+    self.assertEqual(2, cache.evictions)
+
+
+class GetBlobCacheUnitTest(unittest.TestCase):
+
+  def GetConfig(self, directory):
+    config = ConfigParser.SafeConfigParser()
+    config.add_section('blob_cache')
+    config.set('blob_cache', 'directory', directory)
+    config.set('blob_cache', 'size_mb', '1')
+    return config
+
+  def testDisabled(self):
+    self.assertEqual(None, blob_cache.GetBlobCache(self.GetConfig('')))
+
+  def testEnabled(self):
+    directory = tempfile.mkdtemp(prefix='blob_cache_test-')
+    try:
+      cache = blob_cache.GetBlobCache(self.GetConfig(directory))
+      self.assertEqual(1024 * 1024, cache.max_size)
+      self.assertTrue(
+          cache is blob_cache.GetBlobCache(self.GetConfig(directory)))
+    finally:
+      shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -12,6 +12,16 @@ class CatalogLineParseError(errors.Error):
   """Failed to parse a line from a catalog file."""
 
 
+# First characters of lines that might not be package entries.
+_NON_ENTRY_FIRST_CHARS = frozenset(["", "#", "-", "H", " ", "\t", "\r", "\n"])
+
+
+def _SplitPkgList(pkglist):
+  if not pkglist or pkglist == "none":
+    return ()
+  return tuple(pkglist.split("|"))
+
+
 class OpencswCatalogBuilder(object):
 
   def __init__(self, product_dir, catalog_dir):
@@ -68,82 +78,64 @@ class OpencswCatalog(object):
     self.catalog_data = None
 
   def _ParseCatalogLine(self, line):
-    cline_re_str_list = [
-        (
-            r"^"
-            # tmux
-            r"(?P<catalogname>\S+)"
-            r"\s+"
-            # 1.2,REV=2010.05.17
-            r"(?P<version>\S+)"
-            r"\s+"
-            # CSWtmux
-            r"(?P<pkgname>\S+)"
-            r"\s+"
-            # tmux-1.2,REV=2010.05.17-SunOS5.9-sparc-CSW.pkg.gz
-            r"(?P<file_basename>\S+)"
-            r"\s+"
-            # 145351cf6186fdcadcd169b66387f72f
-            r"(?P<md5sum>\S+)"
-            r"\s+"
-            # 214091
-            r"(?P<size>\S+)"
-            r"\s+"
-            # CSWcommon|CSWlibevent
-            r"(?P<deps>\S+)"
-            r"\s+"
-            # none
-            r"(?P<category>\S+)"
-            # An optional empty field.
-            r"("
-              r"\s+"
-              # none\n'
-              r"(?P<i_deps>\S+)"
-            r")?"
-            r"$"
-        ),
-    ]
-    cline_re_list = [re.compile(x) for x in cline_re_str_list]
-    matched = False
-    d = None
-    def SplitPkgList(pkglist):
-      if not pkglist:
-        pkglist = ()
-      elif pkglist == "none":
-        pkglist = ()
-      else:
-        pkglist = tuple(pkglist.split("|"))
-      return pkglist
-    for cline_re in cline_re_list:
-      m = cline_re.match(line)
-      if m:
-        d = m.groupdict()
-        matched = True
-        if not d:
-          raise CatalogLineParseError("Parsed %s data is empty" % repr(line))
-        d["deps"] = SplitPkgList(d["deps"])
-        d["i_deps"] = SplitPkgList(d["i_deps"])
-    if not matched:
-      raise CatalogLineParseError("No regexes matched %s" % repr(line))
-    return d
-
-  def _GetCatalogData(self, fd):
-    catalog_data = []
+    # Package entries start at the beginning of the line.
+    if line[:1].isspace():
+      raise CatalogLineParseError("%s starts with whitespace" % repr(line))
+    fields = line.split()
+    if len(fields) == 9:
+      (catalogname, version, pkgname, file_basename, md5sum, size, deps,
+       category, i_deps) = fields
+    elif len(fields) == 8:
+      (catalogname, version, pkgname, file_basename, md5sum, size, deps,
+       category) = fields
+      i_deps = None
+    else:
+      raise CatalogLineParseError(
+          "%s has %d fields, expected 8 or 9" % (repr(line), len(fields)))
+    return {
+        "catalogname": catalogname,
+        "version": version,
+        "pkgname": pkgname,
+        "file_basename": file_basename,
+        "md5sum": md5sum,
+        "size": size,
+        "deps": _SplitPkgList(deps),
+        "category": category,
+        "i_deps": _SplitPkgList(i_deps),
+    }
+
+  def _IterCatalogData(self, fd):
+    parse = self._ParseCatalogLine
     for line in fd:
-      if not line.strip(): continue
-      if line.startswith("#"): continue
-      if line.startswith("-----BEGIN PGP SIGNED"): continue
-      if line.startswith("Hash: "): continue
-      if line.startswith("-----BEGIN PGP SIGNATURE"): break
+      # Only a handful of lines are not package entries, a cheap check on the
+      # first character lets the others skip the prefix comparisons.
+      if line[:1] in _NON_ENTRY_FIRST_CHARS:
+        if not line.strip(): continue
+        if line.startswith("#"): continue
+        if line.startswith("-----BEGIN PGP SIGNED"): continue
+        if line.startswith("Hash: "): continue
+        if line.startswith("-----BEGIN PGP SIGNATURE"): break
       try:
-        parsed = self._ParseCatalogLine(line)
-        catalog_data.append(parsed)
+        yield parse(line)
       except CatalogLineParseError, e:
         logging.debug("Could not parse %s, %s", repr(line), e)
-    return catalog_data
+
+  def _GetCatalogData(self, fd):
+    return list(self._IterCatalogData(fd))
+
+  def IterCatalogData(self):
+    """Yields parsed catalog entries one by one.
+
+    The file is read lazily, so the whole catalog is never held in memory.
+    The underlying file can only be consumed once; if GetCatalogData() has
+    already been called, the cached entries are returned instead.
+    """
+    if self.catalog_data is not None:
+      return iter(self.catalog_data)
+    return self._IterCatalogData(self.fd)
 
   def GetCatalogData(self):
-    if not self.catalog_data:
+    if self.catalog_data is None:
       self.catalog_data = self._GetCatalogData(self.fd)
     return self.catalog_data
 
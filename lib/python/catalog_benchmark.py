@@ -0,0 +1,83 @@
+#!/opt/csw/bin/python2.6
+
+"""Measures how fast catalog files are parsed by catalog.OpencswCatalog.
+
+A synthetic catalog with the given number of lines is generated in memory,
+wrapped in a PGP signature like the real catalog files on the mirror, and
+parsed a few times. The best run is reported in lines per second and
+compared with the target throughput.
+
+Usage:
+  ./catalog_benchmark.py --lines 4000
+  ./catalog_benchmark.py --catalog /path/to/catalog
+"""
+
+import hashlib
+import logging
+import optparse
+from cStringIO import StringIO
+
+from lib.python import benchmark_util
+from lib.python import catalog
+
+# A full catalog file (~4000 lines) should parse in well under 20ms.
+TARGET_LINES_PER_SECOND = 250000
+
+
+def MakeCatalogLine(i):
+  catalogname = "bench_pkg%d" % i
+  version = "1.%d,REV=2012.01.%02d" % (i, i % 28 + 1)
+  deps = "|".join("CSWdep%d" % x for x in range(i % 7)) or "none"
+  return " ".join([
+    catalogname,
+    version,
+    "CSWbench-pkg%d" % i,
+    "%s-%s-SunOS5.10-sparc-CSW.pkg.gz" % (catalogname, version),
+    hashlib.md5(catalogname).hexdigest(),
+    str(1024 * (i + 1)),
+    deps,
+    "none",
+    "none",
+  ])
+
+
+def MakeCatalog(count):
+  lines = ["-----BEGIN PGP SIGNED MESSAGE-----", "Hash: SHA1", ""]
+  lines.extend(MakeCatalogLine(i) for i in xrange(count))
+  lines.extend(["-----BEGIN PGP SIGNATURE-----", "fake", ""])
+  return "\n".join(lines)
+
+
+def CountEntries(data):
+  return len(list(catalog.OpencswCatalog(StringIO(data)).IterCatalogData()))
+
+
+def MeasureBest(label, data, rounds):
+  runs = [benchmark_util.Measure(CountEntries, data) for i in range(rounds)]
+  count, best = min(runs, key=lambda x: x[1])
+  benchmark_util.PrintRow(label, count, "lines", best,
+                          " (target: %d)" % TARGET_LINES_PER_SECOND)
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--lines", dest="lines", type="int", default=4000,
+                    help="Number of lines in the synthetic catalog.")
+  parser.add_option("--catalog", dest="catalog", default=None,
+                    help="Parse this catalog file instead of a synthetic one.")
+  parser.add_option("--rounds", dest="rounds", type="int", default=5,
+                    help="Number of rounds; the best one is reported.")
+  options, args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING)
+  if options.catalog:
+    with open(options.catalog, "rb") as fd:
+      data = fd.read()
+    label = "file"
+  else:
+    data = MakeCatalog(options.lines)
+    label = "synthetic"
+  MeasureBest(label, data, options.rounds)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,278 @@
+"""A precomputed, memory-mapped index of files in a catalog.
+
+Checkpkg asks the same questions about a catalog over and over: which
+packages ship libfoo.so.1, and which packages own /opt/csw/bin/foo. The
+answers only change when packages are added to or removed from the catalog,
+so instead of asking the database every time, they can be read from an index
+file, built once per (catrel, arch, osrel).
+
+The file is meant to be used with mmap, so that concurrent checkpkg
+processes share it read-only, and a lookup only touches a few pages.
+
+File layout, all integers are little-endian uint32, except the revision,
+which is an uint64:
+
+  header:         MAGIC, catalog revision, record count, offset of the
+                  basename table, offset of the path table
+  records:        basename \\0 path \\0 pkgname \\0, sorted by basename
+  basename table: offsets of the records, sorted by basename
+  path table:     offsets of the records, sorted by the full path
+
+Lookups are binary searches over one of the tables.
+
+An index is written to a temporary file and renamed into place, so readers
+never see a partial file. Each index is stamped with the revision the catalog
+had in the database (models.GetCatalogRevision) before its files were read.
+Any change to the catalog bumps the revision, whichever host or tool makes
+it, so readers compare the stamp with the current revision and ignore an
+index which is out of date. The index then needs to be built again, e.g. by
+'pkgdb build-file-index'.
+"""
+
+import bisect
+import errno
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from lib.python import configuration
+from lib.python import errors
+
+MAGIC = 'CSWFIDX2'
+HEADER = struct.Struct('<8sQIII')
+OFFSET = struct.Struct('<I')
+MAX_FILE_SIZE = 2 ** 32 - 1
+INDEX_SUFFIX = '.idx'
+
+
+class Error(errors.Error):
+  """Generic error in the file index."""
+
+
+class IndexFormatError(Error):
+  """The index file is damaged or has an unknown format."""
+
+
+def _Encode(s):
+  if isinstance(s, unicode):
+    return s.encode('utf-8')
+  return s
+
+
+def _Decode(s):
+  return s.decode('utf-8')
+
+
+def WriteFileIndex(fd, rows, revision=0):
+  """Writes an index of (basename, path, pkgname) rows to a file object.
+
+  Args:
+    revision: the catalog revision the rows have been read at
+  """
+  records = sorted(set(
+      (_Encode(basename), _Encode(path), _Encode(pkgname))
+      for basename, path, pkgname in rows))
+  offset = HEADER.size
+  offsets = []
+  for basename, path, pkgname in records:
+    offsets.append(offset)
+    offset += len(basename) + len(path) + len(pkgname) + 3
+  basename_table_offset = offset
+  path_table_offset = basename_table_offset + OFFSET.size * len(offsets)
+  file_size = path_table_offset + OFFSET.size * len(offsets)
+  if file_size > MAX_FILE_SIZE:
+    raise Error("The index would be too large: %d bytes" % file_size)
+  by_path = sorted(
+      xrange(len(records)),
+      key=lambda i: os.path.join(records[i][1], records[i][0]))
+  fd.write(HEADER.pack(
+      MAGIC, revision, len(records), basename_table_offset,
+      path_table_offset))
+  for record in records:
+    fd.write('\0'.join(record) + '\0')
+  fd.write(''.join(OFFSET.pack(x) for x in offsets))
+  fd.write(''.join(OFFSET.pack(offsets[i]) for i in by_path))
+
+
+class _SortedKeys(object):
+  """A read-only sequence of keys from one of the tables, for bisect."""
+
+  def __init__(self, file_index, table_offset, key_function):
+    self.file_index = file_index
+    self.table_offset = table_offset
+    self.key_function = key_function
+
+  def __len__(self):
+    return self.file_index.record_count
+
+  def __getitem__(self, i):
+    return self.key_function(
+        self.file_index._GetRecord(self.table_offset, i))
+
+
+class FileIndex(object):
+  """Read-only access to an index file."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as fd:
+      file_size = os.fstat(fd.fileno()).st_size
+      if file_size < HEADER.size:
+        raise IndexFormatError("%r is too short" % path)
+      self._data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, self.revision, self.record_count, self._basename_table,
+     self._path_table) = HEADER.unpack_from(self._data, 0)
+    if magic != MAGIC:
+      self.Close()
+      raise IndexFormatError("%r is not a file index" % path)
+    if self._path_table + OFFSET.size * self.record_count != file_size:
+      self.Close()
+      raise IndexFormatError("%r has a wrong size" % path)
+    self._basenames = _SortedKeys(
+        self, self._basename_table, lambda record: record[0])
+    self._full_paths = _SortedKeys(
+        self, self._path_table,
+        lambda record: os.path.join(record[1], record[0]))
+
+  def Close(self):
+    self._data.close()
+
+  def _GetRecord(self, table_offset, i):
+    """Returns the i-th (basename, path, pkgname) tuple from a table."""
+    offset, = OFFSET.unpack_from(self._data, table_offset + OFFSET.size * i)
+    end = offset
+    for unused_i in range(3):
+      end = self._data.find('\0', end) + 1
+    return tuple(self._data[offset:end - 1].split('\0'))
+
+  def _Lookup(self, keys, table_offset, key):
+    key = _Encode(key)
+    i = bisect.bisect_left(keys, key)
+    while i < self.record_count:
+      record = self._GetRecord(table_offset, i)
+      if keys.key_function(record) != key:
+        break
+      yield record
+      i += 1
+
+  def GetPathsAndPkgnamesByBasename(self, basename):
+    """Returns the same structure as Catalog.GetPathsAndPkgnamesByBasename.
+
+    Returns:
+      {u"/opt/csw/lib": [u"CSWfoo", u"CSWbar"]}
+    """
+    pkgs_by_path = {}
+    for unused_basename, path, pkgname in self._Lookup(
+        self._basenames, self._basename_table, basename):
+      pkgs_by_path.setdefault(_Decode(path), []).append(_Decode(pkgname))
+    return pkgs_by_path
+
+  def GetPkgByPath(self, full_file_path):
+    """Returns a frozenset of packages which contain the file."""
+    return frozenset(
+        _Decode(pkgname) for unused_basename, unused_path, pkgname
+        in self._Lookup(self._full_paths, self._path_table, full_file_path))
+
+
+class FileIndexStore(object):
+  """A directory with file indexes, one per catalog."""
+
+  def __init__(self, directory):
+    self.directory = directory
+    configuration.MkdirP(self.directory)
+
+  def _GetPath(self, osrel, arch, catrel, suffix):
+    return os.path.join(
+        self.directory, '%s-%s-%s%s' % (catrel, arch, osrel, suffix))
+
+  def Open(self, osrel, arch, catrel, revision=None):
+    """Returns a FileIndex, or None if there is no index for the catalog.
+
+    Args:
+      revision: the current revision of the catalog; an index built at
+          another revision is out of date, and None is returned.
+    """
+    path = self._GetPath(osrel, arch, catrel, INDEX_SUFFIX)
+    try:
+      file_index = FileIndex(path)
+      if revision is not None and file_index.revision != revision:
+        logging.info("The file index of %s %s %s is out of date: built at "
+                     "revision %d, the catalog is at revision %d.",
+                     catrel, arch, osrel, file_index.revision, revision)
+        file_index.Close()
+        return None
+      return file_index
+    except IndexFormatError as e:
+      logging.warning("Ignoring the file index: %s", e)
+    except (IOError, OSError) as e:
+      if e.errno != errno.ENOENT:
+        logging.warning("Could not open the file index %r: %s", path, e)
+    return None
+
+  def Invalidate(self, osrel, arch, catrel):
+    """Removes the index of a catalog which has just changed.
+
+    Only saves readers on this host from opening an index which is out of
+    date; readers elsewhere rely on the revision check in Open().
+    """
+    try:
+      os.unlink(self._GetPath(osrel, arch, catrel, INDEX_SUFFIX))
+    except (IOError, OSError) as e:
+      if e.errno != errno.ENOENT:
+        logging.warning("Could not invalidate the file index of %s %s %s: %s",
+                        catrel, arch, osrel, e)
+
+  def Build(self, catalog, osrel, arch, catrel):
+    """Writes the index of a catalog, using the database.
+
+    The revision is read before the files, so if the catalog changes in the
+    meantime, the index is stamped with the old revision and readers ignore
+    it.
+
+    Args:
+      catalog: a checkpkg_lib.Catalog object
+
+    Returns:
+      The catalog revision the index has been stamped with.
+    """
+    start_time = time.time()
+    path = self._GetPath(osrel, arch, catrel, INDEX_SUFFIX)
+    revision = catalog.GetCatalogRevision(osrel, arch, catrel)
+    rows = catalog.GetFilesInCatalog(osrel, arch, catrel)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=self.directory, prefix=os.path.basename(path) + '.tmp-')
+    try:
+      with os.fdopen(fd, 'wb') as index_fd:
+        WriteFileIndex(index_fd, rows, revision)
+      os.rename(tmp_path, path)
+    except:
+      if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+      raise
+    logging.debug("Built the file index of %s %s %s at revision %d in %.1fs.",
+                  catrel, arch, osrel, revision, time.time() - start_time)
+    return revision
+
+
+_stores_by_directory = {}
+
+
+def GetFileIndexStore(config=None):
+  """Returns the store configured in the 'file_index' section.
+
+  Returns None if file indexes are not enabled.
+  """
+  if config is None:
+    config = configuration.GetConfig()
+  if not config.has_option('file_index', 'directory'):
+    return None
+  directory = config.get('file_index', 'directory')
+  if not directory:
+    return None
+  directory = os.path.expanduser(directory)
+  if directory not in _stores_by_directory:
+    _stores_by_directory[directory] = FileIndexStore(directory)
+  return _stores_by_directory[directory]
@@ -0,0 +1,187 @@
+#!/usr/bin/env python2.6
+
+import ConfigParser
+import cStringIO
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.python import catalog_file_index
+
+ROWS = [
+    (u'libfoo.so.1', u'/opt/csw/lib', u'CSWlibfoo1'),
+    (u'libfoo.so.1', u'/opt/csw/lib/sparcv9', u'CSWlibfoo1'),
+    (u'libfoo.so.1', u'/opt/csw/lib', u'CSWlibfoo1-old'),
+    (u'foo', u'/opt/csw/bin', u'CSWfoo'),
+    (u'foo', u'/opt/csw/bin', u'CSWfoo'),
+    (u'bar', u'/opt/csw/bin', u'CSWfoo'),
+    (u'bin', u'/opt/csw', u'CSWcommon'),
+    (u'opt', u'/', u'CSWcommon'),
+]
+
+
+class FakeCatalog(object):
+
+  def __init__(self, rows, revision=0):
+    self.rows = rows
+    self.revision = revision
+    self.calls = []
+
+  def GetCatalogRevision(self, osrel, arch, catrel):
+    return self.revision
+
+  def GetFilesInCatalog(self, osrel, arch, catrel):
+    self.calls.append((osrel, arch, catrel))
+    return self.rows
+
+
+class FileIndexUnitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='catalog_file_index_test-')
+    self.path = os.path.join(self.directory, 'index')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def OpenIndex(self, rows):
+    with open(self.path, 'wb') as fd:
+      catalog_file_index.WriteFileIndex(fd, rows)
+    return catalog_file_index.FileIndex(self.path)
+
+  def testGetPathsAndPkgnamesByBasename(self):
+    file_index = self.OpenIndex(ROWS)
+    self.assertEqual(
+        {u'/opt/csw/lib': [u'CSWlibfoo1', u'CSWlibfoo1-old'],
+         u'/opt/csw/lib/sparcv9': [u'CSWlibfoo1']},
+        file_index.GetPathsAndPkgnamesByBasename('libfoo.so.1'))
+    self.assertEqual({u'/opt/csw/bin': [u'CSWfoo']},
+                     file_index.GetPathsAndPkgnamesByBasename(u'foo'))
+    self.assertEqual({}, file_index.GetPathsAndPkgnamesByBasename('baz'))
+    self.assertEqual({}, file_index.GetPathsAndPkgnamesByBasename('zzz'))
+    file_index.Close()
+
+  def testGetPkgByPath(self):
+    file_index = self.OpenIndex(ROWS)
+    self.assertEqual(frozenset([u'CSWfoo']),
+                     file_index.GetPkgByPath('/opt/csw/bin/foo'))
+    self.assertEqual(frozenset([u'CSWlibfoo1', u'CSWlibfoo1-old']),
+                     file_index.GetPkgByPath('/opt/csw/lib/libfoo.so.1'))
+    self.assertEqual(frozenset([u'CSWcommon']),
+                     file_index.GetPkgByPath('/opt'))
+    self.assertEqual(frozenset([u'CSWcommon']),
+                     file_index.GetPkgByPath('/opt/csw/bin'))
+    self.assertEqual(frozenset(), file_index.GetPkgByPath('/opt/csw/bin/baz'))
+    file_index.Close()
+
+  def testNonAsciiNames(self):
+    file_index = self.OpenIndex([(u'f\xf3\xf3', u'/opt/csw/bin', u'CSWfoo')])
+    self.assertEqual({u'/opt/csw/bin': [u'CSWfoo']},
+                     file_index.GetPathsAndPkgnamesByBasename(u'f\xf3\xf3'))
+    self.assertEqual(frozenset([u'CSWfoo']),
+                     file_index.GetPkgByPath(u'/opt/csw/bin/f\xf3\xf3'))
+    file_index.Close()
+
+  def testEmpty(self):
+    file_index = self.OpenIndex([])
+    self.assertEqual({}, file_index.GetPathsAndPkgnamesByBasename('foo'))
+    self.assertEqual(frozenset(), file_index.GetPkgByPath('/opt/csw/bin/foo'))
+    file_index.Close()
+
+  def testBadFile(self):
+    with open(self.path, 'wb') as fd:
+      fd.write('not an index, but long enough')
+    self.assertRaises(catalog_file_index.IndexFormatError,
+                      catalog_file_index.FileIndex, self.path)
+
+  def testTruncatedFile(self):
+    fd = cStringIO.StringIO()
+    catalog_file_index.WriteFileIndex(fd, ROWS)
+    with open(self.path, 'wb') as index_fd:
+      index_fd.write(fd.getvalue()[:-1])
+    self.assertRaises(catalog_file_index.IndexFormatError,
+                      catalog_file_index.FileIndex, self.path)
+
+
+class FileIndexStoreUnitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='catalog_file_index_test-')
+    self.store = catalog_file_index.FileIndexStore(self.directory)
+    self.triad = ('SunOS5.10', 'sparc', 'unstable')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testBuildAndOpen(self):
+    self.assertEqual(None, self.store.Open(*self.triad))
+    catalog = FakeCatalog(ROWS)
+    self.assertEqual(0, self.store.Build(catalog, *self.triad))
+    self.assertEqual([self.triad], catalog.calls)
+    file_index = self.store.Open(*self.triad)
+    self.assertEqual(frozenset([u'CSWfoo']),
+                     file_index.GetPkgByPath('/opt/csw/bin/foo'))
+    file_index.Close()
+    self.assertEqual(None, self.store.Open('SunOS5.10', 'i386', 'unstable'))
+    self.assertEqual(['unstable-sparc-SunOS5.10.idx'],
+                     os.listdir(self.directory))
+
+  def testInvalidate(self):
+    self.store.Build(FakeCatalog(ROWS), *self.triad)
+    file_index = self.store.Open(*self.triad)
+    self.store.Invalidate(*self.triad)
+    self.assertEqual(None, self.store.Open(*self.triad))
+    # Indexes which are already open keep working.
+    self.assertEqual(frozenset([u'CSWfoo']),
+                     file_index.GetPkgByPath('/opt/csw/bin/foo'))
+    file_index.Close()
+
+  def testCatalogChangedDuringBuild(self):
+
+    class ChangingCatalog(FakeCatalog):
+
+      def GetFilesInCatalog(self, osrel, arch, catrel):
+        self.revision += 1
+        return self.rows
+
+    catalog = ChangingCatalog(ROWS, revision=3)
+    self.assertEqual(3, self.store.Build(catalog, *self.triad))
+    self.assertEqual(None, self.store.Open(*(self.triad + (4,))))
+
+  def testRevision(self):
+    self.assertEqual(7, self.store.Build(FakeCatalog(ROWS, 7), *self.triad))
+    file_index = self.store.Open(*(self.triad + (7,)))
+    self.assertEqual(7, file_index.revision)
+    file_index.Close()
+    self.assertEqual(None, self.store.Open(*(self.triad + (8,))))
+    # The index stays in place until it's built again.
+    self.assertEqual(['unstable-sparc-SunOS5.10.idx'],
+                     os.listdir(self.directory))
+
+
+class GetFileIndexStoreUnitTest(unittest.TestCase):
+
+  def GetConfig(self, directory):
+    config = ConfigParser.SafeConfigParser()
+    config.add_section('file_index')
+    config.set('file_index', 'directory', directory)
+    return config
+
+  def testDisabled(self):
+    self.assertEqual(
+        None, catalog_file_index.GetFileIndexStore(self.GetConfig('')))
+
+  def testEnabled(self):
+    directory = tempfile.mkdtemp(prefix='catalog_file_index_test-')
+    try:
+      store = catalog_file_index.GetFileIndexStore(self.GetConfig(directory))
+      self.assertEqual(directory, store.directory)
+      self.assertTrue(store is catalog_file_index.GetFileIndexStore(
+          self.GetConfig(directory)))
+    finally:
+      shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  unittest.main()
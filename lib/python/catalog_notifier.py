@@ -101,21 +101,42 @@ $CatalogList($catalogs)
 
 class NotificationFormatter(object):
 
+  def __init__(self):
+    # Maintainers don't change between catalogs, so they're looked up once.
+    self._maintainer_email_by_md5 = {}
+
+  def _FetchMaintainers(self, md5_sums, rest_client):
+    """Looks up maintainers of packages which haven't been seen yet."""
+    missing = set(md5_sums).difference(self._maintainer_email_by_md5)
+    if not missing:
+      return
+    maintainers = rest_client.GetMaintainersByMd5s(sorted(missing))
+    for md5_sum, maintainer in maintainers.iteritems():
+      self._maintainer_email_by_md5[md5_sum] = maintainer["maintainer_email"]
+
   def _GetPkgsByMaintainer(self, catalogs, rest_client):
     c = catalog.CatalogComparator()
-    pkgs_by_maintainer = {}
+    diffs = []
+    md5_sums = set()
     for catrel, arch, osrel, cat_a, cat_b in catalogs:
-      catalog_key = (catrel, arch, osrel)
       new_pkgs, removed_pkgs, updated_pkgs = c.GetCatalogDiff(cat_a, cat_b)
+      diffs.append(((catrel, arch, osrel), new_pkgs, removed_pkgs, updated_pkgs))
+      md5_sums.update(pkg["md5sum"] for pkg in new_pkgs + removed_pkgs)
+      for d in updated_pkgs:
+        md5_sums.add(d["from"]["md5sum"])
+        md5_sums.add(d["to"]["md5sum"])
+    # All the maintainers are fetched at once, for all the catalogs.
+    self._FetchMaintainers(md5_sums, rest_client)
+    emails = self._maintainer_email_by_md5
+    pkgs_by_maintainer = {}
+    for catalog_key, new_pkgs, removed_pkgs, updated_pkgs in diffs:
       labels_and_lists = (
           ("new_pkgs", new_pkgs),
           ("removed_pkgs", removed_pkgs),
       )
       for label, pkg_list in labels_and_lists:
         for pkg in pkg_list:
-          # This is inefficient: it pulls down the whole package just to fetch the maintainer's email.
-          maintainer = rest_client.GetMaintainerByMd5(pkg["md5sum"])
-          maintainer_email = maintainer["maintainer_email"]
+          maintainer_email = emails[pkg["md5sum"]]
           pkgs_by_maintainer.setdefault(maintainer_email, {})
           pkgs_by_maintainer[maintainer_email].setdefault(label, {})
           labeled = pkgs_by_maintainer[maintainer_email][label]
@@ -128,10 +149,8 @@ class NotificationFormatter(object):
       for d in updated_pkgs:
         from_pkg = d["from"]
         to_pkg = d["to"]
-        maintainer_from = rest_client.GetMaintainerByMd5(from_pkg["md5sum"])
-        maintainer_to = rest_client.GetMaintainerByMd5(to_pkg["md5sum"])
-        from_email = maintainer_from["maintainer_email"]
-        to_email = maintainer_to["maintainer_email"]
+        from_email = emails[from_pkg["md5sum"]]
+        to_email = emails[to_pkg["md5sum"]]
         if from_email == to_email:
           # A normal upgrade, no takeover
           label = "upgraded_pkg"
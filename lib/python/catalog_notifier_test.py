@@ -43,18 +43,11 @@ class NotificationFormatterTest(mox.MoxTestBase):
         ("fossil", "amd67", "SolarOS5.12", cat_a, cat_b),
         ("rock",   "amd65", "SolarOS5.12", cat_a, cat_b),
     ]
-    rest_client_mock.GetMaintainerByMd5('cfe40c06e994f6e8d3b191396d0365cb').AndReturn(
-        {"maintainer_email": "joe@example.com"}
-    )
-    rest_client_mock.GetMaintainerByMd5('cfe40c06e994f6e8d3b191396d0365cb').AndReturn(
-        {"maintainer_email": "joe@example.com"}
-    )
-    rest_client_mock.GetMaintainerByMd5('cfe40c06e994f6e8d3b191396d0365cb').AndReturn(
-        {"maintainer_email": "joe@example.com"}
-    )
-    rest_client_mock.GetMaintainerByMd5('cfe40c06e994f6e8d3b191396d0365cb').AndReturn(
-        {"maintainer_email": "joe@example.com"}
-    )
+    rest_client_mock.GetMaintainersByMd5s(
+        ['cfe40c06e994f6e8d3b191396d0365cb']).AndReturn({
+          'cfe40c06e994f6e8d3b191396d0365cb':
+              {"maintainer_email": "joe@example.com"},
+        })
     cat_a.GetDataByCatalogname().AndReturn({})
     cat_b.GetDataByCatalogname().AndReturn({
       "syslog_ng": catalog_test.PKG_STRUCT_1,
@@ -100,9 +93,11 @@ class NotificationFormatterTest(mox.MoxTestBase):
     catalogs = [
         ("fossil", "amd65", "SolarOS5.12", cat_a, cat_b),
     ]
-    rest_client_mock.GetMaintainerByMd5('cfe40c06e994f6e8d3b191396d0365cb').AndReturn(
-        {"maintainer_email": "joe@example.com"}
-    )
+    rest_client_mock.GetMaintainersByMd5s(
+        ['cfe40c06e994f6e8d3b191396d0365cb']).AndReturn({
+          'cfe40c06e994f6e8d3b191396d0365cb':
+              {"maintainer_email": "joe@example.com"},
+        })
     cat_a.GetDataByCatalogname().AndReturn({
       "syslog_ng": catalog_test.PKG_STRUCT_1,
     })
@@ -145,12 +140,12 @@ class NotificationFormatterTest(mox.MoxTestBase):
     cat_b.GetDataByCatalogname().AndReturn({
       "syslog_ng": catalog_test.PKG_STRUCT_1,
     })
-    rest_client_mock.GetMaintainerByMd5('previous_md5').AndReturn(
-        {"maintainer_email": "jack@example.com"}
-    )
-    rest_client_mock.GetMaintainerByMd5('cfe40c06e994f6e8d3b191396d0365cb').AndReturn(
-        {"maintainer_email": "joe@example.com"}
-    )
+    rest_client_mock.GetMaintainersByMd5s(
+        ['cfe40c06e994f6e8d3b191396d0365cb', 'previous_md5']).AndReturn({
+          'previous_md5': {"maintainer_email": "jack@example.com"},
+          'cfe40c06e994f6e8d3b191396d0365cb':
+              {"maintainer_email": "joe@example.com"},
+        })
     self.mox.ReplayAll()
     result = f._GetPkgsByMaintainer(catalogs, rest_client_mock)
     self.assertTrue("jack@example.com" in result)
@@ -193,12 +188,12 @@ class NotificationFormatterTest(mox.MoxTestBase):
     cat_b.GetDataByCatalogname().AndReturn({
       "syslog_ng": catalog_test.PKG_STRUCT_1,
     })
-    rest_client_mock.GetMaintainerByMd5('previous_md5').AndReturn(
-        {"maintainer_email": "jack@example.com"}
-    )
-    rest_client_mock.GetMaintainerByMd5('cfe40c06e994f6e8d3b191396d0365cb').AndReturn(
-        {"maintainer_email": "jack@example.com"}
-    )
+    rest_client_mock.GetMaintainersByMd5s(
+        ['cfe40c06e994f6e8d3b191396d0365cb', 'previous_md5']).AndReturn({
+          'previous_md5': {"maintainer_email": "jack@example.com"},
+          'cfe40c06e994f6e8d3b191396d0365cb':
+              {"maintainer_email": "jack@example.com"},
+        })
     self.mox.ReplayAll()
     result = f._GetPkgsByMaintainer(catalogs, rest_client_mock)
     # pprint.pprint(result)
@@ -215,6 +210,29 @@ class NotificationFormatterTest(mox.MoxTestBase):
     #     result["jack@example.com"], "jack@example.com",
     #     "http://mirror.example.com")
 
+  def test_GetPkgsByMaintainerMemoized(self):
+    f = catalog_notifier.NotificationFormatter()
+    rest_client_mock = self.mox.CreateMock(rest.RestClient)
+    cat_a = self.mox.CreateMock(catalog.OpencswCatalog)
+    cat_b = self.mox.CreateMock(catalog.OpencswCatalog)
+    catalogs = [
+        ("fossil", "amd65", "SolarOS5.12", cat_a, cat_b),
+    ]
+    for _ in range(2):
+      cat_a.GetDataByCatalogname().AndReturn({})
+      cat_b.GetDataByCatalogname().AndReturn({
+        "syslog_ng": catalog_test.PKG_STRUCT_1,
+      })
+    # Only one lookup for both calls.
+    rest_client_mock.GetMaintainersByMd5s(
+        ['cfe40c06e994f6e8d3b191396d0365cb']).AndReturn({
+          'cfe40c06e994f6e8d3b191396d0365cb':
+              {"maintainer_email": "joe@example.com"},
+        })
+    self.mox.ReplayAll()
+    first = f._GetPkgsByMaintainer(catalogs, rest_client_mock)
+    self.assertEqual(first, f._GetPkgsByMaintainer(catalogs, rest_client_mock))
+
 
 if __name__ == '__main__':
   unittest.main()
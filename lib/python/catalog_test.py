@@ -68,6 +68,45 @@ class OpencswCatalogUnitTest(unittest.TestCase):
                 'version': '1.2,REV=2010.05.17'}
     self.assertEquals(expected, parsed)
 
+  def test_ParseCatalogLineWithIDeps(self):
+    oc = catalog.OpencswCatalog(None)
+    parsed = oc._ParseCatalogLine(CATALOG_LINE_3.replace(
+      ' none\n', ' CSWfoo|CSWbar\n'))
+    self.assertEquals(('CSWfoo', 'CSWbar'), parsed['i_deps'])
+    self.assertEquals('none', parsed['category'])
+
+  def test_ParseCatalogLineBadLine(self):
+    oc = catalog.OpencswCatalog(None)
+    self.assertRaises(catalog.CatalogLineParseError,
+                      oc._ParseCatalogLine, 'tmux 1.2 CSWtmux\n')
+
+  def test_ParseCatalogLineLeadingWhitespace(self):
+    oc = catalog.OpencswCatalog(None)
+    self.assertRaises(catalog.CatalogLineParseError,
+                      oc._ParseCatalogLine, ' ' + CATALOG_LINE_3)
+
+  def testIterCatalogData(self):
+    fd = StringIO('\n'.join([
+      '-----BEGIN PGP SIGNED MESSAGE-----',
+      'Hash: SHA1',
+      '',
+      '# comment',
+      CATALOG_LINE_1,
+      'garbage',
+      CATALOG_LINE_3.strip(),
+      '-----BEGIN PGP SIGNATURE-----',
+      CATALOG_LINE_2,
+    ]))
+    oc = catalog.OpencswCatalog(fd)
+    entries = oc.IterCatalogData()
+    self.assertEquals('syslog_ng', entries.next()['catalogname'])
+    self.assertEquals(['tmux'], [x['catalogname'] for x in entries])
+
+  def testIterCatalogDataAfterGetCatalogData(self):
+    oc = catalog.OpencswCatalog(StringIO(CATALOG_LINE_1))
+    self.assertEquals([PKG_STRUCT_1], oc.GetCatalogData())
+    self.assertEquals([PKG_STRUCT_1], list(oc.IterCatalogData()))
+
   def testGetDataByCatalogname(self):
     fd = StringIO(CATALOG_LINE_1)
     oc = catalog.OpencswCatalog(fd)
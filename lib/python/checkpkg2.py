@@ -4,7 +4,6 @@
 #
 
 import datetime
-import hashlib
 import logging
 import operator
 import optparse
@@ -17,6 +16,7 @@ from lib.python import checkpkg_lib
 from lib.python import common_constants
 from lib.python import configuration
 from lib.python import errors
+from lib.python import file_hash
 from lib.python import models
 from lib.python import overrides
 from lib.python import package_stats
@@ -154,16 +154,9 @@ def main():
       username=username, password=password)
 
   if file_list:
+    hasher = file_hash.GetFileHasher()
     def MakeEntry(file_name):
-      file_hash = hashlib.md5()
-      with open(file_name, "r") as fd:
-        chunk_size = 2 * 1024 * 1024
-        data = fd.read(chunk_size)
-        while data:
-          file_hash.update(data)
-          data = fd.read(chunk_size)
-        md5_sum = file_hash.hexdigest()
-        del file_hash
+      md5_sum = hasher.Md5Sum(file_name)
       _, file_basename = os.path.split(file_name)
       return {
           'pkg_path': file_name,
@@ -5,6 +5,7 @@
 
 import collections
 import copy
+import datetime
 import getpass
 import itertools
 import logging
@@ -19,6 +20,8 @@ import textwrap
 from Cheetah import Template
 from sqlobject import sqlbuilder
 
+from lib.python import blob_cache
+from lib.python import catalog_file_index
 from lib.python import common_constants
 from lib.python import configuration
 from lib.python import database
@@ -31,6 +34,10 @@ from lib.python import sharedlib_utils
 from lib.python import tag
 
 DESCRIPTION_RE = r"^([\S]+) - (.*)$"
+# Rows per INSERT statement when many packages are added to a catalog.
+CATALOG_INSERT_BATCH_SIZE = 500
+# Basenames or paths looked up with a single query by the bulk lookups.
+BULK_LOOKUP_QUERY_SIZE = 200
 
 SYS_DEFAULT_RUNPATH = [
     "/usr/lib/$ISALIST",
@@ -175,13 +182,22 @@ def ElfinfoBlobToStruct(elfdump_data):
 
 
 class LazyElfinfo(object):
-  """Used at runtime for lazy fetches of elfdump info data."""
+  """Used at runtime for lazy fetches of elfdump info data.
 
-  def __init__(self, rest_client):
+  Blobs passed in prefetched are handed out once, and then forgotten to
+  free memory. Other blobs are fetched when they are requested.
+  """
+
+  def __init__(self, rest_client, prefetched=None):
     self.rest_client = rest_client
+    if prefetched is None:
+      prefetched = {}
+    self.prefetched = prefetched
 
   def __getitem__(self, md5_sum):
-    elfdump_data = self.rest_client.GetBlob('elfdump', md5_sum)
+    elfdump_data = self.prefetched.pop(md5_sum, None)
+    if elfdump_data is None:
+      elfdump_data = self.rest_client.GetBlob('elfdump', md5_sum)
     return ElfinfoBlobToStruct(elfdump_data)
 
 
@@ -207,7 +223,9 @@ class CheckpkgManagerBase(SqlobjectHelperMixin):
         pkgdb_url=config.get('rest', 'pkgdb'),
         releases_url=config.get('rest', 'releases'),
         username=username,
-        password=password)
+        password=password,
+        blob_cache=blob_cache.GetBlobCache(config))
+    self.file_index_store = catalog_file_index.GetFileIndexStore(config)
 
   def _ResetState(self):
     self.errors = []
@@ -253,25 +271,17 @@ class CheckpkgManagerBase(SqlobjectHelperMixin):
 
   def GetOptimizedAllStats(self, stats_obj_list):
     logging.info("Unwrapping candies...")
+    # Fetching all the blobs at once lets the REST client reuse connections
+    # and download several blobs in parallel.
+    blobs = self.rest_client.GetBlobs(
+        'pkgstats', [stats_obj.md5_sum for stats_obj in stats_obj_list])
     pkgs_data = []
-    counter = itertools.count()
-    length = len(stats_obj_list)
-    pbar = self.GetProgressBar()
-    pbar.maxval = length
-    pbar.start()
     for stats_obj in stats_obj_list:
-      # This bit is tightly tied to the data structures returned by
-      # PackageStats.
-      #
-      # Python strings are already implementing the flyweight pattern. What's
-      # left is lists and dictionaries.
-      raw_pkg_data = self.rest_client.GetBlob('pkgstats', stats_obj.md5_sum)
-      # Registering a callback allowing the receiver to retrieve the elfdump
-      # information when necessary.
-      raw_pkg_data['elfdump_info'] = LazyElfinfo(self.rest_client)
+      raw_pkg_data = blobs[stats_obj.md5_sum]
+      if raw_pkg_data is None:
+        raise DataError("Stats of %s (%s) are missing on the server."
+                        % (stats_obj.basename, stats_obj.md5_sum))
       pkgs_data.append(raw_pkg_data)
-      pbar.update(counter.next())
-    pbar.finish()
     return pkgs_data
 
   def Run(self):
@@ -328,6 +338,8 @@ class CheckpkgManagerBase(SqlobjectHelperMixin):
     pbar.finish()
     flat_error_list = reduce(operator.add, errors.values(), [])
     screen_report, tags_report = self.FormatReports(errors, messages, gar_lines)
+    if self.rest_client.blob_cache:
+      logging.debug("Blob cache: %s", self.rest_client.blob_cache.GetStats())
     exit_code = 0
     return (exit_code, screen_report, tags_report)
 
@@ -345,7 +357,8 @@ class CheckInterfaceBase(object):
   """
 
   def __init__(self, osrel, arch, catrel, catalog, pkg_set_files, lines_dict=None,
-               rest_client=None):
+               rest_client=None, elfinfo=None, basename_memo=None,
+               file_index=None):
     """
     Args:
       osrel: OS release
@@ -355,6 +368,11 @@ class CheckInterfaceBase(object):
       pkgs_set_files: A dictionary of collections of pairs path / basename
       lines_dict: ?
       rest_client: the rest interface client
+      elfinfo: an optional LazyElfinfo object, holding prefetched data
+      basename_memo: a dictionary of catalog results by basename, shared by
+          all check interfaces of a checkpkg run
+      file_index: an optional catalog_file_index.FileIndex of the catalog,
+          used instead of the database and the REST interface
 
     An example:
     {
@@ -370,6 +388,11 @@ class CheckInterfaceBase(object):
     self.arch = arch
     self.catrel = catrel
     self.catalog = catalog
+    self.elfinfo = elfinfo
+    self.file_index = file_index
+    if basename_memo is None:
+      basename_memo = {}
+    self.basename_memo = basename_memo
     self.common_paths = {}
     self.pkgs_by_path_cache = {}
     if lines_dict:
@@ -404,10 +427,38 @@ class CheckInterfaceBase(object):
   def AddError(self, error):
     self.__errors.append(error)
 
+  def PrefetchPathsAndPkgnamesByBasenames(self, basenames):
+    """Looks up many basenames with a single REST call.
+
+    The results are used by later GetPathsAndPkgnamesByBasename() calls.
+    """
+    if self.file_index:
+      # Index lookups are cheap enough to be done on demand.
+      return
+    missing = sorted(set(basenames).difference(self.basename_memo))
+    if not missing:
+      return
+    paths_and_pkgs_by_basename = (
+        self.rest_client.GetPathsAndPkgnamesByBasenames(
+          self.catrel, self.arch, self.osrel, missing))
+    for basename in missing:
+      self.basename_memo[basename] = paths_and_pkgs_by_basename.get(
+          basename, {})
+
   def GetPathsAndPkgnamesByBasename(self, basename):
     """Proxies calls to class member."""
-    paths_and_pkgs = self.rest_client.GetPathsAndPkgnamesByBasename(
-      self.catrel, self.arch, self.osrel, basename)
+    if basename not in self.basename_memo:
+      if self.file_index:
+        self.basename_memo[basename] = (
+            self.file_index.GetPathsAndPkgnamesByBasename(basename))
+      else:
+        self.basename_memo[basename] = (
+            self.rest_client.GetPathsAndPkgnamesByBasename(
+              self.catrel, self.arch, self.osrel, basename))
+    # Copying, because the lists are modified below.
+    paths_and_pkgs = dict(
+        (path, list(pkgnames))
+        for path, pkgnames in self.basename_memo[basename].iteritems())
     # Removing references to packages under test
     for catalog_path in paths_and_pkgs:
       for pkgname in self.pkg_set_files:
@@ -421,12 +472,26 @@ class CheckInterfaceBase(object):
           paths.append(pkg)
     return paths_and_pkgs
 
+  def PrefetchPkgByPaths(self, file_paths):
+    """Looks up many paths with a single query.
+
+    The catalog object remembers the results, so later GetPkgByPath() calls
+    don't need to query the database.
+    """
+    if self.file_index:
+      return
+    self.catalog.GetPkgByPaths(
+        sorted(set(file_paths)), self.osrel, self.arch, self.catrel)
+
   def GetPkgByPath(self, file_path):
     """Proxies calls to self.system_pkgmap."""
     key = (file_path, self.osrel, self.arch, self.catrel)
     if not key in self.pkgs_by_path_cache:
-      pkgs_in_catalog = self.catalog.GetPkgByPath(
-          file_path, self.osrel, self.arch, self.catrel)
+      if self.file_index:
+        pkgs_in_catalog = self.file_index.GetPkgByPath(file_path)
+      else:
+        pkgs_in_catalog = self.catalog.GetPkgByPath(
+            file_path, self.osrel, self.arch, self.catrel)
       # This response comes from catalog; we need to simulate the state the
       # catalog would have if the set under test in the catalog.  First, we
       # remove old versions of packages under test.
@@ -498,6 +563,8 @@ class CheckInterfaceBase(object):
     self.AddError(checkpkg_tag)
 
   def GetElfdumpInfo(self, md5_sum):
+    if self.elfinfo is not None:
+      return self.elfinfo[md5_sum]
     elfdump_data = self.rest_client.GetBlob('elfdump', md5_sum)
     return ElfinfoBlobToStruct(elfdump_data)
 
@@ -508,9 +575,11 @@ class IndividualCheckInterface(CheckInterfaceBase):
   Wraps the creation of tag.CheckpkgTag objects.
   """
 
-  def __init__(self, pkgname, osrel, arch, catrel, catalog, pkg_set_files, rest_client):
+  def __init__(self, pkgname, osrel, arch, catrel, catalog, pkg_set_files, rest_client,
+               elfinfo=None, basename_memo=None, file_index=None):
     super(IndividualCheckInterface, self).__init__(
-        osrel, arch, catrel, catalog, pkg_set_files, rest_client=rest_client)
+        osrel, arch, catrel, catalog, pkg_set_files, rest_client=rest_client,
+        elfinfo=elfinfo, basename_memo=basename_memo, file_index=file_index)
     self.pkgname = pkgname
 
   def ReportError(self, tag_name, tag_info=None, msg=None):
@@ -531,9 +600,11 @@ class IndividualCheckInterface(CheckInterfaceBase):
 class SetCheckInterface(CheckInterfaceBase):
   """To be passed to set checking functions."""
 
-  def __init__(self, osrel, arch, catrel, catalog, pkg_set_files, rest_client):
+  def __init__(self, osrel, arch, catrel, catalog, pkg_set_files, rest_client,
+               elfinfo=None, basename_memo=None, file_index=None):
     super(SetCheckInterface, self).__init__(
-      osrel, arch, catrel, catalog, pkg_set_files, rest_client=rest_client)
+      osrel, arch, catrel, catalog, pkg_set_files, rest_client=rest_client,
+      elfinfo=elfinfo, basename_memo=basename_memo, file_index=file_index)
 
   def NeedFile(self, pkgname, full_path, reason):
     """See base class _NeedFile."""
@@ -852,12 +923,68 @@ class CheckpkgManager2(CheckpkgManagerBase):
     return examined_files_by_pkg
 
 
+  def PrefetchElfdumpInfo(self, pkgs_data):
+    """Fetches the elfdump info of all binaries in the set at once.
+
+    Returns a LazyElfinfo object holding the fetched data. Blobs which
+    weren't found are fetched again when requested.
+    """
+    md5_sums = []
+    for pkg_data in pkgs_data:
+      md5_sums.extend(md5_sum for _, md5_sum in pkg_data["binary_md5_sums"])
+    logging.debug("Prefetching elfdump info of %d binaries.", len(md5_sums))
+    blobs = self.rest_client.GetBlobs('elfdump', md5_sums)
+    prefetched = dict((md5_sum, blob) for md5_sum, blob in blobs.iteritems()
+                      if blob is not None)
+    elfinfo = LazyElfinfo(self.rest_client, prefetched)
+    for pkg_data in pkgs_data:
+      pkg_data['elfdump_info'] = elfinfo
+    return elfinfo
+
+  def PrefetchCatalogLookups(self, pkgs_data, check_interface):
+    """Resolves the sonames and paths the dependency checks will look up.
+
+    There is one query for all needed sonames, and one for all paths from
+    the pkgmaps, instead of one per soname and per path.
+    """
+    needed_sonames = set()
+    paths = set()
+    for pkg_data in pkgs_data:
+      for binary_info in pkg_data["binaries_dump_info"]:
+        binary_info = representations.BinaryDumpInfo._make(binary_info)
+        needed_sonames.update(binary_info.needed_sonames)
+      for pkgmap_entry in pkg_data["pkgmap"]:
+        pkgmap_entry = representations.PkgmapEntry._make(pkgmap_entry)
+        if pkgmap_entry.path:
+          paths.add(pkgmap_entry.path)
+          paths.add(os.path.dirname(pkgmap_entry.path))
+    logging.debug("Prefetching %d sonames and %d paths.",
+                  len(needed_sonames), len(paths))
+    check_interface.PrefetchPathsAndPkgnamesByBasenames(needed_sonames)
+    check_interface.PrefetchPkgByPaths(paths)
+
   def GetAllTags(self, stats_obj_list):
     errors = {}
     catalog = Catalog()
     logging.debug("Loading all package statistics.")
     pkgs_data = self.GetOptimizedAllStats(stats_obj_list)
     logging.debug("All package statistics loaded.")
+    elfinfo = self.PrefetchElfdumpInfo(pkgs_data)
+    basename_memo = {}
+    file_index = None
+    if self.file_index_store:
+      file_index = self.file_index_store.Open(
+          self.osrel, self.arch, self.catrel,
+          catalog.GetCatalogRevision(self.osrel, self.arch, self.catrel))
+    if not file_index:
+      logging.debug("No file index for %s %s %s, using the database.",
+                    self.catrel, self.arch, self.osrel)
+    # Build a map between packages and files:
+    examined_files_by_pkg = self._ExaminedFilesByPkg(pkgs_data)
+    self.PrefetchCatalogLookups(pkgs_data, SetCheckInterface(
+        self.osrel, self.arch, self.catrel, catalog, examined_files_by_pkg,
+        rest_client=self.rest_client, basename_memo=basename_memo,
+        file_index=file_index))
     messenger = CheckpkgMessenger()
     # Individual checks
     count = itertools.count()
@@ -868,14 +995,13 @@ class CheckpkgManager2(CheckpkgManagerBase):
     needed_pkgs = []
     pbar.start()
     declared_deps_by_pkgname = {}
-    # Build a map between packages and files:
-    examined_files_by_pkg = self._ExaminedFilesByPkg(pkgs_data)
     # Running individual checks
     for pkg_data in pkgs_data:
       pkgname = pkg_data["basic_stats"]["pkgname"]
       check_interface = IndividualCheckInterface(
           pkgname, self.osrel, self.arch, self.catrel, catalog, examined_files_by_pkg,
-          rest_client=self.rest_client)
+          rest_client=self.rest_client, elfinfo=elfinfo,
+          basename_memo=basename_memo, file_index=file_index)
       for function in self.individual_checks:
         logger = logging.getLogger("%s-%s" % (pkgname, function.__name__))
         logger.debug("Calling %s", function.__name__)
@@ -904,7 +1030,8 @@ class CheckpkgManager2(CheckpkgManagerBase):
       logger = logging.getLogger(function.__name__)
       check_interface = SetCheckInterface(
           self.osrel, self.arch, self.catrel, catalog, examined_files_by_pkg,
-          rest_client=self.rest_client)
+          rest_client=self.rest_client, elfinfo=elfinfo,
+          basename_memo=basename_memo, file_index=file_index)
       logger.debug("Calling %s", function.__name__)
       function(pkgs_data, check_interface, logger=logger, messenger=messenger)
       if check_interface.errors:
@@ -913,10 +1040,13 @@ class CheckpkgManager2(CheckpkgManagerBase):
       needed_pkgs.extend(check_interface.needed_pkgs)
     check_interface = SetCheckInterface(
         self.osrel, self.arch, self.catrel, catalog, examined_files_by_pkg,
-        rest_client=self.rest_client)
+        rest_client=self.rest_client, elfinfo=elfinfo,
+        basename_memo=basename_memo, file_index=file_index)
     self._ReportDependencies(check_interface,
         needed_files, needed_pkgs, messenger, declared_deps_by_pkgname)
     errors = self.SetErrorsToDict(check_interface.errors, errors)
+    if file_index:
+      file_index.Close()
     messages = messenger.messages + messenger.one_time_messages.values()
     return errors, messages, messenger.gar_lines
 
@@ -941,9 +1071,15 @@ class Catalog(SqlobjectHelperMixin):
     - getting a list of packages that contain files of certain names
   """
 
-  def __init__(self):
+  def __init__(self, file_index_store=None):
+    """
+    Args:
+      file_index_store: an optional catalog_file_index.FileIndexStore, whose
+          indexes are invalidated when catalogs change
+    """
     super(Catalog, self).__init__()
     self.pkgs_by_path_cache = {}
+    self.file_index_store = file_index_store
 
   def GetInstalledPackages(self, osrel, arch, catrel):
     sqo_osrel, sqo_arch, sqo_catrel = self.GetSqlobjectTriad(
@@ -989,7 +1125,26 @@ class Catalog(SqlobjectHelperMixin):
       {"/opt/csw/lib": ["CSWfoo", "CSWbar"],
        "/opt/csw/1/lib": ["CSWfoomore"]}
     """
-    pkgs = {}
+    pkgs = self.GetPathsAndPkgnamesByBasenames(
+        [basename], osrel, arch, catrel).get(basename, {})
+    logging.debug("self.error_mgr_mock.GetPathsAndPkgnamesByBasename(%s)"
+                  ".AndReturn(%s)", repr(basename), pprint.pformat(pkgs))
+    return pkgs
+
+  def GetPathsAndPkgnamesByBasenames(self, basenames, osrel, arch, catrel):
+    """Bulk version of GetPathsAndPkgnamesByBasename.
+
+    Looks up BULK_LOOKUP_QUERY_SIZE basenames with a single query.
+
+    Returns:
+      {"libfoo.so.1": {"/opt/csw/lib": ["CSWfoo", "CSWbar"]},
+       "libbar.so.1": {"/opt/csw/lib": ["CSWbar"]}}
+
+      Basenames not present in the catalog are not in the dictionary.
+    """
+    pkgs_by_basename = {}
+    if not basenames:
+      return pkgs_by_basename
     sqo_osrel, sqo_arch, sqo_catrel = self.GetSqlobjectTriad(
         osrel, arch, catrel)
 
@@ -1005,27 +1160,25 @@ class Catalog(SqlobjectHelperMixin):
           m.Srv4FileInCatalog,
           m.Srv4FileStats.q.id==m.Srv4FileInCatalog.q.srv4file),
     ]
-    where = sqlobject.AND(
-        m.CswFile.q.basename==basename,
-        m.Srv4FileInCatalog.q.osrel==sqo_osrel,
-        m.Srv4FileInCatalog.q.arch==sqo_arch,
-        m.Srv4FileInCatalog.q.catrel==sqo_catrel,
-    )
-    query = connection.sqlrepr(
-        sqlbuilder.Select(
-          [m.CswFile.q.path, m.Pkginst.q.pkgname],
-          where=where,
-          join=join))
-    rows = connection.queryAll(query)
-    pkgs = {}
-
-    for row in rows:
-      file_path, pkginst = row
-      pkgs.setdefault(file_path, []).append(pkginst)
+    basenames = sorted(set(basenames))
+    for start in xrange(0, len(basenames), BULK_LOOKUP_QUERY_SIZE):
+      where = sqlobject.AND(
+          sqlbuilder.IN(m.CswFile.q.basename,
+                        basenames[start:start + BULK_LOOKUP_QUERY_SIZE]),
+          m.Srv4FileInCatalog.q.osrel==sqo_osrel,
+          m.Srv4FileInCatalog.q.arch==sqo_arch,
+          m.Srv4FileInCatalog.q.catrel==sqo_catrel,
+      )
+      query = connection.sqlrepr(
+          sqlbuilder.Select(
+            [m.CswFile.q.basename, m.CswFile.q.path, m.Pkginst.q.pkgname],
+            where=where,
+            join=join))
+      for basename, file_path, pkginst in connection.queryAll(query):
+        pkgs = pkgs_by_basename.setdefault(basename, {})
+        pkgs.setdefault(file_path, []).append(pkginst)
 
-    logging.debug("self.error_mgr_mock.GetPathsAndPkgnamesByBasename(%s)"
-                  ".AndReturn(%s)", repr(basename), pprint.pformat(pkgs))
-    return pkgs
+    return pkgs_by_basename
 
 
   def GetPathsAndPkgnamesByBasedir(self, basedir, osrel, arch, catrel):
@@ -1065,20 +1218,31 @@ class Catalog(SqlobjectHelperMixin):
     """Returns a list of packages."""
     # TODO(maciej): Move this to models.py and have pkgdb_web return the JSON
     # structure. This is a step towards RESTification.
-    key = (full_file_path, osrel, arch, catrel)
-    if key not in self.pkgs_by_path_cache:
-      file_path, basename = os.path.split(full_file_path)
+    return self.GetPkgByPaths([full_file_path], osrel, arch, catrel)[
+        full_file_path]
+
+  def GetPkgByPaths(self, full_file_paths, osrel, arch, catrel):
+    """Bulk version of GetPkgByPath.
+
+    Paths which aren't in the cache are looked up BULK_LOOKUP_QUERY_SIZE at
+    a time.
+
+    Returns:
+      {"/opt/csw/bin/foo": frozenset(["CSWfoo"]), "/opt/csw/bin/bar": ...}
+    """
+    missing = set()
+    for full_file_path in full_file_paths:
+      key = (full_file_path, osrel, arch, catrel)
+      if key not in self.pkgs_by_path_cache:
+        missing.add(full_file_path)
+    if missing:
+      dirs_and_basenames = sorted(set(os.path.split(x) for x in missing))
       sqo_osrel, sqo_arch, sqo_catrel = self.GetSqlobjectTriad(
           osrel, arch, catrel)
       oac = sqlobject.AND(
           m.Srv4FileInCatalog.q.osrel==sqo_osrel,
           m.Srv4FileInCatalog.q.arch==sqo_arch,
           m.Srv4FileInCatalog.q.catrel==sqo_catrel)
-      path_filter = sqlobject.AND(
-          oac,
-          m.CswFile.q.path==file_path,
-          m.CswFile.q.basename==basename,
-          m.Srv4FileStats.q.registered_level_two==True)
       join = [
           sqlbuilder.INNERJOINOn(None,
             m.Srv4FileStats,
@@ -1090,10 +1254,76 @@ class Catalog(SqlobjectHelperMixin):
             m.CswFile,
             m.Srv4FileStats.q.id==m.CswFile.q.srv4_file),
           ]
-      res = m.Pkginst.select(path_filter, join=join)
-      pkgs = [x.pkgname for x in res]
-      self.pkgs_by_path_cache[key] = frozenset(pkgs)
-    return self.pkgs_by_path_cache[key]
+      connection = m.CswFile._connection
+      pkgs_by_path = dict((x, set()) for x in missing)
+      for start in xrange(0, len(dirs_and_basenames), BULK_LOOKUP_QUERY_SIZE):
+        chunk = dirs_and_basenames[start:start + BULK_LOOKUP_QUERY_SIZE]
+        # Pairs of (path, basename) can't be portably used with IN, so each
+        # pair gets its own condition.
+        path_filter = sqlobject.AND(
+            oac,
+            sqlobject.OR(*[
+              sqlobject.AND(m.CswFile.q.path==file_path,
+                            m.CswFile.q.basename==basename)
+              for file_path, basename in chunk]),
+            m.Srv4FileStats.q.registered_level_two==True)
+        query = connection.sqlrepr(
+            sqlbuilder.Select(
+              [m.CswFile.q.path, m.CswFile.q.basename, m.Pkginst.q.pkgname],
+              where=path_filter,
+              join=join))
+        for file_path, basename, pkgname in connection.queryAll(query):
+          full_file_path = os.path.join(file_path, basename)
+          if full_file_path in pkgs_by_path:
+            pkgs_by_path[full_file_path].add(pkgname)
+      for full_file_path, pkgs in pkgs_by_path.iteritems():
+        key = (full_file_path, osrel, arch, catrel)
+        self.pkgs_by_path_cache[key] = frozenset(pkgs)
+    return dict(
+        (x, self.pkgs_by_path_cache[(x, osrel, arch, catrel)])
+        for x in full_file_paths)
+
+  def GetFilesInCatalog(self, osrel, arch, catrel):
+    """Returns (basename, path, pkgname) tuples of all files in a catalog.
+
+    Used to build file indexes.
+    """
+    sqo_osrel, sqo_arch, sqo_catrel = self.GetSqlobjectTriad(
+        osrel, arch, catrel)
+    connection = m.CswFile._connection
+    join = [
+        sqlbuilder.INNERJOINOn(None,
+          m.Pkginst,
+          m.CswFile.q.pkginst==m.Pkginst.q.id),
+        sqlbuilder.INNERJOINOn(None,
+          m.Srv4FileInCatalog,
+          m.CswFile.q.srv4_file==m.Srv4FileInCatalog.q.srv4file),
+        sqlbuilder.INNERJOINOn(None,
+          m.Srv4FileStats,
+          m.Srv4FileInCatalog.q.srv4file==m.Srv4FileStats.q.id),
+    ]
+    where = sqlobject.AND(
+        m.Srv4FileInCatalog.q.osrel==sqo_osrel,
+        m.Srv4FileInCatalog.q.arch==sqo_arch,
+        m.Srv4FileInCatalog.q.catrel==sqo_catrel,
+        m.Srv4FileStats.q.registered_level_two==True,
+    )
+    query = connection.sqlrepr(
+        sqlbuilder.Select(
+          [m.CswFile.q.basename, m.CswFile.q.path, m.Pkginst.q.pkgname],
+          where=where,
+          join=join))
+    return connection.queryAll(query)
+
+  def GetCatalogRevision(self, osrel, arch, catrel):
+    sqo_osrel, sqo_arch, sqo_catrel = self.GetSqlobjectTriad(
+        osrel, arch, catrel)
+    return m.GetCatalogRevision(sqo_osrel, sqo_arch, sqo_catrel)
+
+  def _CatalogChanged(self, osrel, arch, catrel):
+    self.pkgs_by_path_cache.clear()
+    if self.file_index_store:
+      self.file_index_store.Invalidate(osrel, arch, catrel)
 
   def CommonArchByString(self, s):
     return sharedlib_utils.ArchByString(s)
@@ -1201,28 +1431,214 @@ class Catalog(SqlobjectHelperMixin):
                       sqo_srv4, osrel, arch, catrel)
       # Our srv4 is already part of that catalog.
       return
-    # SQL INSERT happens here.
-    m.Srv4FileInCatalog(
-        arch=sqo_arch,
-        osrel=sqo_osrel,
-        catrel=sqo_catrel,
-        srv4file=sqo_srv4,
-        created_by=who)
+    # The assignment, its catalog line and the change record are written
+    # together.
+    trans = m.Srv4FileInCatalog._connection.transaction()
+    try:
+      # SQL INSERT happens here.
+      m.Srv4FileInCatalog(
+          arch=sqo_arch,
+          osrel=sqo_osrel,
+          catrel=sqo_catrel,
+          srv4file=sqo_srv4,
+          created_by=who,
+          connection=trans)
+      m.AddCatalogLines(trans, sqo_osrel, sqo_arch, sqo_catrel, [sqo_srv4.id])
+      m.RecordCatalogChanges(
+          trans, sqo_osrel, sqo_arch, sqo_catrel,
+          [(m.CATALOG_CHANGE_ADD, sqo_srv4.md5_sum, sqo_srv4.catalogname)],
+          who)
+    except:
+      trans.rollback()
+      raise
+    trans.commit(close=True)
     # The package is now in the catalog.
+    self._CatalogChanged(osrel, arch, catrel)
+
+  def _GetSrv4Names(self, where, join=None):
+    """Returns {srv4 id: (catalogname, pkgname, md5_sum)}."""
+    if join is None:
+      join = []
+    join.append(sqlbuilder.INNERJOINOn(None,
+      m.Pkginst,
+      m.Srv4FileStats.q.pkginst==m.Pkginst.q.id))
+    connection = m.Srv4FileStats._connection
+    rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+      [m.Srv4FileStats.q.id,
+       m.Srv4FileStats.q.catalogname,
+       m.Pkginst.q.pkgname,
+       m.Srv4FileStats.q.md5_sum],
+      where=where,
+      join=join)))
+    return dict((row[0], tuple(row[1:])) for row in rows)
+
+  def AddSrv4sToCatalog(self, sqo_srv4s, osrel, arch, catrel, who=None):
+    """Registers many srv4 files in a catalog, in one transaction.
+
+    Packages are processed in the given order, following the rules of
+    a catalog assignment PUT: a package replaces the package in the catalog
+    which has the same catalogname or the same pkgname. A package later in
+    the list replaces an earlier one, so the result is the same as if the
+    packages were added one by one.
 
-  def RemoveSrv4(self, sqo_srv4, osrel, arch, catrel):
+    Returns:
+      A list of dictionaries, one per package, in the given order, e.g.
+      {"md5_sum": ..., "status": "added", "removed": [md5_sum, ...]}
+      The status is one of "added", "present", "superseded" (replaced by
+      a later package in the list) or "error"; errors come with a "message".
+    """
+    logging.debug("AddSrv4sToCatalog(%d packages, %s, %s, %s, %s)",
+        len(sqo_srv4s), osrel, arch, catrel, who)
+    if not who:
+      who = 'unknown'
+    if arch not in ('i386', 'sparc'):
+      raise CatalogDatabaseError("Wrong architecture: %s" % arch)
     sqo_osrel, sqo_arch, sqo_catrel = self.GetSqlobjectTriad(
         osrel, arch, catrel)
+    results = []
+    candidates = []
+    for sqo_srv4 in sqo_srv4s:
+      result = {'md5_sum': sqo_srv4.md5_sum, 'removed': []}
+      results.append(result)
+      if not self.Srv4MatchesCatalog(sqo_srv4, sqo_arch):
+        result['status'] = 'error'
+        result['message'] = (
+            "Specified package does not match the catalog. "
+            "Package: %s, catalog: %s %s %s"
+            % (sqo_srv4, osrel, arch, catrel))
+      elif not sqo_srv4.registered_level_two:
+        result['status'] = 'error'
+        result['message'] = (
+            "Package %s (%s) is not registered for releases."
+            % (sqo_srv4.basename, sqo_srv4.md5_sum))
+      else:
+        candidates.append((sqo_srv4, result))
+    in_catalog = self._GetSrv4Names(
+        sqlobject.AND(
+          m.Srv4FileInCatalog.q.osrel==sqo_osrel,
+          m.Srv4FileInCatalog.q.arch==sqo_arch,
+          m.Srv4FileInCatalog.q.catrel==sqo_catrel),
+        [sqlbuilder.INNERJOINOn(None,
+          m.Srv4FileInCatalog,
+          m.Srv4FileInCatalog.q.srv4file==m.Srv4FileStats.q.id)])
+    names = {}
+    if candidates:
+      names = self._GetSrv4Names(sqlbuilder.IN(
+        m.Srv4FileStats.q.id, [x.id for x, _ in candidates]))
+    # The planned state of the catalog, updated package by package.
+    planned = dict(in_catalog)
+    ids_by_catalogname = collections.defaultdict(set)
+    ids_by_pkgname = collections.defaultdict(set)
+    for srv4_id, (catalogname, pkgname, _) in planned.iteritems():
+      ids_by_catalogname[catalogname].add(srv4_id)
+      ids_by_pkgname[pkgname].add(srv4_id)
+    added = {}
+    for sqo_srv4, result in candidates:
+      srv4_id = sqo_srv4.id
+      if srv4_id in planned:
+        result['status'] = 'present'
+        continue
+      catalogname, pkgname, md5_sum = names[srv4_id]
+      by_catalogname = ids_by_catalogname[catalogname]
+      by_pkgname = ids_by_pkgname[pkgname]
+      if len(by_catalogname) > 1 or len(by_pkgname) > 1:
+        result['status'] = 'error'
+        result['message'] = (
+            "There is more than one package with catalogname %s or "
+            "pkgname %s in %s %s %s" % (catalogname, pkgname,
+                                        osrel, arch, catrel))
+        continue
+      for conflicting_id in by_catalogname | by_pkgname:
+        c_catalogname, c_pkgname, c_md5_sum = planned.pop(conflicting_id)
+        ids_by_catalogname[c_catalogname].discard(conflicting_id)
+        ids_by_pkgname[c_pkgname].discard(conflicting_id)
+        if conflicting_id in added:
+          added.pop(conflicting_id)['status'] = 'superseded'
+        else:
+          result['removed'].append(c_md5_sum)
+      planned[srv4_id] = (catalogname, pkgname, md5_sum)
+      by_catalogname.add(srv4_id)
+      by_pkgname.add(srv4_id)
+      added[srv4_id] = result
+      result['status'] = 'added'
+    ids_to_delete = sorted(set(in_catalog) - set(planned))
+    ids_to_insert = [x.id for x, _ in candidates
+                     if x.id in added and x.id not in in_catalog]
+    if not ids_to_delete and not ids_to_insert:
+      return results
+    columns = m.Srv4FileInCatalog.sqlmeta.columns
+    template = [columns[x].dbName for x in
+                ('archID', 'osrelID', 'catrelID', 'srv4fileID',
+                 'created_on', 'created_by')]
+    created_on = datetime.datetime.now()
+    connection = m.Srv4FileInCatalog._connection
+    trans = connection.transaction()
     try:
-      # There's a race condition in here. Maybe SQLObject allows to delete atomically?
-      sqo_srv4_in_cat = m.Srv4FileInCatalog.select(
-          sqlobject.AND(
-            m.Srv4FileInCatalog.q.arch==sqo_arch,
+      m.DeleteCatalogLines(trans, sqo_osrel, sqo_arch, sqo_catrel,
+                           ids_to_delete)
+      if ids_to_delete:
+        trans.query(trans.sqlrepr(sqlbuilder.Delete(
+          m.Srv4FileInCatalog.sqlmeta.table,
+          where=sqlobject.AND(
             m.Srv4FileInCatalog.q.osrel==sqo_osrel,
+            m.Srv4FileInCatalog.q.arch==sqo_arch,
             m.Srv4FileInCatalog.q.catrel==sqo_catrel,
-            m.Srv4FileInCatalog.q.srv4file==sqo_srv4)).getOne()
-      # Files belonging to this package should not be removed from the catalog
-      # as the package might be still present in another catalog.
-      sqo_srv4_in_cat.destroySelf()
-    except sqlobject.main.SQLObjectNotFound as e:
-      logging.warning(e)
+            sqlbuilder.IN(m.Srv4FileInCatalog.q.srv4file, ids_to_delete)))))
+      batch_size = CATALOG_INSERT_BATCH_SIZE
+      for start in xrange(0, len(ids_to_insert), batch_size):
+        value_list = [
+            [sqo_arch.id, sqo_osrel.id, sqo_catrel.id, srv4_id,
+             created_on, who]
+            for srv4_id in ids_to_insert[start:start + batch_size]]
+        trans.query(trans.sqlrepr(sqlbuilder.Insert(
+          m.Srv4FileInCatalog.sqlmeta.table,
+          valueList=value_list,
+          template=template)))
+      m.AddCatalogLines(trans, sqo_osrel, sqo_arch, sqo_catrel, ids_to_insert)
+      changes = (
+          [(m.CATALOG_CHANGE_REMOVE, in_catalog[x][2], in_catalog[x][0])
+           for x in ids_to_delete]
+          + [(m.CATALOG_CHANGE_ADD, planned[x][2], planned[x][0])
+             for x in ids_to_insert])
+      m.RecordCatalogChanges(trans, sqo_osrel, sqo_arch, sqo_catrel,
+                             changes, who)
+    except:
+      trans.rollback()
+      raise
+    trans.commit(close=True)
+    self._CatalogChanged(osrel, arch, catrel)
+    return results
+
+  def RemoveSrv4(self, sqo_srv4, osrel, arch, catrel, who=None):
+    if not who:
+      who = 'unknown'
+    sqo_osrel, sqo_arch, sqo_catrel = self.GetSqlobjectTriad(
+        osrel, arch, catrel)
+    where = sqlobject.AND(
+        m.Srv4FileInCatalog.q.arch==sqo_arch,
+        m.Srv4FileInCatalog.q.osrel==sqo_osrel,
+        m.Srv4FileInCatalog.q.catrel==sqo_catrel,
+        m.Srv4FileInCatalog.q.srv4file==sqo_srv4)
+    # The assignment, its catalog line and the change record are removed
+    # together. Files belonging to this package should not be removed from
+    # the catalog as the package might be still present in another catalog.
+    trans = m.Srv4FileInCatalog._connection.transaction()
+    try:
+      if not m.Srv4FileInCatalog.select(where, connection=trans).count():
+        logging.warning("%s is not in catalog %s %s %s",
+                        sqo_srv4, catrel, arch, osrel)
+        trans.commit(close=True)
+        return
+      trans.query(trans.sqlrepr(sqlbuilder.Delete(
+        m.Srv4FileInCatalog.sqlmeta.table, where=where)))
+      m.DeleteCatalogLines(trans, sqo_osrel, sqo_arch, sqo_catrel,
+                           [sqo_srv4.id])
+      m.RecordCatalogChanges(
+          trans, sqo_osrel, sqo_arch, sqo_catrel,
+          [(m.CATALOG_CHANGE_REMOVE, sqo_srv4.md5_sum, sqo_srv4.catalogname)],
+          who)
+    except:
+      trans.rollback()
+      raise
+    trans.commit(close=True)
+    self._CatalogChanged(osrel, arch, catrel)
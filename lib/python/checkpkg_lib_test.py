@@ -13,11 +13,15 @@ import copy
 import cPickle
 import hashlib
 import mox
+import os
 import pprint
 import re
+import shutil
 import sqlite3
 import sqlobject
+import tempfile
 
+from lib.python import catalog_file_index
 from lib.python import checkpkg_lib
 from lib.python import common_constants
 from lib.python import database
@@ -382,8 +386,8 @@ class CheckpkgManager2DatabaseIntegrationTest(
     md5_by_binary = {}
     for bin_path, md5_sum in pkgstats['binary_md5_sums']:
       md5_by_binary[bin_path] = md5_sum
-    self.rest_client_mock.GetBlob('pkgstats', pkg_md5_sum).AndReturn(
-            pkgstats_pruned)
+    self.rest_client_mock.GetBlobs('pkgstats', [pkg_md5_sum]).AndReturn(
+            {pkg_md5_sum: pkgstats_pruned})
     for bin_path, _, _, sonames, _, _, _, _ in pkgstats['binaries_dump_info']:
       for soname in sorted(sonames):
         # self.rest_client_mock.GetBlob('elfinfo', md5_by_binary[bin_path])
@@ -517,6 +521,49 @@ class IndividualCheckInterfaceUnitTest(mox.MoxTestBase):
     paths_and_pkgnames = ici.GetPathsAndPkgnamesByBasename("foo")
     self.assertEqual(expected, paths_and_pkgnames)
 
+  def testPrefetchPathsAndPkgnamesByBasenames(self):
+    catalog_mock = self.mox.CreateMock(checkpkg_lib.Catalog)
+    pkg_set_files = {
+        "CSWfoo": frozenset([("/opt/csw/bin", "foo")]),
+    }
+    self.rest_client_mock.GetPathsAndPkgnamesByBasenames(
+        'calcified', 'amd65', 'AlienOS5.1', ['bar', 'foo']).AndReturn(
+            {'foo': {"/opt/csw/bin": ["CSWfoo", "CSWbar"]}})
+    self.mox.ReplayAll()
+    basename_memo = {}
+    ici = checkpkg_lib.IndividualCheckInterface('CSWfoo', 'AlienOS5.1',
+        'amd65', 'calcified', catalog_mock, pkg_set_files,
+        self.rest_client_mock, basename_memo=basename_memo)
+    ici.PrefetchPathsAndPkgnamesByBasenames(['foo', 'bar', 'foo'])
+    self.assertEqual({"/opt/csw/bin": ["CSWbar", "CSWfoo"]},
+                     ici.GetPathsAndPkgnamesByBasename("foo"))
+    self.assertEqual({}, ici.GetPathsAndPkgnamesByBasename("bar"))
+    # The memo is not modified by the package set overlay.
+    self.assertEqual({"/opt/csw/bin": ["CSWfoo", "CSWbar"]},
+                     basename_memo['foo'])
+
+  def testFileIndex(self):
+    catalog_mock = self.mox.CreateMock(checkpkg_lib.Catalog)
+    file_index_mock = self.mox.CreateMock(catalog_file_index.FileIndex)
+    pkg_set_files = {
+        "CSWfoo": frozenset([("/opt/csw/bin", "foo")]),
+    }
+    file_index_mock.GetPathsAndPkgnamesByBasename('foo').AndReturn(
+        {"/opt/csw/bin": ["CSWfoo", "CSWbar"]})
+    file_index_mock.GetPkgByPath('/opt/csw/bin/foo').AndReturn(
+        frozenset(["CSWfoo", "CSWbar"]))
+    self.mox.ReplayAll()
+    ici = checkpkg_lib.IndividualCheckInterface('CSWfoo', 'AlienOS5.1',
+        'amd65', 'calcified', catalog_mock, pkg_set_files,
+        self.rest_client_mock, file_index=file_index_mock)
+    # Neither the REST interface nor the database are used.
+    ici.PrefetchPathsAndPkgnamesByBasenames(['foo'])
+    ici.PrefetchPkgByPaths(['/opt/csw/bin/foo'])
+    self.assertEqual({"/opt/csw/bin": ["CSWbar", "CSWfoo"]},
+                     ici.GetPathsAndPkgnamesByBasename("foo"))
+    self.assertEqual(set(["CSWbar", "CSWfoo"]),
+                     ici.GetPkgByPath("/opt/csw/bin/foo"))
+
   def testNeededPackage(self):
     catalog_mock = self.mox.CreateMock(checkpkg_lib.Catalog)
     # Test that when you declare a file is needed, the right error
@@ -553,6 +600,321 @@ class SetCheckInterfaceUnitTest(mox.MoxTestBase):
     self.assertEqual("Because.", needed_file.reason)
 
 
+class LazyElfinfoUnitTest(mox.MoxTestBase):
+
+  def setUp(self):
+    super(LazyElfinfoUnitTest, self).setUp()
+    self.rest_client_mock = self.mox.CreateMock(rest.RestClient)
+
+  def testPrefetchedThenFetched(self):
+    self.rest_client_mock.GetBlob('elfdump', 'a' * 32).AndReturn(
+        {'symbol table': [['GLOB', 'B', 'UND', 'libfoo.so.1', 'foo', None]]})
+    self.mox.ReplayAll()
+    elfinfo = checkpkg_lib.LazyElfinfo(
+        self.rest_client_mock, {'a' * 32: {'symbol table': []}})
+    self.assertEqual({'symbol table': []}, elfinfo['a' * 32])
+    # The prefetched data are handed out once, then fetched on demand.
+    data = elfinfo['a' * 32]
+    self.assertEqual('libfoo.so.1', data['symbol table'][0].soname)
+
+  def testPrefetchElfdumpInfo(self):
+    self.mox.StubOutWithMock(rest, 'RestClient')
+    rest.RestClient(
+        pkgdb_url=mox.IsA(str), releases_url=mox.IsA(str),
+        username=mox.IgnoreArg(), password=mox.IgnoreArg(),
+        blob_cache=mox.IgnoreArg()).AndReturn(self.rest_client_mock)
+    self.rest_client_mock.GetBlobs(
+        'elfdump', ['a' * 32, 'b' * 32]).AndReturn(
+            {'a' * 32: {'symbol table': []}, 'b' * 32: None})
+    self.rest_client_mock.GetBlob('elfdump', 'b' * 32).AndReturn(
+        {'symbol table': []})
+    self.mox.ReplayAll()
+    m = checkpkg_lib.CheckpkgManager2(
+        "testname", [], "5.9", "sparc", "unstable")
+    pkgs_data = [
+        {'binary_md5_sums': [('/opt/csw/bin/foo', 'a' * 32)]},
+        {'binary_md5_sums': [('/opt/csw/bin/bar', 'b' * 32)]},
+    ]
+    elfinfo = m.PrefetchElfdumpInfo(pkgs_data)
+    self.assertTrue(pkgs_data[0]['elfdump_info'] is elfinfo)
+    sci = checkpkg_lib.SetCheckInterface(
+        'AlienOS5.1', 'amd65', 'calcified', None, {}, self.rest_client_mock,
+        elfinfo=elfinfo)
+    self.assertEqual({'symbol table': []}, sci.GetElfdumpInfo('a' * 32))
+    self.assertEqual({'symbol table': []}, sci.GetElfdumpInfo('b' * 32))
+
+
+class GetOptimizedAllStatsUnitTest(mox.MoxTestBase):
+
+  def setUp(self):
+    super(GetOptimizedAllStatsUnitTest, self).setUp()
+    self.rest_client_mock = self.mox.CreateMock(rest.RestClient)
+    self.mox.StubOutWithMock(rest, 'RestClient')
+    rest.RestClient(
+        pkgdb_url=mox.IsA(str), releases_url=mox.IsA(str),
+        username=mox.IgnoreArg(), password=mox.IgnoreArg(),
+        blob_cache=mox.IgnoreArg()).AndReturn(self.rest_client_mock)
+    self.stats_objs = [
+        self.mox.CreateMock(models.Srv4FileStats),
+        self.mox.CreateMock(models.Srv4FileStats),
+    ]
+    for stats_obj, md5_sum in zip(self.stats_objs, ('a' * 32, 'b' * 32)):
+      stats_obj.md5_sum = md5_sum
+      stats_obj.basename = 'foo-1.0-SunOS5.9-sparc-CSW.pkg.gz'
+
+  def testInOrder(self):
+    self.rest_client_mock.GetBlobs('pkgstats', ['a' * 32, 'b' * 32]).AndReturn(
+        {'b' * 32: {'name': 'b'}, 'a' * 32: {'name': 'a'}})
+    self.mox.ReplayAll()
+    m = checkpkg_lib.CheckpkgManager2(
+        "testname", [], "5.9", "sparc", "unstable")
+    self.assertEqual([{'name': 'a'}, {'name': 'b'}],
+                     m.GetOptimizedAllStats(self.stats_objs))
+
+  def testMissingStats(self):
+    self.rest_client_mock.GetBlobs('pkgstats', ['a' * 32, 'b' * 32]).AndReturn(
+        {'a' * 32: {'name': 'a'}, 'b' * 32: None})
+    self.mox.ReplayAll()
+    m = checkpkg_lib.CheckpkgManager2(
+        "testname", [], "5.9", "sparc", "unstable")
+    self.assertRaises(checkpkg_lib.DataError,
+                      m.GetOptimizedAllStats, self.stats_objs)
+
+
+class CatalogBulkLookupUnitTest(test_base.SqlObjectTestMixin,
+                                unittest.TestCase):
+
+  def setUp(self):
+    super(CatalogBulkLookupUnitTest, self).setUp()
+    self.dbc.InitialDataImport()
+    self.sqo_arch = models.Architecture.selectBy(id=1).getOne()
+    self.sqo_osrel = models.OsRelease.selectBy(id=1).getOne()
+    self.sqo_catrel = models.CatalogRelease.selectBy(id=1).getOne()
+    self.triad = (self.sqo_osrel.short_name, self.sqo_arch.name,
+                  self.sqo_catrel.name)
+    for pkgname, registered, paths in (
+        ('CSWfoox', True,
+         ['/opt/csw/lib/libfoo.so.1', '/opt/csw/bin/foo']),
+        ('CSWbarx', True,
+         ['/opt/csw/lib/libbar.so.1', '/opt/csw/lib/64/libfoo.so.1']),
+        # Not fully registered, ignored by lookups.
+        ('CSWbazx', False, ['/opt/csw/bin/baz'])):
+      srv4 = test_base.MakeSrv4(self.sqo_osrel, self.sqo_arch, pkgname,
+                                pkgname, registered_level_two=registered)
+      pkginst = srv4.pkginst
+      models.Srv4FileInCatalog(arch=self.sqo_arch, osrel=self.sqo_osrel,
+                               catrel=self.sqo_catrel, srv4file=srv4,
+                               created_by='test')
+      for path in paths:
+        dirname, basename = os.path.split(path)
+        models.CswFile(basename=basename, path=dirname, line=path,
+                       perm_user=None, perm_group=None, perm_mode=None,
+                       target=None, mimetype=None, machine=None,
+                       pkginst=pkginst, srv4_file=srv4)
+
+  def testGetPathsAndPkgnamesByBasenames(self):
+    c = checkpkg_lib.Catalog()
+    result = c.GetPathsAndPkgnamesByBasenames(
+        ['libfoo.so.1', 'libbar.so.1', 'libbaz.so.1'], *self.triad)
+    self.assertEqual({
+        'libfoo.so.1': {'/opt/csw/lib': ['CSWfoox'],
+                        '/opt/csw/lib/64': ['CSWbarx']},
+        'libbar.so.1': {'/opt/csw/lib': ['CSWbarx']},
+    }, result)
+    self.assertEqual({'/opt/csw/lib': ['CSWbarx']},
+                     c.GetPathsAndPkgnamesByBasename('libbar.so.1', *self.triad))
+
+  def testGetPkgByPaths(self):
+    c = checkpkg_lib.Catalog()
+    result = c.GetPkgByPaths(
+        ['/opt/csw/lib/libfoo.so.1', '/opt/csw/lib/64/libfoo.so.1',
+         '/opt/csw/lib/libbar.so.1', '/opt/csw/bin/libfoo.so.1'], *self.triad)
+    self.assertEqual({
+        '/opt/csw/lib/libfoo.so.1': frozenset(['CSWfoox']),
+        '/opt/csw/lib/64/libfoo.so.1': frozenset(['CSWbarx']),
+        '/opt/csw/lib/libbar.so.1': frozenset(['CSWbarx']),
+        '/opt/csw/bin/libfoo.so.1': frozenset(),
+    }, result)
+    self.assertEqual(frozenset(['CSWfoox']),
+                     c.GetPkgByPath('/opt/csw/bin/foo', *self.triad))
+    self.assertEqual(frozenset(),
+                     c.GetPkgByPath('/opt/csw/bin/baz', *self.triad))
+
+  def testBulkLookupsInChunks(self):
+    saved_query_size = checkpkg_lib.BULK_LOOKUP_QUERY_SIZE
+    checkpkg_lib.BULK_LOOKUP_QUERY_SIZE = 1
+    try:
+      c = checkpkg_lib.Catalog()
+      self.assertEqual(
+          ['libbar.so.1', 'libfoo.so.1'],
+          sorted(c.GetPathsAndPkgnamesByBasenames(
+            ['libfoo.so.1', 'libbar.so.1', 'libbaz.so.1'], *self.triad)))
+      # A path and a basename which exist, but not together.
+      result = c.GetPkgByPaths(
+          ['/opt/csw/lib/libbar.so.1', '/opt/csw/lib/64/libbar.so.1'],
+          *self.triad)
+      self.assertEqual({
+          '/opt/csw/lib/libbar.so.1': frozenset(['CSWbarx']),
+          '/opt/csw/lib/64/libbar.so.1': frozenset(),
+      }, result)
+    finally:
+      checkpkg_lib.BULK_LOOKUP_QUERY_SIZE = saved_query_size
+
+  def testGetFilesInCatalog(self):
+    c = checkpkg_lib.Catalog()
+    self.assertEqual([
+        ('foo', '/opt/csw/bin', 'CSWfoox'),
+        ('libbar.so.1', '/opt/csw/lib', 'CSWbarx'),
+        ('libfoo.so.1', '/opt/csw/lib', 'CSWfoox'),
+        ('libfoo.so.1', '/opt/csw/lib/64', 'CSWbarx'),
+    ], sorted(c.GetFilesInCatalog(*self.triad)))
+
+  def testAssignmentAndCatalogLineInOneTransaction(self):
+    c = checkpkg_lib.Catalog()
+    sqo_srv4 = models.Srv4FileStats.selectBy(md5_sum='CSWfoox').getOne()
+    c.RemoveSrv4(sqo_srv4, *self.triad)
+    revision = c.GetCatalogRevision(*self.triad)
+
+    def FailingAddCatalogLines(*args, **kwargs):
+      raise sqlobject.dberrors.OperationalError('disk full')
+
+    saved_add_catalog_lines = models.AddCatalogLines
+    models.AddCatalogLines = FailingAddCatalogLines
+    try:
+      self.assertRaises(sqlobject.dberrors.OperationalError,
+                        c.AddSrv4ToCatalog, sqo_srv4, *self.triad)
+    finally:
+      models.AddCatalogLines = saved_add_catalog_lines
+    self.assertEqual(frozenset(),
+                     c.GetPkgByPath('/opt/csw/bin/foo', *self.triad))
+    self.assertEqual(revision, c.GetCatalogRevision(*self.triad))
+
+  def testFileIndex(self):
+    directory = tempfile.mkdtemp(prefix='checkpkg_lib_test-')
+    try:
+      store = catalog_file_index.FileIndexStore(directory)
+      c = checkpkg_lib.Catalog(file_index_store=store)
+      revision = store.Build(c, *self.triad)
+      self.assertEqual(c.GetCatalogRevision(*self.triad), revision)
+      file_index = store.Open(*(self.triad + (revision,)))
+      self.assertEqual(
+          {'/opt/csw/lib': ['CSWfoox'], '/opt/csw/lib/64': ['CSWbarx']},
+          file_index.GetPathsAndPkgnamesByBasename('libfoo.so.1'))
+      self.assertEqual(frozenset(['CSWfoox']),
+                       file_index.GetPkgByPath('/opt/csw/bin/foo'))
+      file_index.Close()
+      sqo_srv4 = models.Srv4FileStats.selectBy(md5_sum='CSWfoox').getOne()
+      # A change made without the store, e.g. on another host, leaves the
+      # index in place, but it's out of date.
+      checkpkg_lib.Catalog().RemoveSrv4(sqo_srv4, *self.triad)
+      new_revision = c.GetCatalogRevision(*self.triad)
+      self.assertEqual(revision + 1, new_revision)
+      self.assertEqual(None, store.Open(*(self.triad + (new_revision,))))
+      revision = store.Build(c, *self.triad)
+      file_index = store.Open(*(self.triad + (revision,)))
+      self.assertEqual(frozenset(),
+                       file_index.GetPkgByPath('/opt/csw/bin/foo'))
+      file_index.Close()
+      c.AddSrv4ToCatalog(sqo_srv4, *self.triad)
+      self.assertEqual(None, store.Open(*self.triad))
+    finally:
+      shutil.rmtree(directory)
+
+
+class CatalogBulkAssignmentUnitTest(test_base.SqlObjectTestMixin,
+                                    unittest.TestCase):
+
+  def setUp(self):
+    super(CatalogBulkAssignmentUnitTest, self).setUp()
+    self.dbc.InitialDataImport()
+    self.sqo_arch = models.Architecture.selectBy(name='sparc').getOne()
+    self.sqo_osrel = models.OsRelease.selectBy(id=1).getOne()
+    self.sqo_catrel = models.CatalogRelease.selectBy(id=1).getOne()
+    self.triad = (self.sqo_osrel.short_name, self.sqo_arch.name,
+                  self.sqo_catrel.name)
+
+  def MakeSrv4(self, md5_sum, pkgname, catalogname, registered=True):
+    models.CatalogGenData(md5_sum=md5_sum, deps='[]', i_deps='[]',
+                          pkgname=pkgname, pkginfo_name=catalogname)
+    return test_base.MakeSrv4(
+        self.sqo_osrel, self.sqo_arch, pkgname, md5_sum,
+        basename="%s.pkg" % md5_sum, catalogname=catalogname,
+        registered_level_two=registered)
+
+  def GetCatalogMd5Sums(self):
+    res = models.Srv4FileInCatalog.select(sqlobject.AND(
+      models.Srv4FileInCatalog.q.arch==self.sqo_arch,
+      models.Srv4FileInCatalog.q.osrel==self.sqo_osrel,
+      models.Srv4FileInCatalog.q.catrel==self.sqo_catrel))
+    return sorted(x.srv4file.md5_sum for x in res)
+
+  def testAddToEmptyCatalog(self):
+    c = checkpkg_lib.Catalog()
+    srv4s = [self.MakeSrv4('foo-1', 'CSWfoo', 'foo'),
+             self.MakeSrv4('bar-1', 'CSWbar', 'bar')]
+    results = c.AddSrv4sToCatalog(srv4s, *self.triad, who='tester')
+    self.assertEqual(
+        [{'md5_sum': 'foo-1', 'status': 'added', 'removed': []},
+         {'md5_sum': 'bar-1', 'status': 'added', 'removed': []}], results)
+    self.assertEqual(['bar-1', 'foo-1'], self.GetCatalogMd5Sums())
+    sqo_triad = (self.sqo_osrel, self.sqo_arch, self.sqo_catrel)
+    self.assertEqual(1, models.GetCatalogRevision(*sqo_triad))
+    # Adding the same packages again changes nothing.
+    results = c.AddSrv4sToCatalog(srv4s, *self.triad)
+    self.assertEqual(['present', 'present'], [x['status'] for x in results])
+    self.assertEqual(['bar-1', 'foo-1'], self.GetCatalogMd5Sums())
+    self.assertEqual(1, models.GetCatalogRevision(*sqo_triad))
+    c.RemoveSrv4(srv4s[0], *self.triad, who='tester')
+    self.assertEqual(2, models.GetCatalogRevision(*sqo_triad))
+    self.assertEqual(
+        [(1, 'add', 'foo-1', 'tester'), (1, 'add', 'bar-1', 'tester'),
+         (2, 'remove', 'foo-1', 'tester')],
+        [(x[0], x[1], x[2], x[5])
+         for x in models.GetCatalogChanges(*(sqo_triad + (0,)))])
+
+  def testReplacesConflictingPackages(self):
+    c = checkpkg_lib.Catalog()
+    c.AddSrv4ToCatalog(self.MakeSrv4('foo-1', 'CSWfoo', 'foo'), *self.triad)
+    c.AddSrv4ToCatalog(self.MakeSrv4('bar-1', 'CSWbar', 'bar'), *self.triad)
+    c.AddSrv4ToCatalog(self.MakeSrv4('baz-1', 'CSWbaz', 'baz'), *self.triad)
+    srv4s = [
+        # Same catalogname as foo-1.
+        self.MakeSrv4('foo-2', 'CSWfoo-new', 'foo'),
+        # Same pkgname as bar-1.
+        self.MakeSrv4('bar-2', 'CSWbar', 'bar_new'),
+        # Not registered.
+        self.MakeSrv4('baz-2', 'CSWbaz', 'baz', registered=False),
+    ]
+    results = c.AddSrv4sToCatalog(srv4s, *self.triad)
+    self.assertEqual(['foo-1'], results[0]['removed'])
+    self.assertEqual(['bar-1'], results[1]['removed'])
+    self.assertEqual('error', results[2]['status'])
+    self.assertEqual(['bar-2', 'baz-1', 'foo-2'], self.GetCatalogMd5Sums())
+
+  def testLaterPackageWins(self):
+    c = checkpkg_lib.Catalog()
+    c.AddSrv4ToCatalog(self.MakeSrv4('foo-1', 'CSWfoo', 'foo'), *self.triad)
+    srv4s = [self.MakeSrv4('foo-2', 'CSWfoo', 'foo'),
+             self.MakeSrv4('foo-3', 'CSWfoo', 'foo')]
+    results = c.AddSrv4sToCatalog(srv4s, *self.triad)
+    self.assertEqual(
+        [{'md5_sum': 'foo-2', 'status': 'superseded', 'removed': ['foo-1']},
+         {'md5_sum': 'foo-3', 'status': 'added', 'removed': []}], results)
+    self.assertEqual(['foo-3'], self.GetCatalogMd5Sums())
+    lines = models.GetCatalogLines(
+        self.sqo_osrel, self.sqo_arch, self.sqo_catrel)
+    self.assertEqual(['foo-3'], [cjson.decode(x)[4] for x in lines])
+    c.RemoveSrv4(models.Srv4FileStats.selectBy(md5_sum='foo-3').getOne(),
+                 *self.triad)
+    self.assertEqual([], models.GetCatalogLines(
+        self.sqo_osrel, self.sqo_arch, self.sqo_catrel))
+
+  def testWrongArchitecture(self):
+    c = checkpkg_lib.Catalog()
+    self.assertRaises(checkpkg_lib.CatalogDatabaseError,
+                      c.AddSrv4sToCatalog, [], 'SunOS5.10', 'all', 'unstable')
+
+
 class ExtractorsUnitTest(unittest.TestCase):
 
   def testExtractDescriptionFromGoodData(self):
@@ -4,8 +4,10 @@ import hashlib
 import io
 import json
 import logging
+import multiprocessing
 import optparse
 import os
+import resource
 import sys
 import collections
 import mmap
@@ -25,42 +27,70 @@ from lib.python import rest
 from lib.python import representations
 
 
+class Error(errors.Error):
+  """Generic error."""
+
+
+def MakeRestClient(config=None):
+  if config is None:
+    config = configuration.GetConfig()
+  username, password = rest.GetUsernameAndPassword()
+  return rest.RestClient(
+      pkgdb_url=config.get('rest', 'pkgdb'),
+      releases_url=config.get('rest', 'releases'),
+      username=username,
+      password=password)
+
+
 class ElfExtractor(object):
 
   sh_type2name = {'SHT_SUNW_syminfo': 'syminfo', 'SHT_DYNSYM': 'symbols',
                   'SHT_GNU_verneed': 'verneed', 'SHT_GNU_verdef': 'verdef',
                   'SHT_GNU_versym': 'versym', 'SHT_DYNAMIC': 'dynamic'}
 
-  def __init__(self, binary_path, debug=False):
+  def __init__(self, binary_path, debug=False, rest_client=None):
     self.debug = debug
     self._binary_path = binary_path
-    self.config = configuration.GetConfig()
-    username, password = rest.GetUsernameAndPassword()
-    self.rest_client = rest.RestClient(
-        pkgdb_url=self.config.get('rest', 'pkgdb'),
-        releases_url=self.config.get('rest', 'releases'),
-        username=username,
-        password=password)
-    fd = open(self._binary_path, 'rb')
-    self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.PROT_READ)
+    # Only needed to save elfdump data, so it's created on first use.
+    self._rest_client = rest_client
+    with open(self._binary_path, 'rb') as fd:
+      self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.PROT_READ)
     self._elffile = ELFFile(self._mmap)
+    self._md5_sum = None
+    self._sections = None
+
+  @property
+  def rest_client(self):
+    if self._rest_client is None:
+      self._rest_client = MakeRestClient()
+    return self._rest_client
+
+  def Close(self):
+    if self._mmap is not None:
+      self._mmap.close()
+      self._mmap = None
+      self._elffile = None
 
   def _compute_md5_sum(self):
-    md5_hash = hashlib.md5()
-    md5_hash.update(self._mmap)
-    return md5_hash.hexdigest()
+    if self._md5_sum is None:
+      md5_hash = hashlib.md5()
+      md5_hash.update(self._mmap)
+      self._md5_sum = md5_hash.hexdigest()
+    return self._md5_sum
 
   def _get_sections_of_interest(self, *names):
     """ Find and returns the given sections based on their short names
     """
-    sections = {}
-    for section in self._elffile.iter_sections():
-      if section.header['sh_type'] in ElfExtractor.sh_type2name:
-        name = ElfExtractor.sh_type2name[section.header['sh_type']]
-        if name in names:
-          sections[name] = section
-
-    return sections
+    if self._sections is None:
+      # The section headers are only walked once per binary.
+      self._sections = {}
+      for section in self._elffile.iter_sections():
+        if section.header['sh_type'] in ElfExtractor.sh_type2name:
+          name = ElfExtractor.sh_type2name[section.header['sh_type']]
+          self._sections[name] = section
+    return dict((name, section)
+                for name, section in self._sections.iteritems()
+                if name in names)
 
   def _describe_symbol_shndx(self, shndx):
     """ We use our own instead of the one provided by pyelftools.
@@ -218,6 +248,132 @@ class ElfExtractor(object):
       e_machine = 'EM_NONE'
     return ENUM_E_MACHINE[e_machine]
 
+  def Analyze(self):
+    """Collects everything the indexer needs to know about the binary.
+
+    The binary is opened, hashed and parsed once. The elfdump data is saved
+    as a blob; the rest is returned:
+
+      {'md5_sum': ..., 'machine_id': ..., 'dump_info': ...}
+
+    where dump_info is the return value of CollectBinaryDumpinfo().
+    """
+    try:
+      return {'md5_sum': self.CollectBinaryElfinfo(),
+              'machine_id': self.GetMachineIdOfBinary(),
+              'dump_info': self.CollectBinaryDumpinfo()}
+    finally:
+      self.Close()
+
+
+# The rest client of a worker process of the ElfExtractorPool. Each worker
+# builds it once and reuses it for all the binaries it processes.
+_worker_rest_client = None
+
+
+def _InitPoolWorker(memory_limit_mb, rest_client_factory):
+  global _worker_rest_client
+  if memory_limit_mb:
+    limit = memory_limit_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+  _worker_rest_client = rest_client_factory()
+
+
+def _CollectBinaryElfinfoInWorker(binary_path):
+  extractor = ElfExtractor(binary_path, rest_client=_worker_rest_client)
+  try:
+    return extractor.CollectBinaryElfinfo()
+  finally:
+    extractor.Close()
+
+
+def _AnalyzeBinaryInWorker(binary_path):
+  extractor = ElfExtractor(binary_path, rest_client=_worker_rest_client)
+  return extractor.Analyze()
+
+
+class ElfExtractorPool(object):
+  """Runs ElfExtractor in a set of long-lived worker processes.
+
+  Starting a new interpreter for every binary means re-importing pyelftools
+  and re-reading the configuration each time, which dominates the indexing
+  time of packages with many binaries. The workers of this pool are started
+  once and then reused for all binaries of all packages indexed by the
+  process.
+
+  With workers=0, binaries are processed sequentially in the calling process.
+  """
+
+  def __init__(self, workers, memory_limit_mb=None, rest_client_factory=None):
+    if rest_client_factory is None:
+      rest_client_factory = MakeRestClient
+    self.workers = workers
+    self._pool = None
+    if workers:
+      self._pool = multiprocessing.Pool(
+          workers, _InitPoolWorker, (memory_limit_mb, rest_client_factory))
+    else:
+      _InitPoolWorker(None, rest_client_factory)
+
+  def CollectBinaryElfinfo(self, binary_paths):
+    """Returns a list of md5 sums, in the order of binary_paths."""
+    if self._pool is None:
+      return map(_CollectBinaryElfinfoInWorker, binary_paths)
+    return self._pool.map(_CollectBinaryElfinfoInWorker, binary_paths)
+
+  def AnalyzeBinaries(self, binary_paths):
+    """Returns a list of ElfExtractor.Analyze() results.
+
+    The results are in the order of binary_paths.
+    """
+    if self._pool is None:
+      return map(_AnalyzeBinaryInWorker, binary_paths)
+    return self._pool.map(_AnalyzeBinaryInWorker, binary_paths)
+
+  def Close(self):
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+
+_shared_pool = None
+
+
+def GetSharedElfExtractorPool(config=None):
+  """Returns the pool shared by all packages indexed in this process.
+
+  collect_pkg_metadata.py indexes a batch of packages in one process, see
+  package_stats.PACKAGES_PER_PROCESS. The pool has to be closed with
+  CloseSharedElfExtractorPool() before the process exits.
+
+  The pool is configured by the 'elf_workers' and 'elf_worker_memory_mb'
+  options from the 'indexing' section of the configuration.
+  """
+  global _shared_pool
+  if _shared_pool is None:
+    if config is None:
+      config = configuration.GetConfig()
+    workers = 1
+    memory_limit_mb = None
+    if config.has_option('indexing', 'elf_workers'):
+      workers = config.getint('indexing', 'elf_workers')
+    if config.has_option('indexing', 'elf_worker_memory_mb'):
+      memory_limit_mb = config.getint('indexing', 'elf_worker_memory_mb')
+    if workers < 0:
+      raise Error("elf_workers must not be negative, got %r." % workers)
+    logging.debug("Starting an ElfExtractorPool with %d workers, "
+                  "memory limit: %s MB", workers, memory_limit_mb)
+    _shared_pool = ElfExtractorPool(workers, memory_limit_mb)
+  return _shared_pool
+
+
+def CloseSharedElfExtractorPool():
+  global _shared_pool
+  if _shared_pool is not None:
+    _shared_pool.Close()
+    _shared_pool = None
+
 
 if __name__ == '__main__':
   parser = optparse.OptionParser()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python2.6
+
+import hashlib
+import sys
+import unittest
+
+from lib.python import collect_binary_elfinfo
+
+
+class FakeRestClient(object):
+
+  def __init__(self):
+    self.blobs = {}
+
+  def BlobExists(self, tag, md5_sum):
+    return (tag, md5_sum) in self.blobs
+
+  def SaveBlob(self, tag, md5_sum, data):
+    self.blobs[(tag, md5_sum)] = data
+
+
+class ElfExtractorPoolUnitTest(unittest.TestCase):
+
+  def testInProcess(self):
+    rest_client = FakeRestClient()
+    pool = collect_binary_elfinfo.ElfExtractorPool(
+        0, rest_client_factory=lambda: rest_client)
+    with open(sys.executable, 'rb') as fd:
+      expected_md5 = hashlib.md5(fd.read()).hexdigest()
+    self.assertEqual([expected_md5],
+                     pool.CollectBinaryElfinfo([sys.executable]))
+    self.assertTrue(('elfdump', expected_md5) in rest_client.blobs)
+    pool.Close()
+
+  def testAnalyzeBinaries(self):
+    rest_client = FakeRestClient()
+    pool = collect_binary_elfinfo.ElfExtractorPool(
+        0, rest_client_factory=lambda: rest_client)
+    with open(sys.executable, 'rb') as fd:
+      expected_md5 = hashlib.md5(fd.read()).hexdigest()
+    extractor = collect_binary_elfinfo.ElfExtractor(
+        sys.executable, rest_client=rest_client)
+    expected_machine_id = extractor.GetMachineIdOfBinary()
+    expected_dump_info = extractor.CollectBinaryDumpinfo()
+    extractor.Close()
+    results = pool.AnalyzeBinaries([sys.executable])
+    pool.Close()
+    self.assertEqual(
+        [{'md5_sum': expected_md5,
+          'machine_id': expected_machine_id,
+          'dump_info': expected_dump_info}],
+        results)
+    self.assertTrue(('elfdump', expected_md5) in rest_client.blobs)
+
+  def testWorkersKeepOrder(self):
+    pool = collect_binary_elfinfo.ElfExtractorPool(
+        2, rest_client_factory=FakeRestClient)
+    try:
+      md5_sums = pool.CollectBinaryElfinfo([sys.executable] * 3)
+    finally:
+      pool.Close()
+    self.assertEqual(3, len(md5_sums))
+    self.assertEqual(1, len(set(md5_sums)))
+
+
+if __name__ == '__main__':
+  unittest.main()
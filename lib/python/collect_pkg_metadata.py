@@ -1,9 +1,13 @@
 #!/opt/csw/bin/python2.6
 
 import cjson
+import collections
+import contextlib
 import copy
 import datetime
-import hashlib
+import errno
+import gzip
+import itertools
 import logging
 import optparse
 import os
@@ -12,15 +16,21 @@ import shutil
 import sys
 import tempfile
 import time
+from StringIO import StringIO
 
+from lib.python import collect_binary_elfinfo
 from lib.python import common_constants
 from lib.python import configuration
+from lib.python import content_scanner
+from lib.python import file_classifier
+from lib.python import file_hash
 from lib.python import opencsw
 from lib.python import overrides
 from lib.python import pkgmap
 from lib.python import rest
 from lib.python import sharedlib_utils
 from lib.python import shell
+from lib.python import srv4_stream
 from lib.python import util
 from lib.python import representations
 
@@ -53,6 +63,17 @@ BAD_CONTENT_REGEXES = (
 )
 
 
+# Payload files that are read as package metadata.
+OVERRIDES_DIR = "root/opt/csw/share/checkpkg/overrides/"
+PAYLOAD_DIRS = ("root/", "reloc/")
+# Stages of reading a package, see Unpacker.stage_timings. The time spent
+# waiting for the classification of files is not counted as reading.
+STAGE_READ = "read"
+STAGE_CLASSIFY = "classify"
+STAGE_ELF = "elf"
+STAGES = (STAGE_READ, STAGE_CLASSIFY, STAGE_ELF)
+
+
 class Error(Exception):
   """Generic error."""
 
@@ -74,7 +95,7 @@ class Unpacker(object):
     self.pkg_path = pkg_path
     self._work_dir = None
     self._admin_file = None
-    self._gunzipped_path = None
+    self._datastream_path = None
     self._md5_sum = None
     self._stat = None
     self._mtime = None
@@ -85,6 +106,16 @@ class Unpacker(object):
     self._files_metadata = None
     self._binaries = None
     self._file_paths = None
+    # Package files other than the payload, e.g. pkginfo or install/depend.
+    self._package_files = None
+    # Paths of files matching content_scanner regexes, by regex.
+    self._bad_paths = None
+    # ElfExtractor.Analyze() results by binary path, see GetFilesMetadata().
+    self._elf_analysis = None
+    # Seconds spent in each of STAGES, and the number of files classified
+    # by each file_classifier method; filled in when the package is read.
+    self.stage_timings = None
+    self.classification_methods = None
     self.config = configuration.GetConfig()
     username, password = rest.GetUsernameAndPassword()
     self.rest_client = rest.RestClient(
@@ -92,6 +123,14 @@ class Unpacker(object):
         releases_url=self.config.get('rest', 'releases'),
         username=username,
         password=password)
+    skip_mime_types = ()
+    if self.config.has_option('indexing', 'bad_content_skip_mime_types'):
+      skip_mime_types = [
+          x.strip() for x in self.config.get(
+            'indexing', 'bad_content_skip_mime_types').split(',')
+          if x.strip()]
+    self.content_scanner = content_scanner.ContentScanner(
+        BAD_CONTENT_REGEXES, skip_mime_types=skip_mime_types)
 
   def __del__(self):
     self.Cleanup()
@@ -122,17 +161,8 @@ class Unpacker(object):
   @property
   def md5_sum(self):
     if self._md5_sum is None:
-      logging.debug("md5_sum: reading file %r", self.pkg_path)
-      md5_hash = hashlib.md5()
-      with open(self.pkg_path) as fp:
-        # Chunking the data reads to avoid reading huge packages into memory at
-        # once.
-        chunk_size = 2 * 1024 * 1024
-        data = fp.read(chunk_size)
-        while data:
-          md5_hash.update(data)
-          data = fp.read(chunk_size)
-      self._md5_sum = md5_hash.hexdigest()
+      self._md5_sum = file_hash.GetFileHasher(self.config).Md5Sum(
+          self.pkg_path)
     return self._md5_sum
 
   @property
@@ -157,84 +187,213 @@ class Unpacker(object):
       self._mtime = datetime.datetime(*t[:6])
     return self._mtime
 
-  def _Gunzip(self):
-    """Gunzipping the package."""
+  def _OpenDatastream(self):
     gzip_suffix = ".gz"
     pkg_suffix = ".pkg"
-    if self.pkg_path.endswith("%s%s" % (pkg_suffix, gzip_suffix)):
-      # Causing the class to stat the .gz file.  This call throws away the
-      # result, but the result will be cached as a object member.
-      self.mtime
-      self.md5_sum
-      base_name = os.path.split(self.pkg_path)[1][:(-len(gzip_suffix))]
-      self._gunzipped_path = os.path.join(self.work_dir, base_name)
-      with open(self._gunzipped_path, 'w') as gunzipped_file:
-        args = ["gunzip", "-f", "-c", self.pkg_path]
-        unused_ret_code, _, _ = shell.ShellCommand(args, stdout=gunzipped_file)
-    elif self.pkg_path.endswith(pkg_suffix):
-      self._gunzipped_path = self.pkg_path
-    else:
+    if not (self.pkg_path.endswith("%s%s" % (pkg_suffix, gzip_suffix)) or
+            self.pkg_path.endswith(pkg_suffix)):
       raise Error("The file name should end in either "
                   "%s or %s, but it's %s."
                   % (gzip_suffix, pkg_suffix, repr(self.pkg_path)))
-
-  @property
-  def gunzipped_path(self):
-    if self._gunzipped_path is None:
-      self._Gunzip()
-    return self._gunzipped_path
+    return srv4_stream.OpenDatastream(self.pkg_path)
 
   @property
   def pkgname(self):
     """It's necessary to figure out the pkgname from the .pkg file.
-    # nawk 'NR == 2 {print $1; exit;} $f
+
+    Only the datastream header is read.
     """
     if self._pkgname is None:
-      gunzipped_path = self.gunzipped_path
-      args = ["nawk", "NR == 2 {print $1; exit;}", gunzipped_path]
-      ret_code, stdout, stderr = shell.ShellCommand(args)
-      self._pkgname = stdout.strip()
+      with contextlib.closing(self._OpenDatastream()) as fd:
+        pkgnames = srv4_stream.Srv4Reader(fd).pkgnames
+      if len(pkgnames) != 1:
+        raise Error("Exactly one package in the package stream is expected; "
+                    "actual: %s." % pkgnames)
+      self._pkgname = pkgnames[0]
       logging.debug("GetPkgname(): %s", repr(self.pkgname))
     return self._pkgname
 
-  def DirsInWorkdir(self):
-    """Directories present in self.work_dir."""
-    paths = os.listdir(self.work_dir)
-    dirs = []
-    for p in paths:
-      abspath = os.path.join(self.work_dir, p)
-      if os.path.isdir(abspath):
-        dirs.append(abspath)
-    return dirs
-
-  def _TransformToDir(self):
-    """Transforms the file to the directory format.
-
-    This uses the Pkgtrans function at the top, because pkgtrans behaves
-    differently on Solaris 8 and 10.  Having our own implementation helps
-    achieve consistent behavior.
+  def _ReadPackage(self):
+    """Reads the package in a single pass over the datastream.
+
+    The package files, such as pkginfo, pkgmap and install/*, are kept in
+    memory. Payload files are scanned as they are read from the stream, and
+    classified by the shared FileClassifierPool while the following files
+    are read. Only binaries are kept on disk, because pyelftools needs them
+    by path. They end up where pkgtrans would put them.
     """
     if not self._transformed:
-      gunzipped_path = self.gunzipped_path
+      # Causing the class to stat the file. The result will be cached as
+      # a object member.
+      self.mtime
+      self.md5_sum
       pkgname = self.pkgname
-      args = [os.path.join(os.path.dirname(__file__),
-                           "..", "..", "bin", "custom-pkgtrans"),
-              gunzipped_path, self.work_dir, pkgname]
-      shell.ShellCommand(args, allow_error=False)
-      dirs = self.DirsInWorkdir()
-      if len(dirs) != 1:
-        raise Error("Exactly one package in the package stream is expected; actual: "
-                    "%s." % (dirs))
-      self._transformed = True
       self._dir_format_base_dir = os.path.join(self.work_dir, pkgname)
+      self._package_files = {}
+      self._file_paths = []
+      self._files_metadata = []
+      self._bad_paths = {}
+      self.stage_timings = dict.fromkeys(STAGES, 0.0)
+      self.classification_methods = {}
+      written_paths = set()
+      classifier_pool = file_classifier.GetSharedFileClassifierPool(
+          self.config)
+      pending = collections.deque()
+      start_time = time.time()
+      with contextlib.closing(self._OpenDatastream()) as fd:
+        for entry in srv4_stream.Srv4Reader(fd).IterEntries():
+          if not entry.IsRegularFile():
+            continue
+          if not entry.path.startswith(PAYLOAD_DIRS):
+            self._package_files[entry.path] = entry.read()
+            continue
+          if self._ReadPayloadFile(entry, classifier_pool, pending):
+            written_paths.add(entry.path)
+          while len(pending) > classifier_pool.max_pending:
+            self._FinishClassification(*pending.popleft())
+      while pending:
+        self._FinishClassification(*pending.popleft())
+      self.stage_timings[STAGE_READ] = (
+          time.time() - start_time - self.stage_timings[STAGE_CLASSIFY])
+      self.CheckPkgpathExists()
+      start_time = time.time()
+      binary_abs_paths = self._KeepBinaries(written_paths)
+      self._AnalyzeBinaries(binary_abs_paths)
+      self.stage_timings[STAGE_ELF] = time.time() - start_time
+      self._files_metadata = [
+          x._replace(machine_id=self._elf_analysis[x.path]['machine_id'])
+          if x.path in self._elf_analysis else x
+          for x in self._files_metadata]
+      logging.debug(
+          "%s: %d files, timings: %s, classified by: %s",
+          pkgname, len(self._files_metadata),
+          ", ".join("%s %.3fs" % (x, self.stage_timings[x]) for x in STAGES),
+          self.classification_methods)
+      self._transformed = True
+
+  def _ReadPayloadFile(self, entry, classifier_pool, pending):
+    """Collects the metadata of a single file from the payload.
 
-  def GetPkginfoFilename(self):
-    return os.path.join(self._dir_format_base_dir, "pkginfo")
+    The file is read in chunks, it's never held in memory as a whole. It's
+    submitted to the classifier pool and added to pending; its mime type is
+    filled in by _FinishClassification(). If some mime types aren't scanned
+    for bad content, the mime type is waited for before the file is scanned.
+    ELF files are written to disk, since they might be binaries;
+    _KeepBinaries() removes the others.
+
+    Returns True if the file has been written to disk.
+    """
+    self._file_paths.append(entry.path)
+    head = entry.read(util.MAGIC_BUFFER_SIZE)
+    path = util.StripRe(entry.path, util.ROOT_RE)
+    result = classifier_pool.Submit(path, head)
+    mime_type = None
+    if self.content_scanner.skip_mime_types:
+      start_time = time.time()
+      mime_type, unused_method = result.get()
+      self.stage_timings[STAGE_CLASSIFY] += time.time() - start_time
+    self._files_metadata.append(
+        representations.FileMetadata(path, None, None))
+    kept_chunks = None
+    if entry.path.startswith(OVERRIDES_DIR):
+      kept_chunks = []
+    spill_fd = None
+    if head.startswith(file_classifier.ELF_MAGIC):
+      spill_fd = self._CreatePayloadFile(entry.path)
+    def Chunks():
+      for chunk in itertools.chain(
+          [head], entry.IterChunks(self.content_scanner.chunk_size)):
+        if spill_fd:
+          spill_fd.write(chunk)
+        if kept_chunks is not None:
+          kept_chunks.append(chunk)
+        yield chunk
+    chunks = Chunks()
+    try:
+      regexes = self.content_scanner.ScanChunks(chunks, mime_type)
+      # The scanner stops reading once all the regexes have been found, or
+      # doesn't start if the mime type is skipped.
+      for unused_chunk in chunks:
+        pass
+    finally:
+      if spill_fd:
+        spill_fd.close()
+    if kept_chunks is not None:
+      self._package_files[entry.path] = "".join(kept_chunks)
+    pending.append((len(self._files_metadata) - 1, entry.path, result, regexes))
+    return spill_fd is not None
+
+  def _CreatePayloadFile(self, entry_path):
+    abs_path = self.MakeAbsolutePath(entry_path)
+    if not os.path.isdir(os.path.dirname(abs_path)):
+      os.makedirs(os.path.dirname(abs_path))
+    return open(abs_path, "wb")
+
+  def _KeepBinaries(self, written_paths):
+    """Makes sure that exactly the binaries are on disk.
+
+    libmagic has the last word on which files are binaries. Written files
+    which aren't binaries are removed, and binaries which haven't been
+    written, because they don't start with an ELF header, are read from the
+    datastream again.
+
+    Returns a list of (path, absolute path) tuples of the binaries.
+    """
+    binary_abs_paths = []
+    missing_paths = set()
+    for entry_path, file_info in zip(self._file_paths, self._files_metadata):
+      abs_path = self.MakeAbsolutePath(entry_path)
+      is_binary = sharedlib_utils.IsBinary(file_info._asdict(),
+                                           check_consistency=False)
+      if is_binary:
+        binary_abs_paths.append((file_info.path, abs_path))
+        if entry_path not in written_paths:
+          missing_paths.add(entry_path)
+      elif entry_path in written_paths:
+        os.unlink(abs_path)
+    if missing_paths:
+      logging.warning("%s: libmagic reports binaries without an ELF header, "
+                      "reading them again: %s",
+                      self.pkgname, sorted(missing_paths))
+      with contextlib.closing(self._OpenDatastream()) as fd:
+        for entry in srv4_stream.Srv4Reader(fd).IterEntries():
+          if entry.path in missing_paths and entry.IsRegularFile():
+            with contextlib.closing(
+                self._CreatePayloadFile(entry.path)) as spill_fd:
+              for chunk in entry.IterChunks(self.content_scanner.chunk_size):
+                spill_fd.write(chunk)
+    return binary_abs_paths
+
+  def _CountClassification(self, method):
+    self.classification_methods.setdefault(method, 0)
+    self.classification_methods[method] += 1
+
+  def _FinishClassification(self, index, entry_path, result, regexes):
+    """Records the mime type and the bad content of a payload file."""
+    start_time = time.time()
+    mime_type, method = result.get()
+    self.stage_timings[STAGE_CLASSIFY] += time.time() - start_time
+    self._CountClassification(method)
+    file_info = self._files_metadata[index]._replace(mime_type=mime_type)
+    self._files_metadata[index] = file_info
+    for regex in regexes:
+      self._bad_paths.setdefault(regex, []).append(entry_path)
+
+  def _OpenPackageFile(self, *path_parts):
+    """Opens a package file which was read from the datastream.
+
+    Raises IOError if the package doesn't contain the file, just like open().
+    """
+    self._ReadPackage()
+    path = os.path.join(*path_parts)
+    if path not in self._package_files:
+      raise IOError(errno.ENOENT, "No such file in the package", path)
+    return StringIO(self._package_files[path])
 
   def GetParsedPkginfo(self):
     if self._pkginfo_dict is None:
-      with open(self.GetPkginfoFilename(), "r") as pkginfo_fd:
-        self._pkginfo_dict = opencsw.ParsePkginfo(pkginfo_fd)
+      self._pkginfo_dict = opencsw.ParsePkginfo(
+          self._OpenPackageFile("pkginfo"))
     return self._pkginfo_dict
 
   def GetBasedir(self):
@@ -270,20 +429,6 @@ class Unpacker(object):
     basic_stats["size"] = self.size
     return basic_stats
 
-  def _GetOverridesStream(self, file_path):
-    # This might potentially cause a file descriptor leak, but I'm not going to
-    # worry about that at this stage.
-    # NB, the whole catalog run doesn't seem to be suffering. (~2500 packages)
-    #
-    # There is a race condition here, but it's executing sequentially, I don't
-    # expect any concurrency problems.
-    if os.path.isfile(file_path):
-      logging.debug("Opening %s override file." % repr(file_path))
-      return open(file_path, "r")
-    else:
-      logging.debug("Override file %s not found." % repr(file_path))
-      return None
-
   def _ParseOverridesStream(self, stream):
     override_list = []
     for line in stream:
@@ -297,17 +442,13 @@ class Unpacker(object):
     override_list = []
     catalogname = self.GetCatalogname()
     override_paths = (
-        [self._dir_format_base_dir,
-         "root",
-         "opt/csw/share/checkpkg/overrides", catalogname],
-        [self._dir_format_base_dir,
-         "install",
-         "checkpkg_override"],
+        [OVERRIDES_DIR, catalogname],
+        ["install", "checkpkg_override"],
     )
     for override_path in override_paths:
       file_path = os.path.join(*override_path)
       try:
-        with open(file_path, "r") as stream:
+        with contextlib.closing(self._OpenPackageFile(file_path)) as stream:
           override_list.extend(self._ParseOverridesStream(stream))
       except IOError as e:
         logging.debug('Could not open %r: %s' % (file_path, e))
@@ -332,9 +473,9 @@ class Unpacker(object):
     # carry that information.
     depends = []
     i_depends = []
-    depend_file_path = os.path.join(self._dir_format_base_dir, "install", "depend")
+    depend_file_path = os.path.join("install", "depend")
     try:
-      with open(depend_file_path, "r") as fd:
+      with contextlib.closing(self._OpenPackageFile(depend_file_path)) as fd:
         for line in fd:
           fields = re.split(configuration.WS_RE, line)
           if len(fields) < 2:
@@ -351,27 +492,13 @@ class Unpacker(object):
     return depends, i_depends
 
   def CheckPkgpathExists(self):
-    if not os.path.isdir(self._dir_format_base_dir):
-      raise PackageError("%s does not exist or is not a directory"
-                         % self._dir_format_base_dir)
-
-  def GetPathsInSubdir(self, remove_prefix, subdir):
-    file_paths = []
-    for root, dirs, files in os.walk(os.path.join(self._dir_format_base_dir, subdir)):
-      full_paths = [os.path.join(root, f) for f in files]
-      file_paths.extend([f.replace(remove_prefix, "") for f in full_paths])
-    return file_paths
+    if self._package_files is None or "pkginfo" not in self._package_files:
+      raise PackageError("%s does not contain a package"
+                         % repr(self.pkg_path))
 
   def GetAllFilePaths(self):
     """Returns a list of all paths from the package."""
-    if self._file_paths is None:
-      # Support for relocatable packages
-      basedir = self.GetBasedir()
-      self.CheckPkgpathExists()
-      remove_prefix = "%s/" % self._dir_format_base_dir
-      self._file_paths = self.GetPathsInSubdir(remove_prefix, "root")
-      if self.RelocPresent():
-        self._file_paths += self.GetPathsInSubdir(remove_prefix, "reloc")
+    self._ReadPackage()
     return self._file_paths
 
   def GetFilesMetadata(self):
@@ -384,26 +511,20 @@ class Unpacker(object):
       },
     ]
     """
-    if not self._files_metadata:
-      self.CheckPkgpathExists()
-      self._files_metadata = []
-      files_root = self.GetFilesDir()
-      all_files = self.GetAllFilePaths()
-      file_magic = util.FileMagic()
-      basedir = self.GetBasedir()
-      for file_path in all_files:
-        full_path = unicode(self.MakeAbsolutePath(file_path))
-        file_info = util.GetFileMetadata(file_magic, self._dir_format_base_dir, full_path)
-        # To prevent files from containing the full temporary path.
-        file_info_dict = file_info._asdict()
-        file_info_dict["path"] = util.StripRe(file_path, util.ROOT_RE)
-        file_info = representations.FileMetadata(**file_info_dict)
-        self._files_metadata.append(file_info)
-      file_magic.Close()
+    self._ReadPackage()
     return self._files_metadata
 
+  def _AnalyzeBinaries(self, binary_abs_paths):
+    """Reads each binary once, for machine ids, dump info and elfdump data."""
+    logging.debug("Analyzing %d binaries.", len(binary_abs_paths))
+    elf_pool = collect_binary_elfinfo.GetSharedElfExtractorPool(self.config)
+    results = elf_pool.AnalyzeBinaries([x[1] for x in binary_abs_paths])
+    self._elf_analysis = dict(
+        (path, result)
+        for (path, _), result in zip(binary_abs_paths, results))
+
   def RelocPresent(self):
-    return os.path.exists(os.path.join(self._dir_format_base_dir, "reloc"))
+    return any(x.startswith("reloc/") for x in self.GetAllFilePaths())
 
   def GetFilesDir(self):
     """Returns the subdirectory in which files, are either "reloc" or "root"."""
@@ -437,7 +558,6 @@ class Unpacker(object):
     all its callers are modified to use files_metadata instead.
     """
     if self._binaries is None:
-      self.CheckPkgpathExists()
       files_metadata = self.GetFilesMetadata()
       self._binaries = []
       # The nested for-loop looks inefficient.
@@ -453,12 +573,10 @@ class Unpacker(object):
     basedir = self.GetBasedir()
     binaries_dump_info = []
     for binary in self.ListBinaries():
-      binary_abs_path = os.path.join(
-          self._dir_format_base_dir, self.GetFilesDir(), binary)
+      dump_info = self._elf_analysis[binary]['dump_info']
       if basedir:
         binary = os.path.join(basedir, binary)
-      
-      binaries_dump_info.append(util.GetBinaryDumpInfo(binary_abs_path, binary))
+      binaries_dump_info.append(util.MakeBinaryDumpInfo(binary, dump_info))
 
     return binaries_dump_info
 
@@ -487,11 +605,12 @@ class Unpacker(object):
     has_obsolete_info = False
     obsoleted_syntax_ok = True
     obsoleted_by = []
-    obsoleted_by_path = os.path.join(self._dir_format_base_dir, "install", "obsolete")
+    obsoleted_by_path = os.path.join("install", "obsolete")
 
-    if os.path.exists(obsoleted_by_path):
+    self._ReadPackage()
+    if obsoleted_by_path in self._package_files:
       has_obsolete_info = True
-      with open(obsoleted_by_path, "r") as fd:
+      with contextlib.closing(self._OpenPackageFile(obsoleted_by_path)) as fd:
         for line in fd:
           fields = re.split(configuration.WS_RE, line)
           if len(fields) < 2:
@@ -508,15 +627,32 @@ class Unpacker(object):
     }
 
   def GetPkgmap(self, analyze_permissions=False, strip=None):
-    fd = open(os.path.join(self._dir_format_base_dir, "pkgmap"), "r")
+    fd = self._OpenPackageFile("pkgmap")
     basedir = self.GetBasedir()
     return pkgmap.Pkgmap(fd, analyze_permissions, strip, basedir)
 
+  @property
+  def datastream_path(self):
+    """Path to the uncompressed datastream, for tools that need one."""
+    if self._datastream_path is None:
+      gzip_suffix = ".gz"
+      if self.pkg_path.endswith(gzip_suffix):
+        base_name = os.path.basename(self.pkg_path)[:-len(gzip_suffix)]
+        datastream_path = os.path.join(self.work_dir, base_name)
+        with contextlib.closing(gzip.GzipFile(self.pkg_path, "rb")) as src:
+          with open(datastream_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, srv4_stream.READ_CHUNK_SIZE)
+        self._datastream_path = datastream_path
+      else:
+        self._datastream_path = self.pkg_path
+    return self._datastream_path
+
   def GetPkgchkOutput(self):
-    """Returns: (exit code, stdout, stderr)."""
-    if not self._transformed:
-        self._TransformToDir()
-    args = ["/usr/sbin/pkgchk", "-d", self.work_dir, self.pkgname]
+    """Returns: (exit code, stdout, stderr).
+
+    pkgchk reads the datastream itself, the package isn't unpacked for it.
+    """
+    args = ["/usr/sbin/pkgchk", "-d", self.datastream_path, self.pkgname]
     return shell.ShellCommand(args)
 
   def GetPkgchkData(self):
@@ -529,16 +665,17 @@ class Unpacker(object):
     return data
 
   def GetFilesContaining(self, regex_list):
-    full_paths = self.GetAllFilePaths()
-    files_by_pattern = {}
-    for full_path in full_paths:
-      content = open(self.MakeAbsolutePath(full_path), "rb").read()
-      for regex in regex_list:
-        if re.search(regex, content):
-          if regex not in files_by_pattern:
-            files_by_pattern[regex] = []
-          files_by_pattern[regex].append(full_path)
-    return files_by_pattern
+    """Returns paths of files matching each of the regexes.
+
+    The files are scanned while the package is read, so only the regexes of
+    self.content_scanner can be asked for.
+    """
+    self._ReadPackage()
+    unknown = set(regex_list).difference(self.content_scanner.regexes)
+    if unknown:
+      raise Error("Files have not been scanned for %s." % sorted(unknown))
+    return dict((regex, self._bad_paths[regex])
+                for regex in regex_list if regex in self._bad_paths)
 
   def GetMainStatsStruct(self, binary_md5_sums):
     basic_stats = self.GetBasicStats()
@@ -570,30 +707,15 @@ class Unpacker(object):
 
   def _CollectElfdumpData(self):
     logging.debug("Elfdump data.")
-    binary_md5_sums = []
-    for binary in self.ListBinaries():
-      binary_abs_path = os.path.join(
-          self._dir_format_base_dir, self.GetFilesDir(), binary)
-      args = [os.path.join(os.path.dirname(__file__),
-                           'collect_binary_elfinfo.py'),
-              '--input', binary_abs_path]
-      se = None
-      if self.debug:
-        args.append('--debug')
-        se = sys.stderr
-      ret_code, stdout, stderr = shell.ShellCommand(args, stderr=se)
-      if ret_code:
-        raise ShellCommandError(stderr)
-      binary_data = cjson.decode(stdout)
-      binary_md5_sums.append((binary, binary_data['md5_sum']))
-    return binary_md5_sums
-
+    binaries = self.ListBinaries()
+    # The elfdump data was saved while analyzing the binaries.
+    return [(binary, self._elf_analysis[binary]['md5_sum'])
+            for binary in binaries]
 
   def CollectStats(self, force_unpack):
     if force_unpack or not self.rest_client.BlobExists('pkgstats',
                                                        self.md5_sum):
-      self._Gunzip()
-      self._TransformToDir()
+      self._ReadPackage()
       binary_md5_sums = self._CollectElfdumpData()
       main_struct = self.GetMainStatsStruct(binary_md5_sums)
       self.rest_client.SaveBlob('pkgstats', self.md5_sum, main_struct)
@@ -603,23 +725,30 @@ class Unpacker(object):
 
 if __name__ == '__main__':
   parser = optparse.OptionParser()
-  parser.add_option("-i", "--input", dest="input_file",
-                    help="Input file")
+  parser.add_option("-i", "--input", dest="input_files", action="append",
+                    default=[],
+                    help="Input file, can be given more than once")
   parser.add_option("--force-unpack", dest="force_unpack",
                     action="store_true", default=False)
   parser.add_option("--debug", dest="debug",
                     action="store_true", default=False)
   options, args = parser.parse_args()
-  if not options.input_file:
+  if not options.input_files:
     sys.stdout.write("Please provide an input file name. See --help\n")
     sys.exit(1)
   logging.basicConfig(level=logging.DEBUG)
-  unpacker = Unpacker(options.input_file, debug=options.debug)
-  unpacked = unpacker.CollectStats(force_unpack=options.force_unpack)
-  unpacker.Cleanup()
-  data_back = {
-      "md5_sum": unpacker.md5_sum,
-      "unpacked": bool(unpacked),
-  }
-  # Returning data to the master process.
-  print(cjson.encode(data_back))
+  try:
+    for input_file in options.input_files:
+      unpacker = Unpacker(input_file, debug=options.debug)
+      unpacked = unpacker.CollectStats(force_unpack=options.force_unpack)
+      unpacker.Cleanup()
+      data_back = {
+          "md5_sum": unpacker.md5_sum,
+          "unpacked": bool(unpacked),
+      }
+      # Returning data to the master process, one line per package.
+      print(cjson.encode(data_back))
+      sys.stdout.flush()
+  finally:
+    collect_binary_elfinfo.CloseSharedElfExtractorPool()
+    file_classifier.CloseSharedFileClassifierPool()
@@ -1,7 +1,162 @@
 #!/usr/bin/env python
 
+import _bisect
+import gzip
+import mox
+import os
+import shutil
+import tempfile
 import unittest
 
+from lib.python import collect_binary_elfinfo
+from lib.python import collect_binary_elfinfo_test
+from lib.python import collect_pkg_metadata
+from lib.python import content_scanner
+from lib.python import file_classifier
+from lib.python import file_hash
+from lib.python import rest
+from lib.python import srv4_stream_test
+from lib.python import util
+
+
+class UnpackerUnitTest(mox.MoxTestBase):
+
+  def setUp(self):
+    super(UnpackerUnitTest, self).setUp()
+    self.tmpdir = tempfile.mkdtemp()
+    self.mox.StubOutWithMock(rest, 'GetUsernameAndPassword')
+    rest.GetUsernameAndPassword().AndReturn(('joe', None))
+    self.stubs.Set(file_hash, 'GetFileHasher',
+                   lambda config=None: file_hash.FileHasher())
+    self.stubs.Set(file_classifier, 'GetSharedFileClassifierPool',
+                   lambda config=None: file_classifier.FileClassifierPool(0))
+    self.stubs.Set(collect_binary_elfinfo, 'GetSharedElfExtractorPool',
+                   lambda config=None: collect_binary_elfinfo.ElfExtractorPool(
+                       0, rest_client_factory=(
+                           collect_binary_elfinfo_test.FakeRestClient)))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    super(UnpackerUnitTest, self).tearDown()
+
+  def MakeUnpacker(self, extra_files=()):
+    with open(_bisect.__file__, 'rb') as fd:
+      library = fd.read()
+    files = [
+        ('root/opt/csw/lib/libfoo.so.1', library, 0100755),
+        ('root/opt/csw/share/doc/foo/README',
+         'Installed to /usr' '/local/foo\n', 0100644),
+        ('root/opt/csw/share/checkpkg/overrides/foo',
+         'CSWfoo: file-with-bad-content\n', 0100644),
+    ]
+    files.extend(extra_files)
+    pkg_path = os.path.join(self.tmpdir, 'foo-1.0-SunOS5.10-sparc-CSW.pkg.gz')
+    gz = gzip.GzipFile(pkg_path, 'wb')
+    gz.write(srv4_stream_test.MakeDatastream('CSWfoo', files))
+    gz.close()
+    unpacker = collect_pkg_metadata.Unpacker(pkg_path, debug=False)
+    self.addCleanup(unpacker.Cleanup)
+    return unpacker
+
+  def testReadPackage(self):
+    rest_client = collect_binary_elfinfo_test.FakeRestClient()
+    self.stubs.Set(collect_binary_elfinfo, 'GetSharedElfExtractorPool',
+                   lambda config=None: collect_binary_elfinfo.ElfExtractorPool(
+                       0, rest_client_factory=lambda: rest_client))
+    self.mox.ReplayAll()
+    unpacker = self.MakeUnpacker()
+    self.assertEqual('CSWfoo', unpacker.pkgname)
+    self.assertEqual('foo', unpacker.GetCatalogname())
+    self.assertEqual(
+        ['root/opt/csw/lib/libfoo.so.1',
+         'root/opt/csw/share/doc/foo/README',
+         'root/opt/csw/share/checkpkg/overrides/foo'],
+        unpacker.GetAllFilePaths())
+    self.assertEqual(['opt/csw/lib/libfoo.so.1'], unpacker.ListBinaries())
+    self.assertTrue(unpacker.GetFilesMetadata()[0].machine_id)
+    self.assertEqual(
+        [('CSWcommon', 'CSWcommon common ')], unpacker.GetDependencies()[0])
+    self.assertEqual(
+        [{'pkgname': 'CSWfoo', 'tag_name': 'file-with-bad-content',
+          'tag_info': None}],
+        unpacker.GetOverrides())
+    self.assertEqual(
+        {r'/usr' r'/local': ['root/opt/csw/share/doc/foo/README']},
+        unpacker.GetFilesContaining(collect_pkg_metadata.BAD_CONTENT_REGEXES))
+    self.assertTrue('/opt/csw/bin/foo' in
+                    [x.path for x in unpacker.GetPkgmap().entries])
+    self.assertFalse(unpacker.GetObsoletedBy()['has_obsolete_info'])
+    # Only the binary is written to disk.
+    self.assertEqual(
+        ['opt'], os.listdir(os.path.join(unpacker.work_dir, 'CSWfoo', 'root')))
+    self.assertFalse(os.path.exists(os.path.join(
+        unpacker.work_dir, 'CSWfoo', 'root', 'opt', 'csw', 'share')))
+    md5_sum = unpacker._CollectElfdumpData()[0][1]
+    self.assertTrue(('elfdump', md5_sum) in rest_client.blobs)
+    self.assertEqual({'libmagic': 3}, unpacker.classification_methods)
+    self.assertEqual(set(collect_pkg_metadata.STAGES),
+                     set(unpacker.stage_timings))
+
+  def testSkippedMimeTypes(self):
+    self.mox.ReplayAll()
+    unpacker = self.MakeUnpacker()
+    scanner = content_scanner.ContentScanner(
+        collect_pkg_metadata.BAD_CONTENT_REGEXES, skip_mime_types=['text/'])
+    scanned = []
+    search_buffer = scanner._SearchBuffer
+    def RecordingSearchBuffer(data, remaining):
+      scanned.append(data)
+      search_buffer(data, remaining)
+    scanner._SearchBuffer = RecordingSearchBuffer
+    unpacker.content_scanner = scanner
+    self.assertEqual(
+        {}, unpacker.GetFilesContaining(collect_pkg_metadata.BAD_CONTENT_REGEXES))
+    # Only the binary has been scanned, text files have been skipped.
+    self.assertTrue(scanned)
+    self.assertTrue(all(x.startswith('\x7fELF') for x in scanned))
+
+  def testMimeTypesAsFromUnpackedFiles(self):
+    self.mox.ReplayAll()
+    extra_files = [
+        ('root/opt/csw/share/foo/empty', '', 0100644),
+        ('root/opt/csw/bin/foo', '#!/bin/sh\necho foo\n', 0100755),
+    ]
+    unpacker = self.MakeUnpacker(extra_files)
+    mime_types = dict((x.path, x.mime_type)
+                      for x in unpacker.GetFilesMetadata())
+    # The same files, as pkgtrans would unpack them.
+    file_magic = util.FileMagic()
+    self.addCleanup(file_magic.Close)
+    for path, content, unused_mode in extra_files:
+      unpacked_path = os.path.join(self.tmpdir, os.path.basename(path))
+      with open(unpacked_path, 'wb') as fd:
+        fd.write(content)
+      self.assertEqual(file_magic.GetFileMimeType(unpacked_path),
+                       mime_types[path[len('root/'):]])
+
+  def testOnlyBinariesKeptOnDisk(self):
+    self.mox.ReplayAll()
+    relocatable = '\x7fELF\x01\x01\x01' + '\0' * 9 + '\x01\x00' + '\0' * 100
+    unpacker = self.MakeUnpacker(
+        [('root/opt/csw/lib/foo.o', relocatable, 0100644)])
+    self.assertEqual(['opt/csw/lib/libfoo.so.1'], unpacker.ListBinaries())
+    self.assertFalse(os.path.exists(
+        unpacker.MakeAbsolutePath('root/opt/csw/lib/foo.o')))
+
+  def testBinaryMissedByElfHeaderCheck(self):
+    self.mox.ReplayAll()
+    # No file is written while the datastream is read for the first time.
+    self.stubs.Set(file_classifier, 'ELF_MAGIC', 'not an ELF header')
+    unpacker = self.MakeUnpacker()
+    self.assertEqual(['opt/csw/lib/libfoo.so.1'], unpacker.ListBinaries())
+    self.assertEqual(1, len(unpacker.GetBinaryDumpInfo()))
+    self.assertEqual(1, len(unpacker._CollectElfdumpData()))
+
+  def testDatastreamPath(self):
+    self.mox.ReplayAll()
+    unpacker = self.MakeUnpacker()
+    with open(unpacker.datastream_path, 'rb') as fd:
+      self.assertTrue(fd.read().startswith('# PaCkAgE DaTaStReAm'))
 
 
 if __name__ == '__main__':
@@ -93,6 +93,17 @@ PSTAMP_RE = r"(?P<username>\w+)@(?P<hostname>[\w\.-]+)-(?P<timestamp>\d+)"
 # The directory with shared, architecture independent data files.
 OPENCSW_SHARE = "/opt/csw/share/opencsw"
 
+# The maximum number of blobs which can be requested from the releases
+# QueryBlobs resource at once.
+MAX_BULK_BLOBS = 200
+# The maximum number of md5 sums in a single request for maintainers of
+# packages, see rest.RestClient.GetMaintainersByMd5s().
+MAX_BULK_MAINTAINERS = 1000
+# The maximum number of packages added to a catalog with a single request,
+# see rest.RestClient.AddSvr4sToCatalog(). Each request is registered and
+# added in one transaction on the server.
+MAX_BULK_ASSIGNMENTS = 200
+
 SPARCV8_PATHS = (
     'sparcv8',
     'sparcv8-fsmuld',
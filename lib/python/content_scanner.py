@@ -0,0 +1,100 @@
+"""Finds which of a set of regexes occur in files, in a single pass.
+
+All the regexes are combined into one alternation, so each file is scanned
+once regardless of the number of patterns. Files are read in chunks which
+overlap by a fixed number of bytes, so memory use doesn't depend on the size
+of the file. A match is found as long as it's not longer than the overlap.
+
+Example:
+
+  scanner = content_scanner.ContentScanner([r'/usr/local', r'/opt/build'])
+  scanner.ScanFile('/tmp/foo')  # => ['/usr/local']
+"""
+
+import re
+
+SCAN_CHUNK_SIZE = 1024 * 1024
+# The longest match guaranteed to be found across chunk boundaries.
+SCAN_OVERLAP = 4096
+
+
+class ContentScanner(object):
+
+  def __init__(self, regexes, skip_mime_types=(),
+               chunk_size=SCAN_CHUNK_SIZE, overlap=SCAN_OVERLAP):
+    """Constructor.
+
+    Args:
+      regexes: A sequence of regular expressions, as strings.
+      skip_mime_types: Files whose mime type starts with any of these are not
+          scanned.
+      chunk_size: How much data is read at once.
+      overlap: The number of bytes from the end of the previous chunk which
+          are scanned again with the next one.
+    """
+    self.regexes = tuple(regexes)
+    self.skip_mime_types = tuple(skip_mime_types)
+    self.chunk_size = chunk_size
+    self.overlap = overlap
+    self._compiled = [re.compile(x) for x in self.regexes]
+    self._combined_by_indexes = {}
+
+  def _Combined(self, indexes):
+    """Returns one regex matching any of the regexes with given indexes.
+
+    The regexes are joined without wrapping them in groups, which lets the
+    regex engine skip quickly to the positions where a match can start. An
+    alternation at the top level of a regex is fine, inline flags are not.
+    """
+    if indexes not in self._combined_by_indexes:
+      self._combined_by_indexes[indexes] = re.compile(
+          '|'.join(self.regexes[i] for i in indexes))
+    return self._combined_by_indexes[indexes]
+
+  def IsSkipped(self, mime_type):
+    return bool(mime_type) and mime_type.startswith(self.skip_mime_types)
+
+  def _SearchBuffer(self, data, remaining):
+    """Removes the indexes of regexes found in data from remaining."""
+    pos = 0
+    while remaining:
+      indexes = tuple(sorted(remaining))
+      m = self._Combined(indexes).search(data, pos)
+      if not m:
+        break
+      pos = m.start()
+      for i in indexes:
+        if self._compiled[i].match(data, pos):
+          remaining.discard(i)
+          break
+      else:
+        pos += 1
+      # Other regexes might match at the same position, or inside this match,
+      # so the search continues from the start of this match.
+
+  def ScanChunks(self, chunks, mime_type=None):
+    """Returns the regexes found in data coming in chunks.
+
+    Stops reading chunks as soon as all the regexes have been found.
+    """
+    if self.IsSkipped(mime_type):
+      return []
+    remaining = set(range(len(self.regexes)))
+    tail = ''
+    for chunk in chunks:
+      data = tail + chunk
+      self._SearchBuffer(data, remaining)
+      if not remaining:
+        break
+      tail = data[-self.overlap:]
+    return [regex for i, regex in enumerate(self.regexes)
+            if i not in remaining]
+
+  def ScanFile(self, path, mime_type=None):
+    """Returns the regexes found in a file."""
+    if self.IsSkipped(mime_type):
+      return []
+    with open(path, 'rb') as fd:
+      chunks = iter(lambda: fd.read(self.chunk_size), '')
+      return self.ScanChunks(chunks)
+
@@ -0,0 +1,104 @@
+#!/opt/csw/bin/python2.6
+
+"""Compares bad content scanning approaches on a package with large files.
+
+A synthetic package directory is created with a number of small text files
+and a few large binary-like files. Each file is then scanned for
+BAD_CONTENT_REGEXES twice: first by reading it into memory and running each
+regex separately (the old Unpacker.GetFilesContaining), and then with
+content_scanner.ContentScanner. The peak memory use of the process is shown
+after each run; the old approach runs last, so that its spike is visible.
+
+Usage:
+  ./content_scanner_benchmark.py --large-files 3 --large-file-mb 100
+"""
+
+import logging
+import optparse
+import os
+import re
+import resource
+import shutil
+import tempfile
+
+from lib.python import benchmark_util
+from lib.python import collect_pkg_metadata
+from lib.python import content_scanner
+
+
+def MakePackage(directory, small_files, large_files, large_file_mb):
+  paths = []
+  for i in xrange(small_files):
+    path = os.path.join(directory, 'small%d.txt' % i)
+    with open(path, 'wb') as fd:
+      fd.write('#!/bin/sh\nexec /opt/csw/bin/foo "$@"\n' * 50)
+    paths.append(path)
+  block = os.urandom(1024 * 1024)
+  for i in xrange(large_files):
+    path = os.path.join(directory, 'large%d.a' % i)
+    with open(path, 'wb') as fd:
+      for unused_j in xrange(large_file_mb):
+        fd.write(block)
+      # Found only at the end, so that the whole file has to be scanned.
+      fd.write('/usr' '/local/lib')
+    paths.append(path)
+  return paths
+
+
+def ScanOld(paths, regexes):
+  files_by_pattern = {}
+  for path in paths:
+    content = open(path, "rb").read()
+    for regex in regexes:
+      if re.search(regex, content):
+        files_by_pattern.setdefault(regex, []).append(path)
+  return files_by_pattern
+
+
+def ScanNew(paths, regexes):
+  scanner = content_scanner.ContentScanner(regexes)
+  files_by_pattern = {}
+  for path in paths:
+    for regex in scanner.ScanFile(path):
+      files_by_pattern.setdefault(regex, []).append(path)
+  return files_by_pattern
+
+
+def MaxRssMb():
+  # Linux reports kilobytes, Solaris doesn't support it and reports 0.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def Measure(label, scan, paths, regexes):
+  result, elapsed = benchmark_util.Measure(scan, paths, regexes)
+  total_mb = sum(os.path.getsize(x) for x in paths) / 1024.0 / 1024
+  benchmark_util.PrintRow(label, total_mb, "MB", elapsed,
+                          "  peak RSS: %.1fMB" % MaxRssMb())
+  return result
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--small-files", dest="small_files", type="int",
+                    default=2000, help="Number of small files.")
+  parser.add_option("--large-files", dest="large_files", type="int",
+                    default=3, help="Number of large files.")
+  parser.add_option("--large-file-mb", dest="large_file_mb", type="int",
+                    default=100, help="Size of each large file, in MB.")
+  options, args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING)
+  tmpdir = tempfile.mkdtemp(prefix='content_scanner_benchmark-')
+  try:
+    paths = MakePackage(tmpdir, options.small_files, options.large_files,
+                        options.large_file_mb)
+    regexes = collect_pkg_metadata.BAD_CONTENT_REGEXES
+    new = Measure("single", ScanNew, paths, regexes)
+    old = Measure("per-re", ScanOld, paths, regexes)
+    if new != old:
+      print "Results differ!"
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+  main()
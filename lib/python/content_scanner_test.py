@@ -0,0 +1,67 @@
+#!/usr/bin/env python2.6
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.python import content_scanner
+
+REGEXES = (r'/usr' r'/local', r'/opt' r'/build', r'local/bin')
+
+
+class ContentScannerUnitTest(unittest.TestCase):
+
+  def testAllPatternsInOnePass(self):
+    scanner = content_scanner.ContentScanner(REGEXES)
+    self.assertEqual(
+        list(REGEXES),
+        scanner.ScanChunks(['x /usr' '/local/bin y /opt' '/build z']))
+
+  def testOverlappingMatches(self):
+    # 'local/bin' starts inside the match of the first regex.
+    scanner = content_scanner.ContentScanner(REGEXES)
+    self.assertEqual(
+        [REGEXES[0], REGEXES[2]],
+        scanner.ScanChunks(['/usr' '/local/bin']))
+
+  def testMatchAcrossChunks(self):
+    scanner = content_scanner.ContentScanner(REGEXES, overlap=16)
+    self.assertEqual(
+        [REGEXES[1]],
+        scanner.ScanChunks(['a' * 100 + '/op', 't/bu', 'ild' + 'b' * 100]))
+
+  def testNoMatch(self):
+    scanner = content_scanner.ContentScanner(REGEXES)
+    self.assertEqual([], scanner.ScanChunks(['/usr', 'x/local']))
+
+  def testStopsReadingWhenAllFound(self):
+    scanner = content_scanner.ContentScanner(REGEXES[:1])
+    chunks = iter(['/usr' '/local', 'more', 'data'])
+    scanner.ScanChunks(chunks)
+    self.assertEqual(['more', 'data'], list(chunks))
+
+  def testSkipMimeTypes(self):
+    scanner = content_scanner.ContentScanner(
+        REGEXES, skip_mime_types=('image/',))
+    self.assertEqual(
+        [], scanner.ScanChunks(['/usr' '/local'], mime_type='image/png'))
+    self.assertEqual(
+        [REGEXES[0]],
+        scanner.ScanChunks(['/usr' '/local'], mime_type='text/plain'))
+
+  def testScanFile(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmpdir, 'foo')
+      with open(path, 'wb') as fd:
+        fd.write('\0' * 5000 + '/opt' '/build' + '\0' * 5000)
+      scanner = content_scanner.ContentScanner(
+          REGEXES, chunk_size=1000, overlap=100)
+      self.assertEqual([REGEXES[1]], scanner.ScanFile(path))
+    finally:
+      shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -8,7 +8,6 @@ http://pycurl.cvs.sourceforge.net/pycurl/pycurl/tests/test_post2.py?view=markup
 
 from StringIO import StringIO
 import getpass
-import hashlib
 import json
 import logging
 import optparse
@@ -23,6 +22,7 @@ import urllib2
 import common_constants
 import configuration
 import errors
+import file_hash
 import file_set_checker
 import opencsw
 import struct_util
@@ -179,18 +179,14 @@ class Srv4Uploader(object):
       if self.output_to_screen:
         print "All checks successful. Proceeding."
       for arch, osrel in sorted(checkpkg_sets):
-        for filename, md5_sum in checkpkg_sets[(arch, osrel)]:
-          file_metadata = metadata_by_md5[md5_sum]
-          self._InsertIntoCatalog(filename, arch, osrel, file_metadata)
+        files = [(filename, md5_sum, metadata_by_md5[md5_sum])
+                 for filename, md5_sum in checkpkg_sets[(arch, osrel)]]
+        self._InsertIntoCatalog(arch, osrel, files)
 
   def _GetFileMd5sum(self, filename):
     if filename not in self.md5_by_filename:
-      logging.debug("_GetFileMd5sum(%s): Reading the file", filename)
-      with open(filename, "rb") as fd:
-        hash = hashlib.md5()
-        hash.update(fd.read())
-        md5_sum = hash.hexdigest()
-        self.md5_by_filename[filename] = md5_sum
+      self.md5_by_filename[filename] = (
+          file_hash.GetFileHasher().Md5Sum(filename))
     return self.md5_by_filename[filename]
 
   def _MatchSrv4ToCatalogs(self, filename,
@@ -274,20 +270,37 @@ class Srv4Uploader(object):
               catrel, arch, osrel, catalogname)
     return tuple(catalogs)
 
-  def _InsertIntoCatalog(self, filename, arch, osrel, file_metadata):
+  def _InsertIntoCatalog(self, arch, osrel, files):
+    """Inserts a group of packages into a catalog, in one transaction.
+
+    Packages later in the list replace earlier ones with the same catalogname,
+    so the order of files matters.
+
+    Args:
+      arch: string, catalog architecture
+      osrel: string, catalog OS release
+      files: a list of (filename, md5_sum, file_metadata) tuples
+    """
     logging.debug(
         "_InsertIntoCatalog(%s, %s, %s)",
-        repr(arch), repr(osrel), repr(filename))
-    print("Inserting %s (%s %s) into catalog %s %s %s"
-          % (file_metadata["catalogname"],
-             file_metadata["arch"],
-             file_metadata["osrel"],
-             self.catrel, arch, osrel))
-    md5_sum = self._GetFileMd5sum(filename)
-    basename = os.path.basename(filename)
-    parsed_basename = opencsw.ParsePackageFileName(basename)
-    logging.debug("parsed_basename: %s", parsed_basename)
-    return self._rest_client.AddSvr4ToCatalog(self.catrel, arch, osrel, md5_sum)
+        repr(arch), repr(osrel), repr([x[0] for x in files]))
+    for filename, md5_sum, file_metadata in files:
+      print("Inserting %s (%s %s) into catalog %s %s %s"
+            % (file_metadata["catalogname"],
+               file_metadata["arch"],
+               file_metadata["osrel"],
+               self.catrel, arch, osrel))
+    results = self._rest_client.AddSvr4sToCatalog(
+        self.catrel, arch, osrel, [md5_sum for _, md5_sum, _ in files])
+    failed = [x for x in results if x['status'] == 'error']
+    for result in failed:
+      logging.error("Could not insert %s into catalog %s %s %s: %s",
+                    result['md5_sum'], self.catrel, arch, osrel,
+                    result['message'])
+    if failed:
+      raise DataError("%d packages could not be inserted into catalog %s %s %s"
+                      % (len(failed), self.catrel, arch, osrel))
+    return results
 
   def _GetSrv4FileMetadata(self, md5_sum):
     return self._rest_client.GetSrv4FileMetadataForReleases(md5_sum)
@@ -439,13 +439,13 @@ class Srv4UploaderIntegrationUnitTest(mox.MoxTestBase):
     # write tests at the same time you write the code.
     import_metadata_mock = self.mox.StubOutWithMock(su, '_GetFileMd5sum')
     import_metadata_mock = self.mox.StubOutWithMock(su, '_ImportMetadata')
-    import_metadata_mock = self.mox.StubOutWithMock(su, '_InsertIntoCatalog')
     import_metadata_mock = self.mox.StubOutWithMock(su, '_GetSrv4FileMetadata')
     import_metadata_mock = self.mox.StubOutWithMock(su, '_MatchSrv4ToCatalogs')
     import_metadata_mock = self.mox.StubOutWithMock(su, '_RunCheckpkg')
     rest_mock = self.mox.CreateMock(rest.RestClient)
+    rest_mock.IsRegisteredLevelTwo('md5-2').AndReturn(False)
     rest_mock.RegisterLevelTwo('md5-2')
-    rest_mock.RegisterLevelTwo('md5-1')
+    rest_mock.IsRegisteredLevelTwo('md5-1').AndReturn(True)
     su._rest_client = rest_mock
 
     # The 5.9 package
@@ -482,28 +482,48 @@ class Srv4UploaderIntegrationUnitTest(mox.MoxTestBase):
     # This is the critical part of the test: The 5.9 package must not
     # overwrite the 5.10 package in the 5.10 catalog.  It's okay for the
     # 5.10 package to overwrite the 5.9 package in the 5.10 catalog.
+    # Within a group, later packages replace earlier ones.
     #
     #   This would be wrong:
     #
-    # su._InsertIntoCatalog('gdb-7.2,REV=2011.01.21-SunOS5.9-sparc-CSW.pkg.gz',
-    #                       'sparc', 'SunOS5.10', GDB_STRUCT_9)
-    # su._InsertIntoCatalog('gdb-7.2,REV=2011.01.21-SunOS5.9-sparc-CSW.pkg.gz',
-    #                       'sparc', 'SunOS5.9', GDB_STRUCT_9)
-    # su._InsertIntoCatalog('gdb-7.2,REV=2011.01.21-SunOS5.10-sparc-CSW.pkg.gz',
-    #                       'sparc', 'SunOS5.10', GDB_STRUCT_10)
-
-    # This is right. The first insert is superfluous, but harmless.
-    su._InsertIntoCatalog('gdb-7.2,REV=2011.01.21-SunOS5.9-sparc-CSW.pkg.gz',
-                          'sparc', 'SunOS5.10', GDB_STRUCT_9)
-    su._InsertIntoCatalog('gdb-7.2,REV=2011.01.21-SunOS5.10-sparc-CSW.pkg.gz',
-                          'sparc', 'SunOS5.10', GDB_STRUCT_10)
-    su._InsertIntoCatalog('gdb-7.2,REV=2011.01.21-SunOS5.9-sparc-CSW.pkg.gz',
-                          'sparc', 'SunOS5.9', GDB_STRUCT_9)
-
+    # su._InsertIntoCatalog('sparc', 'SunOS5.10', [
+    #     ('gdb-7.2,REV=2011.01.21-SunOS5.10-sparc-CSW.pkg.gz', 'md5-1',
+    #      GDB_STRUCT_10),
+    #     ('gdb-7.2,REV=2011.01.21-SunOS5.9-sparc-CSW.pkg.gz', 'md5-2',
+    #      GDB_STRUCT_9)])
+
+    # This is right. The 5.9 package in the 5.10 catalog is superfluous,
+    # but harmless.
+    rest_mock.AddSvr4sToCatalog(
+        'unstable', 'sparc', 'SunOS5.10', ['md5-2', 'md5-1']).AndReturn([
+          {'md5_sum': 'md5-2', 'status': 'superseded', 'removed': []},
+          {'md5_sum': 'md5-1', 'status': 'added', 'removed': []}])
+    rest_mock.AddSvr4sToCatalog(
+        'unstable', 'sparc', 'SunOS5.9', ['md5-2']).AndReturn([
+          {'md5_sum': 'md5-2', 'status': 'present', 'removed': []}])
 
     self.mox.ReplayAll()
     su.Upload()
 
+  def testInsertIntoCatalogFails(self):
+    su = csw_upload_pkg.Srv4Uploader([], "http://localhost/",
+        output_to_screen=False)
+    rest_mock = self.mox.CreateMock(rest.RestClient)
+    su._rest_client = rest_mock
+    rest_mock.AddSvr4sToCatalog(
+        'unstable', 'sparc', 'SunOS5.10', ['md5-2', 'md5-1']).AndReturn([
+          {'md5_sum': 'md5-2', 'status': 'added', 'removed': []},
+          {'md5_sum': 'md5-1', 'status': 'error',
+           'message': 'Package not registered'}])
+    self.mox.ReplayAll()
+    self.assertRaises(
+        csw_upload_pkg.DataError,
+        su._InsertIntoCatalog, 'sparc', 'SunOS5.10', [
+          ('gdb-7.2,REV=2011.01.21-SunOS5.9-sparc-CSW.pkg.gz', 'md5-2',
+           GDB_STRUCT_9),
+          ('gdb-7.2,REV=2011.01.21-SunOS5.10-sparc-CSW.pkg.gz', 'md5-1',
+           GDB_STRUCT_10)])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -10,7 +10,7 @@ from lib.python import configuration
 from lib.python import models as m
 
 CONFIG_DB_SCHEMA = "db_schema_version"
-DB_SCHEMA_VERSION = 13L
+DB_SCHEMA_VERSION = 16L
 
 # This list of tables is sensitive to the order in which tables are created.
 # After you change the order here, you need to make sure that the tables can
@@ -32,6 +32,9 @@ TABLES = (m.Architecture,
           m.Srv4DependsOn,
           m.Srv4IncompatibleWith,
           m.Srv4FileInCatalog,
+          m.CatalogLine,
+          m.CatalogRevision,
+          m.CatalogChange,
 )
 # Shouldn't this be in common_constants?
 SYSTEM_PKGMAP = "/var/sadm/install/contents"
@@ -59,13 +62,37 @@ class CheckpkgDatabaseMixin(object):
         table.clearTable()
 
   def CreateTables(self):
+    """Creates missing tables.
+
+    Returns:
+      A list of tables which have been created.
+    """
+    created = []
     for table in TABLES:
       try:
+        if table.tableExists():
+          continue
         logging.debug("Creating table %r", table)
         table.createTable(ifNotExists=True)
+        created.append(table)
       except sqlobject.dberrors.OperationalError, e:
         logging.error("Could not create table %r: %s", table, e)
         raise
+    return created
+
+  def FillNewTables(self, created_tables):
+    """Initializes data which depends on newly created tables.
+
+    Catalog revisions start again from 0 in a new CatalogRevision table, so
+    they get a new epoch. Catalog lines are otherwise only written when
+    catalogs change, so an upgraded database would serve empty catalogs.
+    """
+    if m.CatalogRevision in created_tables:
+      m.NewCatalogEpoch()
+    # In a new database, there are no catalog assignments yet.
+    if (m.CatalogLine in created_tables
+        and m.Srv4FileInCatalog not in created_tables):
+      RebuildAllCatalogLines()
 
 
   def InitialDataImport(self):
@@ -140,8 +167,25 @@ class CatalogDatabase(CheckpkgDatabaseMixin):
     sqlobject.sqlhub.processConnection = self.sqo_conn
 
 
+def RebuildAllCatalogLines():
+  """Writes the catalog lines of all catalogs from scratch."""
+  for sqo_catrel in m.CatalogRelease.select():
+    for arch in common_constants.PHYSICAL_ARCHITECTURES:
+      for osrel in common_constants.OS_RELS:
+        RebuildCatalogLines(osrel, arch, sqo_catrel.name)
+
+
+def RebuildCatalogLines(osrel, arch, catrel):
+  logging.info("Rebuilding catalog lines of %s %s %s.", catrel, arch, osrel)
+  try:
+    m.RebuildCatalogLines(*m.GetSqoTriad(osrel, arch, catrel))
+  except sqlobject.main.SQLObjectNotFound as e:
+    logging.warning("Skipping %s %s %s: %s", catrel, arch, osrel, e)
+
+
 def InitDB(config):
   db_uri = configuration.ComposeDatabaseUri(config)
   dbc = CatalogDatabase(uri=db_uri)
-  dbc.CreateTables()
+  created_tables = dbc.CreateTables()
   dbc.InitialDataImport()
+  dbc.FillNewTables(created_tables)
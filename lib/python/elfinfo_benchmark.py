@@ -0,0 +1,87 @@
+#!/opt/csw/bin/python2.6
+
+"""Compares per-binary processes with ElfExtractorPool.
+
+Each directory given on the command line is treated as one unpacked package.
+ELF binaries are found by their header, and their data are extracted first
+by spawning one process per binary (the old collect_pkg_metadata.py
+behavior), and then using an ElfExtractorPool. Blobs are not sent anywhere.
+
+Usage:
+  ./elfinfo_benchmark.py --workers 4 /tmp/pkg1/root /tmp/pkg2/root
+"""
+
+import logging
+import optparse
+import os
+import subprocess
+import sys
+
+from lib.python import benchmark_util
+from lib.python import collect_binary_elfinfo
+
+
+class NullRestClient(object):
+  """Drops all the blobs it is given."""
+
+  def BlobExists(self, tag, md5_sum):
+    return False
+
+  def SaveBlob(self, tag, md5_sum, data):
+    pass
+
+
+def FindBinaries(directory):
+  binaries = []
+  for dirpath, unused_dirnames, filenames in os.walk(directory):
+    for filename in filenames:
+      path = os.path.join(dirpath, filename)
+      if os.path.islink(path) or not os.path.isfile(path):
+        continue
+      with open(path, 'rb') as fd:
+        if fd.read(4) == '\x7fELF':
+          binaries.append(path)
+  return sorted(binaries)
+
+
+def CollectWithProcesses(binary_paths):
+  for binary_path in binary_paths:
+    subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                           '--one', binary_path])
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--workers", dest="workers", type="int", default=2,
+                    help="Number of ElfExtractorPool workers.")
+  parser.add_option("--one", dest="one", default=None,
+                    help="Internal: process a single binary and exit.")
+  options, args = parser.parse_args()
+  if options.one:
+    extractor = collect_binary_elfinfo.ElfExtractor(
+        options.one, rest_client=NullRestClient())
+    extractor.CollectBinaryElfinfo()
+    return
+  if not args:
+    parser.error("Please provide at least one directory.")
+  logging.basicConfig(level=logging.INFO)
+  packages = [(directory, FindBinaries(directory)) for directory in args]
+  pool = collect_binary_elfinfo.ElfExtractorPool(
+      options.workers, rest_client_factory=NullRestClient)
+  total_before, total_after = 0, 0
+  print "%-40s %8s %12s %12s" % ("package", "binaries", "processes", "pool")
+  for directory, binary_paths in packages:
+    unused_result, before = benchmark_util.Measure(
+        CollectWithProcesses, binary_paths)
+    unused_result, after = benchmark_util.Measure(
+        pool.CollectBinaryElfinfo, binary_paths)
+    total_before += before
+    total_after += after
+    print "%-40s %8d %11.2fs %11.2fs" % (
+        directory[-40:], len(binary_paths), before, after)
+  pool.Close()
+  print "%-40s %8s %11.2fs %11.2fs" % ("total", "", total_before, total_after)
+
+
+if __name__ == '__main__':
+  main()
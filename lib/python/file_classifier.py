@@ -0,0 +1,230 @@
+"""Classifies package files by mime type, in a pool of worker processes.
+
+libmagic is slow on text files, and a magic cookie which has classified many
+files sometimes starts to return None. Files are therefore classified by
+long-lived worker processes, each with its own util.FileMagic, which replaces
+its cookie every few thousand files.
+
+libmagic is asked only once for files whose type can be told from their
+first bytes. Its answer for the first such file is reused for the following
+ones, so the result is the same as libmagic's:
+
+  - ELF files, by their class, byte order and e_type. Shared objects are
+    left out: libmagic tells position independent executables from shared
+    libraries by their dynamic section.
+  - a few binary formats with a fixed signature, by the extension and the
+    signature.
+
+Files are classified from their first bytes, with magic.buffer(), because
+they're read from the package datastream and never written to disk. The
+results are the same as magic.file()'s for regular files, except for empty
+ones: libmagic tells them by their size on disk, and reports a different mime
+type for an empty buffer. Empty files are therefore classified by asking
+libmagic about an empty file on disk.
+
+Example:
+
+  pool = file_classifier.GetSharedFileClassifierPool()
+  result = pool.Submit('opt/csw/share/doc/foo/README', head)
+  mime_type, method = result.get()
+"""
+
+import logging
+import multiprocessing
+import os
+import struct
+import tempfile
+
+from lib.python import configuration
+from lib.python import errors
+from lib.python import util
+
+ELF_MAGIC = '\x7fELF'
+# e_ident and e_type, the part of the ELF header needed to tell the type.
+ELF_HEADER_SIZE = 18
+ELF_BYTE_ORDERS = {'\x01': '<', '\x02': '>'}
+# The e_type of shared objects, see the module docstring.
+ELF_SHARED_OBJECT = 3
+# Signatures of binary formats whose mime type only depends on the signature,
+# by extension.
+EXTENSION_SIGNATURES = {
+    '.bz2': ('BZh',),
+    '.gif': ('GIF87a', 'GIF89a'),
+    '.gz': ('\x1f\x8b',),
+    '.jpeg': ('\xff\xd8\xff',),
+    '.jpg': ('\xff\xd8\xff',),
+    '.mo': ('\xde\x12\x04\x95', '\x95\x04\x12\xde'),
+    '.png': ('\x89PNG\r\n\x1a\n',),
+    '.xz': ('\xfd7zXZ\x00',),
+}
+# How a file has been classified.
+METHOD_ELF = 'elf'
+METHOD_EXTENSION = 'extension'
+METHOD_LIBMAGIC = 'libmagic'
+# How many files can wait for each worker, their heads are held in memory.
+PENDING_FILES_PER_WORKER = 8
+
+
+class Error(errors.Error):
+  """Generic error."""
+
+
+def SniffElfType(head):
+  """Returns a (class, byte order, e_type) tuple from an ELF header.
+
+  Returns None for all the other files.
+  """
+  if len(head) < ELF_HEADER_SIZE or not head.startswith(ELF_MAGIC):
+    return None
+  byte_order = ELF_BYTE_ORDERS.get(head[5])
+  if not byte_order:
+    return None
+  e_type, = struct.unpack(byte_order + 'H', head[16:ELF_HEADER_SIZE])
+  return head[4], head[5], e_type
+
+
+class FileClassifier(object):
+  """Classifies files in the calling process."""
+
+  def __init__(self, files_per_cookie=util.MAGIC_FILES_PER_COOKIE):
+    self.file_magic = util.FileMagic(max_files=files_per_cookie)
+    # libmagic's answers, by ELF type or by extension and signature.
+    self._mime_by_signature = {}
+    self._empty_file_mime_type = None
+
+  def Close(self):
+    self.file_magic.Close()
+
+  def _ExtensionSignature(self, path, head):
+    extension = os.path.splitext(path)[1].lower()
+    for signature in EXTENSION_SIGNATURES.get(extension, ()):
+      if head.startswith(signature):
+        return extension, signature
+    return None
+
+  def _GetEmptyFileMimeType(self):
+    if self._empty_file_mime_type is None:
+      fd, empty_path = tempfile.mkstemp(prefix='file_classifier-')
+      try:
+        os.close(fd)
+        self._empty_file_mime_type = self.file_magic.GetFileMimeType(
+            empty_path)
+      finally:
+        os.unlink(empty_path)
+    return self._empty_file_mime_type
+
+  def Classify(self, path, head):
+    """Returns a (mime type, method) tuple.
+
+    Args:
+      path: The path of the file, only the extension is looked at.
+      head: The first util.MAGIC_BUFFER_SIZE bytes of the file.
+    """
+    if not head:
+      return self._GetEmptyFileMimeType(), METHOD_LIBMAGIC
+    elf_type = SniffElfType(head)
+    if elf_type is None:
+      key, method = self._ExtensionSignature(path, head), METHOD_EXTENSION
+    elif elf_type[2] == ELF_SHARED_OBJECT:
+      key, method = None, None
+    else:
+      key, method = elf_type, METHOD_ELF
+    if key in self._mime_by_signature:
+      return self._mime_by_signature[key], method
+    mime_type = self.file_magic.GetBufferMimeType(head, path)
+    if key:
+      self._mime_by_signature[key] = mime_type
+    return mime_type, METHOD_LIBMAGIC
+
+
+# The classifier of a worker process of the FileClassifierPool.
+_worker_classifier = None
+
+
+def _InitPoolWorker(files_per_cookie):
+  global _worker_classifier
+  _worker_classifier = FileClassifier(files_per_cookie)
+
+
+def _ClassifyInWorker(path_and_head):
+  return _worker_classifier.Classify(*path_and_head)
+
+
+class _ClassifiedFile(object):
+  """A result computed right away, with the interface of an AsyncResult."""
+
+  def __init__(self, value):
+    self._value = value
+
+  def get(self):
+    return self._value
+
+
+class FileClassifierPool(object):
+  """Classifies files in a set of long-lived worker processes.
+
+  With workers=0, files are classified in the calling process.
+  """
+
+  def __init__(self, workers, files_per_cookie=util.MAGIC_FILES_PER_COOKIE):
+    self.workers = workers
+    self.max_pending = max(workers, 1) * PENDING_FILES_PER_WORKER
+    self._pool = None
+    if workers:
+      self._pool = multiprocessing.Pool(
+          workers, _InitPoolWorker, (files_per_cookie,))
+    else:
+      _InitPoolWorker(files_per_cookie)
+
+  def Submit(self, path, head):
+    """Starts classifying a file.
+
+    Returns an object whose get() method returns the FileClassifier.Classify()
+    result, waiting for it if necessary.
+    """
+    if self._pool is None:
+      return _ClassifiedFile(_ClassifyInWorker((path, head)))
+    return self._pool.apply_async(_ClassifyInWorker, ((path, head),))
+
+  def Close(self):
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+
+_shared_pool = None
+
+
+def GetSharedFileClassifierPool(config=None):
+  """Returns the pool shared by all packages indexed in this process.
+
+  The pool has to be closed with CloseSharedFileClassifierPool() before the
+  process exits.
+
+  The pool is configured by the 'magic_workers' and 'magic_files_per_cookie'
+  options from the 'indexing' section of the configuration.
+  """
+  global _shared_pool
+  if _shared_pool is None:
+    if config is None:
+      config = configuration.GetConfig()
+    workers = 0
+    files_per_cookie = util.MAGIC_FILES_PER_COOKIE
+    if config.has_option('indexing', 'magic_workers'):
+      workers = config.getint('indexing', 'magic_workers')
+    if config.has_option('indexing', 'magic_files_per_cookie'):
+      files_per_cookie = config.getint('indexing', 'magic_files_per_cookie')
+    if workers < 0:
+      raise Error("magic_workers must not be negative, got %r." % workers)
+    logging.debug("Starting a FileClassifierPool with %d workers, "
+                  "%d files per magic cookie", workers, files_per_cookie)
+    _shared_pool = FileClassifierPool(workers, files_per_cookie)
+  return _shared_pool
+
+
+def CloseSharedFileClassifierPool():
+  global _shared_pool
+  if _shared_pool is not None:
+    _shared_pool.Close()
+    _shared_pool = None
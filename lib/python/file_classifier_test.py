@@ -0,0 +1,136 @@
+#!/usr/bin/env python2.6
+
+import ConfigParser
+import _bisect
+import mox
+import unittest
+
+from lib.python import file_classifier
+from lib.python import util
+
+PNG_HEAD = '\x89PNG\r\n\x1a\n' + '\0' * 100
+
+
+SPARC_EXECUTABLE_HEAD = (
+    '\x7fELF\x01\x02\x01' + '\0' * 9 + '\x00\x02' + '\0' * 100)
+
+
+class SniffElfTypeUnitTest(unittest.TestCase):
+
+  def testSharedLibrary(self):
+    with open(_bisect.__file__, 'rb') as fd:
+      head = fd.read(util.MAGIC_BUFFER_SIZE)
+    self.assertEqual(file_classifier.ELF_SHARED_OBJECT,
+                     file_classifier.SniffElfType(head)[2])
+
+  def testBigEndianExecutable(self):
+    self.assertEqual(('\x01', '\x02', 2),
+                     file_classifier.SniffElfType(SPARC_EXECUTABLE_HEAD))
+
+  def testNotElf(self):
+    self.assertEqual(None, file_classifier.SniffElfType('#!/bin/sh\n'))
+    self.assertEqual(None, file_classifier.SniffElfType('\x7fELF'))
+
+
+class FileClassifierUnitTest(mox.MoxTestBase):
+
+  def MakeClassifier(self):
+    classifier = file_classifier.FileClassifier()
+    classifier.file_magic = self.mox.CreateMock(util.FileMagic)
+    return classifier
+
+  def testElfTypeReusesLibmagicResult(self):
+    classifier = self.MakeClassifier()
+    classifier.file_magic.GetBufferMimeType(
+        SPARC_EXECUTABLE_HEAD, 'opt/csw/bin/foo').AndReturn(
+            'application/x-executable; charset=binary')
+    self.mox.ReplayAll()
+    self.assertEqual(('application/x-executable; charset=binary', 'libmagic'),
+                     classifier.Classify('opt/csw/bin/foo',
+                                         SPARC_EXECUTABLE_HEAD))
+    self.assertEqual(('application/x-executable; charset=binary', 'elf'),
+                     classifier.Classify('opt/csw/bin/bar',
+                                         SPARC_EXECUTABLE_HEAD))
+
+  def testSharedObjectsUseLibmagic(self):
+    classifier = self.MakeClassifier()
+    with open(_bisect.__file__, 'rb') as fd:
+      head = fd.read(util.MAGIC_BUFFER_SIZE)
+    classifier.file_magic.GetBufferMimeType(
+        head, 'opt/csw/lib/libfoo.so').AndReturn('application/x-sharedlib')
+    classifier.file_magic.GetBufferMimeType(
+        head, 'opt/csw/bin/foo').AndReturn('application/x-pie-executable')
+    self.mox.ReplayAll()
+    self.assertEqual(('application/x-sharedlib', 'libmagic'),
+                     classifier.Classify('opt/csw/lib/libfoo.so', head))
+    self.assertEqual(('application/x-pie-executable', 'libmagic'),
+                     classifier.Classify('opt/csw/bin/foo', head))
+
+  def testExtensionReusesLibmagicResult(self):
+    classifier = self.MakeClassifier()
+    classifier.file_magic.GetBufferMimeType(PNG_HEAD, 'a.png').AndReturn(
+        'image/png')
+    self.mox.ReplayAll()
+    self.assertEqual(('image/png', 'libmagic'),
+                     classifier.Classify('a.png', PNG_HEAD))
+    self.assertEqual(('image/png', 'extension'),
+                     classifier.Classify('b.PNG', PNG_HEAD))
+
+  def testExtensionWithoutSignature(self):
+    classifier = self.MakeClassifier()
+    classifier.file_magic.GetBufferMimeType(PNG_HEAD, 'a.png').AndReturn(
+        'image/png')
+    classifier.file_magic.GetBufferMimeType('text', 'b.png').AndReturn(
+        'text/plain')
+    self.mox.ReplayAll()
+    classifier.Classify('a.png', PNG_HEAD)
+    self.assertEqual(('text/plain', 'libmagic'),
+                     classifier.Classify('b.png', 'text'))
+
+  def testEmptyFiles(self):
+    classifier = self.MakeClassifier()
+    classifier.file_magic.GetFileMimeType(mox.IsA(str)).AndReturn(
+        'inode/x-empty')
+    self.mox.ReplayAll()
+    self.assertEqual(('inode/x-empty', 'libmagic'),
+                     classifier.Classify('a.txt', ''))
+    self.assertEqual(('inode/x-empty', 'libmagic'),
+                     classifier.Classify('b.png', ''))
+
+
+class FileClassifierPoolUnitTest(unittest.TestCase):
+
+  def testInProcess(self):
+    pool = file_classifier.FileClassifierPool(0)
+    mime_type, method = pool.Submit('README', 'Hello, world.\n').get()
+    self.assertTrue(mime_type.startswith('text/plain'))
+    self.assertEqual('libmagic', method)
+
+  def testWorkers(self):
+    pool = file_classifier.FileClassifierPool(1, files_per_cookie=2)
+    try:
+      results = [pool.Submit('README%d' % i, 'Hello, world.\n')
+                 for i in range(5)]
+      for result in results:
+        self.assertTrue(result.get()[0].startswith('text/plain'))
+    finally:
+      pool.Close()
+
+
+class SharedFileClassifierPoolUnitTest(unittest.TestCase):
+
+  def tearDown(self):
+    file_classifier.CloseSharedFileClassifierPool()
+
+  def testInProcessByDefault(self):
+    config = ConfigParser.RawConfigParser()
+    pool = file_classifier.GetSharedFileClassifierPool(config)
+    self.assertEqual(0, pool.workers)
+    self.assertTrue(pool is file_classifier.GetSharedFileClassifierPool(config))
+    file_classifier.CloseSharedFileClassifierPool()
+    self.assertFalse(
+        pool is file_classifier.GetSharedFileClassifierPool(config))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,104 @@
+"""Computes md5 sums of package files, once per file.
+
+Package files are hashed by several tools in turn: csw-upload-pkg, checkpkg
+and the package indexer, each in its own process. The sums are kept in a small
+on-disk cache, indexed by the path, size, modification time and inode of the
+file, so that a file is only read again when it changes.
+
+The cache is a blob_cache.BlobCache and is configured in the 'md5_cache'
+section of the configuration.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import re
+
+from lib.python import blob_cache
+from lib.python import configuration
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+MD5_CACHE_TAG = 'md5'
+MD5_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def Md5Sum(path, use_mmap=False, chunk_size=HASH_CHUNK_SIZE):
+  """Returns the md5 sum of a file, without reading it into memory at once."""
+  md5_hash = hashlib.md5()
+  with open(path, 'rb') as fd:
+    if use_mmap and os.fstat(fd.fileno()).st_size:
+      data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        md5_hash.update(data)
+      finally:
+        data.close()
+    else:
+      data = fd.read(chunk_size)
+      while data:
+        md5_hash.update(data)
+        data = fd.read(chunk_size)
+  return md5_hash.hexdigest()
+
+
+def _CacheKey(path, st):
+  # The mtime can be set back after a change, the ctime can't.
+  key = '%s\0%d\0%r\0%r\0%d\0%d' % (
+      os.path.realpath(path), st.st_size, st.st_mtime, st.st_ctime,
+      st.st_ino, st.st_dev)
+  return hashlib.md5(key).hexdigest()
+
+
+class FileHasher(object):
+  """Returns md5 sums of files, from the cache if the file hasn't changed."""
+
+  def __init__(self, cache=None, use_mmap=False):
+    self.cache = cache
+    self.use_mmap = use_mmap
+    self._md5_by_key = {}
+
+  def Md5Sum(self, path):
+    key = _CacheKey(path, os.stat(path))
+    if key in self._md5_by_key:
+      return self._md5_by_key[key]
+    md5_sum = None
+    if self.cache:
+      md5_sum = self.cache.Get(MD5_CACHE_TAG, key)
+      if md5_sum is not None and not MD5_RE.match(md5_sum):
+        logging.warning("Ignoring a bad md5 cache entry for %r: %r",
+                        path, md5_sum)
+        md5_sum = None
+    if md5_sum is None:
+      logging.debug("Md5Sum(%r): reading the file", path)
+      md5_sum = Md5Sum(path, use_mmap=self.use_mmap)
+      if self.cache:
+        self.cache.Put(MD5_CACHE_TAG, key, md5_sum)
+    self._md5_by_key[key] = md5_sum
+    return md5_sum
+
+
+_hashers_by_directory = {}
+
+
+def GetFileHasher(config=None):
+  """Returns the FileHasher using the cache from the 'md5_cache' section.
+
+  Without a configured directory, sums are only remembered by the process.
+  """
+  if config is None:
+    config = configuration.GetConfig()
+  directory = None
+  if config.has_option('md5_cache', 'directory'):
+    directory = config.get('md5_cache', 'directory')
+  if directory:
+    directory = os.path.expanduser(directory)
+  if directory not in _hashers_by_directory:
+    cache = None
+    use_mmap = False
+    if config.has_option('md5_cache', 'use_mmap'):
+      use_mmap = config.getboolean('md5_cache', 'use_mmap')
+    if directory:
+      max_size = config.getint('md5_cache', 'size_mb') * 1024 * 1024
+      cache = blob_cache.BlobCache(directory, max_size)
+    _hashers_by_directory[directory] = FileHasher(cache, use_mmap)
+  return _hashers_by_directory[directory]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python2.6
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.python import blob_cache
+from lib.python import file_hash
+
+
+class Md5SumUnitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'foo.pkg')
+    self.data = 'x' * 1000 + 'y' * 1000
+    with open(self.path, 'wb') as fd:
+      fd.write(self.data)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testChunks(self):
+    self.assertEqual(hashlib.md5(self.data).hexdigest(),
+                     file_hash.Md5Sum(self.path, chunk_size=300))
+
+  def testMmap(self):
+    self.assertEqual(hashlib.md5(self.data).hexdigest(),
+                     file_hash.Md5Sum(self.path, use_mmap=True))
+
+  def testEmptyFileMmap(self):
+    open(self.path, 'wb').close()
+    self.assertEqual(hashlib.md5('').hexdigest(),
+                     file_hash.Md5Sum(self.path, use_mmap=True))
+
+
+class FileHasherUnitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'foo.pkg')
+    with open(self.path, 'wb') as fd:
+      fd.write('foo')
+    self.cache = blob_cache.BlobCache(os.path.join(self.tmpdir, 'md5'),
+                                      1024 * 1024)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testSharedBetweenHashers(self):
+    md5_foo = hashlib.md5('foo').hexdigest()
+    self.assertEqual(
+        md5_foo, file_hash.FileHasher(self.cache).Md5Sum(self.path))
+    # A second process reads the sum from the cache.
+    self.assertEqual(
+        md5_foo, file_hash.FileHasher(self.cache).Md5Sum(self.path))
+    self.assertEqual(1, self.cache.hits)
+
+  def testChangedFileIsHashedAgain(self):
+    hasher = file_hash.FileHasher(self.cache)
+    hasher.Md5Sum(self.path)
+    with open(self.path, 'wb') as fd:
+      fd.write('foobar')
+    os.utime(self.path, (0, 0))
+    self.assertEqual(hashlib.md5('foobar').hexdigest(),
+                     file_hash.FileHasher(self.cache).Md5Sum(self.path))
+
+  def testMtimeRestoredAfterChange(self):
+    st = os.stat(self.path)
+    file_hash.FileHasher(self.cache).Md5Sum(self.path)
+    with open(self.path, 'wb') as fd:
+      fd.write('bar')
+    os.utime(self.path, (st.st_atime, st.st_mtime))
+    self.assertEqual(hashlib.md5('bar').hexdigest(),
+                     file_hash.FileHasher(self.cache).Md5Sum(self.path))
+
+  def testBadCacheEntry(self):
+    st = os.stat(self.path)
+    self.cache.Put(file_hash.MD5_CACHE_TAG,
+                   file_hash._CacheKey(self.path, st), 'garbage')
+    self.assertEqual(hashlib.md5('foo').hexdigest(),
+                     file_hash.FileHasher(self.cache).Md5Sum(self.path))
+
+
+if __name__ == '__main__':
+  unittest.main()
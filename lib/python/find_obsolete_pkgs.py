@@ -33,6 +33,7 @@ import sys
 
 from collections import namedtuple
 
+from lib.python import blob_cache
 from lib.python import common_constants
 from lib.python import configuration
 from lib.python import rest
@@ -232,7 +233,8 @@ def main():
         pkgdb_url=config.get('rest', 'pkgdb'),
         releases_url=config.get('rest', 'releases'),
         username=username,
-        password=password)
+        password=password,
+        blob_cache=blob_cache.GetBlobCache(config))
 
     reallyremovelst, rebuildlst = ComputeRemoveAndRebuild(oldcatrel, newcatrel,
                                                           arch, osrel, rest_client)
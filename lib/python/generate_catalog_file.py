@@ -27,6 +27,7 @@ import logging
 import sys
 import datetime
 
+from lib.python import blob_cache
 from lib.python import configuration
 from lib.python import representations
 from lib.python import rest
@@ -43,21 +44,12 @@ class CatalogFileGenerator(object):
     self.osrel = osrel
     home_dir = os.environ['HOME']
     self.rest_client = rest_client
-    self._catalog = None
-
-  @property
-  def catalog(self):
-    if not self._catalog:
-      self._catalog = self.rest_client.GetCatalogForGeneration(self.catrel,
-                                                               self.arch,
-                                                               self.osrel)
-      try:
-        self._catalog = [representations.CatalogEntry._make(x)
-                         for x in self._catalog]
-      except TypeError:
-        print self._catalog
-        raise
-    return self._catalog
+
+  def IterCatalog(self):
+    """Yields representations.CatalogEntry objects, as they are downloaded."""
+    for entry in self.rest_client.IterCatalogForGeneration(
+        self.catrel, self.arch, self.osrel):
+      yield representations.CatalogEntry._make(entry)
 
   def ComposeCatalogLine(self, catalog_entry):
     items = tuple(catalog_entry)[:9]
@@ -70,25 +62,49 @@ class CatalogFileGenerator(object):
       raise Error("File %s already exists." % out_catalog)
     if os.path.exists(out_desc):
       raise Error("File %s already exists." % out_desc)
-    lines, descriptions = self._GenerateCatalogAsLines()
-    with open(out_catalog, "w") as fd:
-      fd.write("\n".join(lines).encode('utf-8'))
-    with open(out_desc, "w") as fd:
-      fd.write("\n".join(descriptions).encode('utf-8'))
+    # The catalog is written as it's downloaded, a failed download leaves
+    # no files behind.
+    try:
+      with open(out_catalog, "w") as fd:
+        with open(out_desc, "w") as desc_fd:
+          self._WriteCatalog(fd, desc_fd)
+    except:
+      for path in (out_catalog, out_desc):
+        if os.path.exists(path):
+          os.unlink(path)
+      raise
+
+  def _WriteCatalog(self, fd, desc_fd):
+    separator = ""
+    desc_separator = ""
+    for line, description in self._IterCatalogLines():
+      fd.write((separator + line).encode('utf-8'))
+      separator = "\n"
+      if description is not None:
+        desc_fd.write((desc_separator + description).encode('utf-8'))
+        desc_separator = "\n"
+
+  def _IterCatalogLines(self):
+    """Yields (catalog line, description) tuples.
+
+    Lines which don't describe packages come with a None description.
+    """
+    date_iso = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+    yield "# CREATIONDATE %sZ" % date_iso, None
+
+    # Potential additional lines might go here.
+    # yield "...", None
+    for catalog_entry in self.IterCatalog():
+      yield self.ComposeCatalogLine(catalog_entry), catalog_entry.desc
 
   def _GenerateCatalogAsLines(self):
     """Return the complete catalog as a list of lines."""
     lines = []
     descriptions = []
-    date_iso = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
-    lines.append("# CREATIONDATE %sZ" % date_iso)
-
-    # Potential additional lines might go here.
-    # lines.append("...")
-    if self.catalog:  # the catalog might be None
-      for catalog_entry in self.catalog:
-        lines.append(self.ComposeCatalogLine(catalog_entry))
-        descriptions.append(catalog_entry.desc)
+    for line, description in self._IterCatalogLines():
+      lines.append(line)
+      if description is not None:
+        descriptions.append(description)
     return lines, descriptions
 
 
@@ -106,7 +122,8 @@ def main():
       pkgdb_url=config.get('rest', 'pkgdb'),
       releases_url=config.get('rest', 'releases'),
       username=username,
-      password=password)
+      password=password,
+      blob_cache=blob_cache.GetBlobCache(config))
   cfg = CatalogFileGenerator(options.catrel, options.arch, options.osrel,
                              rest_client)
   cfg.GenerateCatalog(options.out_dir)
@@ -4,7 +4,10 @@ import __builtin__
 import datetime
 import io
 import mox
+import os
 import rest
+import shutil
+import tempfile
 import unittest2 as unittest
 
 from lib.python import generate_catalog_file
@@ -51,7 +54,7 @@ class CatalogFileGeneratorUnitTest(mox.MoxTestBase, unittest.TestCase):
                                                      "sparc",
                                                      "SunOS5.10",
                                                      mock_rest)
-    mock_rest.GetCatalogForGeneration('dublin', 'sparc', 'SunOS5.10').AndReturn([])
+    mock_rest.IterCatalogForGeneration('dublin', 'sparc', 'SunOS5.10').AndReturn([])
     self.mox.ReplayAll()
     catalog_lines, descriptions = cfg._GenerateCatalogAsLines()
     expected_lines = [
@@ -70,7 +73,7 @@ class CatalogFileGeneratorUnitTest(mox.MoxTestBase, unittest.TestCase):
                                                      "sparc",
                                                      "SunOS5.10",
                                                      mock_rest)
-    mock_rest.GetCatalogForGeneration('dublin', 'sparc', 'SunOS5.10').AndReturn(PKG_DATA_1)
+    mock_rest.IterCatalogForGeneration('dublin', 'sparc', 'SunOS5.10').AndReturn(PKG_DATA_1)
     self.mox.ReplayAll()
     catalog_lines, descriptions = cfg._GenerateCatalogAsLines()
     expected_lines = [
@@ -87,7 +90,7 @@ class CatalogFileGeneratorUnitTest(mox.MoxTestBase, unittest.TestCase):
                                                      "sparc",
                                                      "SunOS5.10",
                                                      mock_rest)
-    mock_rest.GetCatalogForGeneration('dublin', 'sparc', 'SunOS5.10').AndReturn(PKG_DATA_1)
+    mock_rest.IterCatalogForGeneration('dublin', 'sparc', 'SunOS5.10').AndReturn(PKG_DATA_1)
     fake_file = io.BytesIO()
     fake_desc_file = io.BytesIO()
     open('fake-dir/catalog', 'w').AndReturn(fake_file)
@@ -95,6 +98,25 @@ class CatalogFileGeneratorUnitTest(mox.MoxTestBase, unittest.TestCase):
     self.mox.ReplayAll()
     cfg.GenerateCatalog('fake-dir')
 
+  def testGenerateCatalogFailedDownload(self):
+    mock_rest = self.mox.CreateMock(rest.RestClient)
+    cfg = generate_catalog_file.CatalogFileGenerator("dublin",
+                                                     "sparc",
+                                                     "SunOS5.10",
+                                                     mock_rest)
+    def BrokenDownload():
+      yield PKG_DATA_1[0]
+      raise IOError("Connection reset by peer")
+    mock_rest.IterCatalogForGeneration(
+        'dublin', 'sparc', 'SunOS5.10').AndReturn(BrokenDownload())
+    self.mox.ReplayAll()
+    out_dir = tempfile.mkdtemp(prefix='generate_catalog_file_test-')
+    try:
+      self.assertRaises(IOError, cfg.GenerateCatalog, out_dir)
+      self.assertEqual([], os.listdir(out_dir))
+    finally:
+      shutil.rmtree(out_dir)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -11,18 +11,23 @@ necessary to bring one catalog to the state of another catalog.
 """
 
 from Cheetah import Template
+import Queue
 import cjson
 import logging
 import optparse
 import rest
 import sys
 import re
+import threading
 
+from lib.python import blob_cache
 from lib.python import configuration
 from lib.python import common_constants
 from lib.python import catalog
 from lib.python import opencsw
 
+# Number of catalogs downloaded at the same time.
+DEFAULT_FETCH_THREADS = 8
 
 CATALOG_MOD_TMPL = """#!/bin/bash
 # Catalog modification (not integration yet): $catrel_from -> $catrel_to
@@ -147,24 +152,67 @@ def IndexDictByField(d, field):
   return dict((x[field], x) for x in d)
 
 
+def FetchCatalogs(rest_client, keys, max_threads=DEFAULT_FETCH_THREADS):
+  """Downloads catalogs in parallel, using one RestClient in many threads.
+
+  The work is I/O bound, so threads are enough. The multiprocessing module
+  is avoided, see https://www.opencsw.org/mantis/view.php?id=4894
+
+  Args:
+    keys: a list of (catrel, arch, osrel) tuples
+    max_threads: the maximum number of simultaneous downloads
+
+  Returns:
+    A dictionary of catalogs by key. A catalog can be None, see
+    RestClient.GetCatalog().
+
+  Raises:
+    The first exception raised by a download. The remaining downloads are
+    not started.
+  """
+  key_queue = Queue.Queue()
+  for key in keys:
+    key_queue.put(key)
+  catalogs = {}
+  errors = []
+  lock = threading.Lock()
+  def Worker():
+    while not errors:
+      try:
+        key = key_queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        catalog = rest_client.GetCatalog(*key)
+      except Exception:
+        with lock:
+          errors.append(sys.exc_info())
+        return
+      with lock:
+        catalogs[key] = catalog
+  threads = [threading.Thread(target=Worker)
+             for _ in xrange(min(max_threads, len(keys)))]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    exc_type, exc_value, exc_traceback = errors[0]
+    raise exc_type, exc_value, exc_traceback
+  return catalogs
+
+
 def GetCatalogs(catrel_from, catrel_to,
                 include_version_changes,
-                include_downgrades, rest_client):
-  def GetCatalog(rest_client, r_catrel, r_arch, r_osrel):
-    key = r_catrel, r_arch, r_osrel
-    catalog = rest_client.GetCatalog(*key)
-    return (key, catalog)
-  # TODO(maciej): Enable this once the multiprocessing module is fixed.
-  # https://www.opencsw.org/mantis/view.php?id=4894
-  # proc_pool = multiprocessing.Pool(20)
-  catalogs_to_fetch_args = []
+                include_downgrades, rest_client,
+                max_threads=DEFAULT_FETCH_THREADS):
+  keys = []
   for arch in common_constants.PHYSICAL_ARCHITECTURES:
     for osrel in common_constants.OS_RELS:
       for catrel in (catrel_from, catrel_to):
-        catalogs_to_fetch_args.append((rest_client, catrel, arch, osrel))
-  # Convert this to pool.map when multiprocessing if fixed.
-  catalogs = dict(map(lambda x: GetCatalog(*x), catalogs_to_fetch_args))
-  return catalogs
+        keys.append((catrel, arch, osrel))
+  return FetchCatalogs(rest_client, keys, max_threads)
 
 
 def ComposeDiffsByCatalogname(catalogs, catrel_from, catrel_to,
@@ -264,6 +312,9 @@ def main():
       dest="include_version_changes",
       default=True, action="store_false",
       help="Skip version upgrades (only accept revision upgrades).")
+  parser.add_option("--fetch-threads", dest="fetch_threads",
+      default=DEFAULT_FETCH_THREADS, type="int",
+      help="Number of catalogs to download at the same time.")
   parser.add_option("--debug", dest="debug",
                     default=False, action="store_true")
   options, args = parser.parse_args()
@@ -279,7 +330,8 @@ def main():
       pkgdb_url=config.get('rest', 'pkgdb'),
       releases_url=config.get('rest', 'releases'),
       username=username,
-      password=password)
+      password=password,
+      blob_cache=blob_cache.GetBlobCache(config))
 
   if not options.output_file:
     raise UsageError("Please specify the output file.  See --help.")
@@ -298,7 +350,8 @@ def main():
     catalogs = GetCatalogs(
         catrel_from, catrel_to,
         options.include_version_changes,
-        options.include_downgrades, rest_client)
+        options.include_downgrades, rest_client,
+        max_threads=options.fetch_threads)
     diffs_by_catalogname = ComposeDiffsByCatalogname(
         catalogs, catrel_from, catrel_to,
         options.include_version_changes,
@@ -2,6 +2,7 @@
 
 import Cheetah
 import mox
+import threading
 import unittest
 
 from lib.python import integrate_catalogs
@@ -156,5 +157,41 @@ class TemplateUnitTest(mox.MoxTestBase):
     self.assertEqual(OUT_2.splitlines(), unicode(t).splitlines())
 
 
+class FakeRestClient(object):
+
+  def __init__(self, failing_key=None):
+    self.failing_key = failing_key
+    self.lock = threading.Lock()
+    self.fetched = []
+
+  def GetCatalog(self, catrel, arch, osrel):
+    key = (catrel, arch, osrel)
+    if key == self.failing_key:
+      raise IOError("Could not fetch %s %s %s" % key)
+    with self.lock:
+      self.fetched.append(key)
+    return [{'catalogname': catrel}]
+
+
+class FetchCatalogsUnitTest(unittest.TestCase):
+
+  def testGetCatalogs(self):
+    rest_client = FakeRestClient()
+    catalogs = integrate_catalogs.GetCatalogs(
+        'unstable', 'testing', True, True, rest_client, max_threads=3)
+    self.assertEqual(sorted(catalogs), sorted(rest_client.fetched))
+    self.assertEqual([{'catalogname': 'testing'}],
+                     catalogs[('testing', 'sparc', 'SunOS5.10')])
+
+  def testFetchCatalogsError(self):
+    keys = [('unstable', 'sparc', 'SunOS5.%d' % x) for x in range(8, 12)]
+    rest_client = FakeRestClient(failing_key=keys[1])
+    self.assertRaises(IOError, integrate_catalogs.FetchCatalogs,
+                      rest_client, keys, 2)
+
+  def testFetchNothing(self):
+    self.assertEqual({}, integrate_catalogs.FetchCatalogs(FakeRestClient(), []))
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -8,6 +8,7 @@ import logging
 import os.path
 import re
 import sqlobject
+import time
 from sqlobject import sqlbuilder
 
 
@@ -243,8 +244,8 @@ class Srv4FileStats(sqlobject.SQLObject):
   def __init__(self, *args, **kwargs):
     super(Srv4FileStats, self).__init__(*args, **kwargs)
 
-  def DeleteAllDependentObjects(self):
-    self.RemoveCatalogAssignments()
+  def DeleteAllDependentObjects(self, who='unknown'):
+    self.RemoveCatalogAssignments(who)
     self.RemoveAllCswFiles()
     self.RemoveAllCheckpkgResults()
     self.RemoveOverrides()
@@ -272,11 +273,31 @@ class Srv4FileStats(sqlobject.SQLObject):
           Srv4IncompatibleWith.sqlmeta.table,
           Srv4IncompatibleWith.q.srv4_file==self)))
 
-  def RemoveCatalogAssignments(self):
-    sqlobject.sqlhub.processConnection.query(
-        sqlobject.sqlhub.processConnection.sqlrepr(sqlbuilder.Delete(
-          Srv4FileInCatalog.sqlmeta.table,
-          Srv4FileInCatalog.q.srv4file==self)))
+  def RemoveCatalogAssignments(self, who='unknown'):
+    """Removes the package from all catalogs.
+
+    The assignments, the catalog lines and the change log entries are
+    written in one transaction.
+    """
+    trans = Srv4FileInCatalog._connection.transaction()
+    try:
+      catalogs = set(
+          (x.osrel, x.arch, x.catrel) for x in Srv4FileInCatalog.select(
+            Srv4FileInCatalog.q.srv4file==self, connection=trans))
+      trans.query(trans.sqlrepr(sqlbuilder.Delete(
+        CatalogLine.sqlmeta.table,
+        CatalogLine.q.srv4file==self)))
+      trans.query(trans.sqlrepr(sqlbuilder.Delete(
+        Srv4FileInCatalog.sqlmeta.table,
+        Srv4FileInCatalog.q.srv4file==self)))
+      change = (CATALOG_CHANGE_REMOVE, self.md5_sum, self.catalogname)
+      for sqo_osrel, sqo_arch, sqo_catrel in catalogs:
+        RecordCatalogChanges(
+            trans, sqo_osrel, sqo_arch, sqo_catrel, [change], who)
+    except:
+      trans.rollback()
+      raise
+    trans.commit(close=True)
 
   def GetOverridesResult(self):
     return CheckpkgOverride.select(CheckpkgOverride.q.srv4_file==self)
@@ -501,6 +522,75 @@ class Srv4FileInCatalog(sqlobject.SQLObject):
                self.arch.name, self.osrel.full_name, self.catrel.name))
 
 
+class CatalogLine(sqlobject.SQLObject):
+  """A catalog entry of a package in a catalog, ready to be emitted.
+
+  Mirrors Srv4FileInCatalog for packages used to generate catalogs. The entry
+  is a JSON encoded list of catalog fields, so that generating a catalog
+  doesn't need to join the big tables or to decode dependencies. Rows are
+  written and removed together with catalog assignments, see AddCatalogLines
+  and DeleteCatalogLines.
+  """
+  arch = sqlobject.ForeignKey('Architecture', notNone=True)
+  osrel = sqlobject.ForeignKey('OsRelease', notNone=True)
+  catrel = sqlobject.ForeignKey('CatalogRelease', notNone=True)
+  srv4file = sqlobject.ForeignKey('Srv4FileStats', notNone=True)
+  catalogname = sqlobject.UnicodeCol(notNone=True, length=250)
+  entry = sqlobject.StringCol(notNone=True)
+  uniqueness_idx = sqlobject.DatabaseIndex(
+          'arch', 'osrel', 'catrel', 'srv4file',
+          unique=True)
+  catalog_idx = sqlobject.DatabaseIndex(
+          'arch', 'osrel', 'catrel', 'catalogname')
+
+
+class CatalogRevision(sqlobject.SQLObject):
+  """A counter of changes to a catalog.
+
+  The revision grows every time a package is added to or removed from the
+  catalog, so that clients can tell whether their copy is current.
+  """
+  arch = sqlobject.ForeignKey('Architecture', notNone=True)
+  osrel = sqlobject.ForeignKey('OsRelease', notNone=True)
+  catrel = sqlobject.ForeignKey('CatalogRelease', notNone=True)
+  revision = sqlobject.IntCol(notNone=True, default=0)
+  uniqueness_idx = sqlobject.DatabaseIndex(
+          'arch', 'osrel', 'catrel',
+          unique=True)
+
+
+# The CswConfig option with the epoch of catalog revisions.
+CATALOG_EPOCH_OPTION = u'catalog_revision_epoch'
+CATALOG_CHANGE_ADD = 'add'
+CATALOG_CHANGE_REMOVE = 'remove'
+# Change log entries inserted with a single statement.
+CATALOG_CHANGE_INSERT_BATCH_SIZE = 500
+# Catalog assignments deleted with a single statement.
+CATALOG_ASSIGNMENT_DELETE_BATCH_SIZE = 1000
+
+
+class CatalogChange(sqlobject.SQLObject):
+  """An entry in the append-only change log of a catalog.
+
+  All changes made at once share the revision of the catalog they resulted
+  in, see RecordCatalogChanges. The md5 sum and catalogname are copied, so
+  that the log outlives the srv4 files.
+  """
+  arch = sqlobject.ForeignKey('Architecture', notNone=True)
+  osrel = sqlobject.ForeignKey('OsRelease', notNone=True)
+  catrel = sqlobject.ForeignKey('CatalogRelease', notNone=True)
+  revision = sqlobject.IntCol(notNone=True)
+  action = sqlobject.UnicodeCol(length=10, notNone=True)
+  md5_sum = sqlobject.UnicodeCol(length=32, notNone=True)
+  catalogname = sqlobject.UnicodeCol(length=250, notNone=True)
+  created_on = sqlobject.DateTimeCol(
+      notNone=True,
+      default=sqlobject.DateTimeCol.now)
+  created_by = sqlobject.UnicodeCol(length=50, notNone=True)
+  revision_idx = sqlobject.DatabaseIndex(
+          'arch', 'osrel', 'catrel', 'revision')
+
+
 class Srv4DependsOn(sqlobject.SQLObject):
   """Models dependencies."""
   srv4_file = sqlobject.ForeignKey('Srv4FileStats', notNone=True)
@@ -578,6 +668,442 @@ def GetCatalogGenerationResult(sqo_osrel, sqo_arch, sqo_catrel):
   return rows
 
 
+# Rows inserted into CatalogLine with a single statement.
+CATALOG_LINE_INSERT_BATCH_SIZE = 500
+# Rows fetched from the database at once by IterQuery().
+STREAM_FETCH_SIZE = 500
+
+
+def CatalogEntryFromRow(row):
+  """Formats catalog generation data as a catalog entry.
+
+  Args:
+    row: catalogname, version_string, pkgname, basename, md5_sum, size,
+         deps, i_deps, pkginfo_name
+
+  Returns:
+    A list of strings, aligned with representations.CatalogEntry.
+  """
+  def FormatList(lst):
+    if lst:
+      return '|'.join(lst)
+    else:
+      return 'none'
+  i_deps = cjson.decode(row[7])
+  deps_with_desc = cjson.decode(row[6])
+  deps = [x[0] for x in deps_with_desc if x[0].startswith('CSW')]
+  return [
+      row[0],              # catalogname
+      row[1],              # version
+      row[2],              # pkgname
+      row[3],              # basename
+      row[4],              # md5_sum
+      str(row[5]),         # size
+      FormatList(deps),    # deps
+      "none",              # category
+      FormatList(i_deps),  # i_deps
+      row[8],              # desc
+  ]
+
+
+def _CatalogLinesWhere(sqo_osrel, sqo_arch, sqo_catrel):
+  return sqlbuilder.AND(
+      CatalogLine.q.osrel==sqo_osrel,
+      CatalogLine.q.arch==sqo_arch,
+      CatalogLine.q.catrel==sqo_catrel)
+
+
+def DeleteCatalogLines(connection, sqo_osrel, sqo_arch, sqo_catrel,
+                       srv4_ids=None):
+  """Removes catalog lines of the given packages, or of the whole catalog.
+
+  Args:
+    connection: a connection or a transaction, None for the default one
+    srv4_ids: ids of Srv4FileStats objects, None for all packages
+  """
+  if connection is None:
+    connection = CatalogLine._connection
+  where = _CatalogLinesWhere(sqo_osrel, sqo_arch, sqo_catrel)
+  if srv4_ids is not None:
+    if not srv4_ids:
+      return
+    where = sqlbuilder.AND(where, sqlbuilder.IN(CatalogLine.q.srv4file,
+                                                list(srv4_ids)))
+  connection.query(connection.sqlrepr(sqlbuilder.Delete(
+    CatalogLine.sqlmeta.table, where=where)))
+
+
+def AddCatalogLines(connection, sqo_osrel, sqo_arch, sqo_catrel, srv4_ids,
+                    batch_size=CATALOG_LINE_INSERT_BATCH_SIZE):
+  """Writes catalog lines of packages which have been added to a catalog.
+
+  Packages which aren't used to generate catalogs, or don't have catalog
+  generation data, are skipped.
+
+  Args:
+    connection: a connection or a transaction, None for the default one
+    srv4_ids: ids of Srv4FileStats objects
+  """
+  if connection is None:
+    connection = CatalogLine._connection
+  columns = CatalogLine.sqlmeta.columns
+  template = [columns[x].dbName for x in
+              ('archID', 'osrelID', 'catrelID', 'srv4fileID',
+               'catalogname', 'entry')]
+  srv4_ids = list(srv4_ids)
+  for start in xrange(0, len(srv4_ids), batch_size):
+    rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+      [Srv4FileStats.q.id,
+       Srv4FileStats.q.catalogname,
+       Srv4FileStats.q.version_string,
+       Srv4FileStats.q.basename,
+       Srv4FileStats.q.md5_sum,
+       Srv4FileStats.q.size],
+      where=sqlbuilder.AND(
+        sqlbuilder.IN(Srv4FileStats.q.id, srv4_ids[start:start + batch_size]),
+        Srv4FileStats.q.use_to_generate_catalogs==True))))
+    if not rows:
+      continue
+    # Blob columns need to be decoded by SQLObject.
+    gen_data_by_md5 = dict(
+        (x.md5_sum, x) for x in CatalogGenData.select(
+          sqlbuilder.IN(CatalogGenData.q.md5_sum, [row[4] for row in rows]),
+          connection=connection))
+    value_list = []
+    for srv4_id, catalogname, version, basename, md5_sum, size in rows:
+      gen_data = gen_data_by_md5.get(md5_sum)
+      if not gen_data:
+        logging.warning("There is no catalog generation data for %s.", md5_sum)
+        continue
+      entry = CatalogEntryFromRow(
+          (catalogname, version, gen_data.pkgname, basename, md5_sum, size,
+           gen_data.deps, gen_data.i_deps, gen_data.pkginfo_name))
+      if isinstance(catalogname, unicode):
+        catalogname = catalogname.encode('utf-8')
+      value_list.append([sqo_arch.id, sqo_osrel.id, sqo_catrel.id, srv4_id,
+                         catalogname, cjson.encode(entry)])
+    if not value_list:
+      continue
+    connection.query(connection.sqlrepr(sqlbuilder.Insert(
+      CatalogLine.sqlmeta.table,
+      valueList=value_list,
+      template=template)))
+
+
+def RebuildCatalogLines(sqo_osrel, sqo_arch, sqo_catrel):
+  """Writes all catalog lines of a catalog from scratch.
+
+  'pkgdb initdb' does it for all catalogs when it creates the CatalogLine
+  table. Also needed whenever catalog assignments have been changed bypassing
+  AddCatalogLines and DeleteCatalogLines.
+  """
+  connection = CatalogLine._connection
+  rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+    [Srv4FileInCatalog.q.srv4file],
+    where=sqlbuilder.AND(
+      Srv4FileInCatalog.q.osrel==sqo_osrel,
+      Srv4FileInCatalog.q.arch==sqo_arch,
+      Srv4FileInCatalog.q.catrel==sqo_catrel))))
+  trans = connection.transaction()
+  try:
+    DeleteCatalogLines(trans, sqo_osrel, sqo_arch, sqo_catrel)
+    AddCatalogLines(trans, sqo_osrel, sqo_arch, sqo_catrel,
+                    [row[0] for row in rows])
+    BumpCatalogRevision(trans, sqo_osrel, sqo_arch, sqo_catrel)
+  except:
+    trans.rollback()
+    raise
+  trans.commit(close=True)
+
+
+def IterQuery(select, connection=None, fetch_size=STREAM_FETCH_SIZE):
+  """Yields rows of a query, without reading all of them into memory.
+
+  On MySQL, a server-side cursor is used. The connection is held until the
+  generator is exhausted or garbage collected.
+
+  Args:
+    select: a sqlbuilder.Select object
+    connection: a DBAPI connection, None for the default one
+  """
+  if connection is None:
+    connection = sqlobject.sqlhub.processConnection
+  query = connection.sqlrepr(select)
+  rawconn = connection.getConnection()
+  try:
+    if connection.dbName == 'mysql':
+      import MySQLdb.cursors
+      cursor = rawconn.cursor(MySQLdb.cursors.SSCursor)
+    else:
+      cursor = rawconn.cursor()
+    try:
+      cursor.execute(query)
+      while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+          break
+        for row in rows:
+          yield row
+    finally:
+      cursor.close()
+  finally:
+    connection.releaseConnection(rawconn)
+
+
+def IterCatalogLines(sqo_osrel, sqo_arch, sqo_catrel):
+  """Yields JSON encoded catalog entries, ordered by catalogname."""
+  select = sqlbuilder.Select(
+    [CatalogLine.q.entry],
+    where=_CatalogLinesWhere(sqo_osrel, sqo_arch, sqo_catrel),
+    orderBy=CatalogLine.q.catalogname)
+  for row in IterQuery(select, CatalogLine._connection):
+    yield str(row[0])
+
+
+def GetCatalogLines(sqo_osrel, sqo_arch, sqo_catrel):
+  """Returns JSON encoded catalog entries, ordered by catalogname."""
+  return list(IterCatalogLines(sqo_osrel, sqo_arch, sqo_catrel))
+
+
+def _CatalogRevisionWhere(sqo_osrel, sqo_arch, sqo_catrel):
+  return sqlbuilder.AND(
+      CatalogRevision.q.osrel==sqo_osrel,
+      CatalogRevision.q.arch==sqo_arch,
+      CatalogRevision.q.catrel==sqo_catrel)
+
+
+def GetCatalogRevision(sqo_osrel, sqo_arch, sqo_catrel):
+  """Returns the revision of a catalog, 0 for a catalog never changed."""
+  connection = CatalogRevision._connection
+  rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+    [CatalogRevision.q.revision],
+    where=_CatalogRevisionWhere(sqo_osrel, sqo_arch, sqo_catrel))))
+  if not rows:
+    return 0
+  return int(rows[0][0])
+
+
+def GetCatalogEpoch():
+  """Returns the epoch of catalog revisions in this database.
+
+  Revisions start again from 0 when the CatalogRevision table is created, so
+  a revision number alone doesn't identify a version of a catalog. The epoch,
+  the time at which the table was created, tells such revisions apart. It's
+  set by NewCatalogEpoch(), or on first use.
+  """
+  connection = CswConfig._connection
+  rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+    [CswConfig.q.int_value],
+    where=CswConfig.q.option_key==CATALOG_EPOCH_OPTION)))
+  if rows:
+    return int(rows[0][0])
+  return NewCatalogEpoch()
+
+
+def NewCatalogEpoch():
+  """Starts a new epoch of catalog revisions, returns it."""
+  epoch = int(time.time())
+  connection = CswConfig._connection
+  where = CswConfig.q.option_key==CATALOG_EPOCH_OPTION
+  int_value = CswConfig.sqlmeta.columns['int_value'].dbName
+  rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+      [CswConfig.q.int_value], where=where)))
+  if rows:
+    # Two epochs started within a second still differ.
+    epoch = max(epoch, int(rows[0][0] or 0) + 1)
+    connection.query(connection.sqlrepr(sqlbuilder.Update(
+      CswConfig.sqlmeta.table, values={int_value: epoch}, where=where)))
+    return epoch
+  try:
+    connection.query(connection.sqlrepr(sqlbuilder.Insert(
+      CswConfig.sqlmeta.table,
+      values={CswConfig.sqlmeta.columns['option_key'].dbName:
+              CATALOG_EPOCH_OPTION,
+              int_value: epoch})))
+  except sqlobject.dberrors.DuplicateEntryError:
+    # Somebody else has started the epoch in the meantime.
+    return GetCatalogEpoch()
+  return epoch
+
+
+def BumpCatalogRevision(connection, sqo_osrel, sqo_arch, sqo_catrel):
+  """Increments the revision of a catalog.
+
+  Args:
+    connection: a connection or a transaction, None for the default one
+
+  Returns:
+    The new revision.
+  """
+  if connection is None:
+    connection = CatalogRevision._connection
+  where = _CatalogRevisionWhere(sqo_osrel, sqo_arch, sqo_catrel)
+  rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+    [CatalogRevision.q.id], where=where)))
+  if not rows:
+    columns = CatalogRevision.sqlmeta.columns
+    try:
+      connection.query(connection.sqlrepr(sqlbuilder.Insert(
+        CatalogRevision.sqlmeta.table,
+        values={columns['archID'].dbName: sqo_arch.id,
+                columns['osrelID'].dbName: sqo_osrel.id,
+                columns['catrelID'].dbName: sqo_catrel.id,
+                columns['revision'].dbName: 1})))
+      return 1
+    except sqlobject.dberrors.DuplicateEntryError:
+      # Somebody else has created the counter in the meantime.
+      pass
+  connection.query(connection.sqlrepr(sqlbuilder.Update(
+    CatalogRevision.sqlmeta.table,
+    values={CatalogRevision.sqlmeta.columns['revision'].dbName:
+            CatalogRevision.q.revision + 1},
+    where=where)))
+  rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+    [CatalogRevision.q.revision], where=where)))
+  return int(rows[0][0])
+
+
+def RecordCatalogChanges(connection, sqo_osrel, sqo_arch, sqo_catrel,
+                         changes, who):
+  """Bumps the revision of a catalog and appends changes to its log.
+
+  Args:
+    connection: a connection or a transaction, None for a new transaction
+    changes: a list of (action, md5_sum, catalogname) tuples, where action
+        is CATALOG_CHANGE_ADD or CATALOG_CHANGE_REMOVE
+    who: the user who made the changes
+
+  Returns:
+    The new revision.
+  """
+  if connection is None:
+    trans = CatalogChange._connection.transaction()
+    try:
+      revision = RecordCatalogChanges(
+          trans, sqo_osrel, sqo_arch, sqo_catrel, changes, who)
+    except:
+      trans.rollback()
+      raise
+    trans.commit(close=True)
+    return revision
+  revision = BumpCatalogRevision(connection, sqo_osrel, sqo_arch, sqo_catrel)
+  if isinstance(who, unicode):
+    who = who.encode('utf-8')
+  columns = CatalogChange.sqlmeta.columns
+  template = [columns[x].dbName for x in
+              ('archID', 'osrelID', 'catrelID', 'revision', 'action',
+               'md5_sum', 'catalogname', 'created_on', 'created_by')]
+  created_on = datetime.datetime.now()
+  changes = list(changes)
+  batch_size = CATALOG_CHANGE_INSERT_BATCH_SIZE
+  for start in xrange(0, len(changes), batch_size):
+    value_list = []
+    for action, md5_sum, catalogname in changes[start:start + batch_size]:
+      if isinstance(catalogname, unicode):
+        catalogname = catalogname.encode('utf-8')
+      value_list.append([sqo_arch.id, sqo_osrel.id, sqo_catrel.id, revision,
+                         action, md5_sum, catalogname, created_on, who])
+    connection.query(connection.sqlrepr(sqlbuilder.Insert(
+      CatalogChange.sqlmeta.table,
+      valueList=value_list,
+      template=template)))
+  return revision
+
+
+def DeleteCatalogAssignments(sqo_osrel, sqo_arch, sqo_catrel, assignments,
+                             removed, who):
+  """Removes packages from a catalog, with their catalog lines.
+
+  The change log entries are written in the same transaction.
+
+  Args:
+    assignments: (assignment id, srv4 id) pairs
+    removed: (md5_sum, catalogname) pairs of the removed packages, which
+        are recorded in the change log of the catalog
+    who: the user who removes the packages
+  """
+  trans = Srv4FileInCatalog._connection.transaction()
+  try:
+    batch_size = CATALOG_ASSIGNMENT_DELETE_BATCH_SIZE
+    for start in xrange(0, len(assignments), batch_size):
+      chunk = assignments[start:start + batch_size]
+      DeleteCatalogLines(trans, sqo_osrel, sqo_arch, sqo_catrel,
+                         [srv4_id for _, srv4_id in chunk])
+      trans.query(trans.sqlrepr(sqlbuilder.Delete(
+        Srv4FileInCatalog.sqlmeta.table,
+        where=sqlbuilder.IN(
+          Srv4FileInCatalog.q.id,
+          [assignment_id for assignment_id, _ in chunk]))))
+    RecordCatalogChanges(
+        trans, sqo_osrel, sqo_arch, sqo_catrel,
+        [(CATALOG_CHANGE_REMOVE, md5_sum, catalogname)
+         for md5_sum, catalogname in removed],
+        who)
+  except:
+    trans.rollback()
+    raise
+  trans.commit(close=True)
+
+
+def GetCatalogChanges(sqo_osrel, sqo_arch, sqo_catrel, since_revision,
+                      until_revision=None):
+  """Returns changes of a catalog made after the given revision.
+
+  Args:
+    until_revision: the last revision to return changes of, None for no limit
+
+  Returns:
+    A list of (revision, action, md5_sum, catalogname, created_on,
+    created_by) tuples, oldest first.
+  """
+  connection = CatalogChange._connection
+  where = sqlbuilder.AND(
+      CatalogChange.q.osrel==sqo_osrel,
+      CatalogChange.q.arch==sqo_arch,
+      CatalogChange.q.catrel==sqo_catrel,
+      CatalogChange.q.revision > since_revision)
+  if until_revision is not None:
+    where = sqlbuilder.AND(where, CatalogChange.q.revision <= until_revision)
+  rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+    [CatalogChange.q.revision,
+     CatalogChange.q.action,
+     CatalogChange.q.md5_sum,
+     CatalogChange.q.catalogname,
+     CatalogChange.q.created_on,
+     CatalogChange.q.created_by],
+    where=where,
+    orderBy=[CatalogChange.q.revision, CatalogChange.q.id])))
+  return rows
+
+
+# Number of md5 sums in a single query of GetMaintainersByMd5Sums().
+MAINTAINER_QUERY_SIZE = 1000
+
+
+def GetMaintainersByMd5Sums(md5_sums):
+  """Returns maintainers of many srv4 files, with one query per chunk.
+
+  Returns:
+    {md5_sum: (email, full_name)}, without srv4 files which are unknown.
+    Both fields are None for srv4 files without a maintainer.
+  """
+  connection = Srv4FileStats._connection
+  md5_sums = list(md5_sums)
+  maintainers = {}
+  for start in xrange(0, len(md5_sums), MAINTAINER_QUERY_SIZE):
+    rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+      [Srv4FileStats.q.md5_sum, Maintainer.q.email, Maintainer.q.full_name],
+      where=sqlbuilder.IN(
+        Srv4FileStats.q.md5_sum,
+        md5_sums[start:start + MAINTAINER_QUERY_SIZE]),
+      join=[sqlbuilder.LEFTJOINOn(None,
+        Maintainer,
+        Srv4FileStats.q.maintainer==Maintainer.q.id)])))
+    for md5_sum, email, full_name in rows:
+      maintainers[md5_sum] = (email, full_name)
+  return maintainers
+
+
 def GetRecentlyBuiltPackages():
   join = [
       # sqlbuilder.INNERJOINOn(None,
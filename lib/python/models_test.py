@@ -6,9 +6,10 @@ try:
 except ImportError:
   import unittest
 
+import cjson
+import datetime
 import mox
 import sqlobject
-import datetime
 
 from lib.python import models
 from lib.python import test_base
@@ -91,5 +92,142 @@ class Srv4FileStatsUnitTest(test_base.SqlObjectTestMixin,
     self.assertEqual(0, models.CheckpkgErrorTag.select().count())
 
 
+class CatalogLineUnitTest(test_base.SqlObjectTestMixin, unittest.TestCase):
+
+  def setUp(self):
+    super(CatalogLineUnitTest, self).setUp()
+    self.dbc.InitialDataImport()
+    self.sqo_arch = models.Architecture.selectBy(name='sparc').getOne()
+    self.sqo_osrel = models.OsRelease.selectBy(id=1).getOne()
+    self.sqo_catrel = models.CatalogRelease.selectBy(id=1).getOne()
+    self.triad = (self.sqo_osrel, self.sqo_arch, self.sqo_catrel)
+
+  def MakeSrv4InCatalog(self, name, deps):
+    srv4 = test_base.MakeSrv4(self.sqo_osrel, self.sqo_arch, 'CSW' + name,
+                              name * 32, size=1024L)
+    models.CatalogGenData(
+        md5_sum=name * 32,
+        deps=cjson.encode([[x, 'description'] for x in deps]),
+        i_deps=cjson.encode([]),
+        pkgname=srv4.pkginst_str,
+        pkginfo_name='%s - the %s package' % (name, name))
+    models.Srv4FileInCatalog(
+        arch=self.sqo_arch, osrel=self.sqo_osrel, catrel=self.sqo_catrel,
+        srv4file=srv4, created_by='test')
+    return srv4
+
+  def testAddAndDeleteCatalogLines(self):
+    srv4_b = self.MakeSrv4InCatalog('b', ['CSWcommon', 'SUNWfoo'])
+    srv4_a = self.MakeSrv4InCatalog('a', [])
+    models.AddCatalogLines(None, *(self.triad + ([srv4_a.id, srv4_b.id],)))
+    lines = models.GetCatalogLines(*self.triad)
+    self.assertEqual(
+        [['a', '1.0,REV=2011.01.01', 'CSWa', 'a.pkg', 'a' * 32, '1024',
+          'none', 'none', 'none', 'a - the a package'],
+         ['b', '1.0,REV=2011.01.01', 'CSWb', 'b.pkg', 'b' * 32, '1024',
+          'CSWcommon', 'none', 'none', 'b - the b package']],
+        [cjson.decode(x) for x in lines])
+    models.DeleteCatalogLines(None, *(self.triad + ([srv4_a.id],)))
+    self.assertEqual(1, len(models.GetCatalogLines(*self.triad)))
+    srv4_b.RemoveCatalogAssignments()
+    self.assertEqual([], models.GetCatalogLines(*self.triad))
+
+  def testRemoveCatalogAssignments(self):
+    srv4 = self.MakeSrv4InCatalog('a', [])
+    models.AddCatalogLines(None, *(self.triad + ([srv4.id],)))
+    srv4.DeleteAllDependentObjects(u'joe')
+    self.assertEqual([], models.GetCatalogLines(*self.triad))
+    self.assertEqual(0, models.Srv4FileInCatalog.select().count())
+    self.assertEqual(1, models.GetCatalogRevision(*self.triad))
+    self.assertEqual(
+        [(1, 'remove', 'a' * 32, 'a', 'joe')],
+        [(x[0], x[1], x[2], x[3], x[5])
+         for x in models.GetCatalogChanges(*(self.triad + (0,)))])
+
+  def testRemoveCatalogAssignmentsRolledBack(self):
+    srv4 = self.MakeSrv4InCatalog('a', [])
+    models.AddCatalogLines(None, *(self.triad + ([srv4.id],)))
+    def FailingRecordCatalogChanges(*args):
+      raise sqlobject.dberrors.OperationalError('connection lost')
+    record_catalog_changes = models.RecordCatalogChanges
+    models.RecordCatalogChanges = FailingRecordCatalogChanges
+    try:
+      self.assertRaises(sqlobject.dberrors.OperationalError,
+                        srv4.RemoveCatalogAssignments, u'joe')
+    finally:
+      models.RecordCatalogChanges = record_catalog_changes
+    self.assertEqual(1, len(models.GetCatalogLines(*self.triad)))
+    self.assertEqual(1, models.Srv4FileInCatalog.select().count())
+
+  def testRebuildCatalogLines(self):
+    self.MakeSrv4InCatalog('a', ['CSWcommon'])
+    self.MakeSrv4InCatalog('b', [])
+    models.RebuildCatalogLines(*self.triad)
+    lines = [cjson.decode(x) for x in models.GetCatalogLines(*self.triad)]
+    self.assertEqual(['a', 'b'], [x[0] for x in lines])
+    self.assertEqual('CSWcommon', lines[0][6])
+    # Rebuilding again replaces the lines.
+    models.RebuildCatalogLines(*self.triad)
+    self.assertEqual(2, len(models.GetCatalogLines(*self.triad)))
+
+  def testFilledWhenTableCreated(self):
+    self.MakeSrv4InCatalog('a', [])
+    # A database from before the catalog_line table.
+    models.CatalogLine.dropTable()
+    created_tables = self.dbc.CreateTables()
+    self.assertEqual([models.CatalogLine], created_tables)
+    self.dbc.FillNewTables(created_tables)
+    self.assertEqual(1, len(models.GetCatalogLines(*self.triad)))
+
+
+class CatalogRevisionUnitTest(test_base.SqlObjectTestMixin, unittest.TestCase):
+
+  def setUp(self):
+    super(CatalogRevisionUnitTest, self).setUp()
+    self.dbc.InitialDataImport()
+    self.sqo_osrel = models.OsRelease.selectBy(id=1).getOne()
+    self.sqo_arch = models.Architecture.selectBy(name='sparc').getOne()
+    self.sqo_catrel = models.CatalogRelease.selectBy(id=1).getOne()
+    self.triad = (self.sqo_osrel, self.sqo_arch, self.sqo_catrel)
+
+  def testBumpCatalogRevision(self):
+    self.assertEqual(0, models.GetCatalogRevision(*self.triad))
+    models.BumpCatalogRevision(None, *self.triad)
+    self.assertEqual(1, models.GetCatalogRevision(*self.triad))
+    models.BumpCatalogRevision(None, *self.triad)
+    self.assertEqual(2, models.GetCatalogRevision(*self.triad))
+    other_arch = models.Architecture.selectBy(name='i386').getOne()
+    self.assertEqual(0, models.GetCatalogRevision(
+      self.sqo_osrel, other_arch, self.sqo_catrel))
+
+  def testCatalogEpoch(self):
+    epoch = models.GetCatalogEpoch()
+    self.assertEqual(epoch, models.GetCatalogEpoch())
+    new_epoch = models.NewCatalogEpoch()
+    self.assertTrue(new_epoch > epoch)
+    self.assertEqual(new_epoch, models.GetCatalogEpoch())
+
+  def testRecordCatalogChanges(self):
+    revision = models.RecordCatalogChanges(
+        None, *(self.triad + (
+          [(models.CATALOG_CHANGE_ADD, 'a' * 32, u'foo'),
+           (models.CATALOG_CHANGE_REMOVE, 'b' * 32, u'bar')], u'joe')))
+    self.assertEqual(1, revision)
+    models.RecordCatalogChanges(
+        None, *(self.triad + (
+          [(models.CATALOG_CHANGE_REMOVE, 'a' * 32, u'foo')], u'jane')))
+    self.assertEqual(2, models.GetCatalogRevision(*self.triad))
+    changes = models.GetCatalogChanges(*(self.triad + (0,)))
+    self.assertEqual(
+        [(1, 'add', 'a' * 32, 'foo', 'joe'),
+         (1, 'remove', 'b' * 32, 'bar', 'joe'),
+         (2, 'remove', 'a' * 32, 'foo', 'jane')],
+        [(x[0], x[1], x[2], x[3], x[5]) for x in changes])
+    self.assertEqual(
+        ['remove'],
+        [x[1] for x in models.GetCatalogChanges(*(self.triad + (1,)))])
+    self.assertEqual(
+        2, len(models.GetCatalogChanges(*(self.triad + (0, 1)))))
+
 if __name__ == '__main__':
   unittest.main()
@@ -5,6 +5,7 @@ import copy
 import dateutil.parser
 import itertools
 import logging
+import multiprocessing
 import mute_progressbar
 import os
 import pprint
@@ -101,10 +102,38 @@ class PackageStats(object):
     return self.rest_client.GetBlob('pkgstats', self.GetMd5sum())
 
 
+# How many packages a single collect_pkg_metadata.py process indexes. The
+# process keeps its ELF extraction pool across these packages, and is then
+# replaced, so that memory leaked while indexing is given back.
+PACKAGES_PER_PROCESS = 50
+
+
+def _RunCollectPkgMetadata(job):
+  """Runs collect_pkg_metadata.py for a batch of catalog entries.
+
+  Defined at the module level, so that it can be sent to the worker processes
+  of a multiprocessing.Pool.
+
+  Args:
+    job: A tuple of (indexes, args, stderr_file).
+
+  Returns:
+    A tuple of (indexes, stdout lines), one line per index.
+  """
+  indexes, args, stderr_file = job
+  unused_ret_code, stdout, unused_stderr = shell.ShellCommand(
+      args, allow_error=False, stderr=stderr_file)
+  lines = [x for x in stdout.splitlines() if x.strip()]
+  if len(lines) != len(indexes):
+    raise PackageError("Expected %d results from %r, got %d: %r"
+                       % (len(indexes), args, len(lines), stdout))
+  return indexes, lines
+
+
 class StatsCollector(object):
   """Takes a list of files and makes sure they're put in a database."""
 
-  def __init__(self, logger=None, debug=False):
+  def __init__(self, logger=None, debug=False, workers=None):
     if logger:
       self.logger = logger
     else:
@@ -114,17 +143,41 @@ class StatsCollector(object):
     self.rest_client = rest.RestClient(
         pkgdb_url=self.config.get('rest', 'pkgdb'),
         releases_url=self.config.get('rest', 'releases'))
+    if workers is None:
+      workers = 1
+      if self.config.has_option('indexing', 'workers'):
+        workers = self.config.getint('indexing', 'workers')
+    if workers < 1:
+      raise PackageError("The number of workers must be at least 1, got %r."
+                         % workers)
+    self.workers = workers
+
+  def _VerifyMd5Sum(self, catalog_entry, data_back):
+    if data_back['md5_sum'] != catalog_entry['md5sum']:
+      msg = ('Unexpected file content: catalog said '
+             'that %r would have MD5 sum %r but it '
+             'turned out to be %r when read from allpkgs. '
+             'We cannot continue, because we have no '
+             'access to the data we are asked to examine.'
+             % (catalog_entry['file_basename'],
+                catalog_entry['md5sum'],
+                data_back['md5_sum']))
+      raise PackageError(msg)
 
   def CollectStatsFromCatalogEntries(self, catalog_entries, force_unpack=False):
-    """Returns: A list of md5 sums of collected statistics."""
+    """Returns: A list of md5 sums of collected statistics.
+
+    Packages are indexed in batches of up to PACKAGES_PER_PROCESS, each by
+    one collect_pkg_metadata.py process. With more than one worker, batches
+    are processed by a pool of processes.
+    The returned list follows the order of catalog_entries regardless of the
+    order in which the workers finish.  If any of the packages fails, the
+    remaining jobs are abandoned and the error is raised.
+    """
     args_display = [x['file_basename'] for x in catalog_entries]
     if len(args_display) > 5:
       args_display = args_display[:5] + ["...more..."]
     self.logger.debug("Processing: %s, please be patient", args_display)
-    md5_sum_list = []
-    # Reversing the item order in the list, so that the pop() method can be used
-    # to get packages, and the order of processing still matches the one in the
-    # catalog file.
     total_packages = len(catalog_entries)
     if not total_packages:
       raise PackageError("The length of package list is zero.")
@@ -144,8 +197,13 @@ class StatsCollector(object):
       pbar.start()
     base_dir, _ = os.path.split(__file__)
     collect_pkg_metadata = os.path.join(base_dir, "collect_pkg_metadata.py")
-    for catalog_entry in catalog_entries:
-      pkg_file_name = catalog_entry['pkg_path']
+    workers = min(self.workers, total_packages)
+    # Each worker gets at least one batch.
+    batch_size = min(PACKAGES_PER_PROCESS,
+                     (total_packages + workers - 1) // workers)
+    jobs = []
+    for start in xrange(0, total_packages, batch_size):
+      indexes = range(start, min(start + batch_size, total_packages))
       args = [collect_pkg_metadata]
       stderr_file = subprocess.PIPE
       if self.debug:
@@ -153,25 +211,39 @@ class StatsCollector(object):
         stderr_file = None
       if force_unpack:
         args += ['--force-unpack']
-      args += ['--input', pkg_file_name]
-      ret_code, stdout, stderr = shell.ShellCommand(args, allow_error=False,
-                                                    stderr=stderr_file)
-      try:
-        data_back = cjson.decode(stdout)
-        if data_back['md5_sum'] != catalog_entry['md5sum']:
-          msg = ('Unexpected file content: catalog said '
-                 'that %r would have MD5 sum %r but it '
-                 'turned out to be %r when read from allpkgs. '
-                 'We cannot continue, because we have no '
-                 'access to the data we are asked to examine.'
-                 % (catalog_entry['file_basename'],
-                    catalog_entry['md5sum'],
-                    data_back['md5_sum']))
-          raise PackageError(msg)
-        md5_sum_list.append(data_back['md5_sum'])
-      except cjson.DecodeError:
-        logging.fatal('Could not deserialize %r', stdout)
-        raise
-      pbar.update(counter.next())
+      for index in indexes:
+        args += ['--input', catalog_entries[index]['pkg_path']]
+      jobs.append((indexes, args, stderr_file))
+    pool = None
+    if workers > 1:
+      self.logger.info("Using %d workers.", workers)
+      pool = multiprocessing.Pool(workers)
+      results = pool.imap_unordered(_RunCollectPkgMetadata, jobs)
+    else:
+      results = itertools.imap(_RunCollectPkgMetadata, jobs)
+    md5_sum_by_index = {}
+    try:
+      for indexes, lines in results:
+        for index, line in zip(indexes, lines):
+          catalog_entry = catalog_entries[index]
+          try:
+            data_back = cjson.decode(line)
+          except cjson.DecodeError:
+            logging.fatal('Could not deserialize %r', line)
+            raise
+          self._VerifyMd5Sum(catalog_entry, data_back)
+          md5_sum_by_index[index] = data_back['md5_sum']
+          pbar.update(counter.next())
+    except:
+      if pool:
+        # Abandons the jobs which haven't finished yet, so that the batch
+        # fails as a whole. Stats of packages which were already unpacked
+        # stay in the database; saving them again later is idempotent.
+        pool.terminate()
+        pool.join()
+      raise
+    if pool:
+      pool.close()
+      pool.join()
     pbar.finish()
-    return md5_sum_list
+    return [md5_sum_by_index[i] for i in xrange(total_packages)]
@@ -1,8 +1,86 @@
 #!/usr/bin/env python2.6
 
+import cjson
 import logging
+import mox
 import unittest
 
+from lib.python import package_stats
+from lib.python import shell
+
+
+def InputsAre(pkg_paths):
+  """Matches collect_pkg_metadata.py arguments with given input files."""
+  def Matches(args):
+    inputs = [args[i + 1] for i, x in enumerate(args) if x == '--input']
+    return inputs == pkg_paths
+  return mox.Func(Matches)
+
+
+class StatsCollectorUnitTest(mox.MoxTestBase):
+
+  def setUp(self):
+    super(StatsCollectorUnitTest, self).setUp()
+    self.entries = [
+        {'pkg_path': '/tmp/foo.pkg.gz', 'file_basename': 'foo.pkg.gz',
+         'md5sum': 'a' * 32},
+        {'pkg_path': '/tmp/bar.pkg.gz', 'file_basename': 'bar.pkg.gz',
+         'md5sum': 'b' * 32},
+    ]
+
+  def testDefaultWorkers(self):
+    collector = package_stats.StatsCollector(debug=True)
+    self.assertTrue(collector.workers >= 1)
+
+  def testBadWorkers(self):
+    self.assertRaises(package_stats.PackageError,
+                      package_stats.StatsCollector, debug=True, workers=0)
+
+  def testSequentialKeepsOrder(self):
+    self.mox.StubOutWithMock(shell, 'ShellCommand')
+    shell.ShellCommand(
+        InputsAre(['/tmp/foo.pkg.gz', '/tmp/bar.pkg.gz']), allow_error=False,
+        stderr=None).AndReturn(
+            (0, '\n'.join(cjson.encode({'md5_sum': entry['md5sum']})
+                           for entry in self.entries) + '\n', ''))
+    self.mox.ReplayAll()
+    collector = package_stats.StatsCollector(debug=True, workers=1)
+    self.assertEqual(['a' * 32, 'b' * 32],
+                     collector.CollectStatsFromCatalogEntries(self.entries))
+
+  def testBatches(self):
+    self.stubs.Set(package_stats, 'PACKAGES_PER_PROCESS', 1)
+    self.mox.StubOutWithMock(shell, 'ShellCommand')
+    for entry in self.entries:
+      shell.ShellCommand(
+          InputsAre([entry['pkg_path']]), allow_error=False, stderr=None).AndReturn(
+              (0, cjson.encode({'md5_sum': entry['md5sum']}), ''))
+    self.mox.ReplayAll()
+    collector = package_stats.StatsCollector(debug=True, workers=1)
+    self.assertEqual(['a' * 32, 'b' * 32],
+                     collector.CollectStatsFromCatalogEntries(self.entries))
+
+  def testMissingResult(self):
+    self.mox.StubOutWithMock(shell, 'ShellCommand')
+    shell.ShellCommand(
+        mox.IsA(list), allow_error=False, stderr=None).AndReturn(
+            (0, cjson.encode({'md5_sum': 'a' * 32}), ''))
+    self.mox.ReplayAll()
+    collector = package_stats.StatsCollector(debug=True, workers=1)
+    self.assertRaises(package_stats.PackageError,
+                      collector.CollectStatsFromCatalogEntries, self.entries)
+
+  def testMd5Mismatch(self):
+    self.mox.StubOutWithMock(shell, 'ShellCommand')
+    shell.ShellCommand(
+        mox.IsA(list), allow_error=False, stderr=None).AndReturn(
+            (0, '%s\n%s\n' % (cjson.encode({'md5_sum': 'c' * 32}),
+                              cjson.encode({'md5_sum': 'b' * 32})), ''))
+    self.mox.ReplayAll()
+    collector = package_stats.StatsCollector(debug=True, workers=1)
+    self.assertRaises(package_stats.PackageError,
+                      collector.CollectStatsFromCatalogEntries, self.entries)
+
 
 if __name__ == '__main__':
   logging.basicConfig(level=logging.CRITICAL)
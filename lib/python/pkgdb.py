@@ -18,11 +18,13 @@ import re
 import socket
 import sqlobject
 import sys
+import time
 
 from sqlobject import sqlbuilder
 from Cheetah.Template import Template
 
 from lib.python import catalog
+from lib.python import catalog_file_index
 from lib.python import checkpkg_lib
 from lib.python import common_constants
 from lib.python import configuration
@@ -52,6 +54,8 @@ USAGE = """
        %prog sync-cat-from-file <osrel> <arch> <cat-release> <catalog-file>
        %prog sync-catalogs-from-tree <cat-release> <opencsw-dir>
        %prog gen-cat <allpkgs> <opencsw-dir>
+       %prog build-file-index [ <osrel> <arch> <cat-release> ]
+       %prog rebuild-catalog-lines [ <osrel> <arch> <cat-release> ]
        %prog show cat [options]
 
   Inspecting individual packages:
@@ -100,6 +104,8 @@ CATALOGS_ALLOWED_TO_BE_IMPORTED = frozenset([
   "legacy",
   "unstable",
 ])
+# The number of md5 sums or ids in a single IN clause during a catalog sync.
+SYNC_QUERY_SIZE = 1000
 
 
 class Error(Exception):
@@ -114,6 +120,25 @@ class OpencswTreeError(Error):
   "A problem with the OpenCSW directory tree."
 
 
+class PhaseTimer(object):
+  """Measures how long consecutive phases of an operation take."""
+
+  def __init__(self):
+    self.phases = []
+    self.last_time = time.time()
+
+  def Finish(self, name):
+    now = time.time()
+    self.phases.append((name, now - self.last_time))
+    self.last_time = now
+
+  def __str__(self):
+    total = sum(seconds for _, seconds in self.phases)
+    return ", ".join(
+        ["%s %.1fs" % phase for phase in self.phases]
+        + ["total %.1fs" % total])
+
+
 class HtmlGenerator(object):
 
   def __init__(self, identifiers, template=None, rest_client=None, debug=False):
@@ -205,8 +230,9 @@ def GetPkg(some_id):
 
 class CatalogImporter(object):
 
-  def __init__(self, debug=False):
+  def __init__(self, debug=False, workers=None):
     self.debug = debug
+    self.workers = workers
     config = configuration.GetConfig()
     username, password = rest.GetUsernameAndPassword()
     self.rest_client = rest.RestClient(
@@ -215,42 +241,40 @@ class CatalogImporter(object):
         username=username,
         password=password,
         debug=debug)
+    self.file_index_store = catalog_file_index.GetFileIndexStore(config)
 
   def SyncFromCatalogFile(self, osrel, arch, catrel, catalog_file,
       force_unpack=False):
     """Syncs a given catalog from a catalog file.
 
-    Imports srv4 files if necessary.
+    Imports srv4 files if necessary. The difference between the catalog file
+    and the database is computed with a single query, and applied in bulk.
     """
     if catrel not in CATALOGS_ALLOWED_TO_BE_IMPORTED:
       raise UsageError("Catalogs that can be imported: %s"
                        % CATALOGS_ALLOWED_TO_BE_IMPORTED)
 
+    timer = PhaseTimer()
     catalog_dir = os.path.dirname(catalog_file)
     # The plan:
     # - read in the catalog file, and build a md5-filename correspondence
     # data structure.
     logging.debug("Reading the catalog file from disk.")
     src_catalog = catalog.OpencswCatalog(open(catalog_file, "rb"))
-    catalog_data = src_catalog.GetCatalogData()
     cat_entry_by_md5 = {}
-    cat_entry_by_basename = {}
-    for catalog_entry in catalog_data:
+    for catalog_entry in src_catalog.IterCatalogData():
       cat_entry_by_md5[catalog_entry["md5sum"]] = catalog_entry
-      cat_entry_by_basename[catalog_entry["file_basename"]] = catalog_entry
+    timer.Finish("read")
 
     # - import all srv4 files that were not in the database so far
-    entries_to_import = []
-
     logging.debug("Checking which srv4 files have already been indexed.")
     existence_data = (
         self.rest_client.BulkQueryStatsExistence(list(cat_entry_by_md5)))
     entries_to_import = [cat_entry_by_md5[x]
                          for x in existence_data['missing_stats']]
-
-    md5_sums = []
     if entries_to_import:
-      collector = package_stats.StatsCollector(logger=logging, debug=self.debug)
+      collector = package_stats.StatsCollector(
+          logger=logging, debug=self.debug, workers=self.workers)
       for entry in entries_to_import:
         entry['pkg_path'] = os.path.join(catalog_dir, entry['file_basename'])
       if len(entries_to_import) < 15:
@@ -259,8 +283,9 @@ class CatalogImporter(object):
           logging.info(" + %s", basename)
       else:
         logging.info('Importing %d packages.', len(entries_to_import))
-      md5_sums = collector.CollectStatsFromCatalogEntries(
+      collector.CollectStatsFromCatalogEntries(
           entries_to_import, force_unpack=force_unpack)
+    timer.Finish("import")
 
     # - sync the specific catalog
     #   - find the md5 sum list of the current catalog
@@ -268,38 +293,25 @@ class CatalogImporter(object):
     sqo_osrel = m.OsRelease.selectBy(short_name=osrel).getOne()
     sqo_arch = m.Architecture.selectBy(name=arch).getOne()
     sqo_catrel = m.CatalogRelease.selectBy(name=catrel).getOne()
-    res = m.Srv4FileInCatalog.select(
-        sqlobject.AND(
-          m.Srv4FileInCatalog.q.osrel==sqo_osrel,
-          m.Srv4FileInCatalog.q.arch==sqo_arch,
-          m.Srv4FileInCatalog.q.catrel==sqo_catrel))
-    db_srv4s_in_cat_by_md5 = {}
-    # TODO(maciej): Convert package removals to REST. Maybe in bulk?
-    for srv4_in_cat in res:
-      try:
-        srv4 = srv4_in_cat.srv4file
-        if srv4.use_to_generate_catalogs:
-          db_srv4s_in_cat_by_md5[srv4.md5_sum] = srv4_in_cat
-      except sqlobject.main.SQLObjectNotFound as e:
-        logging.warning("Could not retrieve a srv4 file from the db: %s", e)
-        # Since the srv4_in_cat object has lost its reference, there's no use
-        # keeping it around.
-        srv4_in_cat.destroySelf()
+    assignments_by_md5, dangling = self._GetCatalogAssignments(
+        sqo_osrel, sqo_arch, sqo_catrel)
+    if dangling:
+      logging.warning("%d catalog assignments refer to srv4 files which are "
+                      "not in the database.", len(dangling))
 
-    disk_md5s = set(cat_entry_by_md5)
-    db_md5s = set(db_srv4s_in_cat_by_md5)
     #   - match the md5 sum lists between db and disk
-    md5_sums_to_add = disk_md5s.difference(db_md5s)
-    md5_sums_to_remove = db_md5s.difference(disk_md5s)
+    disk_md5s = set(cat_entry_by_md5)
+    db_md5s = set(assignments_by_md5)
+    md5_sums_to_add = sorted(disk_md5s.difference(db_md5s))
+    md5_sums_to_remove = sorted(db_md5s.difference(disk_md5s))
+    timer.Finish("diff")
     logging.info("There are %s packages to remove and %s to add",
                  len(md5_sums_to_remove),
                  len(md5_sums_to_add))
     if md5_sums_to_remove:
       logging.info("To remove from %s %s %s:", osrel, arch, catrel)
       for md5 in md5_sums_to_remove:
-        logging.info(
-            " - %s",
-            db_srv4s_in_cat_by_md5[md5].srv4file.basename)
+        logging.info(" - %s", assignments_by_md5[md5][2])
 
     if md5_sums_to_add and len(md5_sums_to_add) < 15:
       logging.info("To add to from %s %s %s:", osrel, arch, catrel)
@@ -308,54 +320,137 @@ class CatalogImporter(object):
             " + %s",
             cat_entry_by_md5[md5]["file_basename"])
 
-    user = getpass.getuser()
     # Remove
     # We could use checkpkg_lib.Catalog.RemoveSrv4(), but it would redo
     # many of the database queries and would be much slower.
-    if md5_sums_to_remove:
+    to_delete = dangling + [assignments_by_md5[x][:2]
+                            for x in md5_sums_to_remove]
+    if to_delete:
       logging.info("Removing %d packages from the %s %s %s catalog.",
                    len(md5_sums_to_remove), osrel, arch, catrel)
-      for md5 in md5_sums_to_remove:
-        db_srv4s_in_cat_by_md5[md5].destroySelf()
-
-    if not md5_sums_to_add:
-      return
-    logging.info("Adding %d packages to the %s %s %s catalog.",
-                 len(md5_sums_to_add),
-                 osrel, arch, catrel)
-    pbar = progressbar.ProgressBar(widgets=[
-      progressbar.widgets.Percentage(),
-      ' ',
-      progressbar.widgets.ETA(),
-      ' ',
-      progressbar.widgets.Bar()
-    ])
-    pbar.maxval = len(md5_sums_to_add)
-    pbar.start()
-    counter = itertools.count(1)
-    for md5 in md5_sums_to_add:
-      logging.debug("Adding %s", cat_entry_by_md5[md5]["file_basename"])
-
+      m.DeleteCatalogAssignments(
+          sqo_osrel, sqo_arch, sqo_catrel, to_delete,
+          [(md5, assignments_by_md5[md5][3]) for md5 in md5_sums_to_remove],
+          getpass.getuser())
+    timer.Finish("remove")
+
+    failed = []
+    if md5_sums_to_add:
+      logging.info("Adding %d packages to the %s %s %s catalog.",
+                   len(md5_sums_to_add),
+                   osrel, arch, catrel)
       # Explicitly calling the RegisterLevelTwo function, in case the
       # packages have the flag "use_in_catalogs" set to False. Calling
       # this function will set it to True.
       # Note: This makes populating catalogs really, really slow, and
       # causes subsequent runs to be slow as well. It should only be
       # a temporary measure.
-      try:
-        pkg = m.Srv4FileStats.selectBy(md5_sum=md5).getOne()
-        if (not pkg.registered_level_two or
-            not pkg.use_to_generate_catalogs):
-          self.rest_client.RegisterLevelTwo(md5, use_in_catalogs=True)
-      except sqlobject.main.SQLObjectNotFound:
-        pass
+      md5_sums_to_register = self._GetMd5SumsToRegister(md5_sums_to_add)
+      if md5_sums_to_register:
+        logging.info("Registering %d packages for catalogs.",
+                     len(md5_sums_to_register))
+      pbar = progressbar.ProgressBar(widgets=[
+        progressbar.widgets.Percentage(),
+        ' ',
+        progressbar.widgets.ETA(),
+        ' ',
+        progressbar.widgets.Bar()
+      ])
+      pbar.maxval = len(md5_sums_to_register)
+      pbar.start()
+      counter = itertools.count(1)
+      for md5 in md5_sums_to_register:
+        logging.debug("Registering %s", cat_entry_by_md5[md5]["file_basename"])
+        self.rest_client.RegisterLevelTwo(md5, use_in_catalogs=True)
+        pbar.update(counter.next())
+      pbar.finish()
+      timer.Finish("register")
 
       # No need to explicitly register the package here; the REST
       # interface will implicitly take care of that (except it will not
       # touch the "use_package_in_catalogs" flag.
-      self.rest_client.AddSvr4ToCatalog(catrel, arch, osrel, md5)
-      pbar.update(counter.next())
-    pbar.finish()
+      results = self.rest_client.AddSvr4sToCatalog(
+          catrel, arch, osrel, md5_sums_to_add)
+      for result in results:
+        if result['status'] == 'error':
+          logging.error("Could not add %s to %s %s %s: %s",
+                        cat_entry_by_md5[result['md5_sum']]["file_basename"],
+                        osrel, arch, catrel, result['message'])
+          failed.append(result['md5_sum'])
+      timer.Finish("add")
+
+    if to_delete or md5_sums_to_add:
+      self.BuildFileIndex(osrel, arch, catrel)
+      timer.Finish("index")
+    logging.info("Synced %s %s %s: %s", catrel, arch, osrel, timer)
+    if failed:
+      raise Error("%d packages could not be added to %s %s %s."
+                  % (len(failed), osrel, arch, catrel))
+
+  def _GetCatalogAssignments(self, sqo_osrel, sqo_arch, sqo_catrel):
+    """Reads the assignments of a catalog with a single query.
+
+    Packages which are not used to generate catalogs (e.g. system packages)
+    are skipped.
+
+    Returns:
+      A tuple of ({md5_sum: (assignment id, srv4 id, basename, catalogname)},
+      [...]),
+      where the list contains (assignment id, srv4 id) tuples of assignments
+      of srv4 files which don't exist.
+    """
+    connection = m.Srv4FileInCatalog._connection
+    rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+      [m.Srv4FileInCatalog.q.id,
+       m.Srv4FileInCatalog.q.srv4file,
+       m.Srv4FileStats.q.md5_sum,
+       m.Srv4FileStats.q.basename,
+       m.Srv4FileStats.q.catalogname,
+       m.Srv4FileStats.q.use_to_generate_catalogs],
+      where=sqlobject.AND(
+        m.Srv4FileInCatalog.q.osrel==sqo_osrel,
+        m.Srv4FileInCatalog.q.arch==sqo_arch,
+        m.Srv4FileInCatalog.q.catrel==sqo_catrel),
+      join=[sqlbuilder.LEFTJOINOn(None,
+        m.Srv4FileStats,
+        m.Srv4FileInCatalog.q.srv4file==m.Srv4FileStats.q.id)])))
+    assignments_by_md5 = {}
+    dangling = []
+    for (assignment_id, srv4_id, md5_sum, basename, catalogname,
+         use_in_catalogs) in rows:
+      if md5_sum is None:
+        dangling.append((assignment_id, srv4_id))
+      elif use_in_catalogs:
+        assignments_by_md5[md5_sum] = (
+            assignment_id, srv4_id, basename, catalogname)
+    return assignments_by_md5, dangling
+
+  def _GetMd5SumsToRegister(self, md5_sums):
+    """Returns md5 sums of known packages which aren't used in catalogs yet.
+
+    Packages which aren't in the database yet are registered by the REST
+    interface when they are added to a catalog.
+    """
+    connection = m.Srv4FileStats._connection
+    to_register = set()
+    for start in xrange(0, len(md5_sums), SYNC_QUERY_SIZE):
+      rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+        [m.Srv4FileStats.q.md5_sum],
+        where=sqlobject.AND(
+          sqlbuilder.IN(m.Srv4FileStats.q.md5_sum,
+                        md5_sums[start:start + SYNC_QUERY_SIZE]),
+          sqlobject.OR(
+            m.Srv4FileStats.q.registered_level_two==False,
+            m.Srv4FileStats.q.use_to_generate_catalogs==False)))))
+      to_register.update(row[0] for row in rows)
+    return sorted(to_register)
+
+  def BuildFileIndex(self, osrel, arch, catrel):
+    """Rebuilds the file index of a catalog, if indexes are enabled."""
+    if not self.file_index_store:
+      return
+    logging.info("Building the file index of %s %s %s.", catrel, arch, osrel)
+    self.file_index_store.Build(checkpkg_lib.Catalog(), osrel, arch, catrel)
 
   def SyncFromCatalogTree(self, catrel, base_dir, force_unpack=False):
     logging.debug("SyncFromCatalogTree(%s, %s, force_unpack=%s)",
@@ -411,6 +506,10 @@ def main():
   parser.add_option("--force-unpack", dest="force_unpack",
                     default=False, action="store_true",
                     help="Force unpacking of packages")
+  parser.add_option("--workers", dest="workers",
+                    default=None, type="int",
+                    help=("Number of packages to unpack in parallel "
+                          "(default: [indexing] workers from the config)"))
   options, args = parser.parse_args()
 
   logging_level = logging.INFO
@@ -473,7 +572,8 @@ def main():
   elif command == 'importpkg':
     collector = package_stats.StatsCollector(
         logger=logging,
-        debug=options.debug)
+        debug=options.debug,
+        workers=options.workers)
     file_list = args
     catalog_entries = []
     for file_name in file_list:
@@ -515,7 +615,7 @@ def main():
             "in question is part of at least one catalog.")
       else:
         logging.info("Removing %s", srv4)
-        srv4.DeleteAllDependentObjects()
+        srv4.DeleteAllDependentObjects(getpass.getuser())
         srv4.destroySelf()
   elif command == 'add-to-cat':
     if len(args) < 4:
@@ -596,14 +696,43 @@ def main():
     if len(args) != 4:
       raise UsageError("Wrong number of arguments, see usage.")
     osrel, arch, catrel, catalog_file = args
-    ci = CatalogImporter(debug=options.debug)
+    ci = CatalogImporter(debug=options.debug, workers=options.workers)
     ci.SyncFromCatalogFile(osrel, arch, catrel, catalog_file)
   elif command == 'sync-catalogs-from-tree':
     if len(args) != 2:
       raise UsageError("Wrong number of arguments, see usage.")
-    ci = CatalogImporter(debug=options.debug)
+    ci = CatalogImporter(debug=options.debug, workers=options.workers)
     catrel, base_dir = args
     ci.SyncFromCatalogTree(catrel, base_dir, options.force_unpack)
+  elif command == 'build-file-index':
+    if args and len(args) != 3:
+      raise UsageError("Wrong number of arguments, see usage.")
+    file_index_store = catalog_file_index.GetFileIndexStore()
+    if not file_index_store:
+      raise UsageError(
+          "File indexes are not enabled, see the [file_index] section "
+          "of the configuration.")
+    if args:
+      triads = [tuple(args)]
+    else:
+      triads = [(osrel, arch, sqo_catrel.name)
+                for sqo_catrel in m.CatalogRelease.select()
+                for arch in common_constants.PHYSICAL_ARCHITECTURES
+                for osrel in common_constants.OS_RELS]
+    db_catalog = checkpkg_lib.Catalog()
+    for osrel, arch, catrel in triads:
+      logging.info("Building the file index of %s %s %s.", catrel, arch, osrel)
+      try:
+        file_index_store.Build(db_catalog, osrel, arch, catrel)
+      except sqlobject.main.SQLObjectNotFound as e:
+        logging.warning("Skipping %s %s %s: %s", catrel, arch, osrel, e)
+  elif command == 'rebuild-catalog-lines':
+    if args and len(args) != 3:
+      raise UsageError("Wrong number of arguments, see usage.")
+    if args:
+      database.RebuildCatalogLines(*args)
+    else:
+      database.RebuildAllCatalogLines()
   elif (command, subcommand) == ('show', 'cat'):
     sqo_osrel, sqo_arch, sqo_catrel = m.GetSqoTriad(
         options.osrel, options.arch, options.catrel)
@@ -1,9 +1,15 @@
 #!/usr/bin/env python2.6
 # coding=utf-8
 
-import unittest
-import pkgdb
 import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.python import models
+from lib.python import pkgdb
+from lib.python import test_base
 
 class CatalogImporterUnitTest(unittest.TestCase):
 
@@ -15,6 +21,99 @@ class CatalogImporterUnitTest(unittest.TestCase):
           "/home/mirror/opencsw/current", "SunOS5.9", "sparc"))
 
 
+class FakeRestClient(object):
+
+  def __init__(self):
+    self.registered = []
+    self.added = []
+
+  def BulkQueryStatsExistence(self, md5_sum_list):
+    return {'existing_stats': md5_sum_list, 'missing_stats': []}
+
+  def RegisterLevelTwo(self, md5_sum, use_in_catalogs=True):
+    self.registered.append(md5_sum)
+
+  def AddSvr4sToCatalog(self, catrel, arch, osrel, md5_sums):
+    self.added.append((catrel, arch, osrel, md5_sums))
+    return [{'md5_sum': x, 'status': 'added', 'removed': []}
+            for x in md5_sums]
+
+
+class SyncFromCatalogFileUnitTest(test_base.SqlObjectTestMixin,
+                                  unittest.TestCase):
+
+  def setUp(self):
+    super(SyncFromCatalogFileUnitTest, self).setUp()
+    self.dbc.InitialDataImport()
+    self.tmpdir = tempfile.mkdtemp(prefix='pkgdb_test-')
+    self.sqo_arch = models.Architecture.selectBy(name='sparc').getOne()
+    self.sqo_osrel = models.OsRelease.selectBy(short_name='SunOS5.10').getOne()
+    self.sqo_catrel = models.CatalogRelease.selectBy(name='unstable').getOne()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    super(SyncFromCatalogFileUnitTest, self).tearDown()
+
+  def MakeSrv4(self, name, in_catalog, use_in_catalogs=True):
+    srv4 = test_base.MakeSrv4(
+        self.sqo_osrel, self.sqo_arch, 'CSW' + name, name * 32,
+        basename='%s-1.0-SunOS5.10-sparc-CSW.pkg.gz' % name,
+        use_to_generate_catalogs=use_in_catalogs,
+        version_string='1.0')
+    if in_catalog:
+      models.Srv4FileInCatalog(arch=self.sqo_arch, osrel=self.sqo_osrel,
+                               catrel=self.sqo_catrel, srv4file=srv4,
+                               created_by='test')
+
+  def WriteCatalog(self, names):
+    path = os.path.join(self.tmpdir, 'catalog')
+    with open(path, 'w') as fd:
+      for name in names:
+        fd.write('%s 1.0 CSW%s %s-1.0-SunOS5.10-sparc-CSW.pkg.gz %s 100 '
+                 'CSWcommon none none\n' % (name, name, name, name * 32))
+    return path
+
+  def testSync(self):
+    self.MakeSrv4('a', in_catalog=True)
+    self.MakeSrv4('b', in_catalog=True)
+    self.MakeSrv4('c', in_catalog=False, use_in_catalogs=False)
+    ci = pkgdb.CatalogImporter()
+    ci.rest_client = FakeRestClient()
+    ci.file_index_store = None
+    ci.SyncFromCatalogFile('SunOS5.10', 'sparc', 'unstable',
+                           self.WriteCatalog(['a', 'c', 'd']))
+    self.assertEqual(['c' * 32], ci.rest_client.registered)
+    self.assertEqual(
+        [('unstable', 'sparc', 'SunOS5.10', ['c' * 32, 'd' * 32])],
+        ci.rest_client.added)
+    self.assertEqual(
+        ['a' * 32],
+        [x.srv4file.md5_sum for x in models.Srv4FileInCatalog.select()])
+    self.assertEqual(
+        [(1, 'remove', 'b' * 32)],
+        [x[:3] for x in models.GetCatalogChanges(
+          *(models.GetSqoTriad('SunOS5.10', 'sparc', 'unstable') + (0,)))])
+
+  def testUnchangedCatalog(self):
+    self.MakeSrv4('a', in_catalog=True)
+    ci = pkgdb.CatalogImporter()
+    ci.rest_client = FakeRestClient()
+    ci.file_index_store = None
+    ci.SyncFromCatalogFile('SunOS5.10', 'sparc', 'unstable',
+                           self.WriteCatalog(['a']))
+    self.assertEqual([], ci.rest_client.added)
+    self.assertEqual(1, models.Srv4FileInCatalog.select().count())
+
+
+class PhaseTimerUnitTest(unittest.TestCase):
+
+  def testStr(self):
+    timer = pkgdb.PhaseTimer()
+    timer.Finish('read')
+    timer.Finish('diff')
+    self.assertTrue(str(timer).startswith('read 0.0s, diff 0.0s, total'))
+
+
 class FunctionUnitTest(unittest.TestCase):
 
   def testNormalizeIdentifier(self):
@@ -28,6 +28,12 @@ from lib.python import representations
 
 
 PACKAGE_STATS_VERSION = 13L
+# Number of rows in one INSERT statement. Keeps the statements well below
+# the default max_allowed_packet of MySQL, even with long pkgmap lines.
+CSW_FILE_INSERT_BATCH_SIZE = 500
+# Columns filled from the pkgmap, in the order used by InsertCswFiles().
+CSW_FILE_COLUMNS = ('basename', 'path', 'line', 'perm_user', 'perm_group',
+                    'perm_mode', 'target', 'mimetype', 'machine')
 
 
 def GetOrSetPkginst(pkgname):
@@ -40,6 +46,48 @@ def GetOrSetPkginst(pkgname):
   return pkginst
 
 
+def _EncodeForDatabase(value):
+  # UnicodeCol stores values encoded in utf-8, and the values here bypass the
+  # column validators.
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+def InsertCswFiles(db_pkg_stats, pkginst, rows,
+                   batch_size=CSW_FILE_INSERT_BATCH_SIZE):
+  """Inserts files of a package using multi-row INSERT statements.
+
+  Creating a CswFile object per file means a database round trip per file,
+  which takes minutes for packages with tens of thousands of files. Here
+  all rows are inserted in a single transaction, batch_size rows at a time.
+
+  Args:
+    db_pkg_stats: the Srv4FileStats object the files belong to
+    pkginst: the Pkginst object of the package
+    rows: tuples of values for CSW_FILE_COLUMNS
+  """
+  columns = models.CswFile.sqlmeta.columns
+  template = [columns[x].dbName for x in CSW_FILE_COLUMNS]
+  template.extend(
+      [columns['pkginstID'].dbName, columns['srv4_fileID'].dbName])
+  connection = models.CswFile._connection
+  trans = connection.transaction()
+  try:
+    for start in xrange(0, len(rows), batch_size):
+      value_list = [
+          [_EncodeForDatabase(x) for x in row] + [pkginst.id, db_pkg_stats.id]
+          for row in rows[start:start + batch_size]]
+      trans.query(trans.sqlrepr(sqlbuilder.Insert(
+          models.CswFile.sqlmeta.table,
+          valueList=value_list,
+          template=template)))
+  except:
+    trans.rollback()
+    raise
+  trans.commit(close=True)
+
+
 def StatsStructToDatabaseLevelOne(md5_sum, use_in_catalogs=True):
   """Creates entries for a package in the relational part of the database.
 
@@ -190,6 +238,7 @@ def StatsStructToDatabaseLevelTwo(md5_sum, use_in_catalogs):
       (os.path.join("/", x.path), x.mime_type)
       for x in files_metadata)
   machine_by_path = dict((x.path, x.mime_type) for x in files_metadata)
+  file_rows = []
   for pkgmap_tuple in pkg_stats["pkgmap"]:
     pkgmap_entry = representations.PkgmapEntry._make(pkgmap_tuple)
     if not pkgmap_entry.path:
@@ -215,19 +264,17 @@ def StatsStructToDatabaseLevelTwo(md5_sum, use_in_catalogs):
     machine = None
     if pkgmap_entry.path in machine_by_path:
       machine = machine_by_path[pkgmap_entry.path]
-    # Creating a file entry.
-    models.CswFile(basename=basename,
-                   path=f_path,
-                   line=line_u,
-                   pkginst=pkginst,
-                   srv4_file=db_pkg_stats,
-                   perm_user=pkgmap_entry.owner,
-                   perm_group=pkgmap_entry.group,
-                   perm_mode=pkgmap_entry.mode,
-                   target=pkgmap_entry.target,
-                   mimetype=mimetype,
-                   machine=machine,
-    )
+    # Creating a file entry, in the order of CSW_FILE_COLUMNS.
+    file_rows.append((basename,
+                      f_path,
+                      line_u,
+                      pkgmap_entry.owner,
+                      pkgmap_entry.group,
+                      pkgmap_entry.mode,
+                      pkgmap_entry.target,
+                      mimetype,
+                      machine))
+  InsertCswFiles(db_pkg_stats, pkginst, file_rows)
 
   # Save dependencies in the database.  First remove any dependency rows that
   # might be in the database.
@@ -464,6 +464,55 @@ from testdata.neon_stats import pkgstats as neon_stats
 #     self.fail("The test should not reach this point.")
 
 
+class InsertCswFilesUnitTest(test_base.SqlObjectTestMixin, unittest.TestCase):
+
+  def setUp(self):
+    super(InsertCswFilesUnitTest, self).setUp()
+    self.dbc.InitialDataImport()
+    sqo_arch = m.Architecture.selectBy(name='sparc').getOne()
+    sqo_osrel = m.OsRelease.selectBy(short_name='SunOS5.10').getOne()
+    self.srv4 = test_base.MakeSrv4(
+        sqo_osrel, sqo_arch, 'CSWfoo', 'a' * 32,
+        basename='foo-1.0,REV=2011.01.01-SunOS5.10-sparc-CSW.pkg.gz',
+        registered_level_two=False)
+    self.pkginst = self.srv4.pkginst
+
+  def MakeRows(self, count):
+    return [(u'file%d' % i, u'/opt/csw/share/foo',
+             u'1 f none /opt/csw/share/foo/file%d 0644 root bin' % i,
+             u'root', u'bin', u'0644', None, u'text/plain', None)
+            for i in range(count)]
+
+  def testInsertCswFiles(self):
+    rows = self.MakeRows(1201)
+    rows.append((u'f\xf3\xf3', u'/opt/csw/bin', u'1 s none f\xf3\xf3=foo',
+                 None, None, None, u'foo', None, None))
+    relational_util.InsertCswFiles(self.srv4, self.pkginst, rows,
+                                   batch_size=500)
+    files = m.CswFile.selectBy(srv4_file=self.srv4)
+    self.assertEqual(1202, files.count())
+    sqo_file = m.CswFile.selectBy(basename=u'file7').getOne()
+    self.assertEqual(u'/opt/csw/share/foo', sqo_file.path)
+    self.assertEqual(u'0644', sqo_file.perm_mode)
+    self.assertEqual(None, sqo_file.target)
+    self.assertEqual(self.pkginst, sqo_file.pkginst)
+    sqo_file = m.CswFile.selectBy(basename=u'f\xf3\xf3').getOne()
+    self.assertEqual(u'foo', sqo_file.target)
+    self.assertEqual(None, sqo_file.perm_user)
+    self.srv4.RemoveAllCswFiles()
+    self.assertEqual(0, files.count())
+
+  def testInsertCswFilesIsAtomic(self):
+    rows = self.MakeRows(5)
+    # Violates the NOT NULL constraint of the path column.
+    rows.append((u'bad', None, u'bad', None, None, None, None, None, None))
+    self.assertRaises(
+        sqlobject.dberrors.IntegrityError,
+        relational_util.InsertCswFiles, self.srv4, self.pkginst, rows,
+        batch_size=2)
+    self.assertEqual(0, m.CswFile.selectBy(srv4_file=self.srv4).count())
+
+
 if __name__ == '__main__':
   logging.basicConfig(level=logging.CRITICAL)
   # logging.basicConfig(level=logging.DEBUG)
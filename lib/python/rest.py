@@ -4,11 +4,13 @@ from StringIO import StringIO
 import anydbm
 import cjson
 import getpass
+import hashlib
 import httplib
 import logging
 import os
 import pycurl
 import re
+import time
 import urllib
 import urllib2
 import httplib
@@ -17,6 +19,8 @@ import httplib
 # idempotent, it's safe to repeat a failed query.
 from lib.python import retry_decorator
 
+from lib.python import blob_cache
+from lib.python import common_constants
 from lib.python import configuration
 from lib.python import errors
 from lib.python import shell
@@ -24,6 +28,11 @@ from lib.python import shell
 
 DEFAULT_TRIES = 5
 DEFAULT_RETRY_DELAY = 10
+# Number of simultaneous connections used by GetBlobs() when the server
+# doesn't support bulk requests.
+DEFAULT_MAX_CONNECTIONS = 8
+# Blob cache tag of catalogs, which are validated with ETags on every use.
+CATALOG_CACHE_TAG = 'catalog'
 
 
 class ArgumentError(errors.Error):
@@ -37,12 +46,21 @@ class RestCommunicationError(errors.Error):
 class RestClient(object):
 
   def __init__(self, pkgdb_url, releases_url,
-               username=None, password=None, debug=False):
+               username=None, password=None, debug=False, blob_cache=None):
+    """Constructor.
+
+    Args:
+      blob_cache: An optional blob_cache.BlobCache object, used by GetBlob()
+          and GetBlobs() for blobs that never change, and by GetCatalog()
+          and GetCatalogForGeneration() for catalogs that haven't changed
+          since they were last downloaded.
+    """
     self.pkgdb_url = pkgdb_url
     self.releases_url = releases_url
     self.username = username
     self.password = password
     self.debug = debug
+    self.blob_cache = blob_cache
 
   def ValidateMd5(self, md5_sum):
     if not re.match(r'^[0-9a-f]{32}$', md5_sum):
@@ -90,24 +108,131 @@ class RestClient(object):
         "maintainer_email": pkg["maintainer_email"],
     }
 
+  def GetMaintainersByMd5s(self, md5_sums):
+    """Bulk version of GetMaintainerByMd5.
+
+    Returns:
+      {md5_sum: {"maintainer_email": ...}, ...}, with "Unknown" as the
+      e-mail address of packages which are unknown or have no maintainer.
+    """
+    md5_sums = sorted(set(md5_sums))
+    for md5_sum in md5_sums:
+      self.ValidateMd5(md5_sum)
+    url = self.pkgdb_url + "/srv4/maintainers-by-md5/"
+    maintainers = {}
+    for start in xrange(0, len(md5_sums),
+                        common_constants.MAX_BULK_MAINTAINERS):
+      chunk = md5_sums[start:start + common_constants.MAX_BULK_MAINTAINERS]
+      data = self._RPC(url, chunk)
+      for md5_sum in chunk:
+        email = data.get(md5_sum, {}).get("maintainer_email")
+        maintainers[md5_sum] = {"maintainer_email": email or "Unknown"}
+    return maintainers
+
   def GetCatalogList(self):
     url = self.releases_url + "/catalogs/"
     data = urllib2.urlopen(url).read()
     return cjson.decode(data)
 
   def GetCatalog(self, catrel, arch, osrel):
+    """Returns a list of packages in a catalog, None if it's empty.
+
+    Use IterCatalog() to process the packages as they arrive.
+    """
+    try:
+      return list(self.IterCatalog(catrel, arch, osrel))
+    except urllib2.HTTPError as e:
+      logging.warning("GetCatalog(%s, %s, %s) -- %s", catrel, arch, osrel, e)
+      return None
+
+  def _OpenCatalog(self, url):
+    """Opens a catalog URL, revalidating the cached copy if there is one.
+
+    The cached copy is stored together with the ETag it was served with. The
+    server answers 304 Not Modified if the catalog revision hasn't changed.
+
+    Returns:
+      A tuple (response, cached_fd). The response is None if the cached
+      copy is still current, cached_fd is then a file object with the cached
+      data, which needs to be closed by the caller.
+    """
+    if self.blob_cache is None:
+      return urllib2.urlopen(url), None
+    request = urllib2.Request(url)
+    cached_fd = self.blob_cache.Open(
+        CATALOG_CACHE_TAG, self._CatalogCacheKey(url))
+    if cached_fd is not None:
+      etag = cached_fd.readline().rstrip('\n')
+      request.add_header('If-None-Match', etag)
+    try:
+      response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+      if cached_fd is not None and e.code == httplib.NOT_MODIFIED:
+        logging.debug("%s has not changed since %s", url, etag)
+        return None, cached_fd
+      if cached_fd is not None:
+        cached_fd.close()
+      raise
+    if cached_fd is not None:
+      cached_fd.close()
+    return response, None
+
+  def _CatalogCacheKey(self, url):
+    return hashlib.md5(url).hexdigest()
+
+  def _CreateCatalogCacheEntry(self, url, response):
+    """Returns a blob_cache.BlobWriter for a response, None if not cached."""
+    if self.blob_cache is None:
+      return None
+    etag = response.info().getheader('ETag')
+    if not etag:
+      return None
+    writer = self.blob_cache.Create(
+        CATALOG_CACHE_TAG, self._CatalogCacheKey(url))
+    if writer is not None:
+      writer.write(etag + '\n')
+    return writer
+
+  def _IterCatalogNdjson(self, url):
+    """Yields decoded items of a catalog served as newline delimited JSON.
+
+    Items are decoded as they arrive. If there is a blob cache, the response
+    is written to it line by line, and only kept if it was read to the end.
+    """
+    url += ('&' if '?' in url else '?') + 'format=ndjson'
+    response, cached_fd = self._OpenCatalog(url)
+    if response is None:
+      try:
+        for line in cached_fd:
+          yield cjson.decode(line)
+      finally:
+        cached_fd.close()
+      return
+    writer = self._CreateCatalogCacheEntry(url, response)
+    try:
+      for line in response:
+        if writer is not None:
+          writer.write(line)
+        yield cjson.decode(line)
+    except:
+      if writer is not None:
+        writer.Abort()
+      raise
+    if writer is not None:
+      writer.Commit()
+
+  def IterCatalog(self, catrel, arch, osrel):
+    """Yields the packages of a catalog one by one.
+
+    Raises urllib2.HTTPError if the catalog is empty or doesn't exist.
+    """
     if not catrel:
       raise ArgumentError("Missing catalog release.")
     url = (
         self.pkgdb_url
         + "/catalogs/%s/%s/%s/?quick=true" % (catrel, arch, osrel))
-    logging.debug("GetCatalog(): GET %s", url)
-    try:
-      data = urllib2.urlopen(url).read()
-      return cjson.decode(data)
-    except urllib2.HTTPError as e:
-      logging.warning("%s -- %s", url, e)
-      return None
+    logging.debug("IterCatalog(): GET %s", url)
+    return self._IterCatalogNdjson(url)
 
   def Srv4ByCatalogAndCatalogname(self, catrel, arch, osrel, catalogname):
     """Returns a srv4 data structure or None if not found."""
@@ -231,6 +356,36 @@ class RestClient(object):
     logging.debug("AddSvr4ToCatalog: %s", url)
     return self._CurlPut(url, [])
 
+  @retry_decorator.Retry(tries=DEFAULT_TRIES, delay=DEFAULT_RETRY_DELAY,
+                         exceptions=(RestCommunicationError, pycurl.error))
+  def AddSvr4sToCatalog(self, catrel, arch, osrel, md5_sums):
+    """Adds many packages to a catalog.
+
+    Packages are sent in chunks of common_constants.MAX_BULK_ASSIGNMENTS,
+    each chunk is added in a single transaction. Later packages replace
+    earlier ones with the same catalogname or pkgname. Repeating the call is
+    harmless, packages already in the catalog are reported as present.
+
+    Returns:
+      A list of dictionaries, one per md5 sum, e.g.
+      {"md5_sum": ..., "status": "added", "removed": [md5_sum, ...]}
+      The status is one of "added", "present", "superseded" or "error";
+      errors come with a "message".
+    """
+    md5_sums = list(md5_sums)
+    for md5_sum in md5_sums:
+      self.ValidateMd5(md5_sum)
+    url = (
+        "%s/catalogs/%s/%s/%s/bulk-add/"
+        % (self.releases_url, catrel, arch, osrel))
+    logging.debug("AddSvr4sToCatalog: %s, %d packages", url, len(md5_sums))
+    results = []
+    for start in xrange(0, len(md5_sums),
+                        common_constants.MAX_BULK_ASSIGNMENTS):
+      results.extend(self._RPC(
+          url, md5_sums[start:start + common_constants.MAX_BULK_ASSIGNMENTS]))
+    return results
+
   @retry_decorator.Retry(tries=DEFAULT_TRIES, delay=DEFAULT_RETRY_DELAY,
                          exceptions=(RestCommunicationError, pycurl.error))
   def SaveBlob(self, tag, md5_sum, data):
@@ -243,9 +398,24 @@ class RestClient(object):
       ('md5_sum', md5_sum),
     ])
 
+  def _IsCacheable(self, tag):
+    return (self.blob_cache is not None
+            and tag in blob_cache.IMMUTABLE_BLOB_TAGS)
+
+  def GetBlob(self, tag, md5_sum):
+    if not self._IsCacheable(tag):
+      return self._GetBlob(tag, md5_sum)
+    json_data = self.blob_cache.Get(tag, md5_sum)
+    if json_data is not None:
+      return cjson.decode(json_data)
+    metadata = self._GetBlob(tag, md5_sum)
+    if metadata is not None:
+      self.blob_cache.Put(tag, md5_sum, cjson.encode(metadata))
+    return metadata
+
   @retry_decorator.Retry(tries=DEFAULT_TRIES, delay=DEFAULT_RETRY_DELAY,
                          exceptions=(RestCommunicationError, pycurl.error))
-  def GetBlob(self, tag, md5_sum):
+  def _GetBlob(self, tag, md5_sum):
     url = self.releases_url + "/blob/%s/%s/" % (tag, md5_sum)
     logging.debug('GetBlob() url=%r', url)
     c = pycurl.Curl()
@@ -277,6 +447,184 @@ class RestClient(object):
                       % (tag, md5_sum))
     return metadata
 
+  def GetBlobs(self, tag, md5_sums, max_connections=DEFAULT_MAX_CONNECTIONS):
+    """Fetches many blobs at once.
+
+    Blobs are requested from the bulk endpoint of the releases app,
+    common_constants.MAX_BULK_BLOBS at a time, over a single connection. If
+    the server doesn't have the bulk endpoint, blobs are fetched one by one,
+    with up to max_connections requests in flight at the same time.
+
+    Returns:
+      a dictionary from md5 sums to blobs. Blobs which don't exist are mapped
+      to None, as returned by GetBlob().
+    """
+    blobs = {}
+    pending = []
+    cacheable = self._IsCacheable(tag)
+    for md5_sum in md5_sums:
+      if md5_sum in blobs:
+        continue
+      json_data = None
+      if cacheable:
+        json_data = self.blob_cache.Get(tag, md5_sum)
+      if json_data is None:
+        blobs[md5_sum] = None
+        pending.append(md5_sum)
+      else:
+        blobs[md5_sum] = cjson.decode(json_data)
+    c = pycurl.Curl()
+    try:
+      for start in range(0, len(pending), common_constants.MAX_BULK_BLOBS):
+        chunk = pending[start:start + common_constants.MAX_BULK_BLOBS]
+        chunk_blobs = self._BulkGetBlobs(c, tag, chunk)
+        if chunk_blobs is None:
+          logging.debug("No bulk blob endpoint at %s, fetching blobs "
+                        "one by one.", self.releases_url)
+          blobs.update(self._GetBlobsConcurrently(
+              tag, pending[start:], max_connections))
+          break
+        blobs.update(chunk_blobs)
+    finally:
+      c.close()
+    if cacheable:
+      for md5_sum in pending:
+        if blobs[md5_sum] is not None:
+          self.blob_cache.Put(tag, md5_sum, cjson.encode(blobs[md5_sum]))
+    return blobs
+
+  @retry_decorator.Retry(tries=DEFAULT_TRIES, delay=DEFAULT_RETRY_DELAY,
+                         exceptions=(RestCommunicationError, pycurl.error))
+  def _BulkGetBlobs(self, c, tag, md5_sums):
+    """Makes a single request to the bulk blob endpoint.
+
+    Returns:
+      a dictionary from md5 sums to blobs, or None if the server doesn't
+      have the bulk endpoint.
+    """
+    url = self.releases_url + "/rpc/bulk-blobs/"
+    reader = _NdjsonReader()
+    c.setopt(pycurl.URL, str(url))
+    c.setopt(pycurl.POST, 1)
+    c.setopt(pycurl.HTTPPOST, [
+        ('query_data', cjson.encode([[tag, md5_sum] for md5_sum in md5_sums])),
+    ])
+    c.setopt(pycurl.WRITEFUNCTION, reader.write)
+    c.setopt(pycurl.HTTPHEADER, ["Expect:"])
+    c = self._SetAuth(c)
+    if self.debug:
+      c.setopt(c.VERBOSE, 1)
+    c.perform()
+    http_code = c.getinfo(pycurl.HTTP_CODE)
+    logging.debug("_BulkGetBlobs(): %d %s blobs, HTTP %s in %.3fs",
+                  len(md5_sums), tag, http_code, c.getinfo(pycurl.TOTAL_TIME))
+    if http_code == 404:
+      return None
+    if http_code >= 400 and http_code < 600:
+      raise RestCommunicationError("%s - HTTP code: %s" % (url, http_code))
+    records = reader.Close()
+    blobs = dict((md5_sum, blob) for _, md5_sum, blob in records)
+    missing = set(md5_sums).difference(blobs)
+    if missing:
+      raise RestCommunicationError(
+          "%s - incomplete response, %d blobs missing"
+          % (url, len(missing)))
+    for md5_sum, blob in blobs.iteritems():
+      if blob is None:
+        logging.warning("Blob %r for %r was not found in the database"
+                        % (tag, md5_sum))
+    return blobs
+
+  def _GetBlobsConcurrently(self, tag, md5_sums, max_connections):
+    """Fetches blobs one by one, reusing connections.
+
+    Up to max_connections requests are in flight at the same time. Blobs
+    which failed to download are fetched again, with the same number of
+    tries and delay as GetBlob().
+    """
+    blobs = {}
+    pending = md5_sums
+    for attempt in range(DEFAULT_TRIES):
+      failures = self._FetchBlobs(tag, pending, max_connections, blobs)
+      if not failures:
+        return blobs
+      pending = [md5_sum for md5_sum, _ in failures]
+      last_exception = failures[-1][1]
+      if attempt + 1 < DEFAULT_TRIES:
+        logging.info("Retry, %d %s blobs failed, last exception: %s",
+                     len(failures), tag, last_exception)
+        time.sleep(DEFAULT_RETRY_DELAY)
+    raise last_exception
+
+  def _FetchBlobs(self, tag, md5_sums, max_connections, blobs):
+    """Downloads blobs with a CurlMulti object, storing them in blobs.
+
+    Returns:
+      a list of (md5_sum, exception) tuples for failed downloads.
+    """
+    failures = []
+    queue = list(reversed(md5_sums))
+    multi = pycurl.CurlMulti()
+    free_handles = [pycurl.Curl()
+                    for _ in range(min(max_connections, len(md5_sums)))]
+    all_handles = list(free_handles)
+    active = 0
+    try:
+      while queue or active:
+        while queue and free_handles:
+          c = free_handles.pop()
+          c.md5_sum = queue.pop()
+          c.data = StringIO()
+          url = self.releases_url + "/blob/%s/%s/" % (tag, c.md5_sum)
+          logging.debug('GetBlobs() url=%r', url)
+          c.setopt(pycurl.URL, str(url))
+          c.setopt(pycurl.WRITEFUNCTION, c.data.write)
+          c = self._SetAuth(c)
+          if self.debug:
+            c.setopt(c.VERBOSE, 1)
+          multi.add_handle(c)
+          active += 1
+        ret = pycurl.E_CALL_MULTI_PERFORM
+        while ret == pycurl.E_CALL_MULTI_PERFORM:
+          ret, unused_num_handles = multi.perform()
+        num_queued = 1
+        while num_queued:
+          num_queued, ok_list, err_list = multi.info_read()
+          for c in ok_list:
+            multi.remove_handle(c)
+            active -= 1
+            try:
+              blobs[c.md5_sum] = self._DecodeBlobResponse(tag, c)
+            except RestCommunicationError as e:
+              failures.append((c.md5_sum, e))
+            free_handles.append(c)
+          for c, errno, errmsg in err_list:
+            multi.remove_handle(c)
+            active -= 1
+            logging.debug("GetBlobs(): %s %s failed: %s",
+                          tag, c.md5_sum, errmsg)
+            failures.append((c.md5_sum, pycurl.error(errno, errmsg)))
+            free_handles.append(c)
+        if active:
+          multi.select(1.0)
+    finally:
+      for c in all_handles:
+        c.close()
+      multi.close()
+    return failures
+
+  def _DecodeBlobResponse(self, tag, c):
+    http_code = c.getinfo(pycurl.HTTP_CODE)
+    logging.debug("GetBlobs(): %s %s HTTP %s in %.3fs",
+                  tag, c.md5_sum, http_code, c.getinfo(pycurl.TOTAL_TIME))
+    if http_code == 401:
+      raise RestCommunicationError("Received HTTP code {0}".format(http_code))
+    if http_code >= 200 and http_code <= 299:
+      return cjson.decode(c.data.getvalue())
+    logging.warning("Blob %r for %r was not found in the database"
+                    % (tag, c.md5_sum))
+    return None
+
   def _HttpHeadRequest(self, url):
     """Make a HTTP HEAD request and return the http code."""
     c = pycurl.Curl()
@@ -354,6 +702,15 @@ class RestClient(object):
     url = self.releases_url + "/rpc/bulk-existing-svr4/"
     return self._RPC(url, md5_sum_list)
 
+  def BulkQueryBlobExistence(self, tags, md5_sum_list):
+    """Checks which md5 sums have blobs of the given tags, in one request.
+
+    Returns:
+      {"pkgstats": {"existing": [...], "missing": [...]}, "elfdump": ...}
+    """
+    url = self.releases_url + "/rpc/bulk-existing-svr4/"
+    return self._RPC(url, {'md5_sums': md5_sum_list, 'tags': list(tags)})
+
   def RegisterLevelOne(self, md5_sum):
     self.ValidateMd5(md5_sum)
     url = self.releases_url + "/svr4/%s/db-level-1/" % md5_sum
@@ -383,11 +740,14 @@ class RestClient(object):
     return self._CurlPut(url, [])
 
   def GetCatalogForGeneration(self, catrel, arch, osrel):
+    return list(self.IterCatalogForGeneration(catrel, arch, osrel))
+
+  def IterCatalogForGeneration(self, catrel, arch, osrel):
+    """Yields catalog entries, lists aligned with CatalogEntry, one by one."""
     url = (self.pkgdb_url + "/catalogs/%s/%s/%s/for-generation/"
            % (catrel, arch, osrel))
-    logging.debug("GetCatalogForGeneration(): url=%r", url)
-    data = urllib2.urlopen(url).read()
-    return cjson.decode(data)
+    logging.debug("IterCatalogForGeneration(): url=%r", url)
+    return self._IterCatalogNdjson(url)
 
   def GetBasenamesByCatalogAndDir(self, catrel, arch, osrel, basedir):
     url = (
@@ -405,6 +765,18 @@ class RestClient(object):
     data = urllib2.urlopen(url).read()
     return cjson.decode(data)
 
+  def GetPathsAndPkgnamesByBasenames(self, catrel, arch, osrel, basenames):
+    """Bulk version of GetPathsAndPkgnamesByBasename.
+
+    Returns:
+      {"libfoo.so.1": {"/opt/csw/lib": ["CSWfoo"]}, ...}
+    """
+    url = (
+        self.pkgdb_url
+        + "/catalogs/%s/%s/%s/pkgnames-and-paths-by-basenames/"
+           % (catrel, arch, osrel))
+    return self._RPC(url, list(basenames))
+
   def GetCatalogTimingInformation(self, catrel, arch, osrel):
     url = (
       self.pkgdb_url
@@ -412,6 +784,22 @@ class RestClient(object):
     data = urllib2.urlopen(url).read()
     return cjson.decode(data)
 
+  def GetCatalogChanges(self, catrel, arch, osrel, since_revision=0):
+    """Returns packages added to and removed from a catalog since a revision.
+
+    Returns:
+      {"revision": N, "changes": [{"revision": ..., "action": "add",
+      "md5_sum": ..., "catalogname": ..., "created_on": ..., "created_by": ...},
+      ...]}, where N is the revision to pass in the next call.
+    """
+    url = (
+      self.pkgdb_url
+      + "/catalogs/%s/%s/%s/changes/?%s"
+      % (catrel, arch, osrel, urllib.urlencode({'since': since_revision})))
+    logging.debug("GetCatalogChanges(): GET %s", url)
+    data = urllib2.urlopen(url).read()
+    return cjson.decode(data)
+
   def GetSrv4FileMetadataForReleases(self, md5_sum):
     """I have no idea what I was thinking when I wrote this.
 
@@ -484,6 +872,49 @@ class RestClient(object):
       raise RestCommunicationError("%s - HTTP code: %s" % (url, http_code))
 
 
+class _NdjsonReader(object):
+  """Decodes newline-delimited JSON while it's being received.
+
+  Errors are only reported by Close(), because exceptions raised from pycurl
+  callbacks abort the transfer before the HTTP code can be examined.
+  """
+
+  def __init__(self):
+    self.pending = []
+    self.records = []
+    self.error = None
+
+  def write(self, data):
+    if '\n' not in data:
+      self.pending.append(data)
+      return
+    lines = data.split('\n')
+    self.pending.append(lines[0])
+    lines[0] = ''.join(self.pending)
+    self.pending = [lines.pop()]
+    for line in lines:
+      if line:
+        self._DecodeLine(line)
+
+  def _DecodeLine(self, line):
+    if self.error:
+      return
+    try:
+      self.records.append(cjson.decode(line))
+    except cjson.DecodeError as e:
+      self.error = e
+
+  def Close(self):
+    """Returns all records, including the one not ending with a newline."""
+    line = ''.join(self.pending)
+    self.pending = []
+    if line:
+      self._DecodeLine(line)
+    if self.error:
+      raise RestCommunicationError("Malformed response: %s" % self.error)
+    return self.records
+
+
 class CachedPkgstats(object):
   """Class responsible for holding and caching package stats.
 
@@ -0,0 +1,325 @@
+#!/usr/bin/env python2.6
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import cjson
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+
+from lib.python import blob_cache
+from lib.python import common_constants
+from lib.python import rest
+
+
+class FakeReleasesHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    server = self.server
+    server.requests.append(self.path)
+    if self.path in server.catalogs:
+      etag, data = server.catalogs[self.path]
+      if self.headers.get('If-None-Match') == etag:
+        self._Respond(304, '', etag=etag)
+      elif self.path.endswith('format=ndjson'):
+        self._Respond(200, ''.join(cjson.encode(x) + '\n' for x in data),
+                      etag=etag)
+      else:
+        self._Respond(200, cjson.encode(data), etag=etag)
+      return
+    if self.path.startswith('/catalogs/'):
+      # Empty catalogs are not found.
+      self._Respond(404, '')
+      return
+    m = re.match(r'^/blob/(\w+)/([0-9a-f]{32})/$', self.path)
+    md5_sum = m.group(2)
+    if server.failures.get(md5_sum):
+      server.failures[md5_sum] -= 1
+      self._Respond(401, '')
+    elif md5_sum in server.blobs:
+      self._Respond(200, cjson.encode(server.blobs[md5_sum]))
+    else:
+      self._Respond(404, '')
+
+  def do_POST(self):
+    server = self.server
+    server.requests.append(self.path)
+    form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                            environ={'REQUEST_METHOD': 'POST'})
+    if self.path.endswith('/bulk-add/'):
+      md5_sums = cjson.decode(form.getvalue('query_data'))
+      server.assignment_requests.append(md5_sums)
+      self._Respond(200, cjson.encode(
+          [{'md5_sum': x, 'status': 'added', 'removed': []}
+           for x in md5_sums]))
+      return
+    if not server.bulk or self.path != '/rpc/bulk-blobs/':
+      self._Respond(404, 'not found\nnot found\n')
+      return
+    lines = []
+    for tag, md5_sum in cjson.decode(form.getvalue('query_data')):
+      lines.append(cjson.encode([tag, md5_sum, server.blobs.get(md5_sum)]))
+    self._Respond(200, '\n'.join(lines) + '\n')
+
+  def _Respond(self, code, body, etag=None):
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    if etag:
+      self.send_header('ETag', etag)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class FakeReleasesServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(
+        self, ('127.0.0.1', 0), FakeReleasesHandler)
+    self.blobs = {}
+    self.catalogs = {}
+    self.failures = {}
+    self.requests = []
+    self.assignment_requests = []
+    self.bulk = False
+
+
+class GetBlobsUnitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = FakeReleasesServer()
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.rest_client = rest.RestClient(
+        pkgdb_url=None,
+        releases_url='http://127.0.0.1:%d' % self.server.server_address[1])
+    self.saved_retry_delay = rest.DEFAULT_RETRY_DELAY
+    rest.DEFAULT_RETRY_DELAY = 0
+
+  def tearDown(self):
+    rest.DEFAULT_RETRY_DELAY = self.saved_retry_delay
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testGetBlobs(self):
+    md5_sums = ['%032x' % i for i in range(20)]
+    for md5_sum in md5_sums[:-1]:
+      self.server.blobs[md5_sum] = {'md5_sum': md5_sum}
+    blobs = self.rest_client.GetBlobs('pkgstats', md5_sums, max_connections=3)
+    self.assertEqual(20, len(blobs))
+    self.assertEqual({'md5_sum': md5_sums[0]}, blobs[md5_sums[0]])
+    self.assertEqual(None, blobs[md5_sums[-1]])
+
+  def testGetBlobsBulk(self):
+    self.server.bulk = True
+    md5_sums = ['%032x' % i
+                for i in range(common_constants.MAX_BULK_BLOBS + 1)]
+    for md5_sum in md5_sums[:-1]:
+      self.server.blobs[md5_sum] = {'md5_sum': md5_sum}
+    blobs = self.rest_client.GetBlobs('pkgstats', md5_sums)
+    self.assertEqual(len(md5_sums), len(blobs))
+    self.assertEqual({'md5_sum': md5_sums[0]}, blobs[md5_sums[0]])
+    self.assertEqual(None, blobs[md5_sums[-1]])
+    self.assertEqual(['/rpc/bulk-blobs/'] * 2, self.server.requests)
+
+  def testDuplicatesFetchedOnce(self):
+    md5_sum = 'a' * 32
+    self.server.blobs[md5_sum] = {}
+    self.rest_client.GetBlobs('pkgstats', [md5_sum, md5_sum])
+    self.assertEqual(['/rpc/bulk-blobs/', '/blob/pkgstats/%s/' % md5_sum],
+                     self.server.requests)
+
+  def testRetry(self):
+    md5_sum = 'a' * 32
+    self.server.blobs[md5_sum] = {'foo': 'bar'}
+    self.server.failures[md5_sum] = 2
+    blobs = self.rest_client.GetBlobs('pkgstats', [md5_sum])
+    self.assertEqual({md5_sum: {'foo': 'bar'}}, blobs)
+    self.assertEqual(4, len(self.server.requests))
+
+  def testTooManyFailures(self):
+    md5_sum = 'a' * 32
+    self.server.failures[md5_sum] = rest.DEFAULT_TRIES
+    sleeps = []
+    saved_sleep = rest.time.sleep
+    rest.time.sleep = sleeps.append
+    try:
+      self.assertRaises(rest.RestCommunicationError,
+                        self.rest_client.GetBlobs, 'pkgstats', [md5_sum])
+    finally:
+      rest.time.sleep = saved_sleep
+    # Only between attempts, not after the last one.
+    self.assertEqual(rest.DEFAULT_TRIES - 1, len(sleeps))
+
+  def testBlobCache(self):
+    directory = tempfile.mkdtemp(prefix='rest_test-')
+    try:
+      self.rest_client.blob_cache = blob_cache.BlobCache(directory, 1024)
+      md5_sums = ['a' * 32, 'b' * 32, 'c' * 32]
+      self.server.blobs[md5_sums[0]] = {'foo': 'bar'}
+      self.server.blobs[md5_sums[1]] = {'bar': 'baz'}
+      self.assertEqual({'foo': 'bar'},
+                       self.rest_client.GetBlob('elfdump', md5_sums[0]))
+      self.assertEqual(1, len(self.server.requests))
+      blobs = self.rest_client.GetBlobs('elfdump', md5_sums)
+      self.assertEqual({'bar': 'baz'}, blobs[md5_sums[1]])
+      self.assertEqual(None, blobs[md5_sums[2]])
+      # Only the first blob came from the cache, missing blobs aren't cached.
+      self.assertEqual(
+          ['/blob/elfdump/%s/' % md5_sum for md5_sum in md5_sums[1:]],
+          sorted(self.server.requests[2:]))
+      del self.server.requests[:]
+      self.assertEqual({'bar': 'baz'},
+                       self.rest_client.GetBlob('elfdump', md5_sums[1]))
+      self.assertEqual([], self.server.requests)
+      self.assertEqual(2, self.rest_client.blob_cache.hits)
+    finally:
+      shutil.rmtree(directory)
+
+  def testPkgstatsNotCached(self):
+    directory = tempfile.mkdtemp(prefix='rest_test-')
+    try:
+      self.rest_client.blob_cache = blob_cache.BlobCache(directory, 1024)
+      md5_sum = 'a' * 32
+      self.server.blobs[md5_sum] = {'foo': 'bar'}
+      self.rest_client.GetBlob('pkgstats', md5_sum)
+      # The package was indexed again.
+      self.server.blobs[md5_sum] = {'foo': 'baz'}
+      self.assertEqual({'foo': 'baz'},
+                       self.rest_client.GetBlob('pkgstats', md5_sum))
+      blobs = self.rest_client.GetBlobs('pkgstats', [md5_sum])
+      self.assertEqual({'foo': 'baz'}, blobs[md5_sum])
+      self.assertEqual(0, self.rest_client.blob_cache.hits)
+    finally:
+      shutil.rmtree(directory)
+
+
+class GetCatalogUnitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = FakeReleasesServer()
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.directory = tempfile.mkdtemp(prefix='rest_test-')
+    self.rest_client = rest.RestClient(
+        pkgdb_url='http://127.0.0.1:%d' % self.server.server_address[1],
+        releases_url=None,
+        blob_cache=blob_cache.BlobCache(self.directory, 1024 * 1024))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testCatalogCache(self):
+    path = '/catalogs/unstable/sparc/SunOS5.10/for-generation/?format=ndjson'
+    self.server.catalogs[path] = ('"rev-1"', [['foo', '1.0']])
+    for _ in range(2):
+      self.assertEqual(
+          [['foo', '1.0']],
+          self.rest_client.GetCatalogForGeneration(
+            'unstable', 'sparc', 'SunOS5.10'))
+    # The second response was empty, the catalog came from the cache.
+    self.assertEqual(1, self.rest_client.blob_cache.hits)
+    self.server.catalogs[path] = ('"rev-2"', [['bar', '1.0']])
+    self.assertEqual(
+        [['bar', '1.0']],
+        self.rest_client.GetCatalogForGeneration(
+          'unstable', 'sparc', 'SunOS5.10'))
+    self.assertEqual(3, len(self.server.requests))
+
+  def testIterCatalogForGeneration(self):
+    path = '/catalogs/unstable/sparc/SunOS5.10/for-generation/?format=ndjson'
+    self.server.catalogs[path] = ('"rev-1"', [['foo', '1.0'], ['bar', '1.0']])
+    for _ in range(2):
+      entries = self.rest_client.IterCatalogForGeneration(
+          'unstable', 'sparc', 'SunOS5.10')
+      self.assertEqual(['foo', '1.0'], entries.next())
+      self.assertEqual([['bar', '1.0']], list(entries))
+    self.assertEqual(1, self.rest_client.blob_cache.hits)
+    self.assertEqual(2, len(self.server.requests))
+
+  def testPartiallyReadCatalogNotCached(self):
+    path = '/catalogs/unstable/sparc/SunOS5.10/for-generation/?format=ndjson'
+    self.server.catalogs[path] = ('"rev-1"', [['foo', '1.0'], ['bar', '1.0']])
+    entries = self.rest_client.IterCatalogForGeneration(
+        'unstable', 'sparc', 'SunOS5.10')
+    entries.next()
+    entries.close()
+    self.assertEqual(
+        [['foo', '1.0'], ['bar', '1.0']],
+        self.rest_client.GetCatalogForGeneration(
+          'unstable', 'sparc', 'SunOS5.10'))
+    self.assertEqual(0, self.rest_client.blob_cache.hits)
+    for unused_dirpath, unused_dirnames, filenames in os.walk(self.directory):
+      self.assertEqual([], [x for x in filenames
+                            if x.startswith(blob_cache.TMP_PREFIX)])
+
+  def testCatalogWithoutCache(self):
+    self.rest_client.blob_cache = None
+    path = '/catalogs/unstable/sparc/SunOS5.10/?quick=true&format=ndjson'
+    self.server.catalogs[path] = ('"rev-1"', [{'catalogname': 'foo'}])
+    self.assertEqual(
+        [{'catalogname': 'foo'}],
+        self.rest_client.GetCatalog('unstable', 'sparc', 'SunOS5.10'))
+    self.assertEqual(
+        [{'catalogname': 'foo'}],
+        list(self.rest_client.IterCatalog('unstable', 'sparc', 'SunOS5.10')))
+
+  def testEmptyCatalog(self):
+    self.assertEqual(
+        None, self.rest_client.GetCatalog('unstable', 'sparc', 'SunOS5.10'))
+
+
+class AddSvr4sToCatalogUnitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = FakeReleasesServer()
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.rest_client = rest.RestClient(
+        pkgdb_url=None,
+        releases_url='http://127.0.0.1:%d' % self.server.server_address[1])
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testSplitIntoChunks(self):
+    md5_sums = ['%032x' % i
+                for i in range(common_constants.MAX_BULK_ASSIGNMENTS + 1)]
+    results = self.rest_client.AddSvr4sToCatalog(
+        'unstable', 'sparc', 'SunOS5.10', iter(md5_sums))
+    self.assertEqual(md5_sums, [x['md5_sum'] for x in results])
+    self.assertEqual(
+        [md5_sums[:-1], md5_sums[-1:]], self.server.assignment_requests)
+    self.assertEqual(
+        ['/catalogs/unstable/sparc/SunOS5.10/bulk-add/'] * 2,
+        self.server.requests)
+
+  def testNothingToAdd(self):
+    self.assertEqual(
+        [], self.rest_client.AddSvr4sToCatalog(
+            'unstable', 'sparc', 'SunOS5.10', []))
+    self.assertEqual([], self.server.requests)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
@@ -19,6 +19,7 @@ import pprint
 import sys
 import urllib2
 
+from lib.python import blob_cache
 from lib.python import configuration
 from lib.python import rest
 from lib.python import common_constants
@@ -216,7 +217,8 @@ def main():
       pkgdb_url=config.get('rest', 'pkgdb'),
       releases_url=config.get('rest', 'releases'),
       username=username,
-      password=password)
+      password=password,
+      blob_cache=blob_cache.GetBlobCache(config))
 
   pr = PackageRemover(rest_client)
   pr.RemovePackage(options.catalogname, not options.dry_run, os_releases)
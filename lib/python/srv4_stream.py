@@ -0,0 +1,245 @@
+"""Reads srv4 package datastreams without unpacking them to disk.
+
+A datastream, as written by pkgtrans, is a text header listing the packages,
+followed by a sequence of cpio archives, each padded to 512-byte blocks. The
+first archive holds pkginfo and pkgmap of the package. The following ones
+(one per part) hold the package directory: pkginfo, pkgmap, install/* and
+the payload under root/ or reloc/.
+
+Gzipped datastreams are decompressed on the fly, the data are read in a
+single, sequential pass.
+
+Example:
+
+  with srv4_stream.OpenDatastream('foo-1.0-SunOS5.10-sparc-CSW.pkg.gz') as fd:
+    reader = srv4_stream.Srv4Reader(fd)
+    for entry in reader.IterEntries():
+      if entry.path == 'pkginfo':
+        pkginfo = entry.read()
+"""
+
+import gzip
+import stat
+
+from lib.python import errors
+
+BLOCK_SIZE = 512
+DATASTREAM_MAGIC = '# PaCkAgE DaTaStReAm'
+END_OF_HEADER = '# end of header'
+CPIO_TRAILER = 'TRAILER!!!'
+# Newc (070701), newc with checksums (070702) and odc (070707).
+CPIO_NEWC_MAGICS = ('070701', '070702')
+CPIO_ODC_MAGIC = '070707'
+CPIO_NEWC_HEADER_SIZE = 110
+CPIO_ODC_HEADER_SIZE = 76
+READ_CHUNK_SIZE = 1024 * 1024
+# How many blocks of padding between archives are tolerated.
+MAX_PADDING_BLOCKS = 100
+
+
+class Error(errors.Error):
+  """Generic error."""
+
+
+class DatastreamError(Error):
+  """The file is not a valid package datastream."""
+
+
+def OpenDatastream(path):
+  """Opens a .pkg or a .pkg.gz file for reading."""
+  if path.endswith('.gz'):
+    return gzip.GzipFile(path, 'rb')
+  return open(path, 'rb')
+
+
+class CpioEntry(object):
+  """A file from a cpio archive.
+
+  The content can only be read before the next entry is requested from the
+  reader.
+  """
+
+  def __init__(self, reader, path, mode, size, mtime):
+    self._reader = reader
+    self.path = path
+    self.mode = mode
+    self.size = size
+    self.mtime = mtime
+    self._left = size
+
+  def __repr__(self):
+    return 'CpioEntry(%r, size=%d)' % (self.path, self.size)
+
+  def IsRegularFile(self):
+    return stat.S_ISREG(self.mode)
+
+  def IsDirectory(self):
+    return stat.S_ISDIR(self.mode)
+
+  def read(self, size=-1):
+    if size < 0 or size > self._left:
+      size = self._left
+    if not size:
+      return ''
+    data = self._reader._ReadExactly(size)
+    self._left -= size
+    return data
+
+  def IterChunks(self, chunk_size=READ_CHUNK_SIZE):
+    data = self.read(chunk_size)
+    while data:
+      yield data
+      data = self.read(chunk_size)
+
+  def _Skip(self):
+    while self._left:
+      self.read(READ_CHUNK_SIZE)
+
+
+class Srv4Reader(object):
+  """Iterates over the files of a single package datastream."""
+
+  def __init__(self, fd):
+    self._fd = fd
+    self._offset = 0
+    # Data read ahead while looking for the next archive.
+    self._unread = ''
+    self._pkgnames = None
+
+  def _Read(self, size):
+    if self._unread:
+      data, self._unread = self._unread[:size], self._unread[size:]
+      if len(data) < size:
+        data += self._fd.read(size - len(data))
+    else:
+      data = self._fd.read(size)
+    self._offset += len(data)
+    return data
+
+  def _Unread(self, data):
+    self._unread = data + self._unread
+    self._offset -= len(data)
+
+  def _ReadExactly(self, size):
+    data = self._Read(size)
+    if len(data) != size:
+      raise DatastreamError('Unexpected end of data at offset %d.'
+                            % self._offset)
+    return data
+
+  def _SkipTo(self, alignment):
+    remainder = self._offset % alignment
+    if remainder:
+      self._ReadExactly(alignment - remainder)
+
+  def _ReadHeader(self):
+    header = ''
+    while END_OF_HEADER not in header:
+      block = self._Read(BLOCK_SIZE)
+      if not block:
+        raise DatastreamError('The end of the datastream header not found.')
+      header += block
+      if not header.startswith(DATASTREAM_MAGIC):
+        raise DatastreamError('Not a package datastream: %r'
+                              % header[:len(DATASTREAM_MAGIC)])
+    self._pkgnames = []
+    for line in header.split(END_OF_HEADER)[0].splitlines()[1:]:
+      fields = line.split()
+      if fields and not fields[0].startswith('#'):
+        self._pkgnames.append(fields[0])
+
+  @property
+  def pkgnames(self):
+    """Packages in the datastream, only the header is read."""
+    if self._pkgnames is None:
+      self._ReadHeader()
+    return self._pkgnames
+
+  def _NextArchive(self):
+    """Moves to the start of the next cpio archive.
+
+    Archives start at block boundaries, possibly after a few blocks of
+    padding. Returns the cpio magic, or None at the end of data.
+    """
+    self._SkipTo(BLOCK_SIZE)
+    for unused_i in xrange(MAX_PADDING_BLOCKS):
+      block = self._Read(BLOCK_SIZE)
+      if not block.strip('\0'):
+        if len(block) < BLOCK_SIZE:
+          return None
+        continue
+      magic = block[:6]
+      if magic not in CPIO_NEWC_MAGICS and magic != CPIO_ODC_MAGIC:
+        raise DatastreamError('Unsupported cpio header %r at offset %d.'
+                              % (magic, self._offset - len(block)))
+      self._Unread(block)
+      return magic
+    raise DatastreamError('No cpio archive found before offset %d.'
+                          % self._offset)
+
+  def _ReadNewcHeader(self):
+    header = self._ReadExactly(CPIO_NEWC_HEADER_SIZE)
+    fields = [int(header[i:i + 8], 16)
+              for i in range(6, CPIO_NEWC_HEADER_SIZE, 8)]
+    mode, mtime, size, namesize = fields[1], fields[5], fields[6], fields[11]
+    name = self._ReadExactly(namesize).rstrip('\0')
+    self._SkipTo(4)
+    return name, mode, size, mtime
+
+  def _ReadOdcHeader(self):
+    header = self._ReadExactly(CPIO_ODC_HEADER_SIZE)
+    mode = int(header[18:24], 8)
+    mtime = int(header[48:59], 8)
+    namesize = int(header[59:65], 8)
+    size = int(header[65:76], 8)
+    name = self._ReadExactly(namesize).rstrip('\0')
+    return name, mode, size, mtime
+
+  def _NormalizePath(self, name, pkgname):
+    if name.startswith('./'):
+      name = name[2:]
+    if name.startswith(pkgname + '/'):
+      name = name[len(pkgname) + 1:]
+    return name
+
+  def _IterArchive(self, magic, pkgname):
+    while True:
+      try:
+        if magic == CPIO_ODC_MAGIC:
+          name, mode, size, mtime = self._ReadOdcHeader()
+        elif magic in CPIO_NEWC_MAGICS:
+          name, mode, size, mtime = self._ReadNewcHeader()
+        else:
+          raise DatastreamError('Bad cpio header %r at offset %d.'
+                                % (magic, self._offset))
+      except ValueError, e:
+        raise DatastreamError('Bad cpio header at offset %d: %s'
+                              % (self._offset, e))
+      if name == CPIO_TRAILER:
+        return
+      entry = CpioEntry(self, self._NormalizePath(name, pkgname),
+                        mode, size, mtime)
+      yield entry
+      entry._Skip()
+      if magic != CPIO_ODC_MAGIC:
+        self._SkipTo(4)
+      magic = self._ReadExactly(6)
+      self._Unread(magic)
+
+  def IterEntries(self):
+    """Yields a CpioEntry for every file and directory of the package.
+
+    Paths are relative to the package directory, e.g. 'pkginfo' or
+    'root/opt/csw/bin/foo'. Entries present in more than one archive, such
+    as pkginfo, are yielded more than once.
+    """
+    pkgnames = self.pkgnames
+    if len(pkgnames) != 1:
+      raise DatastreamError(
+          'Exactly one package in the package stream is expected; '
+          'actual: %s.' % pkgnames)
+    magic = self._NextArchive()
+    while magic:
+      for entry in self._IterArchive(magic, pkgnames[0]):
+        yield entry
+      magic = self._NextArchive()
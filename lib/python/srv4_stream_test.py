@@ -0,0 +1,124 @@
+#!/usr/bin/env python2.6
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from lib.python import srv4_stream
+
+PKGINFO = 'PKG=CSWfoo\nNAME=foo - The foo package\nBASEDIR=/\n'
+PKGMAP = ': 1 4\n1 f none /opt/csw/bin/foo 0755 root bin 5 500 1\n'
+
+
+def _Pad(data, alignment):
+  return data + '\0' * (-len(data) % alignment)
+
+
+def MakeCpioEntry(name, data, fmt, mode=0100644):
+  name += '\0'
+  if fmt == 'odc':
+    header = '070707%06o%06o%06o%06o%06o%06o%06o%011o%06o%011o' % (
+        0, 0, mode, 0, 0, 1, 0, 1234567890, len(name), len(data))
+    return header + name + data
+  header = '070701' + ''.join('%08X' % x for x in (
+      0, mode, 0, 0, 1, 1234567890, len(data), 0, 0, 0, 0, len(name), 0))
+  return _Pad(header + name, 4) + _Pad(data, 4)
+
+
+def MakeCpioArchive(files, fmt):
+  data = ''.join(MakeCpioEntry(name, content, fmt, mode)
+                 for name, content, mode in files)
+  data += MakeCpioEntry('TRAILER!!!', '', fmt)
+  return _Pad(data, srv4_stream.BLOCK_SIZE)
+
+
+def MakeDatastream(pkgname, files, fmt='newc'):
+  """Builds a datastream the way pkgtrans lays it out."""
+  header = _Pad('%s\n%s 1 10\n%s\n' % (
+      srv4_stream.DATASTREAM_MAGIC, pkgname, srv4_stream.END_OF_HEADER),
+      srv4_stream.BLOCK_SIZE)
+  first_archive = MakeCpioArchive(
+      [('%s/pkginfo' % pkgname, PKGINFO, 0100644),
+       ('%s/pkgmap' % pkgname, PKGMAP, 0100644)], fmt)
+  part = MakeCpioArchive(
+      [('pkginfo', PKGINFO, 0100644),
+       ('pkgmap', PKGMAP, 0100644),
+       ('install', '', 040755),
+       ('install/depend', 'P CSWcommon common\n', 0100644)] + files, fmt)
+  # An additional block of padding between the archives.
+  return header + first_archive + '\0' * srv4_stream.BLOCK_SIZE + part
+
+
+class Srv4ReaderUnitTest(unittest.TestCase):
+
+  def ReadAll(self, data):
+    reader = srv4_stream.Srv4Reader(StringIO(data))
+    return [(x.path, x.read()) for x in reader.IterEntries()
+            if x.IsRegularFile()]
+
+  def testPkgnames(self):
+    reader = srv4_stream.Srv4Reader(StringIO(MakeDatastream('CSWfoo', [])))
+    self.assertEqual(['CSWfoo'], reader.pkgnames)
+
+  def testIterEntriesNewc(self):
+    files = [('root/opt/csw/bin/foo', 'hello', 0100755)]
+    self.assertEqual(
+        [('pkginfo', PKGINFO), ('pkgmap', PKGMAP),
+         ('pkginfo', PKGINFO), ('pkgmap', PKGMAP),
+         ('install/depend', 'P CSWcommon common\n'),
+         ('root/opt/csw/bin/foo', 'hello')],
+        self.ReadAll(MakeDatastream('CSWfoo', files)))
+
+  def testIterEntriesOdc(self):
+    files = [('root/opt/csw/bin/foo', 'hello', 0100755),
+             ('root/opt/csw/bin/bar', 'x' * 1000, 0100755)]
+    entries = self.ReadAll(MakeDatastream('CSWfoo', files, fmt='odc'))
+    self.assertEqual(('root/opt/csw/bin/bar', 'x' * 1000), entries[-1])
+    self.assertEqual(7, len(entries))
+
+  def testUnreadEntriesAreSkipped(self):
+    files = [('root/a', 'a' * 3000, 0100644),
+             ('root/b', 'b', 0100644)]
+    reader = srv4_stream.Srv4Reader(
+        StringIO(MakeDatastream('CSWfoo', files)))
+    entries = list(reader.IterEntries())
+    self.assertEqual('root/b', entries[-1].path)
+    self.assertEqual(3000, entries[-2].size)
+
+  def testPartialReads(self):
+    files = [('root/a', 'abcdefgh', 0100644)]
+    reader = srv4_stream.Srv4Reader(
+        StringIO(MakeDatastream('CSWfoo', files)))
+    for entry in reader.IterEntries():
+      if entry.path == 'root/a':
+        self.assertEqual(['abc', 'def', 'gh'], list(entry.IterChunks(3)))
+
+  def testNotADatastream(self):
+    reader = srv4_stream.Srv4Reader(StringIO('\x1f\x8b' + 'x' * 1000))
+    self.assertRaises(srv4_stream.DatastreamError, lambda: reader.pkgnames)
+
+  def testTruncated(self):
+    data = MakeDatastream('CSWfoo', [('root/a', 'a' * 3000, 0100644)])
+    reader = srv4_stream.Srv4Reader(StringIO(data[:2000]))
+    self.assertRaises(srv4_stream.DatastreamError, list, reader.IterEntries())
+
+  def testOpenDatastreamGzip(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmpdir, 'foo.pkg.gz')
+      gz = gzip.GzipFile(path, 'wb')
+      gz.write(MakeDatastream('CSWfoo', [('root/a', 'a', 0100644)]))
+      gz.close()
+      fd = srv4_stream.OpenDatastream(path)
+      reader = srv4_stream.Srv4Reader(fd)
+      self.assertEqual('root/a', list(reader.IterEntries())[-1].path)
+      fd.close()
+    finally:
+      shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+  unittest.main()
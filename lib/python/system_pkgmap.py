@@ -3,6 +3,7 @@
 
 import copy
 import datetime
+import getpass
 import hashlib
 import itertools
 import logging
@@ -11,12 +12,13 @@ import os.path
 import progressbar
 import progressbar.widgets
 import re
+import sqlite3
 import sqlobject
 import sys
+import tempfile
 
 from sqlobject import sqlbuilder
 
-from lib.python import checkpkg_lib
 from lib.python import common_constants
 from lib.python import configuration
 from lib.python import errors
@@ -32,6 +34,9 @@ from lib.python import util
 
 CONTENT_PKG_RE = r"^\*?(CSW|SUNW)[0-9a-zA-Z\-]?[0-9a-z\-]+$"
 ALPHANUMERIC_RE = r"[0-9a-zA-Z]+"
+# The first record of chunks saved with SaveChunkStream(). Chunks saved with
+# SaveChunk() consist of a single list.
+CHUNK_STREAM_MARKER = "system-pkgmap-chunk-stream-1"
 
 class ParsingError(errors.Error):
   """Parsing has failed."""
@@ -65,6 +70,15 @@ class OsIndexingBase(object):
       logging.info("%s does not exist.", fn)
       return False
 
+  def SaveChunkStream(self, name, items):
+    """Saves a chunk as a sequence of records, which can be read lazily."""
+    fn = self._ChunkName(name)
+    with open(fn, "w") as fd:
+      logging.debug("Marshalling records to %r.", fn)
+      marshal.dump(CHUNK_STREAM_MARKER, fd)
+      for item in items:
+        marshal.dump(item, fd)
+
   def LoadChunk(self, name):
     fn = self._ChunkName(name)
     with open(fn, "r") as fd:
@@ -72,6 +86,28 @@ class OsIndexingBase(object):
       data = marshal.load(fd)
     return data
 
+  def IterChunk(self, name):
+    """Yields items of a list chunk, one at a time.
+
+    Only chunks saved with SaveChunkStream() are read lazily. Chunks saved
+    with SaveChunk() are loaded into memory as a whole.
+    """
+    fn = self._ChunkName(name)
+    with open(fn, "r") as fd:
+      logging.debug("Reading chunk %r", fn)
+      first = marshal.load(fd)
+      if first != CHUNK_STREAM_MARKER:
+        logging.info("%r is not a stream chunk, loading it into memory.", fn)
+        for item in first:
+          yield item
+        return
+      while True:
+        try:
+          item = marshal.load(fd)
+        except EOFError:
+          break
+        yield item
+
   def _Basename(self):
     return "system-idx-%s-%s" % (self.osrel, self.arch)
 
@@ -341,10 +377,10 @@ class Indexer(OsIndexingBase):
         contents += self._ParsePkgContents(ips_pkgcontents_stream,
                                            self._ParseIpsPkgContentsLine,
                                            show_progress)
-      self.SaveChunk("contents", contents)
+      self.SaveChunkStream("contents", contents)
     if not self.ChunkExists("files_metadata"):
       if not contents:
-        contents = self.LoadChunk("contents")
+        contents = list(self.IterChunk("contents"))
       # We don't need to index anything under /opt/csw.
       contents_namedtuple = [representations.PkgmapEntry._make(x)
                              for x in contents]
@@ -352,11 +388,11 @@ class Indexer(OsIndexingBase):
           x for x in contents_namedtuple
           if not x.path.startswith("/opt/csw")]
       files_metadata = self._GetFilesMetadata(fetch_metadata_for)
-      self.SaveChunk("files_metadata", files_metadata)
+      self.SaveChunkStream("files_metadata", files_metadata)
       del contents # Will it save any memory?
     if not self.ChunkExists("binaries_dump_info"):
       if not files_metadata:
-        files_metadata = self.LoadChunk("files_metadata")
+        files_metadata = list(self.IterChunk("files_metadata"))
       # Changing from named tuples to tuples for marshalling.
       binaries_dump_info = (
           [tuple(x) for x in self._GetBinariesDumpInfo(files_metadata)])
@@ -453,6 +489,70 @@ class Indexer(OsIndexingBase):
     sys.stdout.flush()
     return binaries_dump_info
 
+class PkgmapEntrySpool(object):
+  """Groups pkgmap entries by package, using a temporary file.
+
+  On a large system, the contents of all packages and the metadata of all
+  files don't fit in memory. The spool keeps them in a temporary sqlite
+  database, so that packages can be processed one at a time.
+  """
+
+  def __init__(self, tmpdir=None):
+    fd, self.path = tempfile.mkstemp(
+        prefix="system-pkgmap-", suffix=".db", dir=tmpdir)
+    os.close(fd)
+    self.conn = sqlite3.connect(self.path)
+    # Package names and paths go through unchanged.
+    self.conn.text_factory = str
+    self.conn.execute("PRAGMA synchronous = OFF")
+    self.conn.execute("PRAGMA journal_mode = OFF")
+    self.conn.execute(
+        "CREATE TABLE metadata (path TEXT PRIMARY KEY, data BLOB)")
+    self.conn.execute(
+        "CREATE TABLE entries (pkgname TEXT, path TEXT, data BLOB)")
+
+  def AddFilesMetadata(self, files_metadata):
+    """Adds file metadata tuples."""
+    self.conn.executemany(
+        "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+        ((representations.FileMetadata._make(x).path,
+          buffer(marshal.dumps(tuple(x))))
+         for x in files_metadata))
+
+  def AddEntries(self, pkgnames_and_entries):
+    """Adds (pkgname, PkgmapEntry) pairs."""
+    self.conn.executemany(
+        "INSERT INTO entries VALUES (?, ?, ?)",
+        ((pkgname, x.path, buffer(marshal.dumps(tuple(x))))
+         for pkgname, x in pkgnames_and_entries))
+
+  def GetPkgnameCount(self):
+    return self.conn.execute(
+        "SELECT COUNT(DISTINCT pkgname) FROM entries").fetchone()[0]
+
+  def IterPackages(self):
+    """Yields (pkgname, [(pkgmap entry, file metadata), ...]).
+
+    Entries without file metadata are skipped. Entries of a package are in
+    the order they were added in.
+    """
+    self.conn.execute("CREATE INDEX IF NOT EXISTS entries_pkgname "
+                      "ON entries (pkgname)")
+    cursor = self.conn.execute(
+        "SELECT e.pkgname, e.data, m.data FROM entries e "
+        "JOIN metadata m ON m.path = e.path "
+        "ORDER BY e.pkgname, e.rowid")
+    rows = ((pkgname, representations.PkgmapEntry._make(marshal.loads(entry)),
+             representations.FileMetadata._make(marshal.loads(metadata)))
+            for pkgname, entry, metadata in cursor)
+    for pkgname, group in itertools.groupby(rows, lambda x: x[0]):
+      yield pkgname, [(entry, metadata) for _, entry, metadata in group]
+
+  def Close(self):
+    self.conn.close()
+    os.unlink(self.path)
+
+
 class InstallContentsImporter(OsIndexingBase):
   """Responsible for importing a serialized file into the database."""
 
@@ -468,43 +568,86 @@ class InstallContentsImporter(OsIndexingBase):
         debug=debug)
 
   def _RemoveSystemPackagesFromCatalog(self, data):
+    """Removes system packages from all catalogs of the osrel and arch.
+
+    Each catalog is changed in bulk, and the removals are recorded in its
+    change log.
+    """
     # TODO(maciej): Move this functionality to the server side.
     sqo_osrel, sqo_arch = self._GetSqoOsrelAndArch(data["osrel"], data["arch"])
     # We need to delete assignments from only the system packages, not
     # the CSW packages.
-    result = m.Srv4FileInCatalog.select(
-        sqlobject.AND(
-          m.Srv4FileInCatalog.q.arch==sqo_arch,
-          m.Srv4FileInCatalog.q.osrel==sqo_osrel))
-    for catalog_assignment in result:
-      if not catalog_assignment.srv4file.use_to_generate_catalogs:
-        catalog_assignment.destroySelf()
+    connection = m.Srv4FileInCatalog._connection
+    rows = connection.queryAll(connection.sqlrepr(sqlbuilder.Select(
+      [m.Srv4FileInCatalog.q.catrel,
+       m.Srv4FileInCatalog.q.id,
+       m.Srv4FileInCatalog.q.srv4file,
+       m.Srv4FileStats.q.md5_sum,
+       m.Srv4FileStats.q.catalogname],
+      where=sqlobject.AND(
+        m.Srv4FileInCatalog.q.osrel==sqo_osrel,
+        m.Srv4FileInCatalog.q.arch==sqo_arch,
+        m.Srv4FileInCatalog.q.srv4file==m.Srv4FileStats.q.id,
+        m.Srv4FileStats.q.use_to_generate_catalogs==False))))
+    by_catrel = {}
+    for catrel_id, assignment_id, srv4_id, md5_sum, catalogname in rows:
+      assignments, removed = by_catrel.setdefault(catrel_id, ([], []))
+      assignments.append((assignment_id, srv4_id))
+      removed.append((md5_sum, catalogname))
+    who = getpass.getuser()
+    for catrel_id, (assignments, removed) in sorted(by_catrel.iteritems()):
+      m.DeleteCatalogAssignments(
+          sqo_osrel, sqo_arch, m.CatalogRelease.get(catrel_id),
+          assignments, removed, who)
 
   def ImportData(self, data, show_progress=False, include_prefixes=None):
+    """Composes fake packages and uploads them, one at a time.
+
+    The packages are then added to each catalog with a single request.
+
+    data["contents"] and data["files_metadata"] can be iterators; they are
+    spooled to disk, so memory usage doesn't depend on the size of the
+    system.
+    """
     logging.debug('Cleaning the catalogs.')
     self._RemoveSystemPackagesFromCatalog(data)
     logging.debug('Composing fake packages.')
-    pkgstats_list = self._ComposePkgstats(data)
-    catalogs_to_insert_to = common_constants.DEFAULT_CATALOG_RELEASES
-    logging.info('Inserting system packages into %s.'
-                 % ' '.join(catalogs_to_insert_to))
-    pbar = self._GetPbar(show_progress)
-    pbar.maxval = len(pkgstats_list)
-    pbar.start()
-    for i, pkgstats in enumerate(pkgstats_list):
-      md5_sum = pkgstats['basic_stats']['md5_sum']
-      if not self.rest_client.BlobExists('pkgstats', md5_sum):
-        self.rest_client.SaveBlob('pkgstats', md5_sum, pkgstats)
-      if not self.rest_client.IsRegisteredLevelTwo(md5_sum):
-        self.rest_client.RegisterLevelTwo(md5_sum, use_in_catalogs=False)
+    spool = self._SpoolPkgmapEntries(data, include_prefixes)
+    try:
+      catalogs_to_insert_to = common_constants.DEFAULT_CATALOG_RELEASES
+      logging.info('Inserting system packages into %s.'
+                   % ' '.join(catalogs_to_insert_to))
+      pbar = self._GetPbar(show_progress)
+      pbar.maxval = spool.GetPkgnameCount()
+      pbar.start()
+      pkgstats_iter = self._IterPkgstats(spool, data["osrel"], data["arch"])
+      md5_sums = []
+      for i, pkgstats in enumerate(pkgstats_iter):
+        md5_sum = pkgstats['basic_stats']['md5_sum']
+        if not self.rest_client.BlobExists('pkgstats', md5_sum):
+          self.rest_client.SaveBlob('pkgstats', md5_sum, pkgstats)
+        if not self.rest_client.IsRegisteredLevelTwo(md5_sum):
+          self.rest_client.RegisterLevelTwo(md5_sum, use_in_catalogs=False)
+        md5_sums.append(md5_sum)
+        pbar.update(i)
+      pbar.finish()
       # We need to import these into the regular catalogs.
       # TODO(maciej): Solve the problem of adding a new catalog. All
       # these have to be imported again.
       for catalog_release in catalogs_to_insert_to:
-        self.rest_client.AddSvr4ToCatalog(catalog_release, data['arch'],
-                                          data['osrel'], md5_sum)
-      pbar.update(i)
-    pbar.finish()
+        results = self.rest_client.AddSvr4sToCatalog(
+            catalog_release, data['arch'], data['osrel'], md5_sums)
+        failed = [x for x in results if x['status'] == 'error']
+        for result in failed:
+          logging.error("Could not add %s to %s %s %s: %s",
+                        result['md5_sum'], catalog_release, data['arch'],
+                        data['osrel'], result['message'])
+        if failed:
+          raise DataError("%d system packages could not be added to %s %s %s"
+                          % (len(failed), catalog_release, data['arch'],
+                             data['osrel']))
+    finally:
+      spool.Close()
 
   def _GetSqoOsrelAndArch(self, osrel, arch):
     # TODO(maciej): Remove when _RemoveSystemPackagesFromCatalog uses
@@ -552,64 +695,53 @@ class InstallContentsImporter(OsIndexingBase):
           break
     return skip_pkgname
 
-  def _ComposePkgstats(self, data, include_prefixes=None, show_progress=True):
-    logging.debug("_ComposePkgstats()")
-    osrel = data["osrel"]
-    arch = data["arch"]
-    contents = data["contents"]
-    files_metadata = [representations.FileMetadata._make(x)
-                      for x in data["files_metadata"]]
-    logging.debug("Creating an in-memory index of files metadata (mime types)")
-    metadata_by_file_name = dict(
-        (x.path, x) for x in files_metadata)
-    catalog = checkpkg_lib.Catalog()
-    srv4_files_to_catalog = set()
-    cleaned_pkgs = set()
-    pkgs_by_pkgname = {}
-    pbar = self._GetPbar(show_progress)
-    progressbar_divisor = int(len(contents) / 1000)
-    if progressbar_divisor < 1:
-      progressbar_divisor = 1
-    update_period = 1L
-    pbar.maxval = len(contents)
-    pbar.start()
-    count = itertools.count()
-    plc = fake_pkgstats_composer.PkgstatsListComposer(osrel, arch)
-    # Create a new class responsible for creating pkgstats lists.
-    # We might potentially run out of memory here.
+  def _SpoolPkgmapEntries(self, data, include_prefixes=None):
+    spool = PkgmapEntrySpool()
+    try:
+      logging.debug("Spooling files metadata (mime types)")
+      spool.AddFilesMetadata(data["files_metadata"])
+      logging.debug("Spooling contents")
+      spool.AddEntries(self._IterPkgnamesAndEntries(data["contents"],
+                                                    include_prefixes))
+    except:
+      spool.Close()
+      raise
+    return spool
+
+  def _IterPkgnamesAndEntries(self, contents, include_prefixes):
     for pkgmap_tuple in contents:
       pkgmap_entry = representations.PkgmapEntry._make(pkgmap_tuple)
-      logging.debug("Pkgmap entry: %r", pkgmap_entry)
       for pkgname in pkgmap_entry.pkgnames:
         pkgname = self.SanitizeInstallContentsPkgname(pkgname)
         if not self._SkipPrefix(pkgname, include_prefixes):
-          # This is a little messy. Some pkgmap_entry objects are the
-          # /opt/csw ones which don't have the metadata collected.
-          # We have to skip them.
-          if pkgmap_entry.path not in metadata_by_file_name:
-            continue
-          plc.AddPkgname(pkgname)
-          plc.AddFile(pkgname,
-                      pkgmap_entry,
-                      metadata_by_file_name[pkgmap_entry.path],
-                      None, None)
-      i = count.next()
-      if not i % update_period and (i / progressbar_divisor) <= pbar.maxval:
-        pbar.update(i / progressbar_divisor)
-    pbar.finish()
-    return plc.GetPkgstats()
+          yield pkgname, pkgmap_entry
+
+  def _IterPkgstats(self, spool, osrel, arch):
+    """Yields the pkgstats of one fake package at a time."""
+    for pkgname, entries in spool.IterPackages():
+      plc = fake_pkgstats_composer.PkgstatsListComposer(osrel, arch)
+      plc.AddPkgname(pkgname)
+      # Some pkgmap_entry objects are the /opt/csw ones which don't have
+      # the metadata collected. The spool skips them.
+      for pkgmap_entry, file_metadata in entries:
+        plc.AddFile(pkgname, pkgmap_entry, file_metadata, None, None)
+      for pkgstats in plc.GetPkgstats():
+        yield pkgstats
+
+  def _ComposePkgstats(self, data, include_prefixes=None, show_progress=True):
+    logging.debug("_ComposePkgstats()")
+    spool = self._SpoolPkgmapEntries(data, include_prefixes)
+    try:
+      return list(self._IterPkgstats(spool, data["osrel"], data["arch"]))
+    finally:
+      spool.Close()
 
   def Import(self, show_progress):
-    # Maybe the data will fit in memory.
-    pkginfo = self.LoadChunk("pkginfo")
-    contents = self.LoadChunk("contents")
-    files_metadata = self.LoadChunk("files_metadata")
-    binaries_dump_info = self.LoadChunk("binaries_dump_info")
+    # The pkginfo and binaries_dump_info chunks aren't used to compose
+    # fake packages. The remaining chunks are read lazily.
     self.ImportData({
-      "pkginfo": pkginfo,
-      "contents": contents,
-      "files_metadata": files_metadata,
-      "binaries_dump_info": binaries_dump_info,
+      "contents": self.IterChunk("contents"),
+      "files_metadata": self.IterChunk("files_metadata"),
       "osrel": self.osrel,
       "arch": self.arch,
     }, show_progress=show_progress)
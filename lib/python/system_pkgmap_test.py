@@ -9,10 +9,15 @@ except ImportError:
 import pprint
 import logging
 import datetime
+import mox
+import os
+import shutil
+import tempfile
 
 from lib.python import common_constants
 from lib.python import models
 from lib.python import representations
+from lib.python import rest
 from lib.python import shell
 from lib.python import system_pkgmap
 from lib.python import test_base
@@ -737,6 +742,70 @@ class InstallContentsImporterUnitTest(test_base.SqlObjectTestMixin,
         importer.SanitizeInstallContentsPkgname("!CSWmozilla"))
 
 
+class ImportDataUnitTest(mox.MoxTestBase):
+
+  def testBulkAddErrorFailsTheImport(self):
+    importer = system_pkgmap.InstallContentsImporter("SunOS5.10", "sparc")
+    importer.rest_client = self.mox.CreateMock(rest.RestClient)
+    spool_mock = self.mox.CreateMock(system_pkgmap.PkgmapEntrySpool)
+    self.mox.StubOutWithMock(importer, '_RemoveSystemPackagesFromCatalog')
+    self.mox.StubOutWithMock(importer, '_SpoolPkgmapEntries')
+    self.mox.StubOutWithMock(importer, '_IterPkgstats')
+    data = {'osrel': 'SunOS5.10', 'arch': 'sparc'}
+    pkgstats = {'basic_stats': {'md5_sum': 'a' * 32}}
+    importer._RemoveSystemPackagesFromCatalog(data)
+    importer._SpoolPkgmapEntries(data, None).AndReturn(spool_mock)
+    spool_mock.GetPkgnameCount().AndReturn(1)
+    importer._IterPkgstats(spool_mock, 'SunOS5.10', 'sparc').AndReturn(
+        [pkgstats])
+    importer.rest_client.BlobExists('pkgstats', 'a' * 32).AndReturn(True)
+    importer.rest_client.IsRegisteredLevelTwo('a' * 32).AndReturn(True)
+    importer.rest_client.AddSvr4sToCatalog(
+        mox.IgnoreArg(), 'sparc', 'SunOS5.10', ['a' * 32]).AndReturn([
+          {'md5_sum': 'a' * 32, 'status': 'error',
+           'message': 'Package not registered'}])
+    spool_mock.Close()
+    self.mox.ReplayAll()
+    self.assertRaises(system_pkgmap.DataError, importer.ImportData, data)
+
+
+class RemoveSystemPackagesUnitTest(test_base.SqlObjectTestMixin,
+                                   unittest.TestCase):
+
+  def setUp(self):
+    super(RemoveSystemPackagesUnitTest, self).setUp()
+    self.dbc.InitialDataImport()
+    self.sqo_osrel = models.OsRelease.selectBy(short_name='SunOS5.10').getOne()
+    self.sqo_arch = models.Architecture.selectBy(name='sparc').getOne()
+    self.sqo_catrels = list(models.CatalogRelease.select().orderBy('id'))[:2]
+
+  def MakeSrv4InCatalogs(self, pkgname, md5_sum, use_in_catalogs):
+    srv4 = test_base.MakeSrv4(self.sqo_osrel, self.sqo_arch, pkgname, md5_sum,
+                              use_to_generate_catalogs=use_in_catalogs)
+    for sqo_catrel in self.sqo_catrels:
+      models.Srv4FileInCatalog(arch=self.sqo_arch, osrel=self.sqo_osrel,
+                               catrel=sqo_catrel, srv4file=srv4,
+                               created_by='test')
+
+  def testRemoveSystemPackagesFromCatalog(self):
+    self.MakeSrv4InCatalogs('SUNWfoo', 'a' * 32, False)
+    self.MakeSrv4InCatalogs('SUNWbar', 'b' * 32, False)
+    self.MakeSrv4InCatalogs('CSWfoo', 'c' * 32, True)
+    importer = system_pkgmap.InstallContentsImporter("SunOS5.10", "sparc")
+    importer._RemoveSystemPackagesFromCatalog(
+        {'osrel': 'SunOS5.10', 'arch': 'sparc'})
+    self.assertEqual(
+        ['c' * 32] * 2,
+        [x.srv4file.md5_sum for x in models.Srv4FileInCatalog.select()])
+    for sqo_catrel in self.sqo_catrels:
+      triad = (self.sqo_osrel, self.sqo_arch, sqo_catrel)
+      self.assertEqual(1, models.GetCatalogRevision(*triad))
+      self.assertEqual(
+          [('remove', 'a' * 32), ('remove', 'b' * 32)],
+          sorted((x[1], x[2])
+                 for x in models.GetCatalogChanges(*(triad + (0,)))))
+
+
 class PkgstatsListComposerUnitTest(unittest.TestCase):
 
   DATA = {
@@ -765,6 +834,81 @@ class PkgstatsListComposerUnitTest(unittest.TestCase):
     self.assertEqual(1, len(generated_pkgstats))
     self.AssertDictEqual(EX1_PKGSTATS, generated_pkgstats[0])
 
+  def testComposeFakePackagesFromIterators(self):
+    data = dict(self.DATA)
+    data['contents'] = iter(EX1_CONTENTS)
+    data['files_metadata'] = iter(EX1_FILES_METADATA)
+    generated_pkgstats = self.importer._ComposePkgstats(data, show_progress=False)
+    self.assertEqual(1, len(generated_pkgstats))
+    self.AssertDictEqual(EX1_PKGSTATS, generated_pkgstats[0])
+
+
+class FakeIndexing(system_pkgmap.OsIndexingBase):
+
+  osrel = 'SunOS5.42'
+  arch = 'mips'
+
+
+class ChunkStreamUnitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.old_cwd = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp(prefix='system_pkgmap_test-')
+    os.chdir(self.tmpdir)
+
+  def tearDown(self):
+    os.chdir(self.old_cwd)
+    shutil.rmtree(self.tmpdir)
+
+  def testIterChunkStream(self):
+    indexing = FakeIndexing()
+    indexing.SaveChunkStream('contents', iter(EX1_CONTENTS))
+    result = indexing.IterChunk('contents')
+    self.assertEqual(EX1_CONTENTS[0], result.next())
+    self.assertEqual(EX1_CONTENTS[1:], list(result))
+
+  def testIterChunkList(self):
+    indexing = FakeIndexing()
+    indexing.SaveChunk('contents', EX1_CONTENTS)
+    self.assertEqual(EX1_CONTENTS, list(indexing.IterChunk('contents')))
+
+
+class PkgmapEntrySpoolUnitTest(unittest.TestCase):
+
+  def MakeEntry(self, path, pkgname):
+    return representations.PkgmapEntry(
+        'line', 'none', '0644', 'root', 'bin', path, None, 'f',
+        None, None, None, None, None, [pkgname])
+
+  def testIterPackages(self):
+    spool = system_pkgmap.PkgmapEntrySpool()
+    try:
+      spool.AddFilesMetadata(iter([
+          ('/usr/bin/b', 'text/plain', None),
+          ('/usr/bin/a', 'text/plain', None),
+          ('/usr/bin/c', 'text/plain', None)]))
+      spool.AddEntries(iter([
+          ('SUNWtwo', self.MakeEntry('/usr/bin/c', 'SUNWtwo')),
+          ('SUNWone', self.MakeEntry('/usr/bin/b', 'SUNWone')),
+          ('SUNWone', self.MakeEntry('/usr/bin/a', 'SUNWone')),
+          # No metadata, skipped.
+          ('SUNWone', self.MakeEntry('/usr/bin/d', 'SUNWone')),
+          ('SUNWthree', self.MakeEntry('/usr/bin/e', 'SUNWthree'))]))
+      self.assertEqual(3, spool.GetPkgnameCount())
+      result = [(pkgname, [(x.path, y.path) for x, y in entries])
+                for pkgname, entries in spool.IterPackages()]
+      self.assertEqual([
+          ('SUNWone', [('/usr/bin/b', '/usr/bin/b'),
+                       ('/usr/bin/a', '/usr/bin/a')]),
+          ('SUNWtwo', [('/usr/bin/c', '/usr/bin/c')]),
+      ], result)
+      unused_pkgname, entries = spool.IterPackages().next()
+      pkgmap_entry, unused_file_metadata = entries[0]
+      self.assertEqual(['SUNWone'], pkgmap_entry.pkgnames)
+    finally:
+      spool.Close()
+    self.assertFalse(os.path.exists(spool.path))
+
 
 if __name__ == '__main__':
   logging.basicConfig(level=logging.CRITICAL)
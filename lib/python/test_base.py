@@ -1,9 +1,46 @@
 import database
+import datetime
 import logging
 import sqlobject
 
+from lib.python import models as m
 from lib.python import representations
 
+
+def MakeSrv4(sqo_osrel, sqo_arch, pkgname, md5_sum, **kwargs):
+  """Creates a Srv4FileStats object, and its Pkginst if there's none yet.
+
+  Columns tests usually don't care about get default values; any column can
+  be given as a keyword argument.
+  """
+  pkginst = m.Pkginst.selectBy(pkgname=pkgname).getOne(None)
+  if pkginst is None:
+    pkginst = m.Pkginst(pkgname=pkgname)
+  catalogname = kwargs.get('catalogname', pkgname[3:])
+  columns = dict(
+      arch=sqo_arch,
+      basename='%s.pkg' % catalogname,
+      catalogname=catalogname,
+      filename_arch=sqo_arch,
+      maintainer=None,
+      md5_sum=md5_sum,
+      size=1L,
+      mtime=datetime.datetime.now(),
+      osrel_str=sqo_osrel.short_name,
+      os_rel=sqo_osrel,
+      pkginst=pkginst,
+      pkginst_str=pkgname,
+      registered_level_one=True,
+      registered_level_two=True,
+      use_to_generate_catalogs=True,
+      rev='2011.01.01',
+      stats_version=0,
+      version_string='1.0,REV=2011.01.01',
+      bundle=None)
+  columns.update(kwargs)
+  return m.Srv4FileStats(**columns)
+
+
 class SqlObjectTestMixin(object):
 
   def setUp(self):
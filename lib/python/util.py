@@ -15,6 +15,10 @@ from lib.python.collect_binary_elfinfo import ElfExtractor
 
 
 ROOT_RE = re.compile(r"^(reloc|root)/")
+# How much of a file libmagic looks at, the default of its bytes_max setting.
+MAGIC_BUFFER_SIZE = 1024 * 1024
+# How many files are classified with a magic cookie before it's replaced.
+MAGIC_FILES_PER_COOKIE = 10000
 
 
 class MimeTypeError(errors.Error):
@@ -28,18 +32,24 @@ def StripRe(string_to_strip, strip_re):
 
 class FileMagic(object):
   """Libmagic sometimes returns None, which I think is a bug.
-  Trying to come up with a way to work around that.  It might not even be
-  very helpful, but at least detects the issue and tries to work around it.
+
+  It happens after a large number of files have been classified with the same
+  magic cookie, so the cookie is replaced every max_files files. When libmagic
+  returns None nevertheless, the file is classified again with a new cookie
+  before giving up.
   """
 
-  def __init__(self):
+  def __init__(self, max_files=MAGIC_FILES_PER_COOKIE):
     self.cookie_count = 0
+    self.max_files = max_files
     self._magic_cookie = None
+    self._files_with_cookie = 0
 
   def Close(self):
     if self._magic_cookie is not None:
       self._magic_cookie.close()
       self._magic_cookie = None
+    self._files_with_cookie = 0
 
   @property
   def magic_cookie(self):
@@ -54,58 +64,81 @@ class FileMagic(object):
       self._magic_cookie.setflags(flag)
     return self._magic_cookie
 
+  def _GetMimeType(self, method_name, arg, file_path):
+    if self.max_files and self._files_with_cookie >= self.max_files:
+      logging.debug("Replacing the magic cookie after %d files.",
+                    self._files_with_cookie)
+      self.Close()
+    for unused_attempt in range(2):
+      mime = getattr(self.magic_cookie, method_name)(arg)
+      self._files_with_cookie += 1
+      if mime:
+        return mime
+      logging.warning("libmagic has returned %r for %r, retrying with "
+                      "a new magic cookie.", mime, file_path)
+      self.Close()
+    raise MimeTypeError(
+        "libmagic has failed to return the mime type of %r, also with "
+        "a new magic cookie." % (file_path))
+
   def GetFileMimeType(self, full_path):
     logging.debug("GetFileMimeType(%r)", full_path)
-    mime = self.magic_cookie.file(full_path)
-    if not mime:
-      raise MimeTypeError(
-          "libmagic has failed to return the mime type of %r." % (full_path))
-    return mime
+    return self._GetMimeType("file", full_path, full_path)
+
+  def GetBufferMimeType(self, data, file_path):
+    """Returns the mime type of a file, given the beginning of its content."""
+    return self._GetMimeType("buffer", data, file_path)
+
 
+def GetFileMetadata(file_magic, base_dir, file_path, collect_machine_id=True):
+  """Returns the FileMetadata of a file.
 
-def GetFileMetadata(file_magic, base_dir, file_path):
+  With collect_machine_id=False, the machine_id of binaries is left empty,
+  so that the caller can fill it in from a single pass over each binary.
+  """
   full_path = unicode(os.path.join(base_dir, file_path))
   if not os.access(full_path, os.R_OK):
     return representations.FileMetadata(file_path, None, None)
   file_info_path = StripRe(file_path, ROOT_RE)
-  file_info_mime_type = file_magic.GetFileMimeType(full_path)
-  if base_dir:
-    file_info_path = os.path.join(base_dir, file_info_path)
-  if not file_info_mime_type:
-    logging.error("Could not establish the mime type of %s",
-                  full_path)
+  try:
+    file_info_mime_type = file_magic.GetFileMimeType(full_path)
+  except MimeTypeError, e:
     # We can't allow checkpkg to miss binaries. If we can establish the
     # mime type of a file, we need to fail. Unfortunately, libmagic
     # fails for many files in /opt/csw/share, so we are forced to
     # whitelist them. (Or fix libmagic...)
-    msg = (
-        "It was not possible to establish the mime type of %s.  "
-        "It's a known problem which occurs when indexing a large "
-        "number of packages in a single run.  "
-        "It's probably caused by a bug in libmagic, or a bug in "
-        "libmagic Python bindings. "
-        "Currently, there is no fix for it.  "
-        "You have to restart your process - it "
-        "will probably finish successfully when do you that."
-        % full_path)
-    if "/opt/csw/share" in full_path:
-      file_info_mime_type = "application/octet-stream; fallback"
-      logging.error(msg)
-    else:
-      raise MimeTypeError(msg)
-  if sharedlib_utils.IsBinary({"mime_type": file_info_mime_type}, check_consistency=False):
+    if "/opt/csw/share" not in full_path:
+      raise
+    logging.error("%s Using a fallback mime type.", e)
+    file_info_mime_type = "application/octet-stream; fallback"
+  if base_dir:
+    file_info_path = os.path.join(base_dir, file_info_path)
+  if (collect_machine_id and
+      sharedlib_utils.IsBinary({"mime_type": file_info_mime_type},
+                               check_consistency=False)):
     elffile = ElfExtractor(full_path)
-    file_info_machine_id = elffile.GetMachineIdOfBinary()
+    try:
+      file_info_machine_id = elffile.GetMachineIdOfBinary()
+    finally:
+      elffile.Close()
   else:
     file_info_machine_id = None
   return representations.FileMetadata(
       file_path, file_info_mime_type, file_info_machine_id)
 
+
 def GetBinaryDumpInfo(binary_abs_path, binary):
-  binary_base_name = os.path.basename(binary)
   elf_extractor = ElfExtractor(binary_abs_path)
-  binary_dump_info = elf_extractor.CollectBinaryDumpinfo()
+  try:
+    binary_dump_info = elf_extractor.CollectBinaryDumpinfo()
+  finally:
+    elf_extractor.Close()
+  return MakeBinaryDumpInfo(binary, binary_dump_info)
+
 
+def MakeBinaryDumpInfo(binary, binary_dump_info):
+  """Makes a BinaryDumpInfo out of ElfExtractor.CollectBinaryDumpinfo() data."""
+  binary_base_name = os.path.basename(binary)
   runpath_to_save = []
   if binary_dump_info['runpath']:
       runpath_to_save.extend(binary_dump_info['runpath'])
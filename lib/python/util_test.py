@@ -15,5 +15,43 @@ from lib.python import common_constants
 from lib.python import representations
 
 
+class FileMagicUnitTest(mox.MoxTestBase):
+
+  def testCookieIsReplaced(self):
+    file_magic = util.FileMagic(max_files=2)
+    for unused_i in range(5):
+      file_magic.GetBufferMimeType('Hello, world.\n', 'README')
+    self.assertEqual(3, file_magic.cookie_count)
+    file_magic.Close()
+
+  def testRetryWithNewCookie(self):
+    file_magic = util.FileMagic()
+    cookie = self.mox.CreateMockAnything()
+    cookie.buffer('data').AndReturn(None)
+    cookie.close()
+    self.mox.ReplayAll()
+    file_magic._magic_cookie = cookie
+    self.assertTrue(file_magic.GetBufferMimeType('data', 'foo'))
+    self.assertEqual(1, file_magic.cookie_count)
+    file_magic.Close()
+
+  def testFailure(self):
+    file_magic = util.FileMagic()
+    first_cookie = self.mox.CreateMockAnything()
+    first_cookie.buffer('data').AndReturn(None)
+    first_cookie.close()
+    self.mox.StubOutWithMock(util.magic, 'open')
+    second_cookie = self.mox.CreateMockAnything()
+    util.magic.open(0).AndReturn(second_cookie)
+    second_cookie.load()
+    second_cookie.setflags(mox.IgnoreArg())
+    second_cookie.buffer('data').AndReturn(None)
+    second_cookie.close()
+    self.mox.ReplayAll()
+    file_magic._magic_cookie = first_cookie
+    self.assertRaises(util.MimeTypeError,
+                      file_magic.GetBufferMimeType, 'data', 'foo')
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -8,6 +8,7 @@ import os
 
 import cjson
 import datetime
+import itertools
 import json
 import logging
 import pprint
@@ -22,6 +23,7 @@ from sqlobject import sqlbuilder
 # sys.stderr.write("Python path is {}.\n".format(sys.path))
 
 from lib.python import checkpkg_lib
+from lib.python import common_constants
 from lib.python import models
 from lib.python import representations
 from lib.web import web_lib
@@ -56,10 +58,14 @@ urls_rest = (
       'PkgnamesAndPathsByBasename',  # with ?basename=...
   r'/rest/catalogs/([^/]+)/(sparc|i386)/(SunOS[^/]+)/pkgnames-and-paths-by-basedir',
       'PkgnamesAndPathsByBasedir',  # with ?basedir=...
+  r'/rest/catalogs/([^/]+)/(sparc|i386)/(SunOS[^/]+)/pkgnames-and-paths-by-basenames/',
+      'PkgnamesAndPathsByBasenames',  # POST with query_data=[basename, ...]
   r'/rest/catalogs/([^/]+)/(sparc|i386)/(SunOS[^/]+)/for-generation/',
       'CatalogForGeneration',
   r'/rest/catalogs/([^/]+)/(sparc|i386)/(SunOS[^/]+)/timing/',
       'CatalogTiming',
+  r'/rest/catalogs/([^/]+)/(sparc|i386)/(SunOS[^/]+)/changes/',
+      'CatalogChanges',  # with ?since=revision
   # Query by catalog release, arch, OS release and catalogname
   r'/rest/catalogs/([^/]+)/(sparc|i386)/(SunOS[^/]+)/catalognames/([^/]+)/',
       'Srv4ByCatAndCatalogname',
@@ -68,6 +74,8 @@ urls_rest = (
   r'/rest/maintainers/', 'RestMaintainerList',
   r'/rest/maintainers/by-email/', 'RestMaintainerDetailByName', # with ?email=...
   r'/rest/maintainers/([0-9]+)/', 'RestMaintainerDetail',
+  r'/rest/srv4/maintainers-by-md5/',
+      'RestMaintainersByMd5',  # POST with query_data=[md5_sum, ...]
   r'/rest/srv4/([0-9a-f]{32})/', 'RestSrv4Detail',
   r'/rest/srv4/([0-9a-f]{32})/files/', 'RestSrv4DetailFiles',
   r'/rest/srv4/([0-9a-f]{32})/pkg-stats/', 'RestSrv4FullStats',
@@ -384,15 +392,19 @@ class RestCatalogDetail(object):
           osrel_name, arch_name, catrel_name)
     except sqlobject.main.SQLObjectNotFound:
       raise web.notfound()
-    pkgs = list(models.GetCatPackagesResult(sqo_osrel, sqo_arch, sqo_catrel))
-    if not len(pkgs):
+    # Only the quick representation of packages is served, with or without
+    # ?quick=true.
+    web_lib.CatalogEtag(sqo_osrel, sqo_arch, sqo_catrel, 'quick')
+    pkgs = iter(models.GetCatPackagesResult(sqo_osrel, sqo_arch, sqo_catrel))
+    try:
+      first_pkg = pkgs.next()
+    except StopIteration:
       raise web.notfound()
-    web.header('Content-type', 'application/x-vnd.opencsw.pkg;type=srv4-list')
     # We never want to return complete data for every object (too slow).
-    pkgs_data = [p.GetRestRepr(quick=True)[1] for p in pkgs]
-    response = cjson.encode(pkgs_data)
-    web.header('Content-Length', str(len(response)))
-    return response
+    return web_lib.StreamJsonResponse(
+        'application/x-vnd.opencsw.pkg;type=srv4-list',
+        (cjson.encode(p.GetRestRepr(quick=True)[1])
+         for p in itertools.chain([first_pkg], pkgs)))
 
 
 class PkgnameByFilename(object):
@@ -469,6 +481,56 @@ class PkgnamesAndPathsByBasedir(object):
     return response
 
 
+def GetQueryList():
+  """Returns the list of strings sent in the query_data field of a POST."""
+  user_data = web.input(query_data=None)
+  try:
+    query_list = cjson.decode(user_data.query_data)
+  except (cjson.DecodeError, TypeError):
+    raise web.badrequest()
+  if (not isinstance(query_list, list)
+      or not all(isinstance(x, basestring) for x in query_list)):
+    raise web.badrequest()
+  return query_list
+
+
+class PkgnamesAndPathsByBasenames(object):
+  """Bulk version of PkgnamesAndPathsByBasename."""
+
+  def POST(self, catrel, arch, osrel):
+    basenames = GetQueryList()
+    db_catalog = checkpkg_lib.Catalog()
+    try:
+      data = db_catalog.GetPathsAndPkgnamesByBasenames(
+          basenames, osrel, arch, catrel)
+    except sqlobject.main.SQLObjectNotFound:
+      raise web.notfound()
+    web.header(
+        'Content-type',
+        'application/x-vnd.opencsw.pkg;type=pkgname-list')
+    response = cjson.encode(data)
+    web.header('Content-Length', str(len(response)))
+    return response
+
+
+class RestMaintainersByMd5(object):
+  """Maintainers of many srv4 files, without fetching the srv4 files."""
+
+  def POST(self):
+    md5_sums = GetQueryList()
+    if len(md5_sums) > common_constants.MAX_BULK_MAINTAINERS:
+      raise web.badrequest()
+    maintainers = models.GetMaintainersByMd5Sums(md5_sums)
+    web.header(
+        'Content-type',
+        'application/x-vnd.opencsw.pkg;type=maintainers-by-md5')
+    response = cjson.encode(dict(
+      (md5_sum, {'maintainer_email': email, 'maintainer_full_name': full_name})
+      for md5_sum, (email, full_name) in maintainers.iteritems()))
+    web.header('Content-Length', str(len(response)))
+    return response
+
+
 class RestSrv4Detail(object):
 
   def GET(self, md5_sum):
@@ -490,7 +552,6 @@ class RestSrv4DetailFiles(object):
     except sqlobject.main.SQLObjectNotFound, e:
       raise web.notfound()
     files = models.CswFile.selectBy(srv4_file=pkg)
-    web.header('Content-type', 'application/x-vnd.opencsw.pkg;type=file-list')
     web.header('Access-Control-Allow-Origin', '*')
     def FileDict(file_obj):
       return {
@@ -498,8 +559,9 @@ class RestSrv4DetailFiles(object):
           "path": file_obj.path,
           "line": file_obj.line,
       }
-    serializable_files = [FileDict(x) for x in files]
-    return cjson.encode(serializable_files)
+    return web_lib.StreamJsonResponse(
+        'application/x-vnd.opencsw.pkg;type=file-list',
+        (cjson.encode(FileDict(x)) for x in files))
 
 
 class RestSrv4FullStats(object):
@@ -600,16 +662,16 @@ class RestSrv4List(object):
       # module.
       timezone_diff = 1.0
       return "%.1fh" % (timedelta.seconds / 60.0 / 60.0 - timezone_diff)
-    pkgs_ago = [(x, Ago(now - x.mtime)) for x in pkgs]
+    pkgs_ago = ((x, Ago(now - x.mtime)) for x in pkgs)
     def PrepareForJson(pkg_ago):
       pkg, ago = pkg_ago
       _, pkg_dict = pkg.GetRestRepr(quick=True)
       pkg_dict['ago'] = ago
       pkg_dict['maintainer'] = pkg.maintainer.GetRestRepr()
       return pkg_dict
-    response = cjson.encode([PrepareForJson(x) for x in pkgs_ago])
-    web.header('Content-Length', str(len(response)))
-    return response
+    return web_lib.StreamJsonResponse(
+        'application/x-vnd.opencsw.pkg;type=srv4-list',
+        (cjson.encode(PrepareForJson(x)) for x in pkgs_ago))
 
 
 class Redirection(object):
@@ -671,35 +733,12 @@ class CatalogForGeneration(object):
           osrel_name, arch_name, catrel_name)
     except sqlobject.main.SQLObjectNotFound:
       raise web.notfound()
-    rows = list(models.GetCatalogGenerationResult(sqo_osrel, sqo_arch, sqo_catrel))
-    def FormatList(lst):
-      if lst:
-        return '|'.join(lst)
-      else:
-        return 'none'
-    def GenCatalogEntry(row):
-      i_deps = cjson.decode(row[7])
-      i_deps_str = FormatList(i_deps)
-      deps_with_desc = cjson.decode(row[6])
-      deps = [x[0] for x in deps_with_desc if x[0].startswith('CSW')]
-      deps_str = FormatList(deps)
-      entry = representations.CatalogEntry(
-          catalogname=row[0],  # 0
-          version=row[1],      # 1
-          pkgname=row[2],      # 2
-          basename=row[3],     # 3
-          md5_sum=row[4],      # 4
-          size=str(row[5]),    # 5
-          deps=deps_str,       # 6
-          category="none",     # 7
-          i_deps=i_deps_str,   # 8
-          desc=row[8],         # 9
-      )
-      return entry
-    entries_list = [GenCatalogEntry(row) for row in rows]
-    response = cjson.encode([tuple(x) for x in entries_list])
-    web.header('Content-Length', str(len(response)))
-    return response
+    web_lib.CatalogEtag(sqo_osrel, sqo_arch, sqo_catrel, 'generation')
+    # Catalog lines are stored as JSON already, there's no need to decode
+    # and encode them again.
+    return web_lib.StreamJsonResponse(
+        'application/x-vnd.opencsw.pkg;type=catalog-for-generation',
+        models.IterCatalogLines(sqo_osrel, sqo_arch, sqo_catrel))
 
 
 class CatalogTiming(object):
@@ -738,6 +777,48 @@ class CatalogTiming(object):
     return response
 
 
+class CatalogChanges(object):
+
+  def GET(self, catrel_name, arch_name, osrel_name):
+    """Packages added to and removed from a catalog since a revision.
+
+    Returns {"revision": N, "changes": [...]}, where N is the current
+    revision of the catalog, to be passed as "since" in the next query.
+    """
+    user_data = web.input(since='0')
+    try:
+      since = int(user_data.since)
+    except ValueError:
+      raise web.badrequest()
+    try:
+      sqo_osrel, sqo_arch, sqo_catrel = models.GetSqoTriad(
+          osrel_name, arch_name, catrel_name)
+    except sqlobject.main.SQLObjectNotFound:
+      raise web.notfound()
+    # Reading the revision first, so that changes made in the meantime are
+    # returned by the next query.
+    revision = models.GetCatalogRevision(sqo_osrel, sqo_arch, sqo_catrel)
+    if since < 0 or since > revision:
+      raise web.badrequest()
+    rows = models.GetCatalogChanges(sqo_osrel, sqo_arch, sqo_catrel,
+                                    since, revision)
+    changes = []
+    for rev, action, md5_sum, catalogname, created_on, created_by in rows:
+      changes.append({
+        'revision': int(rev),
+        'action': action,
+        'md5_sum': md5_sum,
+        'catalogname': catalogname,
+        'created_on': models.SanitizeDatetime(created_on),
+        'created_by': created_by,
+      })
+    web.header('Content-type',
+               'application/x-vnd.opencsw.pkg;type=catalog-changes')
+    response = cjson.encode({'revision': revision, 'changes': changes})
+    web.header('Content-Length', str(len(response)))
+    return response
+
+
 debugme = False
 if debugme:
   web.webapi.internalerror = web.debugerror
@@ -7,8 +7,13 @@ import mock
 import unittest
 import webtest
 
+from lib.python import checkpkg_lib
+from lib.python import common_constants
 from lib.python import configuration
 from lib.python import database
+from lib.python import errors
+from lib.python import models
+from lib.python import relational_util
 from lib.web import pkgdb_web
 from lib.web import releases_web
 from lib.web import web_lib
@@ -83,6 +88,227 @@ class PkgdbWebUnitTest(unittest.TestCase):
     resp = self.relapp.delete(
         '/blob/pkgstats/ba3b78331d2ed321900e5da71f7714c5/')
 
+  def testBulkBlobs(self):
+    md5_sum = 'ba3b78331d2ed321900e5da71f7714c5'
+    missing_md5_sum = 'd3b07384d113edec49eaa6238ad5ff00'
+    self.relapp.put(
+        '/blob/pkgstats/%s/' % md5_sum,
+        params={'json_data': cjson.encode(neon_stats), 'md5_sum': md5_sum})
+    query = [['pkgstats', md5_sum], ['pkgstats', missing_md5_sum],
+             ['pkgstats', md5_sum]]
+    resp = self.relapp.post(
+        '/rpc/bulk-blobs/', params={'query_data': cjson.encode(query)})
+    lines = [cjson.decode(line) for line in resp.body.splitlines()]
+    self.assertEqual(
+        [['pkgstats', md5_sum, neon_stats],
+         ['pkgstats', missing_md5_sum, None]],
+        lines)
+    self.relapp.delete('/blob/pkgstats/%s/' % md5_sum)
+
+  def testBulkExistingSvr4(self):
+    md5_sum = 'ba3b78331d2ed321900e5da71f7714c5'
+    missing_md5_sum = 'd3b07384d113edec49eaa6238ad5ff00'
+    self.relapp.put(
+        '/blob/pkgstats/%s/' % md5_sum,
+        params={'json_data': cjson.encode(neon_stats), 'md5_sum': md5_sum})
+    resp = self.relapp.post(
+        '/rpc/bulk-existing-svr4/',
+        params={'query_data': cjson.encode([missing_md5_sum, md5_sum])})
+    self.assertEqual(
+        {'existing_stats': [md5_sum], 'missing_stats': [missing_md5_sum]},
+        cjson.decode(resp.body))
+    self.assertTrue(resp.headers['Server-Timing'].startswith('db;dur='))
+    query = {'md5_sums': [md5_sum, missing_md5_sum],
+             'tags': ['pkgstats', 'elfdump']}
+    resp = self.relapp.post(
+        '/rpc/bulk-existing-svr4/',
+        params={'query_data': cjson.encode(query)})
+    self.assertEqual(
+        {'pkgstats': {'existing': [md5_sum], 'missing': [missing_md5_sum]},
+         'elfdump': {'existing': [], 'missing': [md5_sum, missing_md5_sum]}},
+        cjson.decode(resp.body))
+    self.relapp.delete('/blob/pkgstats/%s/' % md5_sum)
+
+  def testBulkExistingSvr4BadTag(self):
+    query = {'md5_sums': ['ba3b78331d2ed321900e5da71f7714c5'],
+             'tags': ['foo']}
+    self.assertRaises(
+        webtest.AppError,
+        self.relapp.post,
+        '/rpc/bulk-existing-svr4/', params={'query_data': cjson.encode(query)})
+
+  def testBulkBlobsTooMany(self):
+    query = [['pkgstats', '%032x' % i]
+             for i in range(common_constants.MAX_BULK_BLOBS + 1)]
+    self.assertRaises(
+        webtest.AppError,
+        self.relapp.post,
+        '/rpc/bulk-blobs/', params={'query_data': cjson.encode(query)})
+
+  def testBulkBlobsBadTag(self):
+    query = [['foo', 'ba3b78331d2ed321900e5da71f7714c5']]
+    self.assertRaises(
+        webtest.AppError,
+        self.relapp.post,
+        '/rpc/bulk-blobs/', params={'query_data': cjson.encode(query)})
+
+  def testBulkBlobsBadMd5Sum(self):
+    query = [['pkgstats', 1]]
+    resp = self.relapp.post(
+        '/rpc/bulk-blobs/', params={'query_data': cjson.encode(query)},
+        expect_errors=True)
+    self.assertEqual(400, resp.status_int)
+
+  def testBulkAddToCatalog(self):
+    md5_sum = 'ba3b78331d2ed321900e5da71f7714c5'
+    missing_md5_sum = 'd3b07384d113edec49eaa6238ad5ff00'
+    self.relapp.put(
+        '/blob/pkgstats/%s/' % md5_sum,
+        params={'json_data': cjson.encode(neon_stats[0]),
+                'md5_sum': md5_sum})
+    url = '/catalogs/unstable/i386/SunOS5.8/bulk-add/'
+    resp = self.relapp.post(
+        url, params={'query_data': cjson.encode([md5_sum, missing_md5_sum])})
+    results = cjson.decode(resp.body)
+    self.assertEqual({'md5_sum': md5_sum, 'status': 'added', 'removed': []},
+                     results[0])
+    self.assertEqual('error', results[1]['status'])
+    resp = self.relapp.post(
+        url, params={'query_data': cjson.encode([md5_sum])})
+    self.assertEqual('present', cjson.decode(resp.body)[0]['status'])
+    generation_url = '/rest/catalogs/unstable/i386/SunOS5.8/for-generation/'
+    entries = cjson.decode(self.pkgdbapp.get(generation_url).body)
+    self.assertEqual([md5_sum], [x[4] for x in entries])
+    resp = self.pkgdbapp.get(generation_url + '?format=ndjson')
+    self.assertEqual(entries, [cjson.decode(x) for x in resp.body.splitlines()])
+    self.assertTrue(resp.headers['Content-type'].endswith(';format=ndjson'))
+    resp = self.pkgdbapp.get('/rest/catalogs/unstable/i386/SunOS5.8/',
+                             headers={'Accept': web_lib.NDJSON_MIME_TYPE})
+    self.assertEqual(
+        [md5_sum],
+        [cjson.decode(x)['md5_sum'] for x in resp.body.splitlines()])
+    epoch = models.GetCatalogEpoch()
+    etag = self.pkgdbapp.get(generation_url).headers['ETag']
+    self.assertEqual('"unstable-i386-SunOS5.8-generation-%d-1"' % epoch, etag)
+    resp = self.pkgdbapp.get(generation_url,
+                             headers={'If-None-Match': etag}, status=304)
+    self.assertEqual(etag, resp.headers['ETag'])
+    # Another representation of the same catalog has another ETag.
+    catalog_url = '/rest/catalogs/unstable/i386/SunOS5.8/'
+    resp = self.pkgdbapp.get(catalog_url, headers={'If-None-Match': etag})
+    self.assertEqual('"unstable-i386-SunOS5.8-quick-%d-1"' % epoch,
+                     resp.headers['ETag'])
+    self.pkgdbapp.get(catalog_url,
+                      headers={'If-None-Match': resp.headers['ETag']},
+                      status=304)
+    self.assertEqual('Accept', resp.headers['Vary'])
+    # So does the newline delimited JSON representation.
+    resp = self.pkgdbapp.get(
+        catalog_url,
+        headers={'If-None-Match': resp.headers['ETag'],
+                 'Accept': web_lib.NDJSON_MIME_TYPE})
+    self.assertEqual('"unstable-i386-SunOS5.8-quick-ndjson-%d-1"' % epoch,
+                     resp.headers['ETag'])
+    srv4 = models.Srv4FileStats.selectBy(md5_sum=md5_sum).getOne()
+    checkpkg_lib.Catalog().RemoveSrv4(srv4, 'SunOS5.8', 'i386', 'unstable')
+    resp = self.pkgdbapp.get(generation_url, headers={'If-None-Match': etag})
+    self.assertEqual([], cjson.decode(resp.body))
+    self.assertEqual('"unstable-i386-SunOS5.8-generation-%d-2"' % epoch,
+                     resp.headers['ETag'])
+    # A new epoch, e.g. after the revisions table has been created again,
+    # changes the ETag.
+    etag = resp.headers['ETag']
+    self.assertNotEqual(epoch, models.NewCatalogEpoch())
+    resp = self.pkgdbapp.get(generation_url, headers={'If-None-Match': etag})
+    self.assertEqual(200, resp.status_int)
+    changes_url = '/rest/catalogs/unstable/i386/SunOS5.8/changes/'
+    changes = cjson.decode(self.pkgdbapp.get(changes_url).body)
+    self.assertEqual(2, changes['revision'])
+    self.assertEqual(
+        [(1, 'add', md5_sum), (2, 'remove', md5_sum)],
+        [(x['revision'], x['action'], x['md5_sum'])
+         for x in changes['changes']])
+    changes = cjson.decode(
+        self.pkgdbapp.get(changes_url + '?since=1').body)
+    self.assertEqual(['remove'], [x['action'] for x in changes['changes']])
+    self.pkgdbapp.get(changes_url + '?since=3', status=400)
+    self.pkgdbapp.get(changes_url + '?since=foo', status=400)
+    self.relapp.delete('/blob/pkgstats/%s/' % md5_sum)
+
+  def testBulkAddToCatalogBadQuery(self):
+    self.assertRaises(
+        webtest.AppError,
+        self.relapp.post,
+        '/catalogs/unstable/i386/SunOS5.10/bulk-add/',
+        params={'query_data': cjson.encode(['foo'])})
+    self.assertRaises(
+        webtest.AppError,
+        self.relapp.post,
+        '/catalogs/unstable/all/SunOS5.10/bulk-add/',
+        params={'query_data': cjson.encode([])})
+
+  def testBulkAddToCatalogTooManyPackages(self):
+    md5_sums = ['%032x' % i
+                for i in range(common_constants.MAX_BULK_ASSIGNMENTS + 1)]
+    resp = self.relapp.post(
+        '/catalogs/unstable/i386/SunOS5.8/bulk-add/',
+        params={'query_data': cjson.encode(md5_sums)}, expect_errors=True)
+    self.assertEqual(400, resp.status_int)
+
+  def testBulkAddToCatalogLevelTwoDataError(self):
+    md5_sum = 'ba3b78331d2ed321900e5da71f7714c5'
+    self.relapp.put(
+        '/blob/pkgstats/%s/' % md5_sum,
+        params={'json_data': cjson.encode(neon_stats[0]),
+                'md5_sum': md5_sum})
+    # Registering level one again resets level two, other tests might have
+    # registered the package already.
+    srv4, _ = relational_util.StatsStructToDatabaseLevelOne(md5_sum)
+    with mock.patch(
+        'lib.python.relational_util.StatsStructToDatabaseLevelTwo',
+        side_effect=errors.DataError('bad stats')):
+      resp = self.relapp.post(
+          '/catalogs/unstable/i386/SunOS5.8/bulk-add/',
+          params={'query_data': cjson.encode([md5_sum])})
+    self.assertEqual(
+        [{'md5_sum': md5_sum, 'status': 'error', 'message': 'bad stats',
+          'removed': []}],
+        cjson.decode(resp.body))
+    self.assertEqual(
+        0, models.Srv4FileInCatalog.selectBy(srv4file=srv4).count())
+    self.relapp.delete('/blob/pkgstats/%s/' % md5_sum)
+
+  def testMaintainersByMd5(self):
+    md5_sum = 'ba3b78331d2ed321900e5da71f7714c5'
+    missing_md5_sum = 'd3b07384d113edec49eaa6238ad5ff00'
+    self.relapp.put(
+        '/blob/pkgstats/%s/' % md5_sum,
+        params={'json_data': cjson.encode(neon_stats[0]), 'md5_sum': md5_sum})
+    resp = self.pkgdbapp.post(
+        '/rest/srv4/maintainers-by-md5/',
+        params={'query_data': cjson.encode([md5_sum, missing_md5_sum])})
+    srv4 = models.Srv4FileStats.selectBy(md5_sum=md5_sum).getOne()
+    self.assertEqual(
+        {md5_sum: {'maintainer_email': srv4.maintainer.email,
+                   'maintainer_full_name': srv4.maintainer.full_name}},
+        cjson.decode(resp.body))
+    self.relapp.delete('/blob/pkgstats/%s/' % md5_sum)
+
+  def testStreamJson(self):
+    items = [cjson.encode([i]) for i in range(5)]
+    chunks = list(web_lib.StreamJson(items, buffer_size=10))
+    self.assertTrue(len(chunks) > 1)
+    self.assertEqual([[i] for i in range(5)], cjson.decode(''.join(chunks)))
+    self.assertEqual('[]', ''.join(web_lib.StreamJson([])))
+    self.assertEqual('[0]\n[1]\n', ''.join(web_lib.StreamJson(items[:2], True)))
+
+  def testPkgnamesAndPathsByBasenames(self):
+    resp = self.pkgdbapp.post(
+        '/rest/catalogs/unstable/sparc/SunOS5.10/'
+        'pkgnames-and-paths-by-basenames/',
+        params={'query_data': cjson.encode(['libfoo.so.1'])})
+    self.assertEqual({}, cjson.decode(resp.body))
+
 
 if __name__ == '__main__':
   logging.basicConfig(level=logging.ERROR)
@@ -11,10 +11,15 @@ import cjson
 import datetime
 import hashlib
 import logging
+import re
 import sqlobject
 import tempfile
+import time
 import web
 
+from sqlobject import sqlbuilder
+
+from lib.python import catalog_file_index
 from lib.python import checkpkg_lib
 from lib.python import configuration
 from lib.python import common_constants
@@ -40,7 +45,9 @@ urls = (
   r'/svr4/([0-9a-f]{32})/db-level-2/', 'Srv4RelationalLevelTwo',
   r'/blob/([^/]+)/([0-9a-f]{32})/', 'JsonStorage',
   r'/catalogs/([^/]+)/([^/]+)/([^/]+)/([0-9a-f]{32})/', 'Srv4CatalogAssignment',
+  r'/catalogs/([^/]+)/([^/]+)/([^/]+)/bulk-add/', 'Srv4CatalogBulkAssignment',
   r'/rpc/bulk-existing-svr4/', 'QueryExistingSvr4',
+  r'/rpc/bulk-blobs/', 'QueryBlobs',
 )
 
 templatedir = os.path.join(os.path.dirname(__file__), "templates/")
@@ -48,6 +55,7 @@ render = web.template.render(templatedir)
 
 config = configuration.GetConfig()
 ALLPKGS_DIR = os.path.join(config.get("buildfarm", "opencsw_root"), "allpkgs")
+FILE_INDEX_STORE = catalog_file_index.GetFileIndexStore(config)
 CAN_UPLOAD_TO_CATALOGS = frozenset([
     "beanie",
     "bratislava",
@@ -56,6 +64,10 @@ CAN_UPLOAD_TO_CATALOGS = frozenset([
     "unstable",
     "legacy",
 ])
+# The number of blobs fetched from the database with a single query.
+BULK_BLOBS_QUERY_SIZE = 20
+# The number of md5 sums checked for existence with a single query.
+EXISTENCE_QUERY_SIZE = 1000
 
 
 class Index(object):
@@ -228,9 +240,11 @@ class Srv4CatalogAssignment(object):
         # This can throw CatalogDatabaseError if the db user doesn't have
         # enough permissions.
         # raise web.internalerror('Package not registered')
-      c = checkpkg_lib.Catalog()
+      c = checkpkg_lib.Catalog(file_index_store=FILE_INDEX_STORE)
       sqo_osrel, sqo_arch, sqo_catrel = models.GetSqoTriad(
           osrel_name, arch_name, catrel_name)
+      # This is set by basic HTTP auth.
+      username = web.ctx.env.get('REMOTE_USER')
       # See if there already is a package with that catalogname.
       res = c.GetConflictingSrv4ByCatalognameResult(
           srv4, srv4.catalogname,
@@ -239,7 +253,8 @@ class Srv4CatalogAssignment(object):
         # Removing old version of the package from the catalog
         for pkg_in_catalog in res:
           srv4_to_remove = pkg_in_catalog.srv4file
-          c.RemoveSrv4(srv4_to_remove, osrel_name, arch_name, catrel_name)
+          c.RemoveSrv4(srv4_to_remove, osrel_name, arch_name, catrel_name,
+                       who=username)
       # See if there already is a package with that pkgname.
       res = c.GetConflictingSrv4ByPkgnameResult(
           srv4, srv4.pkginst.pkgname,
@@ -248,10 +263,8 @@ class Srv4CatalogAssignment(object):
         # Removing old version of the package from the catalog
         for pkg_in_catalog in res:
           srv4_to_remove = pkg_in_catalog.srv4file
-          c.RemoveSrv4(srv4_to_remove, osrel_name, arch_name, catrel_name)
-
-      # This is set by basic HTTP auth.
-      username = web.ctx.env.get('REMOTE_USER')
+          c.RemoveSrv4(srv4_to_remove, osrel_name, arch_name, catrel_name,
+                       who=username)
 
       c.AddSrv4ToCatalog(srv4, osrel_name, arch_name, catrel_name, who=username)
       web.header(
@@ -288,8 +301,9 @@ class Srv4CatalogAssignment(object):
             "package deletions from an obsolete OS release such as %s "
             "are not allowed" % osrel_name)
       srv4_to_remove = models.Srv4FileStats.selectBy(md5_sum=md5_sum).getOne()
-      c = checkpkg_lib.Catalog()
-      c.RemoveSrv4(srv4_to_remove, osrel_name, arch_name, catrel_name)
+      c = checkpkg_lib.Catalog(file_index_store=FILE_INDEX_STORE)
+      c.RemoveSrv4(srv4_to_remove, osrel_name, arch_name, catrel_name,
+                   who=web.ctx.env.get('REMOTE_USER'))
       msg = ('Package %s / %s removed successfully'
              % (srv4_to_remove.basename, md5_sum))
       response = cjson.encode({'message': msg})
@@ -312,6 +326,103 @@ class Srv4CatalogAssignment(object):
     raise web.notacceptable(data=response)
 
 
+class Srv4CatalogBulkAssignment(object):
+  """Adds many packages to a catalog at once.
+
+  The query_data field contains a list of md5 sums. Packages are registered
+  as needed, the same way as in Srv4CatalogAssignment.PUT, and then added to
+  the catalog in a single transaction. At most
+  common_constants.MAX_BULK_ASSIGNMENTS packages are accepted at once.
+  A package replaces the package with
+  the same catalogname or pkgname, including packages earlier in the list.
+
+  The response contains one result per md5 sum, see
+  checkpkg_lib.Catalog.AddSrv4sToCatalog.
+  """
+
+  def POST(self, catrel_name, arch_name, osrel_name):
+    if catrel_name not in CAN_UPLOAD_TO_CATALOGS:
+      raise web.forbidden()
+    if arch_name == 'all':
+      raise web.badrequest("There is no 'all' catalog, cannot proceed.")
+    form_data = web.input(query_data=None)
+    try:
+      md5_sum_list = cjson.decode(form_data['query_data'])
+    except (cjson.DecodeError, TypeError):
+      raise web.badrequest('Missing or malformed "query_data".')
+    if (not isinstance(md5_sum_list, list)
+        or not all(isinstance(x, basestring) and re.match(r'^[0-9a-f]{32}$', x)
+                   for x in md5_sum_list)):
+      raise web.badrequest('Expected a list of md5 sums.')
+    if len(md5_sum_list) > common_constants.MAX_BULK_ASSIGNMENTS:
+      raise web.badrequest(
+          'Too many packages: %d, the limit is %d.'
+          % (len(md5_sum_list), common_constants.MAX_BULK_ASSIGNMENTS))
+    try:
+      srv4s = []
+      errors_by_md5 = {}
+      for md5_sum in md5_sum_list:
+        srv4, error = self._RegisterSrv4(md5_sum)
+        if error:
+          errors_by_md5[md5_sum] = error
+        else:
+          srv4s.append(srv4)
+      c = checkpkg_lib.Catalog(file_index_store=FILE_INDEX_STORE)
+      # This is set by basic HTTP auth.
+      username = web.ctx.env.get('REMOTE_USER')
+      results = iter(c.AddSrv4sToCatalog(
+          srv4s, osrel_name, arch_name, catrel_name, who=username))
+    except (
+        checkpkg_lib.CatalogDatabaseError,
+        sqlobject.dberrors.OperationalError) as exc:
+      web.header(
+          'Content-Type',
+          'application/x-vnd.opencsw.pkg;type=error-message')
+      response = cjson.encode({
+        "error_message": unicode(exc),
+      })
+      web.header('Content-Length', str(len(response)))
+      raise web.badrequest(response)
+    response_data = []
+    for md5_sum in md5_sum_list:
+      if md5_sum in errors_by_md5:
+        response_data.append({'md5_sum': md5_sum, 'status': 'error',
+                               'message': errors_by_md5[md5_sum],
+                               'removed': []})
+      else:
+        response_data.append(results.next())
+    web.header(
+        'Content-type',
+        'application/x-vnd.opencsw.pkg;type=catalog-update')
+    response = cjson.encode(response_data)
+    web.header('Content-Length', str(len(response)))
+    return response
+
+  def _RegisterSrv4(self, md5_sum):
+    """Returns a (srv4, error message) tuple."""
+    try:
+      srv4 = models.Srv4FileStats.selectBy(md5_sum=md5_sum).getOne()
+    except sqlobject.main.SQLObjectNotFound:
+      try:
+        srv4, _ = relational_util.StatsStructToDatabaseLevelOne(md5_sum)
+      except sqlobject.main.SQLObjectNotFound:
+        return None, u"There are no stats of %s in the database." % md5_sum
+      except errors.DataError as exc:
+        logging.warning(exc)
+        return None, unicode(exc)
+    parsed_basename = opencsw.ParsePackageFileName(srv4.basename)
+    if parsed_basename["vendortag"] not in ("CSW", "FAKE"):
+      return None, (u"Package vendor tag is %s instead of CSW or FAKE."
+                    % parsed_basename["vendortag"])
+    if not srv4.registered_level_two:
+      try:
+        relational_util.StatsStructToDatabaseLevelTwo(md5_sum, True)
+      except errors.DataError as exc:
+        logging.warning(exc)
+        return None, unicode(exc)
+    return srv4, None
+
+
 class JsonStorage(object):
 
   BLOB_CLASSES = {
@@ -394,34 +505,140 @@ class JsonStorage(object):
     return cjson.encode({'message': 'Delete successful.'})
 
 
+def GetExistingMd5Sums(blob_class, md5_sums):
+  """Returns the subset of md5_sums which have blobs in the database.
+
+  Only the md5_sum column is read, so blobs themselves are not transferred.
+  """
+  connection = blob_class._connection
+  existing = set()
+  for start in range(0, len(md5_sums), EXISTENCE_QUERY_SIZE):
+    md5_sums_chunk = md5_sums[start:start + EXISTENCE_QUERY_SIZE]
+    query = connection.sqlrepr(sqlbuilder.Select(
+        [blob_class.q.md5_sum],
+        where=sqlbuilder.IN(blob_class.q.md5_sum, md5_sums_chunk)))
+    existing.update(row[0] for row in connection.queryAll(query))
+  return existing
+
+
 class QueryExistingSvr4(object):
   """Bulk query the existence of stats of md5_sums.
 
   The same can be achieved by repeated calls to HEAD of the blob storage class,
   but this implementation is much faster.
+
+  The query_data field contains either a list of md5 sums, which are looked
+  up in pkgstats, or a dictionary with the "md5_sums" and "tags" keys, to
+  look up several kinds of blobs at once. The response is, respectively:
+
+    {"existing_stats": [...], "missing_stats": [...]}
+    {"pkgstats": {"existing": [...], "missing": [...]}, "elfdump": ...}
+
+  The time spent in the database is reported in the Server-Timing header.
   """
 
   def POST(self):
-    form_data = web.input(query_data={})
-    md5_sum_list = cjson.decode(form_data['query_data'])
-    existing_stats = []
-    missing_stats = []
-    # Maybe there's a more effective way of doing this? For example, a single query?
-    # But the list of md5 sums is usually long, e.g. 3k or 4k items.
-    for md5 in md5_sum_list:
-      stats_count = models.Srv4FileStatsBlob.selectBy(md5_sum=md5).count()
-      if stats_count < 1:
-        missing_stats.append(md5)
-      else:
-        existing_stats.append(md5)
-    ret_payload = cjson.encode({
-      'existing_stats': existing_stats,
-      'missing_stats': missing_stats,
-    })
+    form_data = web.input(query_data=None)
+    try:
+      query = cjson.decode(form_data['query_data'])
+    except (cjson.DecodeError, TypeError):
+      raise web.badrequest('Missing or malformed "query_data".')
+    if isinstance(query, dict):
+      md5_sum_list = query.get('md5_sums')
+      tags = query.get('tags')
+    else:
+      md5_sum_list = query
+      tags = None
+    if (not isinstance(md5_sum_list, list)
+        or not all(isinstance(x, basestring) for x in md5_sum_list)):
+      raise web.badrequest('Expected a list of md5 sums.')
+    if tags is not None:
+      if (not isinstance(tags, list)
+          or not all(x in JsonStorage.BLOB_CLASSES for x in tags)):
+        raise web.badrequest('Expected a list of blob tags, out of: %s'
+                             % sorted(JsonStorage.BLOB_CLASSES))
+    # The lists in the response follow the order of the query.
+    unique_md5_sums = sorted(set(md5_sum_list))
+    start_time = time.time()
+    existing_by_tag = {}
+    for tag in (tags or ['pkgstats']):
+      existing_by_tag[tag] = GetExistingMd5Sums(
+          JsonStorage.BLOB_CLASSES[tag], unique_md5_sums)
+    query_time = time.time() - start_time
+    if tags is None:
+      existing = existing_by_tag['pkgstats']
+      response = {
+        'existing_stats': [x for x in md5_sum_list if x in existing],
+        'missing_stats': [x for x in md5_sum_list if x not in existing],
+      }
+    else:
+      response = {}
+      for tag, existing in existing_by_tag.iteritems():
+        response[tag] = {
+          'existing': [x for x in md5_sum_list if x in existing],
+          'missing': [x for x in md5_sum_list if x not in existing],
+        }
+    ret_payload = cjson.encode(response)
+    web.header('Content-Type', 'application/json')
+    web.header('Server-Timing',
+               'db;dur=%.1f;desc="%d md5 sums"'
+               % (query_time * 1000, len(unique_md5_sums)))
     web.header('Content-Length', str(len(ret_payload)))
     return ret_payload
 
 
+class QueryBlobs(object):
+  """Bulk fetch of blobs.
+
+  The request contains a JSON list of [tag, md5_sum] pairs in the query_data
+  field. The response has one line per distinct pair, in the format of
+  [tag, md5_sum, blob], where blob is null if it's not in the database.
+  Lines are sent as soon as they are read from the database, so the response
+  is never held in memory as a whole.
+  """
+
+  def POST(self):
+    form_data = web.input(query_data=None)
+    try:
+      pairs = cjson.decode(form_data['query_data'])
+    except (cjson.DecodeError, TypeError):
+      raise web.badrequest('Missing or malformed "query_data".')
+    if not isinstance(pairs, list):
+      raise web.badrequest('"query_data" must be a list of [tag, md5] pairs.')
+    if len(pairs) > common_constants.MAX_BULK_BLOBS:
+      raise web.badrequest('Too many blobs requested: %d, the limit is %d.'
+                           % (len(pairs), common_constants.MAX_BULK_BLOBS))
+    md5_sums_by_tag = {}
+    for pair in pairs:
+      if (not isinstance(pair, list) or len(pair) != 2
+          or pair[0] not in JsonStorage.BLOB_CLASSES
+          or not isinstance(pair[1], basestring)
+          or not re.match(r'^[0-9a-f]{32}$', pair[1])):
+        raise web.badrequest('Invalid [tag, md5] pair: %r' % (pair,))
+      tag, md5_sum = pair
+      md5_sums = md5_sums_by_tag.setdefault(tag, [])
+      if md5_sum not in md5_sums:
+        md5_sums.append(md5_sum)
+    web.header('Content-Type', 'application/x-ndjson')
+    return self.StreamBlobs(md5_sums_by_tag)
+
+  def StreamBlobs(self, md5_sums_by_tag):
+    for tag, md5_sums in sorted(md5_sums_by_tag.iteritems()):
+      blob_class = JsonStorage.BLOB_CLASSES[tag]
+      encoded_tag = cjson.encode(tag)
+      for start in range(0, len(md5_sums), BULK_BLOBS_QUERY_SIZE):
+        md5_sums_chunk = md5_sums[start:start + BULK_BLOBS_QUERY_SIZE]
+        missing = set(md5_sums_chunk)
+        res = blob_class.select(
+            sqlbuilder.IN(blob_class.q.md5_sum, md5_sums_chunk))
+        for obj in res:
+          missing.discard(obj.md5_sum)
+          # The blob is already serialized, it can be sent as it is.
+          yield '[%s,"%s",%s]\n' % (encoded_tag, str(obj.md5_sum), obj.json)
+        for md5_sum in sorted(missing):
+          yield '[%s,"%s",null]\n' % (encoded_tag, md5_sum)
+
+
 class Srv4RelationalLevelOne(object):
   """Registers the package: creates a set of relational database entries."""
 
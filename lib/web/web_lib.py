@@ -1,6 +1,14 @@
 # A common library for web apps.
 
+import web
+
 from lib.python import configuration
+from lib.python import models
+
+# Media type of newline delimited JSON responses.
+NDJSON_MIME_TYPE = 'application/x-ndjson'
+# Approximate size of chunks of streamed responses.
+STREAM_BUFFER_SIZE = 64 * 1024
 
 connected_to_db = False
 
@@ -14,3 +22,94 @@ def ConnectToDatabase():
   if not connected_to_db:
     configuration.SetUpSqlobjectConnection()
     connected_to_db = True
+
+
+def CatalogEtag(sqo_osrel, sqo_arch, sqo_catrel, representation):
+  """Sets the ETag header of a catalog response.
+
+  The ETag is derived from the representation of the catalog, the epoch of
+  catalog revisions in the database and the revision of the catalog. If the
+  client already has that revision, raises 304 Not Modified instead of
+  letting the caller compute the response.
+
+  Args:
+    representation: a name of the format of the response, e.g. 'quick';
+        newline delimited JSON gets its own ETag, see WantsNdjson().
+  """
+  if WantsNdjson():
+    representation += '-ndjson'
+  # The format can be chosen with the Accept header.
+  web.header('Vary', 'Accept', unique=True)
+  revision = models.GetCatalogRevision(sqo_osrel, sqo_arch, sqo_catrel)
+  etag = '"%s-%s-%s-%s-%d-%d"' % (
+      sqo_catrel.name, sqo_arch.name, sqo_osrel.short_name, representation,
+      models.GetCatalogEpoch(), revision)
+  web.header('ETag', etag)
+  if_none_match = web.ctx.env.get('HTTP_IF_NONE_MATCH')
+  if if_none_match:
+    if etag in [x.strip() for x in if_none_match.split(',')]:
+      raise web.notmodified()
+  return etag
+
+
+def WantsNdjson():
+  """Tells whether the client asked for newline delimited JSON.
+
+  Either with ?format=ndjson, or with the Accept header.
+  """
+  if web.input(format='').format == 'ndjson':
+    return True
+  return NDJSON_MIME_TYPE in web.ctx.env.get('HTTP_ACCEPT', '')
+
+
+def StreamJson(encoded_items, ndjson=False, buffer_size=STREAM_BUFFER_SIZE):
+  """Yields JSON encoded items as a JSON list, or as newline delimited JSON.
+
+  The response is sent in chunks of about buffer_size bytes, as soon as the
+  items come in, so neither the list nor the response is held in memory.
+  Don't set Content-Length for such responses.
+
+  Args:
+    encoded_items: an iterable of JSON encoded strings
+    ndjson: if True, yields one item per line instead of a JSON list
+  """
+  if ndjson:
+    separator = '\n'
+    chunks = []
+  else:
+    separator = ', '
+    chunks = ['[']
+  size = 0
+  first = True
+  for item in encoded_items:
+    if ndjson:
+      chunks.append(item)
+      chunks.append(separator)
+    else:
+      if not first:
+        chunks.append(separator)
+      chunks.append(item)
+    first = False
+    size += len(item) + len(separator)
+    if size >= buffer_size:
+      yield ''.join(chunks)
+      chunks = []
+      size = 0
+  if not ndjson:
+    chunks.append(']')
+  if chunks:
+    yield ''.join(chunks)
+
+
+def StreamJsonResponse(content_type, encoded_items):
+  """Sets the Content-type header and returns a streamed response.
+
+  The format, a JSON list or newline delimited JSON, is chosen by the client,
+  see WantsNdjson().
+  """
+  ndjson = WantsNdjson()
+  if ndjson:
+    content_type += ';format=ndjson'
+  web.header('Content-type', content_type)
+  web.header('Vary', 'Accept', unique=True)
+  return StreamJson(encoded_items, ndjson)